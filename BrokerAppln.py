@@ -4,6 +4,8 @@ import configparser # for configuration parsing
 import logging # for logging. Use it in place of print statements.
 from topic_selector import TopicSelector
 from CS6381_MW.BrokerMW import BrokerMW
+from CS6381_MW.AsyncMW import AsyncBrokerMW
+from CS6381_MW.ChordDHT import ChordRing
 from CS6381_MW import discovery_pb2
 from CS6381_MW import topic_pb2
 from enum import Enum  # for an enumeration we are using to describe what state we are in
@@ -40,6 +42,8 @@ class BrokerAppln ():
         self.lookup = None # one of the diff ways we do lookup
         self.dissemination = None # direct or via broker
         self.is_ready = None
+        self.M = None # number of nodes in the distributed hash table (Strategy=DHT only)
+        self.asyncio = False # run on the asyncio middleware (AsyncMW) instead of the Reactor
     
     @handle_exception
     def configure(self, args):
@@ -52,7 +56,10 @@ class BrokerAppln ():
         config.read(args.config)
         self.lookup = config["Discovery"]["Strategy"]
         self.dissemination = config["Dissemination"]["Strategy"]
-        self.mw_obj = BrokerMW(self.logger)
+        if self.lookup == "DHT":
+            self.M = len(ChordRing.load(args.dht_json))
+        self.asyncio = args.asyncio
+        self.mw_obj = AsyncBrokerMW(self.logger) if self.asyncio else BrokerMW(self.logger)
         self.mw_obj.configure(args) # pass remainder of the args to the m/w object
         self.topiclist = ["weather", "humidity", "airquality", "light", "pressure", "temperature", "sound", "altitude", "location"] # Subscribe to all topics
         self.logger.info("BrokerAppln::configure - configuration complete")
@@ -65,7 +72,10 @@ class BrokerAppln ():
         self.mw_obj.set_upcall_handle(self)
         self.mw_obj.setWatch()
         self.state = self.State.REGISTER
-        self.mw_obj.event_loop(timeout=0)  # start the event loop
+        if self.asyncio:
+            self.mw_obj.drive(self.mw_obj.run())
+        else:
+            self.mw_obj.event_loop(timeout=0)  # start the event loop
         self.logger.info("BrokerAppln::driver completed")
     
     @handle_exception    
@@ -129,7 +139,6 @@ class BrokerAppln ():
         self.logger.info("     Dissemination: {}".format (self.dissemination))
         self.logger.info("     Iterations: {}".format (self.iters))
         self.logger.info("     Frequency: {}".format (self.frequency))
-        super().dumpFingerTable()
         self.logger.info ("**********************************")
 
 # Parse command line arguments
@@ -149,6 +158,7 @@ def parseCmdLineArgs ():
     parser.add_argument ("-j", "--dht_json", default="dht.json", help="JSON file with all DHT nodes, default dht.json")
     # New code for PA3
     parser.add_argument ("-z", "--zookeeper", default="localhost:2181", help="IPv4 address for the zookeeper service, default = localhost:2181")
+    parser.add_argument ("-A", "--asyncio", action="store_true", help="Run on the asyncio middleware instead of the Reactor event loop")
     return parser.parse_args()
 
 def main():
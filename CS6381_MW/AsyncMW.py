@@ -0,0 +1,312 @@
+"""
+Asyncio variant of the middleware, built on zmq.asyncio.
+
+AsyncPublisherMW, AsyncSubscriberMW, AsyncBrokerMW and AsyncDiscoveryMW are the middleware
+classes we already have with their sockets made from an asyncio context: configuration,
+ZooKeeper bookkeeping, ownership and request building are inherited unchanged, and what used to
+be a Reactor handler becomes a task awaiting its socket. Requests to the discovery service are
+coroutines that return the response (register, waitReady, lookupTopics) instead of upcalls the
+application state machine waits for, and the data plane is a task per socket (run()) awaiting
+the next message. Upcalls made from it (data_received) may be coroutines; they are awaited.
+
+Everything runs on the one event loop of the middleware object (self.loop), so the control
+plane (discovery requests, ZooKeeper watches, timers) and the data plane interleave at await
+points and never need a lock to share the sockets. ZooKeeper is the exception as its client is
+blocking and calls us back on its own thread: AsyncCoordination runs the blocking calls in the
+default executor and hands watch events to the loop with call_soon_threadsafe. The middleware
+does the same for the callbacks it installs itself through onLoop(), and AsyncDiscoveryMW posts
+leadership changes the same way instead of through its inproc PAIR.
+
+Timers (schedule/cancel) run on the loop too, with the Reactor's convention: a callback
+returning 0 makes us call the application's invoke_operation, which is how DiscoveryAppln arms
+and expires its leases whichever loop it runs on.
+
+The applications pick this variant with -A/--asyncio and drive it with drive(coroutine); see
+async_benchmark.py for how it compares with the Reactor.
+"""
+
+import asyncio
+import inspect
+import json
+import time
+import zmq
+import zmq.asyncio
+from functools import partial
+from CS6381_MW import discovery_pb2
+from CS6381_MW.Common import PinguMW
+from CS6381_MW.PublisherMW import PublisherMW
+from CS6381_MW.SubscriberMW import SubscriberMW
+from CS6381_MW.BrokerMW import BrokerMW
+from CS6381_MW.DiscoveryMW import DiscoveryMW
+from CS6381_MW.ZkCache import ZkCache
+
+class AsyncCoordination():
+    def __init__(self, zk, logger, loop):
+        self.zk = zk
+        self.logger = logger
+        self.loop = loop
+
+    # a ZooKeeper call, run in the default executor so that it does not block the loop
+    async def call(self, fn, *args, **kwargs):
+        return await self.loop.run_in_executor(None, partial(fn, *args, **kwargs))
+
+    async def create(self, path, value=b"", **kwargs):
+        return await self.call(self.zk.create, path, value, **kwargs)
+
+    async def get(self, path):
+        return await self.call(self.zk.get, path)
+
+    async def exists(self, path):
+        return await self.call(self.zk.exists, path)
+
+    async def delete(self, path, recursive=False):
+        return await self.call(self.zk.delete, path, recursive=recursive)
+
+    # a callback of the ZooKeeper thread, run on the loop instead
+    def onLoop(self, callback):
+        return lambda *args: self.loop.call_soon_threadsafe(callback, *args)
+
+    # the ZkEvents of a prefix of the shared ZkCache as an async iterator
+    async def events(self, prefix):
+        queue = asyncio.Queue()
+        callback = self.onLoop(queue.put_nowait)
+        cache = ZkCache.forClient(self.zk, self.logger)
+        await self.call(cache.listen, prefix, callback)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            cache.unlisten(callback)
+
+    # the data of the znode at path once it exists; TimeoutError after timeout seconds
+    async def waitFor(self, path, timeout=None):
+        start = time.monotonic()
+        events = self.events(path)
+        try:
+            while True:
+                event = await asyncio.wait_for(events.__anext__(), timeout)
+                if event.data is not None:
+                    self.logger.info("AsyncCoordination::waitFor - {} ready after {:.3f}s".format(path, time.monotonic() - start))
+                    return event.data
+        except asyncio.TimeoutError:
+            raise TimeoutError("gave up waiting for " + path)
+        finally:
+            await events.aclose()
+
+class AsyncPinguMW(PinguMW):
+    feedback_capable = False # run() awaits the data sockets only, so [Feedback] is left off
+
+    def __init__(self, logger):
+        super().__init__(logger)
+        self.context = zmq.asyncio.Context(zmq.Context.instance()) # shadows the process wide context
+        self.loop = asyncio.new_event_loop() # watches and timers may be queued before drive()
+        self.coord = None # AsyncCoordination over self.zk, made on first use
+        self.main = None # task of the coroutine we drive
+        self.request_timeout = 5.0 # in sec; a request not answered by then is sent again
+
+    def coordination(self):
+        if self.coord is None:
+            self.coord = AsyncCoordination(self.zk, self.logger, self.loop)
+        return self.coord
+
+    def onLoop(self, callback):
+        return lambda *args: self.loop.call_soon_threadsafe(callback, *args)
+
+    # run the application's coroutine on our loop until it returns or disable_event_loop()
+    def drive(self, coro):
+        self.main = self.loop.create_task(coro)
+        try:
+            self.loop.run_until_complete(self.main)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.loop.run_until_complete(self.settle())
+
+    # cancel what is left on our loop, the tasks of the watches and timers included
+    async def settle(self):
+        pending = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    def disable_event_loop(self):
+        self.handle_events = False
+        if self.main is not None:
+            self.main.cancel()
+
+    # timers on our loop, with the Reactor's conventions (see PinguMW.schedule)
+    def schedule(self, delay_ms, callback, name=None, interval_ms=None):
+        timer = {"deadline": self.loop.time() + delay_ms / 1000.0, "handle": None}
+
+        def fire():
+            if interval_ms is not None:
+                timer["deadline"] = max(timer["deadline"] + interval_ms / 1000.0, self.loop.time())
+                timer["handle"] = self.loop.call_at(timer["deadline"], fire)
+            if callback() == 0:
+                self.upcall_obj.invoke_operation()
+
+        timer["handle"] = self.loop.call_at(timer["deadline"], fire)
+        return timer
+
+    def cancel(self, timer):
+        timer["handle"].cancel()
+
+    # setRequest runs in configure, before the loop does; we wait for the znode on the loop anyway
+    def waitForZnode(self, name_of_MW, path, timeout=None):
+        self.loop.run_until_complete(self.coordination().waitFor(path, timeout))
+
+    # one round trip to the discovery service. REQ_RELAXED (see watchDiscovery) lets us send the
+    # request again when the replica we picked does not answer in time
+    async def request(self, name_of_MW, buf2send):
+        while True:
+            await self.req.send(buf2send)
+            try:
+                bytesRcvd = await asyncio.wait_for(self.req.recv(), self.request_timeout)
+            except asyncio.TimeoutError:
+                self.logger.info(str(name_of_MW) + "::request - no reply in {}s, sending again".format(self.request_timeout))
+                continue
+            discovery_response = discovery_pb2.DiscoveryResp()
+            discovery_response.ParseFromString(bytesRcvd)
+            return discovery_response
+
+    async def registered(self, name_of_MW, name, topiclist):
+        buf2send = self.registerReq(name_of_MW, name, topiclist)
+        while True:
+            discovery_response = await self.request(name_of_MW, buf2send)
+            if discovery_response.register_resp.status != discovery_pb2.STATUS_CHECK_AGAIN:
+                break
+            self.logger.info(str(name_of_MW) + "::registered - no discovery leader yet, registering again")
+            await asyncio.sleep(self.register_retry_ms / 1000.0) # see PinguMW.registerAgain
+        self.keepAlive([discovery_response.register_resp])
+        return discovery_response.register_resp
+
+    # ask whether the system is ready every retry_ms until it is
+    async def waitReady(self, name_of_MW, retry_ms):
+        while True:
+            discovery_response = await self.request(name_of_MW, self.isReadyReq())
+            if discovery_response.isready_resp.status:
+                return discovery_response.isready_resp
+            self.logger.info(str(name_of_MW) + "::waitReady - not ready yet; check again")
+            await asyncio.sleep(retry_ms / 1000.0)
+
+    # with OverflowPolicy=Block, wait for the outbox of a sender to drain
+    async def holdBack(self):
+        while self.outbox.congested():
+            await asyncio.sleep(self.outbox.retry_ms / 1000.0)
+
+    # an upcall the application may have written as a coroutine
+    async def upcall(self, name, *args):
+        result = getattr(self.upcall_obj, name)(*args)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+class AsyncPublisherMW(AsyncPinguMW, PublisherMW):
+    async def register(self, name, topiclist, strength=0):
+        self.logger.info("AsyncPublisherMW::register - register publisher to ZK")
+        self.name = name
+        data = {"id": dict({"id": name, "addr": self.addr, "port": self.port}, **self.locality), "topiclist": topiclist, "strength": strength}
+        await self.coordination().call(self.announce, "PublisherMW", name, json.dumps(data).encode("utf-8"), topiclist, "pub", "/publisher")
+        return await self.registered("PublisherMW", name, topiclist)
+
+    async def waitReady(self, retry_ms):
+        return await super().waitReady("PublisherMW", retry_ms)
+
+    async def disseminate(self, id, topic, data, current_time):
+        send_str = topic + ":" + id + ":" + data + ":" + current_time
+        self.logger.info("AsyncPublisherMW::disseminate - {}".format(send_str))
+        buf = bytes(send_str, "utf-8")
+        if self.multicast is not None:
+            self.multicast.send(topic, buf)
+        elif self.outbox is not None:
+            self.outbox.send(topic, buf)
+            await self.holdBack()
+        else:
+            await self.pub.send(buf)
+        if self.ring is not None:
+            self.ring.write(buf)
+
+class AsyncSubscriberMW(AsyncPinguMW, SubscriberMW):
+    reads_rings = False # run() awaits the SUB socket only
+
+    async def register(self, name, topiclist):
+        self.topiclist = topiclist
+        data = {"id": {"id": name, "addr": self.addr, "port": self.port}, "topiclist": topiclist}
+        await self.coordination().call(self.announce, "SubscriberMW", name, json.dumps(data).encode("utf-8"), topiclist, "sub")
+        return await self.registered("SubscriberMW", name, topiclist)
+
+    async def waitReady(self, retry_ms):
+        return await super().waitReady("SubscriberMW", retry_ms)
+
+    async def lookupTopics(self, topiclist):
+        discovery_response = await self.request("SubscriberMW", self.lookupReq(topiclist))
+        self.joinGroups(discovery_response.lookup_resp.groups)
+        return discovery_response.lookup_resp
+
+    # the data plane: every message of our SUB socket, or of our DISH socket with
+    # Strategy=Multicast, goes to the application
+    async def run(self):
+        if self.dish is not None:
+            await asyncio.gather(self.receive(), self.receiveGroups())
+        else:
+            await self.receive()
+
+    async def receiveGroups(self):
+        while self.handle_events:
+            msg = self.multicast.check((await self.dish.recv(copy=False)).bytes)
+            self.logger.info("AsyncSubscriberMW::receiveGroups - received message = {}".format(msg))
+            await self.upcall("data_received", msg)
+
+    async def receive(self):
+        while self.handle_events:
+            msg = await self.sub.recv_string()
+            if self.ownership is not None and not self.ownership.accepts(*msg.split(":")[:2]):
+                continue
+            self.logger.info("AsyncSubscriberMW::receive - received message = {}".format(msg))
+            await self.upcall("data_received", msg)
+
+class AsyncBrokerMW(AsyncPinguMW, BrokerMW):
+    # publications down to the subscribers and subscriptions up to the publishers, concurrently
+    async def run(self):
+        await asyncio.gather(self.forwardPublications(), self.forwardSubscriptions())
+
+    async def forwardPublications(self):
+        while self.handle_events:
+            msg = await self.sub.recv_string()
+            if self.ownership is not None and not self.ownership.accepts(*msg.split(":")[:2]):
+                continue
+            self.outbox.send(msg.split(":", 1)[0], bytes(msg + ":(from broker)", "utf-8"))
+            await self.holdBack()
+
+    async def forwardSubscriptions(self):
+        while self.handle_events:
+            await self.sub.send(await self.pub.recv())
+
+class AsyncDiscoveryMW(AsyncPinguMW, DiscoveryMW):
+    # leadership changes come from the ZooKeeper thread; apply them on the loop
+    def post(self, action, metadata=None):
+        self.loop.call_soon_threadsafe(self.control, action, metadata)
+
+    def control(self, action, metadata):
+        if self.applyActions([(action, metadata)]) == 0:
+            self.upcall_obj.invoke_operation()
+
+    # requests, replies relayed back from the leader or the DHT, and state from the leader
+    async def run(self):
+        self.upcall_obj.invoke_operation()
+        relays = [self.relay(sock) for sock in ([self.fwd] if self.fwd is not None else []) + list(self.peers.values())]
+        backups = [self.receiveBackups()] if self.sub is not None else []
+        await asyncio.gather(self.serveRequests(), *relays, *backups)
+
+    async def serveRequests(self):
+        while self.handle_events:
+            if self.serve(await self.rep.recv_multipart()) == 0:
+                self.upcall_obj.invoke_operation()
+
+    async def relay(self, sock):
+        while self.handle_events:
+            await self.rep.send_multipart(await sock.recv_multipart())
+
+    async def receiveBackups(self):
+        while self.handle_events:
+            self.applyBackup(await self.sub.recv_multipart())
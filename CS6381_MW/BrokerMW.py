@@ -3,12 +3,13 @@ from CS6381_MW import discovery_pb2
 from CS6381_MW import topic_pb2
 from CS6381_MW.Common import PinguMW
 from functools import wraps
-import time
+import configparser
 import json
-from kazoo.client import KazooClient
-from kazoo.exceptions import NodeExistsError, NoNodeError
-from kazoo.recipe.election import Election
-from kazoo.recipe.watchers import DataWatch
+from kazoo.exceptions import NodeExistsError
+from CS6381_MW.ZkCache import ZkCache, ZkEventType
+from CS6381_MW.Ownership import Ownership
+from CS6381_MW.Outbox import Outbox
+from CS6381_MW.Feedback import FeedbackServer
 
 class BrokerMW(PinguMW):
     def __init__ (self, logger):
@@ -16,6 +17,14 @@ class BrokerMW(PinguMW):
         self.req = None # will be a ZMQ REQ socket to talk to Discovery service
         self.pub = None # will be a ZMQ XPUB socket for representing publisher
         self.sub = None # will be a ZMQ XSUB socket for representing publisher
+        self.zk = None # for zookeeper client
+        self.membership = None # Coalescer of the /publisher events, for its counters
+        self.name = None # our name, used when we try to become the broker leader
+        self.ownership = None # who owns each topic, with Ownership=Exclusive
+        self.connected = set() # publisher endpoints we follow, with Ownership=Exclusive
+        self.outbox = None # what forwarding does when the queue of a subscriber is full (see Outbox)
+        self.reading = True # False while OverflowPolicy=Block holds back our publishers
+        self.feedback = None # hears from our subscribers how far behind they are, with [Feedback]
         
     def handle_exception(func):
         @wraps(func)
@@ -31,22 +40,42 @@ class BrokerMW(PinguMW):
         self.logger.info("BrokerMW::configure")
         self.port = args.port
         self.addr = args.addr
-        context = zmq.Context()  # returns a singleton object
-        self.poller = zmq.Poller()
+        self.name = args.name
+        config = configparser.ConfigParser()
+        config.read(args.config)
+        self.lookup = config["Discovery"]["Strategy"]
+        self.setIdlePolicy(config, "Broker")
+        self.transport.configure(config, shm=False) # we forward from a SUB socket, not from rings
+        self.startup_timeout = config.getfloat("Discovery", "StartupTimeoutS", fallback=0) or None
+        self.membership_window = config.getint("Discovery", "MembershipWindowMs", fallback=100)
+        if self.lookup != "DHT" and config.get("Dissemination", "Ownership", fallback="Shared") == "Exclusive":
+            self.ownership = Ownership(self.logger, self.transport) # the watch on /publisher picks the owners
+        self.outbox = Outbox(self.logger, "BrokerMW")
+        self.outbox.configure(config, "Broker")
+        self.dht_json = args.dht_json
+        context = self.context
         self.req = context.socket(zmq.REQ)
         self.pub = context.socket(zmq.XPUB)
         self.sub = context.socket(zmq.XSUB)
-        self.poller.register(self.req, zmq.POLLIN)
-        self.poller.register(self.sub, zmq.POLLIN)
-        connect_str = "tcp://" + args.discovery
-        self.req.connect(connect_str)
+        self.outbox.attach(self.pub, self.schedule, self.cancel, self.resume)
+        Outbox.setHwm(self.sub, rcv=self.outbox.rcv_hwm)
+        self.reactor.register(self.req, self.handle_reply, "BrokerMW.req")
+        self.reactor.register(self.sub, self.forward_publication, "BrokerMW.sub")
+        self.reactor.register(self.pub, self.forward_subscription, "BrokerMW.pub")
+        self.zk = self.session(args.zookeeper)
+        self.zk.start()
+        self.setRequest()
         bind_string = "tcp://*:" + str(self.port)
         self.pub.bind(bind_string)
+        if FeedbackServer.isEnabled(config) and self.feedback_capable:
+            self.feedback = FeedbackServer(self.logger, self.name, relay=True)
+            self.feedback.configure(config)
+            self.feedback.attach(self, ["tcp://" + self.addr + ":" + str(self.port)])
         self.logger.info("BrokerMW::configure completed")
         
     # run the event loop where we expect to receive a reply to a sent request
     def event_loop(self, timeout=None):
-        super().event_loop("BrokerMW", self.req, timeout)
+        super().event_loop("BrokerMW", timeout)
     
     @handle_exception
     def handle_reply(self):
@@ -55,6 +84,8 @@ class BrokerMW(PinguMW):
         discovery_response = discovery_pb2.DiscoveryResp()
         discovery_response.ParseFromString(bytesRcvd)
         if (discovery_response.msg_type == discovery_pb2.TYPE_REGISTER):
+            if self.registerAgain("BrokerMW", [discovery_response.register_resp]):
+                return None
             timeout = self.upcall_obj.register_response(discovery_response.register_resp)
         elif (discovery_response.msg_type == discovery_pb2.TYPE_ISREADY):
             timeout = self.upcall_obj.isready_response(discovery_response.isready_resp)
@@ -77,18 +108,54 @@ class BrokerMW(PinguMW):
     def disable_event_loop(self):
         super().disable_event_loop()
     
+    # one message from the publishers, or None if it is not from the owner of its topic
     @handle_exception 
     def receive_msg_sub(self):
         self.logger.info("BrokerMW::recv_msg_sub - receive messages")
         msg = self.sub.recv_string()
+        if self.ownership is not None and not self.ownership.accepts(*msg.split(":")[:2]):
+            return None
         self.logger.info("BrokerMW::recv_msg_sub - received message = {}".format (msg))               
         return msg 
+
+    # the reactor calls us for every message from the publishers; we pass it on, marked as
+    # coming through us, to the subscribers
+    @handle_exception
+    def forward_publication(self):
+        msg = self.receive_msg_sub()
+        if msg is not None:
+            msg += ":(from broker)"
+            if self.feedback is not None:
+                self.feedback.forwarded(msg) # with the seq of its publisher, kept if reliable
+            self.send_msg_pub(msg)
+        return None
+
+    # subscriptions of the subscribers arrive on our XPUB socket; the XSUB socket passes them
+    # up to the publishers, so they only send us the topics somebody wants
+    @handle_exception
+    def forward_subscription(self):
+        self.sub.send(self.pub.recv())
+        return None
     
     @handle_exception
     def send_msg_pub(self, send_str):
         self.logger.info("BrokerMW::send_msg_pub - disseminate messages to subscribers from broker")
         self.logger.info("BrokerMW::send_msg_pub - {}".format (send_str))
-        self.pub.send(bytes(send_str, "utf-8"))
+        self.outbox.send(send_str.split(":", 1)[0], bytes(send_str, "utf-8"))
+        if self.outbox.congested() and self.reading:
+            # stop reading from the publishers until the subscribers catch up; their queues
+            # to us fill up instead
+            self.logger.info("BrokerMW::send_msg_pub - subscribers are full, holding back the publishers")
+            self.reactor.unregister(self.sub)
+            self.reading = False
+
+    # our outbox is empty again: back to forwarding
+    def resume(self):
+        if not self.reading:
+            self.logger.info("BrokerMW::resume - forwarding again")
+            self.reactor.register(self.sub, self.forward_publication, "BrokerMW.sub")
+            self.reading = True
+        return None
 
     @handle_exception
     def receiveAllPublishers(self):
@@ -104,21 +171,28 @@ class BrokerMW(PinguMW):
     @handle_exception    
     def connect2pubs(self, IP, port):
         connect_str = "tcp://" + IP + ":" + str(port)
+        if self.ownership is not None:
+            return # we only connect to the owners, see setWatch
         self.logger.info("BrokerMW:: connect2pubs method. connect_str = {}".format(connect_str))
         self.sub.connect(connect_str)
         
     # New code for PA3
     """
-    setRequest() method sets up the connection to the leader, which is responsible for handling 
-    client requests. It first waits for the existence of the leader node in the ZooKeeper cluster. 
-    When it exists, it retrieves the metadata of the leader node and connects the request socket to 
-    the address of the leader.
+    setRequest() method sets up the connection to the discovery service. It first waits for the 
+    existence of the leader node in the ZooKeeper cluster. When it exists, the request socket is
+    connected to every discovery replica (see PinguMW.watchDiscovery), which answer our lookups
+    themselves and forward registrations to the leader. With Strategy=DHT we instead enter the
+    Chord ring through a random node from dht.json.
 
-    setWatch() method sets up watches for the changes of the /broker and /leader nodes in the 
-    ZooKeeper cluster. If the /broker node is deleted, it calls the brokerLeader() method to try 
-    to become the leader. If the /leader node changes, it calls the setRequest() method to update 
-    the connection to the leader. It also sets up a watch for the changes of the /publisher node, 
-    which is used to update the list of available publishers.
+    setWatch() method listens to the /broker node and the /publisher group through the shared
+    ZkCache. If the /broker node is missing or deleted, it calls the brokerLeader() method to try
+    to become the leader. Publisher changes arrive one at a time as added/updated/removed events,
+    so we only connect to the publisher that joined and disconnect from the one that left. Events
+    are coalesced over MembershipWindowMs (config.ini) so that a storm of publishers joining at
+    once is applied as one diff; self.membership counts the events that were suppressed.
+    With Ownership=Exclusive the events go to an Ownership object instead and we only follow
+    the publishers that own at least one topic (followOwners); receive_msg_sub drops messages
+    from publishers that do not own their topic, so only one stream per topic is forwarded.
 
     brokerLeader() method is responsible for creating a broker node in the ZooKeeper cluster if 
     it does not exist. It sets the value of the node to the JSON encoded string of the broker's 
@@ -126,42 +200,42 @@ class BrokerMW(PinguMW):
 
     subscribe() method subscribes to a list of available publishers. It connects the subscriber 
     socket to each publisher's address to start receiving messages.
+    unsubscribe() disconnects from them again.
     """
     @handle_exception
     def setRequest(self):
-        while self.zk.exists("/leader") == None:
-            time.sleep(1)
-        meta = json.loads(self.zk.get("/leader")[0].decode('utf-8'))
-        if self.discovery != None:
-            self.logger.info("SubscriberMW::set_req: disconnecting from {}".format(self.discovery))
-            self.req.disconnect(self.discovery)
-        self.req.connect(meta["repAddress"])
-        self.discovery = meta["repAddress"]
-        self.logger.info("BrokerMW::set_req: connected to {}".format(self.discovery))
+        if self.lookup == "DHT":
+            self.connectDHT("BrokerMW", self.dht_json)
+            return
+        self.waitForZnode("BrokerMW", "/leader", self.startup_timeout)
+        self.watchDiscovery("BrokerMW")
+        self.logger.info("BrokerMW::set_req: connected to the discovery replicas")
 
     @handle_exception
     def setWatch(self):
-        @self.zk.DataWatch("/broker")
-        def watchBroker(data, stat):
-            if data is None:
+        cache = ZkCache.forClient(self.zk, self.logger)
+
+        def watchBroker(event):
+            if event.kind == ZkEventType.REMOVED:
                 self.logger.info("BrokerMW::watchBroker: broker node has been deleted. Trying to become leader")
-                self.brokerLeader()
-                
-        @self.zk.DataWatch("/leader")
-        def watchLeader(data, stat):
-            self.logger.info("BrokerMW::watchLeader: leader node changed")
-            self.setRequest()
-        
-        @self.zk.ChildrenWatch("/publisher")
-        def watchPublishers(children):
-            self.logger.info("BrokerMW::watchPublishers: publishers changed, re-subscribing")
-            publishers = []
-            for c in children:
-                path = "/publisher/" + c
-                data, _ = self.zk.get(path)
-                publishers.append(json.loads(data.decode("utf-8"))['id'])
-            self.logger.info("BrokerMW::watch_pubs: {}".format(publishers))
-            self.subscribe(publishers)
+                self.brokerLeader(self.name)
+
+        def watchPublishers(events):
+            if self.ownership is not None:
+                self.ownership.apply(events)
+                self.followOwners()
+                return
+            # one diff for everything that changed during the window
+            removed = [event.old["id"] for event in events if event.kind != ZkEventType.ADDED]
+            added = [event.data["id"] for event in events if event.kind != ZkEventType.REMOVED]
+            self.logger.info("BrokerMW::watchPublishers: {} publishers added, {} removed".format(len(added), len(removed)))
+            self.unsubscribe(removed)
+            self.subscribe(added)
+
+        cache.listen("/broker", self.onLoop(watchBroker))
+        if not cache.exists("/broker"):
+            self.brokerLeader(self.name)
+        self.membership = cache.listenCoalesced("/publisher", self.onLoop(watchPublishers), self.membership_window)
 
     @handle_exception
     def brokerLeader(self, name):
@@ -175,10 +249,34 @@ class BrokerMW(PinguMW):
         except NodeExistsError:
             self.logger.info("BrokerMW::brokerLeader: broker node exists")
     
+    @handle_exception
+    def followOwners(self):
+        wanted = self.ownership.wanted()
+        for addr in [addr for addr in self.connected if addr not in wanted]:
+            self.logger.info("BrokerMW::followOwners: disconnecting from {}".format(addr))
+            self.sub.disconnect(addr)
+            self.connected.discard(addr)
+        for addr in wanted:
+            if addr not in self.connected:
+                self.logger.info("BrokerMW::followOwners: connecting to {}".format(addr))
+                self.sub.connect(addr)
+                self.connected.add(addr)
+
     @handle_exception    
     def subscribe(self, publist):
         self.logger.info("BrokerMW::subscribe")
         for pub in publist:
-            addr = "tcp://" + pub['addr'] + ":" + str(pub['port'])
+            addr = self.transport.choose(pub) # ipc or inproc when the publisher is co-located
             self.logger.info("BrokerMW::subscribe: subscribing to {}".format(addr))
-            self.sub.connect(addr)
\ No newline at end of file
+            self.sub.connect(addr)
+
+    @handle_exception
+    def unsubscribe(self, publist):
+        self.logger.info("BrokerMW::unsubscribe")
+        for pub in publist:
+            addr = self.transport.choose(pub)
+            self.logger.info("BrokerMW::unsubscribe: disconnecting from {}".format(addr))
+            try:
+                self.sub.disconnect(addr)
+            except zmq.ZMQError:
+                pass # never got connected
\ No newline at end of file
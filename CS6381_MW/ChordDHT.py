@@ -0,0 +1,83 @@
+"""
+ChordRing holds the view one discovery node has of the Chord ring used by Strategy=DHT.
+
+The members of the ring are the discovery nodes listed in dht.json. Node ids are the 48 bit
+values obtained from the SHA-256 digest of "id:IP:port" (see collision_test.py for why 48 bits),
+and the same hash function places every key (topic names, registrant ids) on the ring. A key is
+owned by its successor, the first node whose id is equal to or follows the key.
+
+The complete membership is only used to build our finger table once at startup. Routing itself
+follows the Chord rules and only ever looks at our successor and our fingers, so any key is
+reached in O(log N) hops:
+
+nextHop(key): if the key falls between us and our successor the successor owns it; otherwise
+we forward to the closest finger that precedes the key.
+"""
+
+import hashlib  # for the secure hash library
+import json
+from bisect import bisect_left
+
+class ChordRing():
+    def __init__(self, nodes, my_id, bits=48):
+        self.bits = bits # size of the identifier space in bits
+        self.modulus = 2 ** bits
+        self.nodes = sorted(nodes, key=lambda n: n["hash"]) # the whole ring ordered by id
+        self.hashes = [n["hash"] for n in self.nodes]
+        self.me = None # our entry from dht.json
+        for n in self.nodes:
+            if n["id"] == my_id:
+                self.me = n
+        if self.me is None:
+            raise ValueError("{} is not a member of the DHT".format(my_id))
+        idx = self.hashes.index(self.me["hash"])
+        self.successor = self.nodes[(idx + 1) % len(self.nodes)]
+        self.predecessor = self.nodes[idx - 1]
+        # finger[i] is the successor of (me + 2^i) mod 2^bits
+        self.fingers = [self.findSuccessor((self.me["hash"] + 2 ** i) % self.modulus) for i in range(bits)]
+
+    @staticmethod
+    def hashOf(key, bits=48):
+        hash_digest = hashlib.sha256(bytes(key, "utf-8")).digest()
+        num_bytes = int(bits / 8)
+        return int.from_bytes(hash_digest[:num_bytes], "big")
+
+    @staticmethod
+    def load(dht_json):
+        with open(dht_json) as f:
+            return json.load(f)["dht"]
+
+    @staticmethod
+    def endpoint(node):
+        return "tcp://" + node["IP"] + ":" + str(node["port"])
+
+    # only used while building the finger table
+    def findSuccessor(self, key):
+        idx = bisect_left(self.hashes, key)
+        return self.nodes[idx % len(self.nodes)]
+
+    # is key in the ring interval (lo, hi]
+    def between(self, key, lo, hi):
+        if lo < hi:
+            return lo < key <= hi
+        return key > lo or key <= hi # the interval wraps around zero (or covers the whole ring)
+
+    def owns(self, key):
+        return self.between(key, self.predecessor["hash"], self.me["hash"])
+
+    def nextHop(self, key):
+        if self.between(key, self.me["hash"], self.successor["hash"]):
+            return self.successor
+        for finger in reversed(self.fingers):
+            # closest preceding finger: strictly between us and the key
+            if finger["hash"] != key and self.between(finger["hash"], self.me["hash"], key):
+                return finger
+        return self.successor
+
+    # distinct nodes we may forward to
+    def peers(self):
+        peers = {}
+        for finger in [self.successor] + self.fingers:
+            if finger["id"] != self.me["id"]:
+                peers[finger["id"]] = finger
+        return list(peers.values())
@@ -1,8 +1,22 @@
 from CS6381_MW import discovery_pb2
 from CS6381_MW import topic_pb2
-from functools import wraps
+from functools import partial, wraps
+from kazoo.exceptions import RolledBackError
+import json
+import random
+import threading
+import time
+import zmq
+from CS6381_MW.ChordDHT import ChordRing
+from CS6381_MW.Coordination import coordinationClient
+from CS6381_MW.TimerWheel import HierarchicalTimerWheel
+from CS6381_MW.Transport import Transport
+from CS6381_MW.ZkCache import ZkCache
 
 class PinguMW():
+    host = None # the Host running the middleware objects of this process, if any (see Host)
+    feedback_capable = True # our Reactor services the side channel of [Feedback] (see Feedback)
+
     def handle_exception(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
@@ -14,68 +28,700 @@ class PinguMW():
 
     def __init__(self, logger):
         self.logger = logger  # internal logger for print statements
-        self.poller = None # used to wait on incoming replies
+        self.reactor = Reactor(logger) if self.host is None else self.host.reactorFor(logger) # the event loop; middlewares register their sockets with it
+        self.context = zmq.Context.instance() # the middlewares make their sockets from it
         self.addr = None # our advertised IP address
         self.port = None # port num where we are going to publish our topics
         self.upcall_obj = None # handle to appln obj to handle appln-specific data
         self.handle_events = True # in general we keep going thru the event loop
+        self.disc_endpoints = set() # discovery replicas our REQ socket is connected to
+        self.lookup = None # discovery strategy from config.ini
+        self.lease_ms = 0 # lease we ask for when registering; 0 means no lease
+        self.startup_timeout = None # in sec; how long to wait for the quorum/leader, None is forever
+        self.registrations = [] # (id, single registration request) of the request in flight
+        self.registration = None # the registration request in flight, single or batch
+        self.register_retry_ms = 1000 # how long to wait before sending it again during a failover
+        self.transport = Transport(logger) # which of tcp/ipc/inproc we bind and connect over
+        self.locality = {} # endpoints we advertise besides addr:port, and where we run (Transport)
         
     @handle_exception
-    def event_loop(self, name_of_MW, zmq_socket, timeout=None):
+    def event_loop(self, name_of_MW, timeout=None):
         logmsg = str(name_of_MW) + "::event_loop - run the event loop"
         self.logger.info(logmsg)
-        while self.handle_events:  
-            events = dict(self.poller.poll (timeout=timeout))
-            if name_of_MW == "PublisherMW" or name_of_MW == "SubscriberMW" or name_of_MW == "BrokerMW":
-                if not events:  # it starts with a True value
-                    timeout = self.upcall_obj.invoke_operation()
-                elif zmq_socket in events: 
-                    timeout = self.handle_reply()
-            else:
-                raise Exception("Unknown event after poll")
+        if self.handle_events:
+            self.reactor.run(self.upcall_obj.invoke_operation, timeout)
         logmsg = str(name_of_MW) + "::event_loop - out of the event loop"
         self.logger.info(logmsg)
 
     @handle_exception
     def register(self, name_of_MW, name, topiclist):
         self.logger.info(str(name_of_MW) + "::register - start")
+        self.registration = self.registerReq(name_of_MW, name, topiclist)
+        self.req.send(self.registration)
+        self.logger.info(str(name_of_MW) + "::register - sent register message and now wait for reply")
+
+    # the serialized registration request; it is also kept in self.registrations for keepAlive
+    def registerReq(self, name_of_MW, name, topiclist):
         reg_info = discovery_pb2.RegistrantInfo()
         reg_info.id = name  # ID
         reg_info.addr = self.addr  # IP 
         reg_info.port = self.port # PORT
+        Transport.toInfo(reg_info, self.locality)
         register_req = discovery_pb2.RegisterReq()  
-            
-        if name_of_MW == "SubscriberMW":
-            register_req.role = discovery_pb2.ROLE_SUBSCRIBER  # we are a subscriber
-        elif name_of_MW == "PublisherMW": 
-            register_req.role = discovery_pb2.ROLE_PUBLISHER  # we are a publisher
-        elif name_of_MW == "BrokerMW":
-            register_req.role = discovery_pb2.ROLE_BOTH # we are a broker
-                
+        register_req.role = self.roleOf(name_of_MW)
         register_req.info.CopyFrom(reg_info)  
         register_req.topiclist[:] = topiclist  
+        register_req.lease_ms = self.lease_ms
         disc_req = discovery_pb2.DiscoveryReq() 
         disc_req.msg_type = discovery_pb2.TYPE_REGISTER  
         disc_req.register_req.CopyFrom(register_req)
         self.logger.info(str(name_of_MW) + "::register - done building the outer message")
         buf2send = disc_req.SerializeToString()
-        self.req.send(buf2send) 
-        self.logger.info(str(name_of_MW) + "::register - sent register message and now wait for reply")
+        self.registrations = [(name, buf2send)]
+        return buf2send
+
+    """
+    register_batch(self, name_of_MW, registrants): Registers many entities of our role with a single
+    round trip. Each registrant is a dict with id, addr, port and topiclist. The discovery service
+    applies the whole batch in one pass and answers with one RegisterResp per registrant, in order.
+    """
+    @handle_exception
+    def register_batch(self, name_of_MW, registrants):
+        self.logger.info(str(name_of_MW) + "::register_batch - {} registrants".format(len(registrants)))
+        disc_req = discovery_pb2.DiscoveryReq()
+        disc_req.msg_type = discovery_pb2.TYPE_REGISTER_BATCH
+        self.registrations = []
+        for registrant in registrants:
+            register_req = disc_req.register_batch_req.registrations.add()
+            register_req.role = self.roleOf(name_of_MW)
+            register_req.info.id = registrant["id"]
+            register_req.info.addr = registrant["addr"]
+            register_req.info.port = registrant["port"]
+            register_req.topiclist[:] = registrant["topiclist"]
+            register_req.lease_ms = self.lease_ms
+            single_req = discovery_pb2.DiscoveryReq()
+            single_req.msg_type = discovery_pb2.TYPE_REGISTER
+            single_req.register_req.CopyFrom(register_req)
+            self.registrations.append((registrant["id"], single_req.SerializeToString()))
+        self.registration = disc_req.SerializeToString()
+        self.req.send(self.registration)
+        self.logger.info(str(name_of_MW) + "::register_batch - sent batch and now wait for reply")
+
+    """
+    lookup_batch(self, name_of_MW, topiclists): Looks up the publishers of several topic lists with
+    a single round trip. The reply holds one LookupPubByTopicResp per topic list, in order.
+    """
+    @handle_exception
+    def lookup_batch(self, name_of_MW, topiclists):
+        self.logger.info(str(name_of_MW) + "::lookup_batch - {} lookups".format(len(topiclists)))
+        disc_req = discovery_pb2.DiscoveryReq()
+        disc_req.msg_type = discovery_pb2.TYPE_LOOKUP_BATCH
+        for topiclist in topiclists:
+            disc_req.lookup_batch_req.lookups.add().topiclist[:] = topiclist
+        self.req.send(disc_req.SerializeToString())
+        self.logger.info(str(name_of_MW) + "::lookup_batch - sent batch and now wait for reply")
+
+    """
+    keepAlive(self, results): Called by the middleware with the RegisterResp(s) of the registration
+    request that was in flight, in the order of self.registrations. Every successful registration
+    that was granted a lease is handed to the process wide Heartbeater, which renews it from then on.
+    """
+    def keepAlive(self, results):
+        for (name, buf), reg_resp in zip(self.registrations, results):
+            if reg_resp.status == discovery_pb2.STATUS_SUCCESS and reg_resp.lease_ms:
+                Heartbeater.instance(self.logger).keep(name, buf, reg_resp.lease_ms)
+        self.registrations = []
+
+    """
+    registerAgain(self, name_of_MW, results): Called by the middleware with the RegisterResp(s)
+    before keepAlive. While the discovery service has no leader (during a failover) it answers
+    STATUS_CHECK_AGAIN; rather than handing that to the application as a failure we send the same
+    request again after register_retry_ms, and return True. Our znodes are already announced, so
+    only the request is sent again.
+    """
+    def registerAgain(self, name_of_MW, results):
+        if not any(reg_resp.status == discovery_pb2.STATUS_CHECK_AGAIN for reg_resp in results):
+            return False
+        self.logger.info(str(name_of_MW) + "::registerAgain - no discovery leader yet, registering again in {} ms".format(self.register_retry_ms))
+        registration = self.registration
+        def resend():
+            self.req.send(registration)
+            return None
+        self.schedule(self.register_retry_ms, resend, str(name_of_MW) + ".registerAgain")
+        return True
+
+    def roleOf(self, name_of_MW):
+        if name_of_MW == "SubscriberMW":
+            return discovery_pb2.ROLE_SUBSCRIBER  # we are a subscriber
+        elif name_of_MW == "PublisherMW": 
+            return discovery_pb2.ROLE_PUBLISHER  # we are a publisher
+        elif name_of_MW == "BrokerMW":
+            return discovery_pb2.ROLE_BOTH # we are a broker
+        return discovery_pb2.ROLE_UNKNOWN
 
     @handle_exception
     def is_ready(self, name_of_MW):
         self.logger.info(str(name_of_MW) + "::is_ready - start")
+        buf2send = self.isReadyReq()
+        self.logger.info("Stringified serialized buf = {}".format (buf2send))
+        self.req.send(buf2send)  # we use the "send" method of ZMQ that sends the bytes
+        self.logger.info(str(name_of_MW) + "::is_ready - request sent and now wait for reply")
+
+    def isReadyReq(self):
         isready_req = discovery_pb2.IsReadyReq() 
         disc_req = discovery_pb2.DiscoveryReq()
         disc_req.msg_type = discovery_pb2.TYPE_ISREADY
         disc_req.isready_req.CopyFrom(isready_req)
-        buf2send = disc_req.SerializeToString()
-        self.logger.info("Stringified serialized buf = {}".format (buf2send))
-        self.req.send(buf2send)  # we use the "send" method of ZMQ that sends the bytes
-        self.logger.info(str(name_of_MW) + "::is_ready - request sent and now wait for reply")
+        return disc_req.SerializeToString()
     
     def set_upcall_handle(self, upcall_obj):
         self.upcall_obj = upcall_obj
         
     def disable_event_loop (self):
-        self.handle_events = False
\ No newline at end of file
+        self.handle_events = False
+        self.reactor.stop()
+
+    # idle policy of our event loop from the [EventLoop] section of config.ini; {role}IdlePolicy
+    # overrides IdlePolicy for one role
+    def setIdlePolicy(self, config, role):
+        policy = config.get("EventLoop", "IdlePolicy", fallback="Block")
+        policy = config.get("EventLoop", role + "IdlePolicy", fallback=policy)
+        self.reactor.setIdlePolicy(policy, config.getint("EventLoop", "SpinPolls", fallback=1000))
+
+    # our ZooKeeper client; the middleware objects of a Host share its session
+    def session(self, hosts, timeout=10.0):
+        if self.host is not None:
+            return self.host.session(hosts, self.logger, timeout)
+        return coordinationClient(hosts, self.logger, timeout)
+
+    # timers of the application, run from our event loop (see Reactor.schedule)
+    def schedule(self, delay_ms, callback, name=None, interval_ms=None):
+        return self.reactor.schedule(delay_ms, callback, name, interval_ms)
+
+    def cancel(self, handle):
+        self.reactor.cancel(handle)
+
+    # wraps a watch callback so that it runs where our sockets live: watches fire on the
+    # ZooKeeper thread, coalesced ones on a timer thread, and neither our sockets nor the Reactor
+    # may be touched from there (see Reactor.threadsafe). Wrap on the thread of the loop
+    def onLoop(self, callback):
+        return self.reactor.threadsafe(callback)
+
+    # New code for PA3
+    """
+    watchDiscovery(self, name_of_MW): Every discovery node advertises itself under /discovery/{name}
+    with the address of its ROUTER socket. Replicas answer lookups from their replicated state and
+    forward registrations to the leader, so instead of talking to the leader only we connect our REQ
+    socket to every member of the /discovery group and let ZMQ round robin the requests across them.
+    The shared ZkCache tells us which replica joined or died, and we connect or disconnect just
+    that one, keeping the set of connected replicas in sync. REQ_RELAXED and
+    REQ_CORRELATE let us resend a request when the replica we picked goes away before replying,
+    and IMMEDIATE keeps requests from being queued for a replica we are not connected to (a dead
+    one we have not been told about yet, or one we are still connecting to).
+    """
+    @handle_exception
+    def watchDiscovery(self, name_of_MW):
+        self.logger.info(str(name_of_MW) + "::watchDiscovery - spread lookups over the /discovery replicas")
+        self.req.setsockopt(zmq.REQ_RELAXED, 1)
+        self.req.setsockopt(zmq.REQ_CORRELATE, 1)
+        self.req.setsockopt(zmq.IMMEDIATE, 1)
+
+        def watchReplicas(event):
+            old = event.old["repAddress"] if event.old else None
+            new = event.data["repAddress"] if event.data else None
+            if old == new:
+                return
+            if old in self.disc_endpoints:
+                self.logger.info(str(name_of_MW) + "::watchDiscovery - disconnecting from replica {}".format(old))
+                self.req.disconnect(old)
+                self.disc_endpoints.discard(old)
+            if new is not None:
+                self.logger.info(str(name_of_MW) + "::watchDiscovery - connecting to replica {}".format(new))
+                self.req.connect(new)
+                self.disc_endpoints.add(new)
+            Heartbeater.instance(self.logger).setEndpoints(self.disc_endpoints)
+
+        ZkCache.forClient(self.zk, self.logger).listen("/discovery", self.onLoop(watchReplicas))
+
+    """
+    announce(self, name_of_MW, name, value, topiclist, side, group=None): Creates our ephemeral
+    znodes: /{group}/{name} if a group is given, and /topics/{topic}/{side}/{name} for every topic
+    we publish (side "pub") or subscribe to (side "sub"), all with the same value. They are created
+    in one ZooKeeper transaction so nobody ever sees us under some of our topics only. Transactions
+    cannot create the parents, so those are made first; they are persistent and shared by everyone.
+    Clients then only need to watch the topics they care about (see ZkCache.topicGroup).
+    """
+    @handle_exception
+    def announce(self, name_of_MW, name, value, topiclist, side, group=None):
+        self.logger.info(str(name_of_MW) + "::announce - {} under {} topics".format(name, len(topiclist)))
+        paths = ["/topics/" + topic + "/" + side + "/" + name for topic in topiclist]
+        if group is not None:
+            paths.insert(0, group + "/" + name)
+        for path in paths:
+            self.zk.ensure_path(path.rsplit("/", 1)[0])
+        transaction = self.zk.transaction()
+        for path in paths:
+            transaction.create(path, value=value, ephemeral=True)
+        results = transaction.commit()
+        # raise the operation that failed, not the ones rolled back because of it
+        for result in sorted(results, key=lambda result: isinstance(result, RolledBackError)):
+            if isinstance(result, Exception):
+                raise result
+
+    """
+    waitForZnode(self, name_of_MW, path, timeout=None) and waitForChildren(self, name_of_MW, path,
+    count, timeout=None): Block until the znode at path exists, or until it has at least count
+    children. Both set a kazoo DataWatch/ChildrenWatch whose callback sets an Event, so we wake up
+    the moment ZooKeeper notifies us instead of on the next tick of a sleep loop. We log every
+    few seconds while waiting and raise TimeoutError if timeout (in seconds) runs out first.
+    """
+    @handle_exception
+    def waitForZnode(self, name_of_MW, path, timeout=None):
+        present = threading.Event()
+
+        @self.zk.DataWatch(path)
+        def watchZnode(data, stat):
+            if stat is None:
+                return True # not there yet, keep watching
+            present.set()
+            return False # one shot; stop watching
+
+        self.waitForEvent(name_of_MW, present, path, timeout)
+
+    @handle_exception
+    def waitForChildren(self, name_of_MW, path, count, timeout=None):
+        enough = threading.Event()
+
+        @self.zk.ChildrenWatch(path)
+        def watchChildren(children):
+            if len(children) < count:
+                self.logger.info(str(name_of_MW) + "::waitForChildren - {} of {} under {}".format(len(children), count, path))
+                return True
+            enough.set()
+            return False
+
+        self.waitForEvent(name_of_MW, enough, path, timeout)
+
+    def waitForEvent(self, name_of_MW, event, what, timeout=None, log_every=5):
+        start = time.monotonic()
+        while not event.is_set():
+            remaining = log_every if timeout is None else min(log_every, timeout - (time.monotonic() - start))
+            if remaining <= 0:
+                raise TimeoutError(str(name_of_MW) + " gave up waiting for " + what)
+            if not event.wait(timeout=remaining):
+                self.logger.info(str(name_of_MW) + "::waitForEvent - still waiting for {}".format(what))
+        self.logger.info(str(name_of_MW) + "::waitForEvent - {} ready after {:.3f}s".format(what, time.monotonic() - start))
+
+    """
+    connectDHT(self, name_of_MW, dht_json): With Strategy=DHT there is no leader to wait for.
+    We connect to one discovery node picked at random from dht.json; that node routes our
+    requests to the nodes owning the keys.
+    """
+    @handle_exception
+    def connectDHT(self, name_of_MW, dht_json):
+        node = random.choice(ChordRing.load(dht_json))
+        self.logger.info(str(name_of_MW) + "::connectDHT - entering the ring through {}".format(node["id"]))
+        self.req.connect(ChordRing.endpoint(node))
+        self.disc_endpoints = set([ChordRing.endpoint(node)])
+
+
+"""
+Heartbeater renews the leases of all the registrations made from this process.
+
+There is one per process, shared by every middleware object in it, so a process hosting many
+entities still sends a single HeartbeatReq listing all of their ids every third of the shortest
+lease. It runs in a daemon thread with its own DEALER socket connected to the discovery replicas
+(replicas forward heartbeats to the leader) and its own Reactor, on which every beat schedules
+the next one, so renewals go on whatever the application's loop is busy with and processes that
+have no loop (the benchmarks) are covered too. Ids the leader reports as unknown, e.g. after we
+were paused for longer than our lease, are registered again with the request we kept for them.
+"""
+class Heartbeater():
+    _instance = None
+    _guard = threading.Lock()
+
+    @classmethod
+    def instance(cls, logger):
+        with cls._guard:
+            if cls._instance is None:
+                cls._instance = cls(logger)
+            return cls._instance
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.lock = threading.Lock() # protects everything below
+        self.entities = {} # id -> serialized TYPE_REGISTER request used to re-register it
+        self.lease_ms = None # shortest lease granted to any of our entities
+        self.endpoints = set() # discovery replicas we should be connected to
+        self.thread = None
+
+    def keep(self, name, register_buf, lease_ms):
+        with self.lock:
+            self.entities[name] = register_buf
+            self.lease_ms = lease_ms if self.lease_ms is None else min(self.lease_ms, lease_ms)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="Heartbeater", daemon=True)
+                self.thread.start()
+
+    def drop(self, name):
+        with self.lock:
+            self.entities.pop(name, None)
+
+    def setEndpoints(self, endpoints):
+        with self.lock:
+            self.endpoints = set(endpoints)
+
+    def run(self):
+        sock = zmq.Context.instance().socket(zmq.DEALER)
+        sock.setsockopt(zmq.LINGER, 0)
+        reactor = Reactor(self.logger)
+        reactor.register(sock, lambda: self.handleReply(sock), "Heartbeater.replies")
+        connected = set()
+
+        def beat():
+            nonlocal connected
+            with self.lock:
+                interval_ms = self.lease_ms / 3.0
+                endpoints = set(self.endpoints)
+                ids = list(self.entities.keys())
+            for ep in endpoints - connected:
+                sock.connect(ep)
+            for ep in connected - endpoints:
+                sock.disconnect(ep)
+            connected = endpoints
+            if ids and connected:
+                disc_req = discovery_pb2.DiscoveryReq()
+                disc_req.msg_type = discovery_pb2.TYPE_HEARTBEAT
+                disc_req.heartbeat_req.ids[:] = ids
+                sock.send_multipart([b"", disc_req.SerializeToString()])
+                self.logger.debug("Heartbeater::run - heartbeat for {} entities".format(len(ids)))
+            # the shortest lease may have changed, so the next beat is scheduled every time
+            reactor.schedule(interval_ms, beat, "Heartbeater.beat")
+
+        beat()
+        reactor.run(lambda: None)
+
+    def handleReply(self, sock):
+        disc_resp = discovery_pb2.DiscoveryResp()
+        disc_resp.ParseFromString(sock.recv_multipart()[-1])
+        if disc_resp.msg_type != discovery_pb2.TYPE_HEARTBEAT:
+            return # the answer to a re-registration; the next heartbeat tells us how it went
+        for name in disc_resp.heartbeat_resp.unknown:
+            with self.lock:
+                register_buf = self.entities.get(name)
+            if register_buf is not None:
+                self.logger.info("Heartbeater::handleReply - {} lost its lease, registering it again".format(name))
+                sock.send_multipart([b"", register_buf])
+
+
+"""
+Reactor is the event loop every middleware runs on.
+
+Sockets are registered with the handler that services them: a method that reads one message
+and returns what upcalls return, i.e. 0 to call the idle operation (invoke_operation) right
+away, None to wait for the next event, or a timeout in msec. Timers are callbacks scheduled
+after a delay, optionally every interval, and run from the loop too, so that nothing has to
+sleep in it; they return the same as handlers. Their deadlines are kept in a
+HierarchicalTimerWheel, so thousands of them cost O(1) to schedule and cancel, and the poll
+timeout is computed from the earliest one.
+
+Every wakeup services all the sockets that are ready, not just the first one. A ready socket
+is drained while it has messages, up to its budget per wakeup, so a busy data socket cannot
+starve the request socket or the control socket; whatever is left is picked up by the next
+poll, which returns at once. The timeouts the handlers return are combined by taking the
+shortest. The idle operation runs when a poll times out without events.
+
+For every handler and timer the reactor counts the calls, the messages handled and the time
+spent in them, and for timers how late they ran; stats() returns them and they are logged when
+the loop ends, together with the CPU the loop used per message.
+
+Neither the sockets nor the Reactor are thread-safe: everything above is called from the
+loop's thread only. Other threads (ZooKeeper watches, timer threads) hand their work to the loop
+through threadsafe(), which queues it and wakes the loop up through an inproc PAIR.
+
+How the loop waits when nothing is ready is its idle policy (see setIdlePolicy):
+
+    Block     poll with the timeout until something happens; no CPU while idle, but every
+              message pays for waking the thread up
+    Spin      poll without blocking up to SpinPolls times first, then block; messages that
+              follow each other closely find the loop awake, at the price of a short spin
+              after each burst
+    BusyPoll  never block; lowest wake-up latency, one core fully used
+"""
+class Reactor():
+    class Handler():
+        def __init__(self, sock, callback, name, budget, pending=None):
+            self.sock = sock
+            self.callback = callback # reads one message, returns an upcall timeout
+            self.name = name
+            self.budget = budget # max messages per wakeup
+            self.pending = pending # True while messages wait elsewhere than on sock (shm rings)
+            self.calls = 0 # wakeups in which we were serviced
+            self.messages = 0
+            self.busy_ns = 0 # time spent in the callback
+            self.max_ns = 0 # longest single call
+            self.exhausted = 0 # wakeups that ended on the budget with messages left
+            self.late_ms = 0 # timers only: total and worst delay past their deadline
+            self.max_late_ms = 0
+
+    def __init__(self, logger, budget=64):
+        self.logger = logger
+        self.budget = budget # default budget of the handlers
+        self.poller = zmq.Poller()
+        self.handlers = {} # socket -> Handler
+        self.sources = {} # socket -> Handler, of the handlers that also have a pending() to poll
+        self.wheel = HierarchicalTimerWheel(now_ms=self.now())
+        self.timers = {} # handle -> (callback, name, interval in msec or None, deadline in msec)
+        self.timer_seq = 0
+        self.timer_stats = {} # timer name -> Handler, only for its counters
+        self.running = False
+        self.policy = "Block" # idle policy, see setIdlePolicy
+        self.spin_polls = 0 # non-blocking polls before blocking, with the Spin policy
+        self.polls = 0 # polls made, of which empty_polls returned nothing
+        self.empty_polls = 0
+        self.cpu = 0 # process time used by the last run(), in sec
+        self.wall = 0 # wall clock time of the last run(), in sec
+        self.wake_in = None # PAIR the loop is woken up on when other threads queued calls
+        self.wake_out = None # PAIR they ring it with
+        self.wake_lock = threading.Lock() # protects wake_out and calls
+        self.calls = [] # callbacks queued by other threads, for the loop to run
+
+    IDLE_POLICIES = ("Block", "Spin", "BusyPoll")
+
+    def setIdlePolicy(self, policy, spin_polls=1000):
+        if policy not in self.IDLE_POLICIES:
+            raise ValueError("Unknown idle policy {}, should be one of {}".format(policy, ", ".join(self.IDLE_POLICIES)))
+        self.policy = policy
+        self.spin_polls = spin_polls
+
+    # pending, if given, is polled along with sock: the handler is called while either has
+    # messages. It is how messages that arrive without a socket (shm rings) are serviced; sock
+    # then only carries the wakeups for when we block.
+    def register(self, sock, callback, name=None, budget=None, pending=None):
+        self.handlers[sock] = self.Handler(sock, callback, name or str(sock), budget or self.budget, pending)
+        self.poller.register(sock, zmq.POLLIN)
+        if pending is not None:
+            self.sources[sock] = self.handlers[sock]
+
+    def unregister(self, sock):
+        if self.handlers.pop(sock, None) is not None:
+            self.poller.unregister(sock)
+            self.sources.pop(sock, None)
+
+    # callback as a function that may be called from any thread and runs callback, with the
+    # same arguments, on the loop's next turn, the way timers run (see runCalls). Call it from
+    # the loop's thread, which is where the wakeup socket is made and polled the first time
+    def threadsafe(self, callback):
+        if self.wake_in is None:
+            context = zmq.Context.instance()
+            address = "inproc://reactor-wake-{}".format(id(self))
+            self.wake_in = context.socket(zmq.PAIR)
+            self.wake_in.bind(address)
+            self.poller.register(self.wake_in, zmq.POLLIN) # no handler: run() empties it
+            self.wake_out = context.socket(zmq.PAIR)
+            self.wake_out.connect(address)
+
+        def post(*args):
+            with self.wake_lock:
+                self.calls.append(partial(callback, *args))
+                if len(self.calls) == 1: # one wakeup per batch; the loop takes all of them
+                    self.wake_out.send(b"")
+        return post
+
+    # runs the calls queued by other threads; returns the shortest timeout they asked for. Like
+    # timers, and unlike handlers, a call returning None leaves the idle operation where it was
+    def runCalls(self):
+        if not self.calls:
+            return None
+        while self.wake_in.poll(timeout=0):
+            self.wake_in.recv()
+        with self.wake_lock:
+            calls, self.calls = self.calls, []
+        counters = self.timer_stats.setdefault("Reactor.calls", self.Handler(None, None, "Reactor.calls", 1))
+        timeouts = []
+        for call in calls:
+            start = time.perf_counter_ns()
+            timeout = call()
+            spent = time.perf_counter_ns() - start
+            counters.calls += 1
+            counters.messages += 1
+            counters.busy_ns += spent
+            counters.max_ns = max(counters.max_ns, spent)
+            if timeout is not None:
+                timeouts.append(timeout)
+        return min(timeouts) if timeouts else None
+
+    @staticmethod
+    def now():
+        return time.monotonic() * 1000
+
+    # run callback after delay_ms, and then every interval_ms if given; returns a handle for cancel()
+    def schedule(self, delay_ms, callback, name=None, interval_ms=None):
+        self.timer_seq += 1
+        name = name or getattr(callback, "__name__", "timer")
+        if name not in self.timer_stats:
+            self.timer_stats[name] = self.Handler(None, callback, name, 1)
+        deadline = self.now() + delay_ms
+        self.timers[self.timer_seq] = (callback, name, interval_ms, deadline)
+        self.wheel.schedule(self.timer_seq, deadline)
+        return self.timer_seq
+
+    def cancel(self, handle):
+        self.wheel.cancel(handle)
+        self.timers.pop(handle, None)
+
+    def stop(self):
+        self.running = False
+
+    """
+    run(self, idle, timeout=None): Runs until stop() is called. idle is the operation run when
+    a poll times out; it returns the next timeout the way handlers do. timeout is the first one.
+    """
+    def run(self, idle, timeout=None):
+        self.running = True
+        wall, cpu = time.monotonic(), time.process_time()
+        idle_at = None if timeout is None else time.monotonic() + timeout / 1000.0
+        while self.running:
+            events = self.wait(self.pollTimeout(idle_at))
+            if events and self.wake_in is not None:
+                events = [event for event in events if event[0] is not self.wake_in] # see runCalls
+            if events:
+                timeout = self.dispatch(events)
+                idle_at = None if timeout is None else time.monotonic() + timeout / 1000.0
+            timeouts = [timeout for timeout in (self.runCalls(), self.runTimers()) if timeout is not None]
+            timeout = min(timeouts) if timeouts else None
+            if timeout is not None:
+                due = time.monotonic() + timeout / 1000.0
+                idle_at = due if idle_at is None else min(idle_at, due)
+            if not events and idle_at is not None and time.monotonic() >= idle_at and self.running:
+                timeout = idle()
+                idle_at = None if timeout is None else time.monotonic() + timeout / 1000.0
+        self.wall, self.cpu = time.monotonic() - wall, time.process_time() - cpu
+        self.report()
+
+    def wait(self, timeout):
+        if not self.handlers and self.wake_in is None:
+            # zmq returns at once when polling no sockets; a loop with timers only sleeps instead
+            time.sleep(3600 if timeout is None else timeout / 1000.0)
+            return []
+        if self.policy != "Block" and timeout != 0:
+            deadline = None if timeout is None else time.monotonic() + timeout / 1000.0
+            spins = 0
+            while self.policy == "BusyPoll" or spins < self.spin_polls:
+                events = self.poll(0)
+                if events:
+                    return events
+                spins += 1
+                if deadline is not None and time.monotonic() >= deadline:
+                    return []
+            if deadline is not None:
+                timeout = max(0, int((deadline - time.monotonic()) * 1000 + 0.999))
+        return self.poll(timeout)
+
+    def poll(self, timeout):
+        ready = [(sock, zmq.POLLIN) for sock, handler in self.sources.items() if handler.pending()]
+        events = self.poller.poll(timeout=0 if ready else timeout)
+        if ready:
+            polled = set(sock for sock, _ in events)
+            events += [event for event in ready if event[0] not in polled]
+        self.polls += 1
+        if not events:
+            self.empty_polls += 1
+        return events
+
+    # msec until the idle operation or the next timer is due, None if neither is
+    def pollTimeout(self, idle_at):
+        timeouts = [self.wheel.nextTimeout(self.now())]
+        if idle_at is not None:
+            timeouts.append(max(0, int((idle_at - time.monotonic()) * 1000 + 0.999)))
+        timeouts = [timeout for timeout in timeouts if timeout is not None]
+        return min(timeouts) if timeouts else None
+
+    def dispatch(self, events):
+        timeouts = []
+        for sock, _ in events:
+            handler = self.handlers.get(sock)
+            if handler is None:
+                continue # unregistered by a handler of this same wakeup
+            handled = 0
+            start = time.perf_counter_ns()
+            while True:
+                call_start = time.perf_counter_ns()
+                timeout = handler.callback()
+                handler.max_ns = max(handler.max_ns, time.perf_counter_ns() - call_start)
+                handled += 1
+                if timeout is not None:
+                    timeouts.append(timeout)
+                if not (self.readable(sock) or (handler.pending is not None and handler.pending())) or not self.running:
+                    break
+                if handled >= handler.budget:
+                    handler.exhausted += 1
+                    break
+            handler.calls += 1
+            handler.messages += handled
+            handler.busy_ns += time.perf_counter_ns() - start
+        return min(timeouts) if timeouts else None
+
+    @staticmethod
+    def readable(sock):
+        if not isinstance(sock, zmq.Socket):
+            return False # a plain file descriptor; poll it again
+        return bool(sock.getsockopt(zmq.EVENTS) & zmq.POLLIN)
+
+    # runs the timers that are due; returns the shortest timeout they asked for
+    def runTimers(self):
+        timeouts = []
+        now = self.now()
+        for handle in self.wheel.advance(now):
+            if handle not in self.timers:
+                continue # cancelled by a timer that ran before it
+            callback, name, interval_ms, deadline = self.timers[handle]
+            late_ms = now - deadline
+            if interval_ms is None:
+                del self.timers[handle]
+            else:
+                # keep the period without drifting, but do not make up for missed runs
+                deadline = max(deadline + interval_ms, now)
+                self.timers[handle] = (callback, name, interval_ms, deadline)
+                self.wheel.schedule(handle, deadline)
+            start = time.perf_counter_ns()
+            timeout = callback()
+            spent = time.perf_counter_ns() - start
+            counters = self.timer_stats[name]
+            counters.late_ms += late_ms
+            counters.max_late_ms = max(counters.max_late_ms, late_ms)
+            counters.calls += 1
+            counters.messages += 1
+            counters.busy_ns += spent
+            counters.max_ns = max(counters.max_ns, spent)
+            if timeout is not None:
+                timeouts.append(timeout)
+        return min(timeouts) if timeouts else None
+
+    def stats(self):
+        stats = {}
+        messages = 0
+        for handler in self.handlers.values():
+            stats[handler.name] = self.countersOf(handler)
+            stats[handler.name]["exhausted"] = handler.exhausted
+            messages += handler.messages
+        for timer in self.timer_stats.values():
+            stats[timer.name] = self.countersOf(timer)
+            stats[timer.name]["late_mean_ms"] = round(timer.late_ms / timer.calls, 3) if timer.calls else 0
+            stats[timer.name]["late_max_ms"] = round(timer.max_late_ms, 3)
+        stats["loop"] = {"policy": self.policy, "polls": self.polls, "empty_polls": self.empty_polls,
+                         "messages": messages, "cpu_ms": round(self.cpu * 1000, 1),
+                         "cpu_pct": round(100 * self.cpu / self.wall, 1) if self.wall else 0,
+                         "cpu_us_per_msg": round(self.cpu * 1e6 / messages, 1) if messages else 0}
+        return stats
+
+    @staticmethod
+    def countersOf(handler):
+        return {"calls": handler.calls, "messages": handler.messages,
+                "busy_ms": round(handler.busy_ns / 1e6, 3),
+                "max_ms": round(handler.max_ns / 1e6, 3),
+                "mean_us": round(handler.busy_ns / 1e3 / handler.messages, 1) if handler.messages else 0}
+
+    def report(self):
+        for name, counters in self.stats().items():
+            self.logger.info("Reactor::report - {}: {}".format(name, counters))
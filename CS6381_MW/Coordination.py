@@ -0,0 +1,574 @@
+"""
+Coordination backends for the middleware.
+
+All the middleware classes get their ZooKeeper handle from coordinationClient(hosts, logger),
+through PinguMW.session (which gives the middleware objects of a Host one shared client), and
+only use this subset of the kazoo client API:
+
+    start(), stop(), state, add_listener(fn), remove_listener(fn)
+    create(path, value, ephemeral, sequence, makepath), ensure_path(path)
+    get(path), exists(path), get_children(path), set(path, value), delete(path, recursive)
+    transaction() with create/delete/set_data and commit()
+    DataWatch(path)(fn) and ChildrenWatch(path)(fn), same semantics as the kazoo recipes
+
+With a regular "host:port" list we hand back a KazooClient. With "local://host:port" we hand back
+a LocalClient talking to a LocalCoordServer (see coord_server.py), a small ZooKeeper stand-in
+served over a ZMQ ROUTER socket. It keeps the tree in memory and implements sessions the way
+ZooKeeper does: a client pings every third of the session timeout, a session that has not been
+heard from within the timeout expires, and its ephemeral znodes are deleted (firing the watches
+of everybody else), which is what leader and membership failover rely on. Killed processes
+therefore disappear from the tree after the session timeout, exactly like with ZooKeeper, and a
+clean stop() closes the session right away. Errors are raised as the kazoo exceptions
+(NoNodeError, NodeExistsError, ...) so callers do not care which backend they got.
+
+Wire format: every request is one JSON frame {"id", "op", "sid", ...} answered by
+{"id", "result"} or {"id", "error", "msg"}; the server pushes {"event": "data"|"children",
+"path"} frames for the paths a session watches. Znode data travels as latin-1 strings.
+
+LocalClient runs one I/O thread that owns the DEALER socket (callers hand it requests through a
+queue and a wake-up pipe) and one event thread that runs the watch callbacks, so callbacks may
+make blocking calls, as with kazoo.
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import zmq
+from kazoo.client import KazooClient
+from kazoo.exceptions import (BadVersionError, NoNodeError, NodeExistsError, NotEmptyError,
+                              NoChildrenForEphemeralsError, RolledBackError, SessionExpiredError,
+                              ZookeeperError)
+from kazoo.protocol.states import KazooState, ZnodeStat
+
+LOCAL_SCHEME = "local://"
+
+ERRORS = dict((cls.__name__, cls) for cls in [BadVersionError, NoNodeError, NodeExistsError, NotEmptyError,
+                                               NoChildrenForEphemeralsError, RolledBackError, SessionExpiredError])
+
+def coordinationClient(hosts, logger=None, timeout=10.0):
+    if hosts.startswith(LOCAL_SCHEME):
+        return LocalClient(hosts[len(LOCAL_SCHEME):], logger, timeout)
+    return KazooClient(hosts=hosts, timeout=timeout)
+
+def parentOf(path):
+    return path.rsplit("/", 1)[0] or "/"
+
+def encode(value):
+    return value.decode("latin-1") if value is not None else ""
+
+def decode(value):
+    return value.encode("latin-1")
+
+# Server
+
+class Znode():
+    def __init__(self, data, owner, zxid):
+        self.data = data
+        self.owner = owner # session id for ephemeral znodes, 0 otherwise
+        self.czxid = zxid
+        self.mzxid = zxid
+        self.version = 0
+        self.cversion = 0 # bumped on every child change; also numbers sequence znodes
+        self.children = set()
+        self.ctime = self.mtime = int(time.time() * 1000)
+
+    def stat(self):
+        return [self.czxid, self.mzxid, self.ctime, self.mtime, self.version, self.cversion, 0,
+                self.owner, len(self.data), len(self.children), self.mzxid]
+
+class LocalCoordServer():
+    def __init__(self, endpoint, logger, session_timeout_ms=4000):
+        self.endpoint = endpoint # e.g. tcp://127.0.0.1:2182
+        self.logger = logger
+        self.session_timeout = session_timeout_ms / 1000.0
+        self.tree = {"/": Znode("", 0, 0)}
+        self.zxid = 0
+        self.next_session = 1
+        self.sessions = {} # session id -> {"identity", "last_seen", "ephemerals"}
+        self.watchers = {"data": {}, "children": {}} # kind -> path -> set of session ids
+        self.running = False
+        self.thread = None
+
+    def startInThread(self):
+        self.thread = threading.Thread(target=self.serve, name="LocalCoordServer", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def serve(self):
+        sock = zmq.Context.instance().socket(zmq.ROUTER)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.bind(self.endpoint)
+        self.sock = sock
+        self.running = True
+        self.logger.info("LocalCoordServer::serve - listening on {}".format(self.endpoint))
+        while self.running:
+            if sock.poll(timeout=100):
+                identity, frame = sock.recv_multipart()
+                self.handle(identity, json.loads(frame.decode("utf-8")))
+            self.expireSessions()
+        sock.close()
+
+    def handle(self, identity, req):
+        reply = {"id": req.get("id")}
+        try:
+            op = req["op"]
+            if op == "connect":
+                reply["result"] = self.openSession(identity, req.get("timeout_ms"))
+            else:
+                session = self.sessions.get(req.get("sid"))
+                if session is None:
+                    raise SessionExpiredError("session {} has expired".format(req.get("sid")))
+                session["identity"] = identity
+                session["last_seen"] = time.monotonic()
+                reply["result"] = getattr(self, "op_" + op)(req["sid"], req)
+        except ZookeeperError as e:
+            reply["error"] = type(e).__name__
+            reply["msg"] = str(e)
+        self.sock.send_multipart([identity, json.dumps(reply).encode("utf-8")])
+
+    # sessions
+    def openSession(self, identity, timeout_ms=None):
+        # like ZooKeeper, the client proposes its session timeout; ours is the default
+        timeout = timeout_ms / 1000.0 if timeout_ms else self.session_timeout
+        sid = self.next_session
+        self.next_session += 1
+        self.sessions[sid] = {"identity": identity, "last_seen": time.monotonic(), "ephemerals": set(),
+                              "timeout": timeout}
+        return {"sid": sid, "timeout_ms": int(timeout * 1000)}
+
+    def closeSession(self, sid):
+        session = self.sessions.pop(sid, None)
+        if session is None:
+            return
+        for path in sorted(session["ephemerals"], reverse=True):
+            if path in self.tree:
+                self.remove(path)
+        for paths in self.watchers.values():
+            for sids in paths.values():
+                sids.discard(sid)
+
+    def expireSessions(self):
+        now = time.monotonic()
+        for sid in [sid for sid, s in self.sessions.items() if now - s["last_seen"] > s["timeout"]]:
+            self.logger.info("LocalCoordServer::expireSessions - session {} expired".format(sid))
+            self.closeSession(sid)
+
+    # watches
+    def notify(self, kind, path):
+        for sid in list(self.watchers[kind].get(path, ())):
+            session = self.sessions.get(sid)
+            if session is not None:
+                event = {"event": kind, "path": path}
+                self.sock.send_multipart([session["identity"], json.dumps(event).encode("utf-8")])
+
+    # tree mutations; they only run after all checks have passed
+    def add(self, sid, path, data, ephemeral):
+        self.zxid += 1
+        parent = self.tree[parentOf(path)]
+        self.tree[path] = Znode(data, sid if ephemeral else 0, self.zxid)
+        parent.children.add(path.rsplit("/", 1)[1])
+        parent.cversion += 1
+        if ephemeral:
+            self.sessions[sid]["ephemerals"].add(path)
+        self.notify("data", path)
+        self.notify("children", parentOf(path))
+
+    def remove(self, path):
+        self.zxid += 1
+        node = self.tree.pop(path)
+        parent = self.tree[parentOf(path)]
+        parent.children.discard(path.rsplit("/", 1)[1])
+        parent.cversion += 1
+        if node.owner in self.sessions:
+            self.sessions[node.owner]["ephemerals"].discard(path)
+        self.notify("data", path)
+        self.notify("children", path)
+        self.notify("children", parentOf(path))
+
+    def modify(self, path, data):
+        self.zxid += 1
+        node = self.tree[path]
+        node.data = data
+        node.version += 1
+        node.mzxid = self.zxid
+        node.mtime = int(time.time() * 1000)
+        self.notify("data", path)
+
+    def node(self, path):
+        if path not in self.tree:
+            raise NoNodeError(path)
+        return self.tree[path]
+
+    def checkCreate(self, path, ephemeral, sequence, makepath):
+        parent = parentOf(path)
+        if parent not in self.tree and not makepath:
+            raise NoNodeError(parent)
+        if parent in self.tree and self.tree[parent].owner:
+            raise NoChildrenForEphemeralsError(parent)
+        if sequence:
+            path = path + "%010d" % (self.tree[parent].cversion if parent in self.tree else 0)
+        if path in self.tree:
+            raise NodeExistsError(path)
+        return path
+
+    # operations
+    def op_ping(self, sid, req):
+        return None
+
+    def op_close(self, sid, req):
+        self.closeSession(sid)
+        return None
+
+    def op_create(self, sid, req):
+        path = self.checkCreate(req["path"], req["ephemeral"], req["sequence"], req["makepath"])
+        parts = path.split("/")
+        for i in range(2, len(parts)):
+            ancestor = "/".join(parts[:i])
+            if ancestor not in self.tree:
+                self.add(sid, ancestor, "", False)
+        self.add(sid, path, req["value"], req["ephemeral"])
+        return path
+
+    def op_get(self, sid, req):
+        node = self.node(req["path"])
+        return [node.data, node.stat()]
+
+    def op_exists(self, sid, req):
+        node = self.tree.get(req["path"])
+        return node.stat() if node is not None else None
+
+    def op_get_children(self, sid, req):
+        return sorted(self.node(req["path"]).children)
+
+    def op_set(self, sid, req):
+        node = self.node(req["path"])
+        if req.get("version", -1) not in (-1, node.version):
+            raise BadVersionError(req["path"])
+        self.modify(req["path"], req["value"])
+        return node.stat()
+
+    def op_delete(self, sid, req):
+        path = req["path"]
+        node = self.node(path)
+        if node.children and not req.get("recursive"):
+            raise NotEmptyError(path)
+        # children first, deepest paths first
+        for child in sorted([p for p in self.tree if p.startswith(path + "/")], reverse=True):
+            self.remove(child)
+        self.remove(path)
+        return True
+
+    def op_multi(self, sid, req):
+        # check everything first so that the transaction is all or nothing
+        results = []
+        created = set()
+        failed = False
+        for op in req["ops"]:
+            try:
+                if op["op"] == "create":
+                    path = self.checkCreate(op["path"], op["ephemeral"], op["sequence"], False)
+                    if path in created:
+                        raise NodeExistsError(path)
+                    created.add(path)
+                    results.append(path)
+                elif op["op"] in ("delete", "set"):
+                    self.node(op["path"])
+                    results.append(True)
+            except ZookeeperError as e:
+                failed = True
+                results.append({"error": type(e).__name__, "msg": str(e)})
+        if failed:
+            # like ZooKeeper, the operations that would have worked report that they were rolled back
+            return [r if isinstance(r, dict) else {"error": "RolledBackError", "msg": ""} for r in results]
+        for op in req["ops"]:
+            if op["op"] == "create":
+                self.op_create(sid, dict(op, makepath=False))
+            elif op["op"] == "delete":
+                self.op_delete(sid, op)
+            elif op["op"] == "set":
+                self.op_set(sid, op)
+        return results
+
+    def op_watch(self, sid, req):
+        self.watchers[req["kind"]].setdefault(req["path"], set()).add(sid)
+        return None
+
+    def op_unwatch(self, sid, req):
+        self.watchers[req["kind"]].get(req["path"], set()).discard(sid)
+        return None
+
+# Client
+
+class LocalClient():
+    def __init__(self, endpoint, logger=None, timeout=10.0):
+        self.endpoint = "tcp://" + endpoint
+        self.logger = logger
+        self.timeout = timeout
+        self.state = KazooState.LOST
+        self.sid = None
+        self.ping_interval = None
+        self.listeners = []
+        self.watches = {"data": {}, "children": {}} # kind -> path -> list of recipes
+        self.pending = {} # request id -> Future
+        self.next_id = 0
+        self.outbox = queue.Queue() # requests waiting for the I/O thread
+        self.events = queue.Queue() # callbacks waiting for the event thread
+        self.lock = threading.Lock() # protects next_id, pending and watches
+        self.wake_r, self.wake_w = os.pipe()
+        self.io_thread = None
+        self.running = False
+
+    # lifecycle
+    def start(self, timeout=None):
+        if self.state == KazooState.CONNECTED:
+            return
+        self.running = True
+        self.io_thread = threading.Thread(target=self.ioLoop, name="LocalClient-io", daemon=True)
+        self.io_thread.start()
+        threading.Thread(target=self.eventLoop, name="LocalClient-events", daemon=True).start()
+        session = self.call({"op": "connect", "timeout_ms": int(self.timeout * 1000)}, timeout or self.timeout)
+        self.sid = session["sid"]
+        self.ping_interval = session["timeout_ms"] / 3000.0
+        self.setState(KazooState.CONNECTED)
+
+    def stop(self):
+        if self.state == KazooState.CONNECTED:
+            try:
+                self.call({"op": "close"})
+            except ZookeeperError:
+                pass
+        self.setState(KazooState.LOST)
+        self.running = False
+        self.events.put(None)
+        os.write(self.wake_w, b"x")
+
+    def close(self):
+        pass # nothing left to release after stop()
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def setState(self, state):
+        if state == self.state:
+            return
+        self.state = state
+        for listener in list(self.listeners):
+            self.events.put(lambda listener=listener: listener(state))
+
+    # requests
+    def call(self, req, timeout=None):
+        future = Future()
+        with self.lock:
+            self.next_id += 1
+            req["id"] = self.next_id
+            self.pending[req["id"]] = future
+        req["sid"] = self.sid
+        self.outbox.put(req)
+        os.write(self.wake_w, b"x")
+        reply = future.result(timeout=timeout or self.timeout)
+        if "error" in reply:
+            if reply["error"] == "SessionExpiredError":
+                self.setState(KazooState.LOST)
+            raise ERRORS.get(reply["error"], ZookeeperError)(reply.get("msg"))
+        return reply["result"]
+
+    def ioLoop(self):
+        sock = zmq.Context.instance().socket(zmq.DEALER)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.connect(self.endpoint)
+        poller = zmq.Poller()
+        poller.register(sock, zmq.POLLIN)
+        poller.register(self.wake_r, zmq.POLLIN)
+        last_ping = time.monotonic()
+        while self.running:
+            events = dict(poller.poll(timeout=100))
+            if self.wake_r in events:
+                os.read(self.wake_r, 4096)
+            while not self.outbox.empty():
+                sock.send(json.dumps(self.outbox.get()).encode("utf-8"))
+                last_ping = time.monotonic()
+            if sock in events:
+                while sock.poll(timeout=0):
+                    self.dispatch(json.loads(sock.recv().decode("utf-8")))
+            if self.sid is not None and self.ping_interval and time.monotonic() - last_ping > self.ping_interval:
+                with self.lock:
+                    self.next_id += 1
+                    self.pending[self.next_id] = Future() # nobody waits for it; errors still show
+                    sock.send(json.dumps({"id": self.next_id, "op": "ping", "sid": self.sid}).encode("utf-8"))
+                last_ping = time.monotonic()
+        sock.close()
+
+    def dispatch(self, msg):
+        if "event" in msg:
+            with self.lock:
+                recipes = list(self.watches[msg["event"]].get(msg["path"], []))
+            for recipe in recipes:
+                self.events.put(recipe.run)
+            return
+        with self.lock:
+            future = self.pending.pop(msg["id"], None)
+        if msg.get("error") == "SessionExpiredError" and self.state != KazooState.LOST:
+            self.setState(KazooState.LOST)
+        if future is not None:
+            future.set_result(msg)
+
+    def eventLoop(self):
+        while True:
+            callback = self.events.get()
+            if callback is None:
+                return
+            try:
+                callback()
+            except Exception as e:
+                if self.logger is not None:
+                    self.logger.error("LocalClient::eventLoop - watch callback failed: {}".format(e))
+
+    # the kazoo API subset
+    def create(self, path, value=b"", acl=None, ephemeral=False, sequence=False, makepath=False):
+        return self.call({"op": "create", "path": path, "value": encode(value), "ephemeral": ephemeral,
+                          "sequence": sequence, "makepath": makepath})
+
+    def ensure_path(self, path, acl=None):
+        if self.exists(path) is None:
+            try:
+                self.create(path, makepath=True)
+            except NodeExistsError:
+                pass
+        return True
+
+    def get(self, path, watch=None):
+        data, stat = self.call({"op": "get", "path": path})
+        return decode(data), ZnodeStat(*stat)
+
+    def exists(self, path, watch=None):
+        stat = self.call({"op": "exists", "path": path})
+        return ZnodeStat(*stat) if stat is not None else None
+
+    def get_children(self, path, watch=None, include_data=False):
+        return self.call({"op": "get_children", "path": path})
+
+    def set(self, path, value, version=-1):
+        return ZnodeStat(*self.call({"op": "set", "path": path, "value": encode(value), "version": version}))
+
+    def delete(self, path, version=-1, recursive=False):
+        return self.call({"op": "delete", "path": path, "version": version, "recursive": recursive})
+
+    def transaction(self):
+        return LocalTransaction(self)
+
+    def DataWatch(self, path, func=None):
+        if func is not None:
+            return LocalDataWatch(self, path, func)
+        return lambda func: LocalDataWatch(self, path, func) and func
+
+    def ChildrenWatch(self, path, func=None):
+        if func is not None:
+            return LocalChildrenWatch(self, path, func)
+        return lambda func: LocalChildrenWatch(self, path, func) and func
+
+    def addWatch(self, kind, path, recipe):
+        with self.lock:
+            first = path not in self.watches[kind]
+            self.watches[kind].setdefault(path, []).append(recipe)
+        if first:
+            self.call({"op": "watch", "kind": kind, "path": path})
+
+    def removeWatch(self, kind, path, recipe):
+        with self.lock:
+            recipes = self.watches[kind].get(path, [])
+            if recipe in recipes:
+                recipes.remove(recipe)
+            last = not recipes
+            if last:
+                self.watches[kind].pop(path, None)
+        if last and self.state == KazooState.CONNECTED:
+            self.call({"op": "unwatch", "kind": kind, "path": path})
+
+class LocalTransaction():
+    def __init__(self, client):
+        self.client = client
+        self.ops = []
+
+    def create(self, path, value=b"", acl=None, ephemeral=False, sequence=False):
+        self.ops.append({"op": "create", "path": path, "value": encode(value), "ephemeral": ephemeral, "sequence": sequence})
+
+    def delete(self, path, version=-1):
+        self.ops.append({"op": "delete", "path": path, "version": version})
+
+    def set_data(self, path, value, version=-1):
+        self.ops.append({"op": "set", "path": path, "value": encode(value), "version": version})
+
+    def commit(self):
+        results = self.client.call({"op": "multi", "ops": self.ops})
+        return [ERRORS.get(r["error"], ZookeeperError)(r["msg"]) if isinstance(r, dict) else r for r in results]
+
+# Watch recipes with the semantics of kazoo.recipe.watchers: the function is called right away
+# and then on every change, until it returns False.
+
+class LocalDataWatch():
+    def __init__(self, client, path, func):
+        self.client = client
+        self.path = path
+        self.func = func
+        self.lock = threading.Lock()
+        self.version = None
+        self.called = False
+        self.stopped = False
+        client.addWatch("data", path, self)
+        self.run()
+
+    def run(self):
+        with self.lock:
+            if self.stopped:
+                return
+            try:
+                data, stat = self.client.get(self.path)
+            except NoNodeError:
+                data, stat = None, None
+            version = stat.mzxid if stat is not None else None
+            if self.called and version == self.version:
+                return
+            self.called = True
+            self.version = version
+            if self.func(data, stat) is False:
+                self.stopped = True
+                self.client.removeWatch("data", self.path, self)
+
+class LocalChildrenWatch():
+    def __init__(self, client, path, func):
+        self.client = client
+        self.path = path
+        self.func = func
+        self.lock = threading.Lock()
+        self.prior = None
+        self.stopped = False
+        client.addWatch("children", path, self)
+        self.run()
+
+    def run(self):
+        with self.lock:
+            if self.stopped:
+                return
+            try:
+                children = self.client.get_children(self.path)
+            except NoNodeError:
+                self.stopped = True # like kazoo, a watch on a deleted node ends
+                self.client.removeWatch("children", self.path, self)
+                return
+            if children == self.prior:
+                return
+            self.prior = children
+            if self.func(children) is False:
+                self.stopped = True
+                self.client.removeWatch("children", self.path, self)
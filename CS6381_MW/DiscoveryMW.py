@@ -2,11 +2,17 @@ import zmq  # ZMQ sockets
 from CS6381_MW import discovery_pb2
 from CS6381_MW import topic_pb2
 from CS6381_MW.Common import PinguMW
-from functools import wraps
-from kazoo.client import KazooClient
+from CS6381_MW.ChordDHT import ChordRing
+from CS6381_MW.ZkCache import ZkCache, ZkEventType
+from CS6381_MW.Coordination import coordinationClient
+from CS6381_MW.Transport import Transport
+from CS6381_MW.Multicast import Multicast
+from functools import partial, wraps
 from kazoo.exceptions import NodeExistsError, NoNodeError
-from kazoo.recipe.election import Election
+from kazoo.protocol.states import KazooState
 from kazoo.recipe.watchers import DataWatch
+import configparser
+import threading
 import time
 import json
 
@@ -26,83 +32,153 @@ class DiscoveryMW(PinguMW):
         self.zk = None # for zookeeper client
         self.pub = None # Publisher from leader to replicas
         self.sub = None # Subscriber from leader to replicas
+        self.fwd = None # DEALER used by replicas to forward registrations to the leader
+        self.name = None # our name in the /discovery group
+        self.is_leader = False # True once we own the /leader znode
+        self.leader_rep = None # ROUTER address of the current leader
+        self.leader_pub = None # PUB address of the current leader
+        self.envelope = None # routing frames of the request being served
+        self.replica_lookups = True # whether replicas answer lookups themselves
+        self.max_staleness = 2000 # in msec; beyond this replicas hand lookups to the leader
+        self.last_sync = None # monotonic time at which we last heard from the leader
+        self.lookup = None # discovery strategy from config.ini
+        self.ring = None # our view of the Chord ring when Strategy=DHT
+        self.peers = {} # DHT node id -> DEALER connected to that finger
+        self.session_timeout = 10000 # in msec; how long ZooKeeper takes to notice we died
+        self.candidate = None # our sequential znode under /election
+        self.elected = False # True once we are first in line under /election
+        self.session_lost = False # our ZooKeeper session expired and we have not rejoined yet
+        self.control_in = None # PAIR the event loop is woken up on when leadership changes
+        self.control_out = None # PAIR the watch callbacks ring it with
+        self.control_lock = threading.Lock() # protects control_out and actions
+        self.actions = [] # leadership changes waiting for the event loop
+        self.multicast = None # maps topics to their groups with Strategy=Multicast dissemination
         
     @handle_exception
     def configure (self, args):
         self.logger.info("DiscoveryMW::configure")
         self.port = args.port
         self.addr = args.addr
-        context = zmq.Context()  # returns a singleton object
-        self.poller = zmq.Poller()
+        self.name = args.name
+        config = configparser.ConfigParser()
+        config.read(args.config)
+        self.lookup = config["Discovery"]["Strategy"]
+        self.setIdlePolicy(config, "Discovery")
+        self.replica_lookups = config.getboolean("Discovery", "ReplicaLookups", fallback=True)
+        self.max_staleness = config.getint("Discovery", "MaxStalenessMs", fallback=2000)
+        self.startup_timeout = config.getfloat("Discovery", "StartupTimeoutS", fallback=0) or None
+        self.session_timeout = config.getint("Discovery", "SessionTimeoutMs", fallback=10000)
+        if config.get("Dissemination", "Strategy", fallback="Direct") == "Multicast":
+            self.multicast = Multicast(self.logger) # lookups answer with the groups of the topics
+            self.multicast.configure(config)
+        context = self.context
         self.rep = context.socket(zmq.ROUTER)
-        self.poller.register(self.rep, zmq.POLLIN)
+        self.reactor.register(self.rep, self.handle_request, "DiscoveryMW.rep")
         bind_string = "tcp://*:" + str(self.port)
         self.rep.bind(bind_string)
+        if self.lookup == "DHT":
+            self.setupDHT(args.dht_json, context)
+            self.logger.info("DiscoveryMW::configure completed")
+            return
         self.pub = context.socket(zmq.PUB)
         self.sub = context.socket(zmq.SUB)
-        self.poller.register(self.sub, zmq.POLLIN)
+        self.sub.setsockopt_string(zmq.SUBSCRIBE, "backup")
+        self.reactor.register(self.sub, self.receiverFromLeader, "DiscoveryMW.sub")
         bindString = "tcp://*:" + str(self.port + 1)
         self.pub.bind(bindString)
+        self.fwd = context.socket(zmq.DEALER)
+        self.reactor.register(self.fwd, partial(self.handle_forwarded, self.fwd), "DiscoveryMW.fwd")
+        control = "inproc://discovery-control-{}".format(id(self))
+        self.control_in = context.socket(zmq.PAIR)
+        self.control_in.bind(control)
+        self.reactor.register(self.control_in, self.handle_control, "DiscoveryMW.control")
+        self.control_out = context.socket(zmq.PAIR)
+        self.control_out.connect(control)
         self.logger.info("DiscoveryMW::configure: create ZK client")
-        self.zk = KazooClient(hosts=args.zookeeper)
+        self.zk = coordinationClient(args.zookeeper, self.logger, self.session_timeout / 1000.0)
+        self.zk.add_listener(self.watchSession)
         self.quorum = args.quorum
         self.assureQuorum(args.name)
         self.logger.info("DiscoveryMW::configure: ZK client state = {}".format(self.zk.state))
         self.logger.info("DiscoveryMW::configure completed")
         
     # run the event loop where we expect to receive sth
-    @handle_exception
     def event_loop(self, timeout=None):
-        self.logger.info("DiscoveryMW::event_loop - start")
-        while self.handle_events:
-            events = dict(self.poller.poll(timeout=timeout))
-            if not events:
-                timeout = self.upcall_obj.invoke_operation()
-            elif self.rep in events:
-                timeout = self.handle_request()
-            elif self.sub in events:
-                timeout = self.receiverFromLEader()
-            else:
-                raise Exception("Unknown event after poll")
-        self.logger.info("DiscoveryMW::event_loop - end")
+        super().event_loop("DiscoveryMW", timeout)
         
     @handle_exception
     def handle_request(self):
         self.logger.info("DiscoveryMW::handle_request")
-        bytesRcvd = self.rep.recv()
+        return self.serve(self.rep.recv_multipart())
+
+    # one request, as received on our ROUTER socket
+    @handle_exception
+    def serve(self, frames):
+        # everything up to the payload is the routing envelope (client identity, and the
+        # replica identity as well when the request was forwarded to us by a replica)
+        self.envelope = frames[:-1]
+        bytesRcvd = frames[-1]
         disc_req = discovery_pb2.DiscoveryReq()
         disc_req.ParseFromString(bytesRcvd)
         self.logger.info("DiscoveryMW::handle_request - bytes received")
+        if self.ring is not None:
+            return self.handle_dht(disc_req)
         if (disc_req.msg_type == discovery_pb2.TYPE_REGISTER):
+            if not self.is_leader:
+                return self.forwardToLeader(disc_req, bytesRcvd)
             self.logger.info("DiscoveryMW::handle_request - register")
             timeout = self.upcall_obj.register_request(disc_req.register_req)
         elif (disc_req.msg_type == discovery_pb2.TYPE_ISREADY):
             self.logger.info("DiscoveryMW::handle_request - is ready")
             timeout = self.upcall_obj.isready_request()
         elif (disc_req.msg_type == discovery_pb2.TYPE_LOOKUP_ALL_PUBS):
+            if not self.canServeLookup():
+                return self.forwardToLeader(disc_req, bytesRcvd)
             self.logger.info("DiscoveryMW::handle_request - all pubs")
             timeout = self.upcall_obj.handle_all_publist()
         elif (disc_req.msg_type == discovery_pb2.TYPE_LOOKUP_PUB_BY_TOPIC):
+            if not self.canServeLookup():
+                return self.forwardToLeader(disc_req, bytesRcvd)
             self.logger.info("DiscoveryMW::handle_request - pub by topic")
             timeout = self.upcall_obj.handle_topic_request(disc_req.lookup_req)
+        elif (disc_req.msg_type == discovery_pb2.TYPE_REGISTER_BATCH):
+            if not self.is_leader:
+                return self.forwardToLeader(disc_req, bytesRcvd)
+            self.logger.info("DiscoveryMW::handle_request - register batch")
+            timeout = self.upcall_obj.register_batch_request(disc_req.register_batch_req)
+        elif (disc_req.msg_type == discovery_pb2.TYPE_LOOKUP_BATCH):
+            if not self.canServeLookup():
+                return self.forwardToLeader(disc_req, bytesRcvd)
+            self.logger.info("DiscoveryMW::handle_request - lookup batch")
+            timeout = self.upcall_obj.lookup_batch_request(disc_req.lookup_batch_req)
+        elif (disc_req.msg_type == discovery_pb2.TYPE_HEARTBEAT):
+            if not self.is_leader:
+                if self.leader_rep is None:
+                    return self.send_heartbeat([], 0) # nobody holds leases yet
+                return self.forwardToLeader(disc_req, bytesRcvd)
+            timeout = self.upcall_obj.heartbeat_request(disc_req.heartbeat_req)
         else: 
             raise ValueError("Unrecognized response message")
         return timeout
 
     @handle_exception    
-    def handle_register(self, status, reason):
+    def handle_register(self, status, reason, hops=0, lease_ms=0, retry=False):
         self.logger.info("DiscoveryMW::handle_register:: check whether the registration has been successful")
         register_response = discovery_pb2.RegisterResp() 
-        if status: # if status is true, registration = successful
+        if retry: # nobody can store it right now; the client sends it again
+            register_response.status = discovery_pb2.Status.STATUS_CHECK_AGAIN
+        elif status: # if status is true, registration = successful
             register_response.status = discovery_pb2.Status.STATUS_SUCCESS
         else: # otherwise failure
             register_response.status = discovery_pb2.Status.STATUS_FAILURE
         register_response.reason = reason
+        register_response.hops = hops
+        register_response.lease_ms = lease_ms
         discovery_response = discovery_pb2.DiscoveryResp()
         discovery_response.msg_type = discovery_pb2.TYPE_REGISTER
         discovery_response.register_resp.CopyFrom(register_response)
         buf2send = discovery_response.SerializeToString()
-        self.rep.send(buf2send)
+        self.reply(buf2send)
         self.logger.info("DiscoveryMW::handle_register:: registration status has been checked. plz check the message")
         return 0
 
@@ -115,41 +191,118 @@ class DiscoveryMW(PinguMW):
         discovery_response.msg_type = discovery_pb2.TYPE_ISREADY
         discovery_response.isready_resp.CopyFrom(ready_response)
         buf2send = discovery_response.SerializeToString()
-        self.rep.send(buf2send)
+        self.reply(buf2send)
         self.logger.info("DiscoveryMW::update_is_ready_status:: is_ready status sent.")
 
     @handle_exception
-    def send_pubinfo_for_topic(self, pub_in_topic):
+    def send_pubinfo_for_topic(self, pub_in_topic, version=0, hops=0, topiclist=()):
         self.logger.info("DiscoveryMW::send_pubinfo_for_topic:: Start this method")
         lookup_response = discovery_pb2.LookupPubByTopicResp() 
+        lookup_response.state_version = version
+        lookup_response.staleness_ms = self.staleness()
+        lookup_response.served_by = self.name
+        lookup_response.hops = hops
+        if self.multicast is not None:
+            pub_in_topic = []
+            self.fillGroups(lookup_response, topiclist)
         for pub in pub_in_topic:
             reg_info = lookup_response.publisher_info.add()
-            reg_info.id = pub[0] # name
-            reg_info.addr = pub[1] # addr
-            reg_info.port = pub[2] # port
+            self.fillRegistrant(reg_info, pub)
             self.logger.info("DiscoveryMW::send_pubinfo_fo_topic:: Publisher address is tcp://{}:{}".format(reg_info.addr, reg_info.port))
         discovery_response = discovery_pb2.DiscoveryResp()
         discovery_response.msg_type = discovery_pb2.TYPE_LOOKUP_PUB_BY_TOPIC
         discovery_response.lookup_resp.CopyFrom(lookup_response)
         buf2send = discovery_response.SerializeToString()
-        self.rep.send(buf2send)  
+        self.reply(buf2send)
         self.logger.info ("DiscoveryMW::send_pubinfo_for_topic:: List of publishers sent")
 
     @handle_exception    
-    def send_all_pub_list(self, pub_list):
+    def send_all_pub_list(self, pub_list, version=0, hops=0):
         self.logger.info ("DiscoveryMW::send_all_pub_list:: Start this method")
         lookup_response = discovery_pb2.LookupAllPubsResp()
+        lookup_response.state_version = version
+        lookup_response.staleness_ms = self.staleness()
+        lookup_response.served_by = self.name
+        lookup_response.hops = hops
         for pub in pub_list:
             reg_info = lookup_response.publist.add()
-            reg_info.id = pub[0] # name
-            reg_info.addr = pub[1] # addr
-            reg_info.port = pub[2] # port
+            self.fillRegistrant(reg_info, pub)
             self.logger.info("DiscoveryMW::send_all_pub_list:: Publisher address is tcp://{}:{}".format(reg_info.addr, reg_info.port))
         discovery_response = discovery_pb2.DiscoveryResp()
         discovery_response.msg_type = discovery_pb2.TYPE_LOOKUP_ALL_PUBS
         discovery_response.allpubs_resp.CopyFrom(lookup_response)
         buf2send = discovery_response.SerializeToString()
-        self.rep.send(buf2send)
+        self.reply(buf2send)
+
+    @handle_exception
+    def send_register_batch(self, results, hops=0, leases=None, retry=False):
+        self.logger.info("DiscoveryMW::send_register_batch:: {} results".format(len(results)))
+        batch_response = discovery_pb2.RegisterBatchResp()
+        for i, (status, reason) in enumerate(results):
+            register_response = batch_response.results.add()
+            register_response.status = discovery_pb2.STATUS_SUCCESS if status else discovery_pb2.STATUS_FAILURE
+            if retry:
+                register_response.status = discovery_pb2.STATUS_CHECK_AGAIN
+            register_response.reason = reason
+            register_response.hops = hops
+            register_response.lease_ms = leases[i] if leases else 0
+        discovery_response = discovery_pb2.DiscoveryResp()
+        discovery_response.msg_type = discovery_pb2.TYPE_REGISTER_BATCH
+        discovery_response.register_batch_resp.CopyFrom(batch_response)
+        self.reply(discovery_response.SerializeToString())
+        return 0
+
+    @handle_exception
+    def send_lookup_batch(self, results, version=0, topiclists=()):
+        self.logger.info("DiscoveryMW::send_lookup_batch:: {} results".format(len(results)))
+        batch_response = discovery_pb2.LookupBatchResp()
+        batch_response.state_version = version
+        batch_response.staleness_ms = self.staleness()
+        batch_response.served_by = self.name
+        for pub_in_topic in results:
+            lookup_response = batch_response.results.add()
+            if pub_in_topic is None: # this item could not be served
+                lookup_response.status = discovery_pb2.STATUS_FAILURE
+                continue
+            lookup_response.status = discovery_pb2.STATUS_SUCCESS
+            if self.multicast is not None:
+                self.fillGroups(lookup_response, topiclists[len(batch_response.results) - 1])
+                continue
+            for pub in pub_in_topic:
+                self.fillRegistrant(lookup_response.publisher_info.add(), pub)
+        discovery_response = discovery_pb2.DiscoveryResp()
+        discovery_response.msg_type = discovery_pb2.TYPE_LOOKUP_BATCH
+        discovery_response.lookup_batch_resp.CopyFrom(batch_response)
+        self.reply(discovery_response.SerializeToString())
+
+    @handle_exception
+    def send_heartbeat(self, unknown, lease_ms):
+        self.logger.debug("DiscoveryMW::send_heartbeat:: {} unknown ids".format(len(unknown)))
+        discovery_response = discovery_pb2.DiscoveryResp()
+        discovery_response.msg_type = discovery_pb2.TYPE_HEARTBEAT
+        discovery_response.heartbeat_resp.unknown[:] = unknown
+        discovery_response.heartbeat_resp.lease_ms = lease_ms
+        self.reply(discovery_response.SerializeToString())
+        return 0
+
+    # with Strategy=Multicast we hand out the group of every topic looked up, not publishers
+    def fillGroups(self, lookup_response, topiclist):
+        for topic in topiclist:
+            group = lookup_response.groups.add()
+            group.topic = topic
+            group.endpoint = self.multicast.groupOf(topic)
+
+    # pub is [name, addr, port] and, when the publisher advertised more endpoints, its locality
+    def fillRegistrant(self, reg_info, pub):
+        reg_info.id = pub[0] # name
+        reg_info.addr = pub[1] # addr
+        reg_info.port = pub[2] # port
+        if len(pub) > 3:
+            Transport.toInfo(reg_info, pub[3])
+
+    @handle_exception
+    def reply(self, buf2send):
+        self.rep.send_multipart(self.envelope + [buf2send])
 
     # here we save a pointer (handle) to the application object
     def set_upcall_handle(self, upcall_obj):
@@ -162,30 +315,67 @@ class DiscoveryMW(PinguMW):
     """
     assureQuorum(self, name): This method starts a ZooKeeper client and creates a node under the 
     "/discovery" path with the given name as the node name. The node is ephemeral, meaning that 
-    it will be automatically deleted when the client session ends. The method then waits until 
-    the number of nodes under "/discovery" is equal to or greater than a predefined quorum value. 
-    Once the quorum is met, it calls the createLeader() method to create a leader node.
+    it will be automatically deleted when the client session ends. The node carries the addresses
+    of our ROUTER and PUB sockets so that clients can spread their lookups over all replicas.
+    The method then waits until the number of nodes under "/discovery" is equal to or greater 
+    than a predefined quorum value (see PinguMW.waitForChildren; we are woken up by the watch as
+    soon as the last member joins). Once the quorum is met we enter the election.
+
+    campaign(self), checkElection(self): Leader election with the usual ZooKeeper recipe (the one
+    behind kazoo's Election, which we do not use since its run() blocks a thread until elected).
+    Every node creates an ephemeral sequential znode under "/election"; the lowest sequence number
+    is first in line. Everybody else watches only the candidate just ahead of it, so a death wakes
+    up one node instead of the whole quorum, and the successor is known before anything fails.
 
-    createLeader(self, name): This method creates a leader node under the "/leader" path, 
-    containing the name of the leader, the address for the publisher socket, and the address 
-    for the replication socket. If a leader node already exists, it connects to it through the 
-    subscriber socket.
+    claimLeadership(self): Called on the node that is first in line. It creates the ephemeral
+    "/leader" znode with our metadata. If the previous leader's znode is still there (its session
+    has expired but ZooKeeper has not removed all of its znodes yet) we claim it once it is gone.
 
-    watchLeader(self, data): This method uses a decorator to watch changes to the "/leader" node.
-    If the node is deleted, it calls the createLeader() method to create a new leader node.
+    Standbys are kept ready for the takeover: their ROUTER and PUB sockets are bound from the
+    start, clients are already connected to them, and they hold the leader's state as of the last
+    backup (at most SyncIntervalMs old). A takeover thus only swaps the "/leader" metadata; how
+    fast it starts depends on how quickly ZooKeeper expires the dead leader (SessionTimeoutMs).
 
-    watchBroker(self, data): This method uses a decorator to watch changes to the "/broker" path. 
-    When a change occurs, it retrieves the data and uses it to update the broker information.
+    setWatch(self): Listens to "/leader" and "/broker" through the shared ZkCache. Everybody,
+    the leader included, learns who leads from "/leader": when it changes we follow the new
+    leader (or become the leader if it names us); when it is deleted, the node first in line
+    claims it and the others stop forwarding to the dead leader. Broker changes are passed to the
+    application via setBrokerInfo.
+
+    post(self, action, metadata), handle_control(self): Watches run on the ZooKeeper thread but
+    our sockets belong to the event loop, so leadership changes are queued and the event loop is
+    woken up through an inproc PAIR to apply them: "follow" a leader (becomeLeader if it is us),
+    "orphan" when there is no leader, and "rejoin" once a new session replaces an expired one.
+    After a change the loop calls invoke_operation right away, so a new leader arms its leases
+    and publishes its state without waiting for a request.
+
+    watchSession(self, state): When our session expires our znodes are gone and somebody else may
+    lead already, so we stop leading at once. When the client gets a new session we re-create
+    our "/discovery" znode and enter the election again.
+
+    followLeader(self, metadata): Connects the SUB socket to the leader's replication socket and
+    the forwarding DEALER to the leader's ROUTER, disconnecting from any previous leader first.
 
     waitBroker(self): This method waits until a node is created under the "/broker" path.
+    Both waits give up after StartupTimeoutS from config.ini when it is set.
 
-    sendStateReplica(self, topics2pubs, pubs2ip, no_pubs, no_subs, state): This method sends a 
-    state message to the replication service. The message contains information about topics, 
-    publishers, subscribers, and the current state.
+    canServeLookup(self), staleness(self): The leader always answers lookups. A replica answers
+    them from its replicated state as long as it has heard from the leader within MaxStalenessMs,
+    otherwise the lookup is handed to the leader like a registration. staleness() is what gets
+    reported back to the client in each lookup reply.
 
-    receiverFromLEader(self): This method receives data from the leader node through the 
-    subscriber socket. It then extracts information about topics, publishers, and subscribers, 
-    and calls the setState() method to update the state.
+    forwardToLeader(self, disc_req, buf), handle_forwarded(self): Replicas relay registrations to
+    the leader over the DEALER socket, keeping the client's routing envelope so that the leader's
+    reply can be routed straight back to the client through our ROUTER socket. With no leader to
+    relay to, as between the death of a leader and the election of the next, we answer with a
+    reply of the request's own type and STATUS_CHECK_AGAIN, and the client sends it again (see
+    PinguMW.registerAgain).
+
+    sendStateReplica(self, state): The leader publishes its registration state on the "backup" 
+    topic after every change and periodically thereafter.
+
+    receiverFromLeader(self): This method receives the state from the leader through the 
+    subscriber socket, records when we last synced, and calls the setState() method.
     """
     
     @handle_exception     
@@ -193,60 +383,306 @@ class DiscoveryMW(PinguMW):
         self.logger.info("DiscoveryMW::assureQuorum - start")
         self.zk.start()
         self.logger.info("DiscoveryMW::assureQuorum: ZK client state = {}".format(self.zk.state))
-        self.zk.create("/discovery/" + name, ephemeral=True, makepath=True)
-        while len(self.zk.get_children("/discovery")) < self.quorum:
-            self.logger.info("DiscoveryMW::assureQuorum: quorum_size not met, waiting for 3s")
-            time.sleep(3)
-            self.logger.info("DiscoveryMW::assureQuorum: quorum_size met, creating leader")
-            self.createLeader(name)
-    
+        self.zk.create("/discovery/" + name, value=self.metadata().encode("utf-8"), ephemeral=True, makepath=True)
+        self.waitForChildren("DiscoveryMW", "/discovery", self.quorum, self.startup_timeout)
+        self.logger.info("DiscoveryMW::assureQuorum: quorum_size met, entering the election")
+        self.campaign()
+
+    def metadata(self):
+        repAddress = "tcp://" + self.addr + ":" + str(self.port)
+        pubAddress = "tcp://" + self.addr + ":" + str(self.port + 1)
+        return json.dumps({"name": self.name, "repAddress": repAddress, "pubAddress": pubAddress})
+
     @handle_exception
-    def createLeader(self, name):            
-        try:
-            self.logger.info("DiscoveryMW::createLeader: - start")
-            repAddress = "tcp://" + self.addr + ":" + str(self.port)
-            pubAddress = "tcp://" + self.addr + ":" + str(self.port + 1)
-            metaJSON = json.dumps({"name": name, "repAddress": repAddress, "pubAddress": pubAddress})
-            self.zk.create("/leader", value=metaJSON.encode("utf-8"), ephemeral=True, makepath=True)
-            self.logger.info("DiscoveryMW::createLeader: leader created")
-        except NodeExistsError:
-            self.logger.info("DiscoveryMW::createLeader: leader already exists, connecting to leader through the SUB socket")
-            metadata = json.loads(self.zk.get("/leader")[0].decode("utf-8"))
-            self.logger.info("DiscoveryMW::createLeader: leader address = {}".format(metadata["pubAddress"]))
-            self.sub.connect(metadata["pubAddress"])
-            self.sub.setsockopt_string(zmq.SUBSCRIBE, "backup")
+    def campaign(self):
+        self.elected = False
+        self.candidate = self.zk.create("/election/n_", value=self.metadata().encode("utf-8"),
+                                        ephemeral=True, sequence=True, makepath=True)
+        self.logger.info("DiscoveryMW::campaign - candidate {}".format(self.candidate))
+        self.checkElection()
+
+    @handle_exception
+    def checkElection(self):
+        candidates = sorted(self.zk.get_children("/election"))
+        mine = self.candidate.rsplit("/", 1)[1]
+        if mine not in candidates:
+            return # our session expired; watchSession enters us again
+        position = candidates.index(mine)
+        if position == 0:
+            self.logger.info("DiscoveryMW::checkElection - first in line")
+            self.elected = True
+            self.claimLeadership()
             return
-     
-    @DataWatch("/leader")
+        predecessor = "/election/" + candidates[position - 1]
+        self.logger.info("DiscoveryMW::checkElection - standing by behind {}".format(predecessor))
+
+        @self.zk.DataWatch(predecessor)
+        def watchPredecessor(data, stat):
+            if stat is None:
+                self.checkElection()
+                return False
+
     @handle_exception
-    def watchLeader(self, data):
-        if data is None:
-            self.logger.info("DiscoveryMW::watchLeader - start")
-            self.createLeader()
-        
-    @DataWatch("/broker")
+    def claimLeadership(self):
+        while self.elected:
+            try:
+                self.zk.create("/leader", value=self.metadata().encode("utf-8"), ephemeral=True, makepath=True)
+                self.logger.info("DiscoveryMW::claimLeadership: leader created")
+                return
+            except NodeExistsError:
+                try:
+                    data, _ = self.zk.get("/leader")
+                except NoNodeError:
+                    continue # gone in the meantime, try again
+                if json.loads(data.decode("utf-8"))["name"] != self.name:
+                    self.logger.info("DiscoveryMW::claimLeadership: waiting for the old /leader to go")
+                return
+
+    def watchSession(self, state):
+        if state == KazooState.LOST:
+            self.logger.info("DiscoveryMW::watchSession - session expired, stepping down")
+            self.session_lost = True
+            self.elected = False
+            self.post("orphan")
+        elif state == KazooState.CONNECTED and self.session_lost:
+            self.session_lost = False
+            self.post("rejoin")
+
+    def post(self, action, metadata=None):
+        with self.control_lock:
+            self.actions.append((action, metadata))
+            self.control_out.send(b"")
+
+    @handle_exception
+    def handle_control(self):
+        while self.control_in.poll(timeout=0):
+            self.control_in.recv()
+        with self.control_lock:
+            actions, self.actions = self.actions, []
+        return self.applyActions(actions)
+
+    @handle_exception
+    def applyActions(self, actions):
+        for action, metadata in actions:
+            if action == "follow":
+                self.followLeader(metadata)
+            elif action == "orphan":
+                self.unfollow()
+            elif action == "rejoin":
+                self.unfollow()
+                try:
+                    self.zk.create("/discovery/" + self.name, value=self.metadata().encode("utf-8"), ephemeral=True, makepath=True)
+                except NodeExistsError:
+                    pass
+                self.campaign()
+        return 0 # let the application act on the change right away
+
     @handle_exception
-    def watchBroker(self, data):
-        if data:
-            self.logger.info("DiscoveryMW::watchBroker - start")
-            aboutBroker = json.loads(data.decode("utf-8"))
-            self.upcall_obj.setBrokerInfo(aboutBroker)
+    def unfollow(self):
+        if self.leader_pub is not None:
+            self.sub.disconnect(self.leader_pub)
+            self.fwd.disconnect(self.leader_rep)
+        self.leader_pub = None
+        self.leader_rep = None
+        self.is_leader = False
+
+    @handle_exception
+    def becomeLeader(self):
+        self.unfollow()
+        self.logger.info("DiscoveryMW::becomeLeader - taking over as the leader")
+        self.is_leader = True
+
+    @handle_exception
+    def followLeader(self, metadata):
+        if metadata["name"] == self.name:
+            if not self.is_leader:
+                self.becomeLeader()
+            return
+        if metadata["pubAddress"] == self.leader_pub:
+            return
+        self.logger.info("DiscoveryMW::followLeader: leader address = {}".format(metadata["pubAddress"]))
+        self.unfollow()
+        self.sub.connect(metadata["pubAddress"])
+        self.fwd.connect(metadata["repAddress"])
+        self.leader_pub = metadata["pubAddress"]
+        self.leader_rep = metadata["repAddress"]
+
+    @handle_exception
+    def setWatch(self):
+        cache = ZkCache.forClient(self.zk, self.logger)
+
+        def watchLeader(event):
+            if event.kind == ZkEventType.REMOVED:
+                self.logger.info("DiscoveryMW::watchLeader - leader is gone")
+                self.post("orphan")
+                if self.elected:
+                    self.claimLeadership()
+            else:
+                self.post("follow", event.data)
+
+        def watchBroker(event):
+            if event.kind != ZkEventType.REMOVED:
+                self.logger.info("DiscoveryMW::watchBroker - start")
+                self.upcall_obj.setBrokerInfo(event.data)
+
+        cache.listen("/leader", watchLeader)
+        cache.listen("/broker", watchBroker)
 
     @handle_exception
     def waitBroker(self):
-        while not self.zk.exists("/broker"):
-            time.sleep(1)
+        self.waitForZnode("DiscoveryMW", "/broker", self.startup_timeout)
+
+    def staleness(self):
+        if self.is_leader:
+            return 0
+        if self.last_sync is None:
+            return 0xFFFFFFFF # never synced
+        return min(int((time.monotonic() - self.last_sync) * 1000), 0xFFFFFFFF)
+
+    def canServeLookup(self):
+        if self.is_leader or self.leader_rep is None:
+            return True
+        return self.replica_lookups and self.staleness() <= self.max_staleness
+
+    @handle_exception
+    def forwardToLeader(self, disc_req, buf):
+        if self.leader_rep is None:
+            self.logger.info("DiscoveryMW::forwardToLeader - no leader to forward to")
+            reason = "No discovery leader has been elected yet, try again"
+            if disc_req.msg_type == discovery_pb2.TYPE_REGISTER_BATCH:
+                return self.send_register_batch([(False, reason)] * len(disc_req.register_batch_req.registrations), retry=True)
+            return self.handle_register(False, reason, retry=True)
+        self.logger.info("DiscoveryMW::forwardToLeader - forwarding to {}".format(self.leader_rep))
+        self.fwd.send_multipart(self.envelope + [buf])
+        return 0
+
+    @handle_exception
+    def handle_forwarded(self, sock):
+        # the reply still carries the client envelope so we just route it back
+        self.rep.send_multipart(sock.recv_multipart())
+        return 0
     
     @handle_exception
-    def sendStateReplica(self, topics2pubs, pubs2ip, no_pubs, no_subs, state):
+    def sendStateReplica(self, state):
         self.logger.info("DiscoveryMW::send_state_to_replica - start")
-        topics2pubsJSON = json.dumps(topics2pubs)
-        pubs2ipJSON = json.dumps(pubs2ip)
-        self.pub.send_multipart([ topics2pubsJSON.encode("utf-8"), pubs2ipJSON.encode("utf-8"), no_pubs, no_subs])
+        self.pub.send_multipart([b"backup", json.dumps(state).encode("utf-8")])
     
     @handle_exception
     def receiverFromLeader(self):
-        dataReceived = self.sub.recv_multipart()
-        topics2pubs = json.loads(dataReceived[0].decode("utf-8"))
-        pubs2ip = json.loads(dataReceived[1].decode("utf-8"))
-        self.upcall_obj.setState(topics2pubs, pubs2ip, dataReceived[2], dataReceived[3])
\ No newline at end of file
+        return self.applyBackup(self.sub.recv_multipart())
+
+    @handle_exception
+    def applyBackup(self, dataReceived):
+        self.last_sync = time.monotonic()
+        self.upcall_obj.setState(json.loads(dataReceived[1].decode("utf-8")))
+        return 0
+
+    # DHT lookups (Strategy=DHT)
+    """
+    setupDHT(self, dht_json, context): Builds our view of the Chord ring from dht.json (see
+    ChordDHT.ChordRing) and connects one DEALER socket to each distinct finger. No ZooKeeper
+    quorum or leader is involved in this mode; every node is equal.
+
+    handle_dht(self, disc_req): Batched requests are not routed; every item of a batch is
+    answered with STATUS_FAILURE. Registrations in the DHT are not leased, so heartbeats are
+    answered right away. Other requests arriving from clients get a DhtRoute attached listing
+    the keys whose owners must be visited: the topics of a publisher registration or of a
+    lookup, or the registrant id for subscribers and brokers. The keys are ordered clockwise
+    from us so the request travels around the ring once. Every node handles the pending keys it
+    owns through the dht_* upcalls and forwards the request to nextHop() for the next key. The
+    node that resolves the last key replies, and the reply retraces the path through
+    handle_forwarded, each hop popping its own routing frame. Lookups of all publishers walk
+    the ring through the successors and stop before getting back to the entry node.
+
+    forwardDHT(self, disc_req, node): Counts the hop and forwards the request, keeping the
+    envelope, to the given finger.
+
+    dumpFingerTable(self): Logs our finger table.
+    """
+    @handle_exception
+    def setupDHT(self, dht_json, context):
+        self.logger.info("DiscoveryMW::setupDHT - build the finger table from {}".format(dht_json))
+        self.ring = ChordRing(ChordRing.load(dht_json), self.name)
+        for node in self.ring.peers():
+            sock = context.socket(zmq.DEALER)
+            sock.connect(ChordRing.endpoint(node))
+            self.reactor.register(sock, partial(self.handle_forwarded, sock), "DiscoveryMW.peer." + node["id"])
+            self.peers[node["id"]] = sock
+
+    def clockwise(self, key):
+        return (ChordRing.hashOf(key) - self.ring.me["hash"]) % self.ring.modulus
+
+    @handle_exception
+    def handle_dht(self, disc_req):
+        route = disc_req.route
+        if not disc_req.HasField("route"):
+            self.logger.info("DiscoveryMW::handle_dht - new request entering the ring")
+            route.origin = self.ring.me["hash"]
+            if disc_req.msg_type == discovery_pb2.TYPE_REGISTER:
+                if disc_req.register_req.role == discovery_pb2.ROLE_PUBLISHER:
+                    route.pending[:] = sorted(set(disc_req.register_req.topiclist), key=self.clockwise)
+                else:
+                    route.pending[:] = [disc_req.register_req.info.id]
+            elif disc_req.msg_type == discovery_pb2.TYPE_LOOKUP_PUB_BY_TOPIC:
+                route.pending[:] = sorted(set(disc_req.lookup_req.topiclist), key=self.clockwise)
+            elif disc_req.msg_type == discovery_pb2.TYPE_ISREADY:
+                return self.upcall_obj.isready_request()
+            elif disc_req.msg_type == discovery_pb2.TYPE_REGISTER_BATCH:
+                reason = "Batched registrations are not supported with Strategy=DHT"
+                return self.send_register_batch([(False, reason)] * len(disc_req.register_batch_req.registrations))
+            elif disc_req.msg_type == discovery_pb2.TYPE_LOOKUP_BATCH:
+                self.send_lookup_batch([None] * len(disc_req.lookup_batch_req.lookups))
+                return 0
+            elif disc_req.msg_type == discovery_pb2.TYPE_HEARTBEAT:
+                return self.send_heartbeat([], 0) # DHT registrations are not leased
+            elif disc_req.msg_type != discovery_pb2.TYPE_LOOKUP_ALL_PUBS:
+                raise ValueError("Unrecognized response message")
+        if disc_req.msg_type == discovery_pb2.TYPE_LOOKUP_ALL_PUBS:
+            self.addFound(route, self.upcall_obj.dht_all_pubs())
+            if self.ring.successor["hash"] == route.origin:
+                self.send_all_pub_list([self.pubOf(p) for p in route.found], 0, route.hops)
+                return 0
+            return self.forwardDHT(disc_req, self.ring.successor)
+        while route.pending and self.ring.owns(ChordRing.hashOf(route.pending[0])):
+            key = route.pending[0]
+            del route.pending[0]
+            if disc_req.msg_type == discovery_pb2.TYPE_REGISTER:
+                status, reason = self.upcall_obj.dht_register(disc_req.register_req, key)
+                if not status and not route.reason:
+                    route.reason = reason
+            else:
+                self.addFound(route, self.upcall_obj.dht_lookup(key))
+        if route.pending:
+            return self.forwardDHT(disc_req, self.ring.nextHop(ChordRing.hashOf(route.pending[0])))
+        self.logger.info("DiscoveryMW::handle_dht - resolved after {} hops".format(route.hops))
+        if disc_req.msg_type == discovery_pb2.TYPE_REGISTER:
+            if route.reason:
+                return self.handle_register(False, route.reason, route.hops)
+            return self.handle_register(True, "The registration is stored in the DHT.", route.hops)
+        self.send_pubinfo_for_topic([self.pubOf(p) for p in route.found], 0, route.hops, disc_req.lookup_req.topiclist)
+        return 0
+
+    def addFound(self, route, pubs):
+        seen = set(p.id for p in route.found)
+        for pub in pubs:
+            if pub[0] not in seen:
+                self.fillRegistrant(route.found.add(), pub)
+                seen.add(pub[0])
+
+    @staticmethod
+    def pubOf(reg_info):
+        return [reg_info.id, reg_info.addr, reg_info.port, Transport.localityOf(reg_info)]
+
+    @handle_exception
+    def forwardDHT(self, disc_req, node):
+        disc_req.route.hops += 1
+        self.logger.info("DiscoveryMW::forwardDHT - forwarding to {}".format(node["id"]))
+        self.peers[node["id"]].send_multipart(self.envelope + [disc_req.SerializeToString()])
+        return 0
+
+    @handle_exception
+    def dumpFingerTable(self):
+        self.logger.info("     Node: {} ({})".format(self.ring.me["id"], self.ring.me["hash"]))
+        self.logger.info("     Successor: {}  Predecessor: {}".format(self.ring.successor["id"], self.ring.predecessor["id"]))
+        for i, finger in enumerate(self.ring.fingers):
+            self.logger.debug("     Finger[{}]: {}".format(i, finger["id"]))
@@ -0,0 +1,518 @@
+"""
+Feedback: a side channel from the subscribers back to whoever sends to them, publishers and the
+broker ([Feedback] in config.ini).
+
+PUB/SUB only flows one way, so a sender cannot tell a subscriber that keeps up from one that
+falls behind: ZMQ queues for each subscriber up to SndHwm and then drops, or, with XPUB_NODROP,
+holds everybody back (see Outbox). With Enabled=True every sender binds a ROUTER socket at the
+feedback endpoint of each of its data endpoints (Transport.feedbackOf) and every subscriber
+connects a DEALER, named after itself, to that of each sender it connects to. On connecting the
+subscriber says HELLO with its topics and the sender answers WELCOME with its name, and whether
+it relays the messages of others (the broker).
+
+Senders number the messages of every topic per publisher: the publisher appends ":seq" after
+the time and the broker forwards it as it is. The subscriber takes it off again before the
+application sees the message, and every AckMs acknowledges to each sender the highest seq it
+delivered of each topic and publisher. The lag of a subscriber is the number of messages of
+its topics sent since its HELLO that it has not acknowledged yet, so one that never acks lags
+as much as one that acks late; every CheckMs the sender compares it to LagThreshold. A
+subscriber over it for LagStrikes checks in a row is a chronic laggard, and SlowPolicy decides:
+
+    Report      log it, nothing more
+    Degrade     the subscriber is told to conflate all of its topics (see SubscriberMW), which
+                delivers only the newest waiting message of each, until its lag is back under
+                half of LagThreshold
+    Disconnect  the subscriber is told to disconnect from the sender; it connects again after
+                RejoinMs, having skipped what was sent meanwhile
+
+Either way the queues of the laggard stop filling up, so that its sender, and the subscribers
+that keep up, are neither held back nor see messages dropped on its account. A PUB socket cannot
+close the pipe of one subscriber, so the subscriber's middleware carries out the isolation when
+its sender tells it to. A subscriber not heard from for ForgetMs is forgotten; one with nothing
+to ack sends an empty ACK every ForgetMs/2 so that it is not forgotten while idle.
+
+Credits=N turns the acks into credit based flow control: every subscriber
+grants a publisher N messages beyond what it acknowledged, and acks as soon as it has delivered
+a quarter of them rather than waiting for AckMs. The credit of a publisher is the least that any
+of its subscribers has left (N minus its lag, which counts from its HELLO, so a subscriber that
+just joined is not overrun before its first ack); with none left it is congested() and
+PublisherAppln skips its rounds until acks come in, so it sends at the pace of its slowest
+subscriber instead of its frequency. With SndHwm and RcvHwm both above N nothing is dropped. A
+subscriber that dies holds the publisher back until it is forgotten, and SlowPolicy still
+isolates chronic laggards (set LagThreshold below N for it to apply). The broker forwards at
+the pace its own queues allow (OverflowPolicy=Block), not by credits.
+
+ReliableTopics lists the topics with the reliable QoS; the others stay best effort. Senders
+keep the last HistorySize messages of every reliable stream, keyed by seq; the broker keeps
+those it forwarded. A subscriber that sees the seq of a reliable stream jump knows what it
+missed and NACKs the missing ranges to the sender at once, and again every AckMs for up to
+NackRetries times; the sender retransmits what its history still has over the side channel,
+in batches of up to NackBatch messages, to that subscriber only. Recovered messages are
+delivered as they come, after the ones that overtook them, and duplicates are dropped. Only
+what is missed costs bandwidth, so delivery is near lossless as long as the history reaches
+back far enough; what it does not is counted as lost. A gap shows once the next message of its
+stream arrives, so a stream that stops is not repaired at its tail. The first message of a
+stream a subscriber sees is where it joined, not a gap.
+"""
+
+import collections
+import json
+import time
+import zmq
+
+class Feedback():
+    POLICIES = ("Report", "Degrade", "Disconnect")
+
+    def __init__(self, logger, name):
+        self.logger = logger
+        self.name = name # ours: the identity of our DEALERs, or what we WELCOME with
+        self.port_offset = 1000
+        self.ack_ms = 200
+        self.check_ms = 1000
+        self.lag_threshold = 10000
+        self.lag_strikes = 3
+        self.policy = "Report"
+        self.rejoin_ms = 10000
+        self.forget_ms = 10000
+        self.credits = 0 # window of every subscriber, in messages; 0 is no flow control
+        self.reliable = frozenset() # topics with the reliable QoS
+        self.history_size = 4096 # messages kept per reliable stream
+        self.nack_batch = 256
+        self.nack_retries = 3
+        self.mw = None # the middleware object we work for (see attach)
+        self.timer = None
+
+    # is the side channel on? Only then do senders number their messages
+    @staticmethod
+    def isEnabled(config):
+        return config.getboolean("Feedback", "Enabled", fallback=False)
+
+    def configure(self, config):
+        self.port_offset = config.getint("Feedback", "PortOffset", fallback=self.port_offset)
+        self.ack_ms = config.getint("Feedback", "AckMs", fallback=self.ack_ms)
+        self.check_ms = config.getint("Feedback", "CheckMs", fallback=self.check_ms)
+        self.lag_threshold = config.getint("Feedback", "LagThreshold", fallback=self.lag_threshold)
+        self.lag_strikes = config.getint("Feedback", "LagStrikes", fallback=self.lag_strikes)
+        self.policy = config.get("Feedback", "SlowPolicy", fallback=self.policy)
+        if self.policy not in self.POLICIES:
+            raise ValueError("Unknown SlowPolicy {}, should be one of {}".format(self.policy, ", ".join(self.POLICIES)))
+        self.rejoin_ms = config.getint("Feedback", "RejoinMs", fallback=self.rejoin_ms)
+        self.forget_ms = config.getint("Feedback", "ForgetMs", fallback=self.forget_ms)
+        self.credits = config.getint("Feedback", "Credits", fallback=self.credits)
+        self.reliable = frozenset(topic.strip() for topic in config.get("Feedback", "ReliableTopics", fallback="").split(",") if topic.strip())
+        self.history_size = config.getint("Feedback", "HistorySize", fallback=self.history_size)
+        self.nack_batch = config.getint("Feedback", "NackBatch", fallback=self.nack_batch)
+        self.nack_retries = config.getint("Feedback", "NackRetries", fallback=self.nack_retries)
+
+    @staticmethod
+    def now():
+        return time.monotonic() * 1000
+
+    @staticmethod
+    def encode(kind, body=None):
+        return [kind, json.dumps(body).encode("utf-8") if body is not None else b""]
+
+    @staticmethod
+    def decode(frame):
+        return json.loads(frame) if frame else None
+
+class Peer():
+    """What a sender knows about one subscriber"""
+
+    def __init__(self, identity, now):
+        self.identity = identity
+        self.topics = None # prefixes of its topics, from its HELLO; None until it said HELLO
+        self.acked = {} # topic:publisher -> highest seq the subscriber delivered, or we sent before its HELLO
+        self.heard = now # monotonic msec when it last told us anything
+        self.lag = 0
+        self.strikes = 0 # checks in a row over LagThreshold
+        self.isolated = False # SlowPolicy was applied and it has not caught up since
+
+class FeedbackServer(Feedback):
+    """The sender's end: a ROUTER socket next to our data endpoints, the seq of every stream we
+    send and what each subscriber acknowledged of them"""
+
+    def __init__(self, logger, name, relay=False):
+        super().__init__(logger, name)
+        self.relay = relay # we forward the messages of publishers (the broker)
+        self.router = None
+        self.sent = {} # topic:publisher -> seq of the last message we sent of it
+        self.peers = {} # identity -> Peer
+        self.degrades = 0 # times we told a subscriber to degrade, or to disconnect
+        self.disconnects = 0
+        self.max_lag = 0
+        self.stalls = 0 # times we ran out of credit
+        self.history = {} # topic:publisher -> OrderedDict seq -> message, of the reliable topics
+        self.nacks = 0
+        self.retransmitted = 0
+        self.unavailable = 0 # NACKed messages no longer in our history
+
+    # bind our ROUTER next to the data endpoints of mw and start checking on the subscribers
+    def attach(self, mw, endpoints):
+        self.mw = mw
+        self.router = mw.context.socket(zmq.ROUTER)
+        self.router.setsockopt(zmq.ROUTER_HANDOVER, 1) # a subscriber that rejoins takes over its name
+        self.router.setsockopt(zmq.LINGER, 0)
+        mw.transport.bindFeedback(self.router, endpoints, self.port_offset)
+        mw.reactor.register(self.router, self.handle, self.name + ".feedback")
+        self.timer = mw.schedule(self.check_ms, self.check, self.name + ".feedbackCheck", self.check_ms)
+
+    # msg, of topic from us, publisher pub_id, with the seq of the next message of it appended
+    def stamp(self, topic, pub_id, msg):
+        key = topic + ":" + pub_id
+        seq = self.sent.get(key, 0) + 1
+        if seq == 1:
+            self.started(key, seq)
+        self.sent[key] = seq
+        msg += ":" + str(seq)
+        if topic in self.reliable:
+            self.keep(key, seq, msg)
+        return msg
+
+    # the broker passes on msg with the seq its publisher gave it
+    def forwarded(self, msg):
+        parts = msg.split(":", 5)
+        if len(parts) > 4 and parts[4].isdigit():
+            key = parts[0] + ":" + parts[1]
+            if key not in self.sent:
+                self.started(key, int(parts[4]))
+            self.sent[key] = int(parts[4])
+            if parts[0] in self.reliable:
+                self.keep(key, int(parts[4]), msg)
+
+    # a stream we send from seq on: the subscribers of its topic owe us everything of it from there
+    def started(self, key, seq):
+        for peer in self.peers.values():
+            if peer.topics is not None and key.startswith(peer.topics):
+                peer.acked.setdefault(key, seq - 1)
+
+    # a subscriber said HELLO: it owes us what we send of its topics from now on
+    def greet(self, peer, topics):
+        peer.topics = tuple(topics)
+        for key, seq in self.sent.items():
+            if key.startswith(peer.topics):
+                peer.acked[key] = max(peer.acked.get(key, 0), seq)
+
+    def keep(self, key, seq, msg):
+        history = self.history.get(key)
+        if history is None:
+            history = self.history[key] = collections.OrderedDict()
+        history[seq] = msg
+        if len(history) > self.history_size:
+            history.popitem(last=False)
+
+    # what a subscriber NACKed, {key: [[first, last], ...]}, from our history, in batches
+    def retransmit(self, identity, ranges):
+        self.nacks += 1
+        batch = []
+        for key, spans in ranges.items():
+            history = self.history.get(key, {})
+            for first, last in spans:
+                for seq in range(first, last + 1):
+                    msg = history.get(seq)
+                    if msg is None:
+                        self.unavailable += 1
+                        continue
+                    batch.append(msg)
+                    if len(batch) >= self.nack_batch:
+                        self.send(identity, b"RETX", batch)
+                        batch = []
+        if batch:
+            self.send(identity, b"RETX", batch)
+
+    # what a subscriber has not acknowledged of its streams: after its HELLO we know all of them,
+    # before it only those it acked
+    def lagOf(self, peer):
+        return sum(max(0, self.sent.get(key, 0) - seq) for key, seq in peer.acked.items())
+
+    # messages we may still send before the slowest subscriber has used up its credits; None
+    # without flow control or subscribers
+    def credit(self):
+        if not self.credits or not self.peers:
+            return None
+        return self.credits - max(self.lagOf(peer) for peer in self.peers.values())
+
+    # with Credits: hold back until the slowest subscriber grants more
+    def congested(self):
+        credit = self.credit()
+        if credit is None or credit > 0:
+            return False
+        self.stalls += 1
+        return True
+
+    def send(self, identity, kind, body=None):
+        try:
+            self.router.send_multipart([identity] + self.encode(kind, body), zmq.NOBLOCK)
+            if kind == b"RETX":
+                self.retransmitted += len(body)
+        except zmq.Again:
+            pass # the subscriber is gone, or not reading its side channel either
+
+    # the reactor calls us for every message of a subscriber
+    def handle(self):
+        identity, kind, body = self.router.recv_multipart()
+        peer = self.peers.get(identity)
+        if peer is None:
+            peer = self.peers[identity] = Peer(identity, self.now())
+            self.logger.info("{}::feedback - subscriber {} joined".format(self.name, identity.decode("utf-8", "replace")))
+        peer.heard = self.now()
+        if kind == b"HELLO":
+            self.greet(peer, (self.decode(body) or {}).get("topics", [""]))
+            self.send(identity, b"WELCOME", {"name": self.name, "relay": self.relay})
+        elif kind == b"ACK":
+            for key, seq in self.decode(body).items():
+                peer.acked[key] = max(peer.acked.get(key, 0), seq)
+        elif kind == b"NACK":
+            self.retransmit(identity, self.decode(body))
+        return None
+
+    # timer: the lag of every subscriber, and what SlowPolicy does about chronic laggards
+    def check(self):
+        now = self.now()
+        for identity, peer in list(self.peers.items()):
+            subscriber = identity.decode("utf-8", "replace")
+            if now - peer.heard > self.forget_ms:
+                self.logger.info("{}::feedback - forgetting subscriber {}, silent for {} ms".format(self.name, subscriber, now - peer.heard))
+                del self.peers[identity]
+                continue
+            peer.lag = self.lagOf(peer)
+            self.max_lag = max(self.max_lag, peer.lag)
+            peer.strikes = peer.strikes + 1 if peer.lag > self.lag_threshold else 0
+            if peer.strikes >= self.lag_strikes and not peer.isolated:
+                self.isolate(peer, subscriber)
+            elif peer.isolated and peer.lag < self.lag_threshold // 2:
+                self.logger.warning("{}::feedback - subscriber {} caught up, lag {}".format(self.name, subscriber, peer.lag))
+                if self.policy == "Degrade":
+                    self.send(identity, b"RESTORE")
+                peer.isolated = False
+        self.logger.debug("{}::feedback - lag {}".format(self.name, {p.identity.decode("utf-8", "replace"): p.lag for p in self.peers.values()}))
+        return None
+
+    def isolate(self, peer, subscriber):
+        self.logger.warning("{}::feedback - subscriber {} is {} messages behind for {} checks: {}".format(
+            self.name, subscriber, peer.lag, peer.strikes, self.policy))
+        peer.isolated = True
+        if self.policy == "Degrade":
+            self.send(peer.identity, b"DEGRADE")
+            self.degrades += 1
+        elif self.policy == "Disconnect":
+            self.send(peer.identity, b"DISCONNECT", {"rejoin_ms": self.rejoin_ms})
+            del self.peers[peer.identity] # it says HELLO again when it rejoins
+            self.disconnects += 1
+
+    def stats(self):
+        return {"subscribers": len(self.peers), "max_lag": self.max_lag, "degrades": self.degrades,
+                "disconnects": self.disconnects, "stalls": self.stalls, "nacks": self.nacks,
+                "retransmitted": self.retransmitted, "unavailable": self.unavailable, "lags": {p.identity.decode("utf-8", "replace"): p.lag for p in self.peers.values()}}
+
+    def close(self):
+        if self.router is None:
+            return
+        self.logger.info("{}::feedback - {}".format(self.name, self.stats()))
+        self.mw.cancel(self.timer)
+        self.mw.reactor.unregister(self.router)
+        self.router.close()
+        self.router = None
+
+class Sender():
+    """What a subscriber knows about one sender: the DEALER to its side channel and who it is"""
+
+    def __init__(self, connect_str, dealer):
+        self.connect_str = connect_str # of its data endpoint
+        self.dealer = dealer
+        self.name = None # from its WELCOME
+        self.relay = False
+
+class FeedbackClient(Feedback):
+    """The subscriber's end: a DEALER per sender we are connected to, the highest seq of every
+    stream we delivered and what we miss of the reliable ones"""
+
+    def __init__(self, logger, name):
+        super().__init__(logger, name)
+        self.senders = {} # connect_str -> Sender
+        self.named = {} # name of a sender -> Sender
+        self.delivered = {} # topic:publisher -> highest seq we delivered
+        self.unacked = set() # keys delivered since our last ACK
+        self.retired = [] # DEALERs of senders we left, to close from our ack timer (see detach)
+        self.unacked_count = 0 # messages delivered since our last ACK
+        self.told = self.now() # monotonic msec of our last ACK
+        self.missing = {} # topic:publisher -> {seq: [NACKs sent, msec of the last one]}, of reliable topics
+        self.gaps = 0 # messages of reliable topics we found missing
+        self.recovered = 0
+        self.lost = 0 # of those, what no retransmission brought back
+
+    # mw is the SubscriberMW that carries out what our senders tell us (see isolate there)
+    def start(self, mw):
+        self.mw = mw
+        self.timer = mw.schedule(self.ack_ms, self.ack, "FeedbackClient.ack", self.ack_ms)
+
+    # connect a DEALER to the side channel of the sender at connect_str
+    def attach(self, connect_str):
+        dealer = self.mw.context.socket(zmq.DEALER)
+        dealer.setsockopt(zmq.IDENTITY, self.name.encode("utf-8"))
+        dealer.setsockopt(zmq.LINGER, 0)
+        dealer.connect(self.mw.transport.feedbackOf(connect_str, self.port_offset))
+        sender = self.senders[connect_str] = Sender(connect_str, dealer)
+        self.mw.reactor.register(dealer, lambda: self.handle(sender), "FeedbackClient." + connect_str)
+        self.send(sender, b"HELLO", {"topics": sorted(self.mw.subscribed)})
+
+    def detach(self, connect_str):
+        sender = self.senders.pop(connect_str, None)
+        if sender is None:
+            return
+        if sender.name is not None and self.named.get(sender.name) is sender:
+            del self.named[sender.name]
+        self.mw.reactor.unregister(sender.dealer)
+        # we may be leaving from the handler of this very dealer (DISCONNECT), which the reactor
+        # reads again once the handler returns; ack() closes it
+        self.retired.append(sender.dealer)
+
+    def send(self, sender, kind, body=None):
+        try:
+            sender.dealer.send_multipart(self.encode(kind, body), zmq.NOBLOCK)
+        except zmq.Again:
+            pass # not connected yet, or the sender is gone
+
+    # msg as its sender numbered it: note its seq and return it without
+    def seen(self, msg):
+        parts = msg.split(":")
+        if len(parts) < 5 or not parts[4].isdigit():
+            return msg
+        key = parts[0] + ":" + parts[1]
+        seq = int(parts[4])
+        last = self.delivered.get(key)
+        if last is not None and seq > last + 1 and parts[0] in self.reliable:
+            self.missed(key, last + 1, seq - 1)
+        if seq > self.delivered.get(key, 0):
+            self.delivered[key] = seq
+            self.unacked.add(key)
+            self.unacked_count += 1
+            if self.credits and self.unacked_count * 4 >= self.credits:
+                self.ack() # grant more credit before the publisher runs out
+        del parts[4]
+        return ":".join(parts)
+
+    # the senders of a stream: its publisher if we reach it directly, else our relays
+    def targetsOf(self, key):
+        sender = self.named.get(key.split(":", 1)[1])
+        return [sender] if sender is not None else [s for s in self.senders.values() if s.relay]
+
+    # send {key: value} to the senders of each key, one message per sender
+    def tell(self, kind, values):
+        bodies = {}
+        for key, value in values.items():
+            for target in self.targetsOf(key):
+                bodies.setdefault(target.connect_str, {})[key] = value
+        for connect_str, body in bodies.items():
+            self.send(self.senders[connect_str], kind, body)
+
+    # seqs first..last of a reliable stream never came: NACK them now. What is older than any
+    # history reaches back to is lost already
+    def missed(self, key, first, last):
+        self.gaps += last - first + 1
+        if last - first + 1 > self.history_size:
+            self.lost += last - first + 1 - self.history_size
+            first = last - self.history_size + 1
+        waiting = self.missing.setdefault(key, {})
+        now = self.now()
+        for seq in range(first, last + 1):
+            waiting[seq] = [1, now]
+        self.tell(b"NACK", {key: [[first, last]]})
+
+    @staticmethod
+    def spans(seqs):
+        spans = []
+        for seq in sorted(seqs):
+            if spans and spans[-1][1] == seq - 1:
+                spans[-1][1] = seq
+            else:
+                spans.append([seq, seq])
+        return spans
+
+    # NACK again what is still missing after AckMs, giving up after NackRetries
+    def renack(self):
+        now = self.now()
+        ranges = {}
+        for key, waiting in list(self.missing.items()):
+            due = [seq for seq, (tries, at) in waiting.items() if now - at >= self.ack_ms]
+            for seq in due:
+                if waiting[seq][0] >= self.nack_retries:
+                    del waiting[seq]
+                    self.lost += 1
+                else:
+                    waiting[seq] = [waiting[seq][0] + 1, now]
+            again = [seq for seq in due if seq in waiting]
+            if again:
+                ranges[key] = self.spans(again)
+            if not waiting:
+                del self.missing[key]
+        if ranges:
+            self.tell(b"NACK", ranges)
+
+    # timer: tell each sender how far we got with its streams; those of publishers we reach
+    # through a relay go to the relay. With Credits every ack is a grant as well. With nothing
+    # to ack we still send an empty ACK now and then
+    def ack(self):
+        while self.retired:
+            self.retired.pop().close()
+        if self.missing:
+            self.renack()
+        if not self.unacked:
+            if self.now() - self.told >= self.forget_ms / 2: # so that our senders keep our HELLO
+                for sender in self.senders.values():
+                    self.send(sender, b"ACK", {})
+                self.told = self.now()
+            return None
+        self.tell(b"ACK", {key: self.delivered[key] for key in self.unacked})
+        self.unacked.clear()
+        self.unacked_count = 0
+        self.told = self.now()
+        return None
+
+    # a batch of retransmitted messages: those we still miss, without their seq
+    def retransmitted(self, msgs):
+        found = []
+        for msg in msgs:
+            parts = msg.split(":")
+            key = parts[0] + ":" + parts[1]
+            waiting = self.missing.get(key)
+            if waiting is None or waiting.pop(int(parts[4]), None) is None:
+                continue # a duplicate
+            if not waiting:
+                del self.missing[key]
+            self.recovered += 1
+            del parts[4]
+            found.append(":".join(parts))
+        return found
+
+    def stats(self):
+        return {"gaps": self.gaps, "recovered": self.recovered, "lost": self.lost,
+                "missing": sum(len(waiting) for waiting in self.missing.values())}
+
+    # the reactor calls us for every message of one of our senders
+    def handle(self, sender):
+        kind, body = sender.dealer.recv_multipart()
+        body = self.decode(body)
+        if kind == b"WELCOME":
+            sender.name = body["name"]
+            sender.relay = body["relay"]
+            self.named[sender.name] = sender
+            self.unacked.update(self.delivered) # it may have missed our acks so far
+        elif kind == b"RETX":
+            found = self.retransmitted(body)
+            return self.mw.recover(found) if found else None
+        elif kind in (b"DEGRADE", b"RESTORE", b"DISCONNECT"):
+            self.logger.warning("FeedbackClient::handle - {} from {}".format(kind.decode(), sender.name or sender.connect_str))
+            return self.mw.isolate(sender.connect_str, kind.decode(), body)
+        return None
+
+    def close(self):
+        if self.mw is None:
+            return
+        if self.reliable:
+            self.logger.info("FeedbackClient::close - {}".format(self.stats()))
+        self.mw.cancel(self.timer)
+        for connect_str in list(self.senders):
+            self.detach(connect_str)
+        while self.retired:
+            self.retired.pop().close()
@@ -0,0 +1,199 @@
+"""
+Host runs many middleware objects, and the applications on top of them, in one process.
+
+Every publisher and subscriber normally is a process of its own, with its own event loop and
+its own ZooKeeper session. For large local experiments HostAppln.py instead makes one Host and
+then any number of PublisherAppln/SubscriberAppln objects, each configured and driven as usual.
+While a Host is active (PinguMW.host) the middleware objects made in the process share:
+
+    the context    zmq.Context.instance(), as always; the Host lifts its cap on sockets (and our
+                   limit on open files) so that hundreds of entities fit
+    the loop       one Reactor services the sockets and timers of all of them; each middleware
+                   object gets a HostedReactor, a view of it that keeps the idle operation
+                   (invoke_operation) of its application to itself
+    the session    one coordination client per ZooKeeper ensemble (PinguMW.session), started by
+                   the first entity that starts it and stopped by the Host once the loop is done
+    heartbeats     one Heartbeater per process, as always, renewing the leases of all of them
+
+What stays per entity is what makes it one: its name, its sockets and endpoints, its znodes and
+its registration with the discovery service. The ephemeral znodes of an entity live as long as
+the shared session, so an entity that is done still looks registered until the Host exits.
+
+The Host's loop runs until every entity has stopped its event loop (disable_event_loop) or
+stop() is called. It has one idle policy, HostIdlePolicy in [EventLoop] (see setIdlePolicy).
+"""
+
+import resource
+import zmq
+from CS6381_MW.Common import PinguMW, Reactor
+from CS6381_MW.Coordination import coordinationClient
+
+class SharedSession():
+    """The coordination client of a Host, handed to all of its middleware objects. start() only
+    starts it the first time and stop() leaves it to the Host; the rest is the client's."""
+
+    def __init__(self, client):
+        self.client = client
+        self.started = False
+
+    def start(self, *args, **kwargs):
+        if not self.started:
+            self.client.start(*args, **kwargs)
+            self.started = True
+
+    def stop(self):
+        pass # other entities still use the session
+
+    def close(self):
+        if self.started:
+            self.client.stop()
+            self.started = False
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+class HostedReactor():
+    """What a middleware object sees of the Host's Reactor, with the same calls as a Reactor.
+
+    The Reactor runs one idle operation, when none of its sockets had anything, and a handler's
+    result replaces its next deadline. Here every entity has an idle operation of its own, so its
+    deadline is a timer on the shared loop: a handler or timer of the entity asking for a
+    timeout brings the idle operation forward to it, and None leaves it as it was. run() only
+    arms the first one and returns; the Host's loop does the running."""
+
+    def __init__(self, host, label):
+        self.host = host
+        self.reactor = host.reactor
+        self.label = label # prefix of our handler names in the Reactor's report
+        self.idle = None # the application's invoke_operation, from run()
+        self.idle_timer = None # handle of the timer that runs idle next
+        self.idle_at = None # when, in the Reactor's msec
+        self.sockets = []
+        self.timers = set() # handles of our timers still scheduled
+        self.running = False
+
+    # the Host's loop has one policy for all of us (see Host.setIdlePolicy)
+    def setIdlePolicy(self, policy, spin_polls=1000):
+        pass
+
+    def register(self, sock, callback, name=None, budget=None, pending=None):
+        self.sockets.append(sock)
+        self.reactor.register(sock, lambda: self.after(callback()), self.label + "." + (name or str(sock)), budget, pending)
+
+    def unregister(self, sock):
+        if sock in self.sockets:
+            self.sockets.remove(sock)
+        self.reactor.unregister(sock)
+
+    def schedule(self, delay_ms, callback, name=None, interval_ms=None):
+        def fire():
+            if interval_ms is None:
+                self.timers.discard(handle)
+            return self.after(callback())
+        handle = self.reactor.schedule(delay_ms, fire, name or getattr(callback, "__name__", "timer"), interval_ms)
+        self.timers.add(handle)
+        return handle
+
+    def cancel(self, handle):
+        self.timers.discard(handle)
+        self.reactor.cancel(handle)
+
+    def threadsafe(self, callback):
+        return self.reactor.threadsafe(lambda *args: self.after(callback(*args)))
+
+    # a timeout asked for by one of our handlers or timers; the shared loop gets None
+    def after(self, timeout):
+        if timeout is None or not self.running:
+            return None
+        due = self.reactor.now() + timeout
+        if self.idle_timer is not None:
+            if self.idle_at <= due:
+                return None
+            self.reactor.cancel(self.idle_timer)
+        self.idle_at = due
+        self.idle_timer = self.reactor.schedule(timeout, self.runIdle, "HostedReactor.idle")
+        return None
+
+    def runIdle(self):
+        self.idle_timer = None
+        return self.after(self.idle())
+
+    def run(self, idle, timeout=None):
+        self.idle = idle
+        self.running = True
+        self.host.started(self)
+        self.after(timeout)
+
+    # our application is done: nothing of ours runs any more, and the Host may be done too
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        for handle in [self.idle_timer] + list(self.timers):
+            if handle is not None:
+                self.reactor.cancel(handle)
+        self.idle_timer = None
+        self.timers = set()
+        for sock in self.sockets:
+            self.reactor.unregister(sock)
+        self.sockets = []
+        self.host.stopped(self)
+
+class Host():
+    def __init__(self, logger, max_sockets=65536):
+        self.logger = logger
+        self.reactor = Reactor(logger) # the one loop of the process
+        self.sessions = {} # ZooKeeper hosts -> SharedSession
+        self.running = set() # HostedReactors whose application has not stopped yet
+        self.hosted = 0 # HostedReactors handed out
+        # every entity has a few sockets (and each tcp/ipc one a file descriptor or more)
+        zmq.Context.instance().set(zmq.MAX_SOCKETS, max_sockets)
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    # from now on the middleware objects made in this process are ours
+    def activate(self):
+        PinguMW.host = self
+
+    def deactivate(self):
+        if PinguMW.host is self:
+            PinguMW.host = None
+
+    # the idle policy of our loop: {HostIdlePolicy} overrides IdlePolicy in [EventLoop]
+    def setIdlePolicy(self, config):
+        policy = config.get("EventLoop", "IdlePolicy", fallback="Block")
+        policy = config.get("EventLoop", "HostIdlePolicy", fallback=policy)
+        self.reactor.setIdlePolicy(policy, config.getint("EventLoop", "SpinPolls", fallback=1000))
+
+    def reactorFor(self, logger):
+        self.hosted += 1
+        return HostedReactor(self, logger.name.rsplit(".", 1)[-1] or str(self.hosted))
+
+    def session(self, hosts, logger, timeout=10.0):
+        if hosts not in self.sessions:
+            self.sessions[hosts] = SharedSession(coordinationClient(hosts, logger, timeout))
+        return self.sessions[hosts]
+
+    def started(self, hosted):
+        self.running.add(hosted)
+
+    def stopped(self, hosted):
+        self.running.discard(hosted)
+        if not self.running:
+            self.logger.info("Host::stopped - all {} entities are done".format(self.hosted))
+            self.reactor.stop()
+
+    def stop(self):
+        self.reactor.stop()
+
+    # run the loop until every entity is done or stop(), then close the shared sessions
+    def run(self):
+        self.logger.info("Host::run - {} entities, {} running".format(self.hosted, len(self.running)))
+        try:
+            if self.running:
+                self.reactor.run(lambda: None)
+        finally:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
@@ -0,0 +1,114 @@
+"""
+Multicast dissemination (Strategy=Multicast in [Dissemination] of config.ini) over ZMQ RADIO/DISH.
+
+With Direct dissemination every subscriber gets its own copy of every message from the PUB
+socket of every publisher, so what a publisher sends grows with its subscribers. Here each topic
+maps to a UDP multicast group instead, and a publisher sends every message once, on a RADIO
+socket connected to the group of its topic; the network copies it to every subscriber on the
+segment that joined the group with its DISH socket. The RADIO/DISH group of a message is its
+topic, so a DISH also drops the topics it did not join if two of them hash to the same address.
+
+Topics map to MulticastBase plus a hash of the topic in its last 16 bits, all on MulticastPort,
+and MulticastInterface (if set) picks the interface they are sent and joined on. The discovery
+service hands the groups out: in this mode a lookup answers with the group of each topic asked
+for rather than with publisher endpoints. Publishers use the same mapping without asking, since
+config.ini is the same system wide.
+
+UDP gives no delivery guarantee. With MulticastSequence=True every message carries a sequence
+number per publisher and topic as its last field, which the subscriber strips before the
+upcall; a gap counts as lost messages, one going backwards as late (reordered or duplicated).
+
+RADIO and DISH are draft sockets: libzmq and pyzmq have to be built with the draft API, which
+available() tells. Without it publishers and subscribers fail at configure with an error saying
+so.
+"""
+
+import ipaddress
+import zlib
+import zmq
+
+class Multicast():
+    def __init__(self, logger):
+        self.logger = logger
+        self.base = ipaddress.IPv4Address("239.192.0.0") # organization local scope
+        self.port = 5600
+        self.interface = "" # e.g. eth0; empty for the default route's
+        self.sequence = True # number the messages to detect loss
+        self.radios = {} # topic -> RADIO socket connected to its group
+        self.sent = {} # topic -> sequence number of the last message we sent
+        self.expected = {} # (publisher, topic) -> next sequence number we expect
+        self.lost = 0 # messages that never came, going by the sequence numbers
+        self.late = 0 # messages that came after a later one, or twice
+        self.joined = set() # topics our DISH socket joined
+        self.bound = set() # group endpoints our DISH socket is bound to
+
+    @staticmethod
+    def available():
+        return zmq.has("draft") and hasattr(zmq, "RADIO")
+
+    # the discovery service only maps topics to groups; publishers and subscribers also require()
+    def configure(self, config):
+        self.base = ipaddress.IPv4Address(config.get("Dissemination", "MulticastBase", fallback=str(self.base)))
+        self.port = config.getint("Dissemination", "MulticastPort", fallback=self.port)
+        self.interface = config.get("Dissemination", "MulticastInterface", fallback=self.interface)
+        self.sequence = config.getboolean("Dissemination", "MulticastSequence", fallback=self.sequence)
+
+    def require(self):
+        if not self.available():
+            raise ValueError("Strategy=Multicast needs RADIO/DISH, a draft API this libzmq {} / pyzmq {} was not built with".format(zmq.zmq_version(), zmq.__version__))
+
+    # the udp endpoint of the group of a topic
+    def groupOf(self, topic):
+        addr = self.base + (zlib.crc32(topic.encode("utf-8")) & 0xffff)
+        interface = self.interface + ";" if self.interface else ""
+        return "udp://{}{}:{}".format(interface, addr, self.port)
+
+    # publisher side: one send per message, to the group of its topic. A RADIO never blocks, so
+    # its sockets come from the process wide context whichever loop the publisher runs on
+    def send(self, topic, buf):
+        radio = self.radios.get(topic)
+        if radio is None:
+            radio = zmq.Context.instance().socket(zmq.RADIO)
+            radio.connect(self.groupOf(topic))
+            self.radios[topic] = radio
+            self.logger.info("Multicast::send - {} goes to {}".format(topic, self.groupOf(topic)))
+        if self.sequence:
+            seq = self.sent.get(topic, 0) + 1
+            self.sent[topic] = seq
+            buf += b":" + str(seq).encode("utf-8")
+        radio.send(buf, group=topic)
+
+    # subscriber side: bind the DISH socket to the group of a topic and join it
+    def join(self, dish, topic, endpoint):
+        if endpoint not in self.bound:
+            dish.bind(endpoint)
+            self.bound.add(endpoint)
+        if topic not in self.joined:
+            dish.join(topic)
+            self.joined.add(topic)
+            self.logger.info("Multicast::join - {} on {}".format(topic, endpoint))
+
+    # the message as the publisher disseminated it, from what our DISH socket received, having
+    # checked and stripped its sequence number
+    def check(self, data):
+        msg = data.decode("utf-8")
+        if not self.sequence:
+            return msg
+        msg, seq = msg.rsplit(":", 1)
+        seq = int(seq)
+        topic, publisher = msg.split(":", 2)[:2]
+        expected = self.expected.get((publisher, topic))
+        if expected is not None and seq != expected:
+            if seq > expected:
+                self.lost += seq - expected
+                self.logger.warning("Multicast::check - lost {} messages of {} on {}".format(seq - expected, publisher, topic))
+            else:
+                self.late += 1
+                return msg
+        self.expected[(publisher, topic)] = seq + 1
+        return msg
+
+    def close(self):
+        for radio in self.radios.values():
+            radio.close()
+        self.radios = {}
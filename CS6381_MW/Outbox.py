@@ -0,0 +1,174 @@
+"""
+Outbox: high water marks of the data sockets, and what a sender does when a queue is full
+([Queues] in config.ini).
+
+ZMQ keeps a queue per subscriber on the PUB/XPUB socket sending to it and one on the SUB socket
+receiving, each stopping at its high water mark: SNDHWM and RCVHWM, 1000 messages unless set,
+0 for no limit. SndHwm and RcvHwm set them for every role and {Role}SndHwm / {Role}RcvHwm
+(Publisher, Broker, Subscriber) for one. A PUB socket that finds the queue of a subscriber full
+drops the message for that subscriber and tells nobody. With an OverflowPolicy we set
+XPUB_NODROP instead, so that a send that does not fit fails with EAGAIN, and the policy decides:
+
+    Drop      the message is dropped and counted; for every subscriber, since ZMQ cannot send
+              it to some of them only
+    Block     the message waits here, and so does everything sent after it, until the queues
+              have room again; we try again every RetryMs. Meanwhile the sender is congested():
+              PublisherAppln skips its rounds and the broker stops reading from its publishers,
+              which fills their queues in turn. Nothing is lost
+    Conflate  while the queues are full only the newest waiting message of every topic is kept;
+              the ones it replaced are counted as conflated
+
+ConflateTopics lists topics that are samples of a state, where only the newest value matters
+(e.g. temperature,pressure,altitude). A send of theirs that does not fit is held conflated
+whatever the policy, so that at most one message per conflated topic waits; without a policy
+the other topics are then dropped and counted. ZMQ fans a message out to all the subscribers
+of the socket, so this holds for all of them together once one is full. Subscribers conflate
+too (SubscriberMW): of what waits on their socket they deliver the newest message per topic.
+
+Without a policy or conflated topics (the default) the sockets behave as they always did.
+Either way sends never block the event loop. stats() has the counters (sent, dropped,
+conflated, retries) and the depth of our backlog (backlog, max_backlog; what ZMQ queues is not
+visible to us); they are logged every ReportMs, if set, and when the sender closes.
+"""
+
+import collections
+import zmq
+import zmq.asyncio
+
+class Outbox():
+    POLICIES = ("Drop", "Block", "Conflate")
+
+    def __init__(self, logger, name="Outbox"):
+        self.logger = logger
+        self.name = name # whose outbox, for the log
+        self.policy = None # one of POLICIES, None for plain PUB behaviour
+        self.conflate = frozenset() # topics held conflated whatever the policy
+        self.snd_hwm = None # None leaves the ZMQ default
+        self.rcv_hwm = None
+        self.retry_ms = 1
+        self.report_ms = 0
+        self.sock = None
+        self.schedule = None # the timers of our middleware object (see attach)
+        self.cancel = None
+        self.drained = None # called once a backlog is all sent
+        self.retry_timer = None
+        self.report_timer = None
+        self.backlog = collections.OrderedDict() # key -> (topic, buf); the topic is the key with Conflate
+        self.seq = 0 # keys of the backlog with Block
+        self.sent = 0
+        self.dropped = 0
+        self.conflated = 0
+        self.retries = 0 # sends tried again that still did not fit
+        self.max_backlog = 0
+
+    # {role}{key} overrides {key} in [Queues]
+    @staticmethod
+    def setting(config, role, key, fallback=None):
+        return config.get("Queues", role + key, fallback=config.get("Queues", key, fallback=fallback))
+
+    @classmethod
+    def conflatedTopics(cls, config, role):
+        return frozenset(topic.strip() for topic in cls.setting(config, role, "ConflateTopics", "").split(",") if topic.strip())
+
+    @classmethod
+    def hwms(cls, config, role):
+        snd = cls.setting(config, role, "SndHwm")
+        rcv = cls.setting(config, role, "RcvHwm")
+        return (int(snd) if snd is not None else None, int(rcv) if rcv is not None else None)
+
+    # before the socket binds or connects; HWMs only apply to the pipes made after them
+    @staticmethod
+    def setHwm(sock, snd=None, rcv=None):
+        if snd is not None:
+            sock.setsockopt(zmq.SNDHWM, snd)
+        if rcv is not None:
+            sock.setsockopt(zmq.RCVHWM, rcv)
+
+    def configure(self, config, role):
+        self.snd_hwm, self.rcv_hwm = self.hwms(config, role)
+        self.policy = self.setting(config, role, "OverflowPolicy") or None
+        if self.policy is not None and self.policy not in self.POLICIES:
+            raise ValueError("Unknown OverflowPolicy {}, should be one of {}".format(self.policy, ", ".join(self.POLICIES)))
+        self.conflate = self.conflatedTopics(config, role)
+        self.retry_ms = int(self.setting(config, role, "RetryMs", 1))
+        self.report_ms = int(self.setting(config, role, "ReportMs", 0))
+
+    # sock is the PUB/XPUB socket we send on; schedule and cancel those of the middleware object
+    def attach(self, sock, schedule, cancel, drained=None):
+        self.setHwm(sock, snd=self.snd_hwm)
+        if self.policy is not None or self.conflate:
+            sock.setsockopt(zmq.XPUB_NODROP, 1)
+        # an asyncio socket answers a non-blocking send with a future; we want the EAGAIN
+        self.sock = zmq.Socket.shadow(sock.underlying) if isinstance(sock, zmq.asyncio.Socket) else sock
+        self.schedule = schedule
+        self.cancel = cancel
+        self.drained = drained
+        if self.report_ms:
+            self.report_timer = schedule(self.report_ms, self.report, self.name + ".report", self.report_ms)
+
+    # True if the message went out now
+    def send(self, topic, buf):
+        holds = self.policy in ("Block", "Conflate") or topic in self.conflate
+        if holds and self.backlog:
+            self.hold(topic, buf) # behind what already waits
+            return False
+        try:
+            self.sock.send(buf, zmq.NOBLOCK)
+            self.sent += 1
+            return True
+        except zmq.Again:
+            if holds:
+                self.hold(topic, buf)
+            else:
+                self.dropped += 1
+            return False
+
+    def hold(self, topic, buf):
+        if self.policy == "Conflate" or topic in self.conflate:
+            if topic in self.backlog:
+                self.conflated += 1
+            self.backlog[topic] = (topic, buf)
+        else:
+            self.seq += 1
+            self.backlog[self.seq] = (topic, buf)
+        self.max_backlog = max(self.max_backlog, len(self.backlog))
+        if self.retry_timer is None:
+            self.retry_timer = self.schedule(self.retry_ms, self.retry, self.name + ".retry", self.retry_ms)
+
+    # timer: send what waits, oldest first, for as long as it fits
+    def retry(self):
+        while self.backlog:
+            key = next(iter(self.backlog))
+            try:
+                self.sock.send(self.backlog[key][1], zmq.NOBLOCK)
+            except zmq.Again:
+                self.retries += 1
+                return None
+            del self.backlog[key]
+            self.sent += 1
+        self.cancel(self.retry_timer)
+        self.retry_timer = None
+        return self.drained() if self.drained is not None else None
+
+    # with Block the sender should hold back while anything waits
+    def congested(self):
+        return self.policy == "Block" and bool(self.backlog)
+
+    def stats(self):
+        return {"policy": self.policy, "sent": self.sent, "dropped": self.dropped, "conflated": self.conflated,
+                "retries": self.retries, "backlog": len(self.backlog), "max_backlog": self.max_backlog}
+
+    def report(self):
+        self.logger.info("{}::report - {}".format(self.name, self.stats()))
+        return None
+
+    # what still waits is lost, and counted as dropped
+    def close(self):
+        for timer in (self.retry_timer, self.report_timer):
+            if timer is not None:
+                self.cancel(timer)
+        self.retry_timer = self.report_timer = None
+        self.dropped += len(self.backlog)
+        self.backlog.clear()
+        if self.sock is not None:
+            self.report()
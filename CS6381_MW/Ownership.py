@@ -0,0 +1,111 @@
+"""
+Ownership keeps track of which publisher owns each topic when Ownership=Exclusive (config.ini).
+
+Publishers put an ownership strength per topic in their znodes (PublisherMW.register). Of all
+the live publishers of a topic the strongest one owns it, ties going to the smallest name so
+that every subscriber and broker picks the same one. Only the owner's stream is delivered:
+the subscriber (or broker) connects to the owners only, and drops what it gets from a publisher
+for a topic that publisher does not own, since a SUB socket cannot filter per connection.
+
+Ownership changes as the publisher znodes come and go, which the middleware feeds to apply()
+as ZkEvents, either from the /topics/{topic}/pub groups (subscribers) or from /publisher
+(brokers). When the owner of a topic goes away its ephemeral znodes are deleted, the next
+strongest publisher takes over and we connect to it; no request to the discovery service is
+involved.
+
+Every switchover is timed when the first message of the new owner is accepted:
+
+    gap_ms        since the last message of the old owner; what the application saw
+    detect_ms     of that, until we learnt that ownership changed (the old owner's session
+                  timeout, when it died)
+    switchover_ms of that, from learning about the change to hearing from the new owner
+"""
+
+import threading
+import time
+from CS6381_MW.Transport import Transport
+
+class Ownership():
+    def __init__(self, logger, transport=None):
+        self.logger = logger
+        self.transport = transport or Transport(logger) # picks the endpoint of each publisher
+        self.lock = threading.Lock() # watches update us while the receiving thread asks
+        self.candidates = {} # topic -> {publisher name: strength}
+        self.endpoints = {} # publisher name -> endpoint we connect to, see Transport.choose
+        self.owners = {} # topic -> name of the publisher that owns it
+        self.last_heard = {} # topic -> monotonic time of the last message we accepted
+        self.pending = {} # topic -> (monotonic time ownership changed, previous owner)
+        self.switchovers = [] # one dict per completed switchover
+        self.rejected = 0 # messages dropped since their publisher did not own the topic
+
+    @staticmethod
+    def strengthOf(info, topic):
+        strength = info.get("strength", 0)
+        if isinstance(strength, dict):
+            return strength.get(topic, 0)
+        return strength
+
+    # the topics a publisher znode speaks for: the one of its topic group, or all of them
+    @staticmethod
+    def topicsOf(path, info):
+        parts = path.split("/")
+        if len(parts) == 5 and parts[1] == "topics":
+            return [parts[2]]
+        return info.get("topiclist", [])
+
+    def apply(self, events):
+        with self.lock:
+            touched = set()
+            for event in events:
+                if event.old is not None:
+                    for topic in self.topicsOf(event.path, event.old):
+                        self.candidates.get(topic, {}).pop(event.name, None)
+                        touched.add(topic)
+                if event.data is not None:
+                    self.endpoints[event.name] = self.transport.choose(event.data["id"])
+                    for topic in self.topicsOf(event.path, event.data):
+                        self.candidates.setdefault(topic, {})[event.name] = self.strengthOf(event.data, topic)
+                        touched.add(topic)
+            for topic in touched:
+                self.elect(topic)
+
+    def elect(self, topic):
+        candidates = self.candidates.get(topic, {})
+        owner = min(candidates, key=lambda name: (-candidates[name], name)) if candidates else None
+        previous = self.owners.get(topic)
+        if owner == previous:
+            return
+        self.logger.info("Ownership::elect - {} now owned by {} (was {})".format(topic, owner, previous))
+        if owner is None:
+            del self.owners[topic]
+        else:
+            self.owners[topic] = owner
+        if previous is not None and topic not in self.pending:
+            self.pending[topic] = (time.monotonic(), previous)
+
+    # endpoint -> number of topics its publisher owns; what we should be connected to
+    def wanted(self):
+        with self.lock:
+            wanted = {}
+            for owner in self.owners.values():
+                endpoint = self.endpoints[owner]
+                wanted[endpoint] = wanted.get(endpoint, 0) + 1
+            return wanted
+
+    def accepts(self, topic, pub_id):
+        with self.lock:
+            if self.owners.get(topic) != pub_id:
+                self.rejected += 1
+                return False
+            now = time.monotonic()
+            if topic in self.pending:
+                changed_at, previous = self.pending.pop(topic)
+                last = self.last_heard.get(topic, changed_at)
+                switchover = {"topic": topic, "from": previous, "to": pub_id,
+                              "gap_ms": round((now - last) * 1000, 1),
+                              "detect_ms": round((changed_at - last) * 1000, 1),
+                              "switchover_ms": round((now - changed_at) * 1000, 1)}
+                self.switchovers.append(switchover)
+                self.logger.info("Ownership::accepts - switchover {}".format(switchover))
+            self.last_heard[topic] = now
+            return True
@@ -2,14 +2,12 @@ import zmq  # ZMQ sockets
 from CS6381_MW import discovery_pb2
 from CS6381_MW import topic_pb2
 from CS6381_MW.Common import PinguMW
+from CS6381_MW.Multicast import Multicast
+from CS6381_MW.Outbox import Outbox
+from CS6381_MW.Feedback import FeedbackServer
 from functools import wraps
-from kazoo.client import KazooClient
-from kazoo.exceptions import NodeExistsError, NoNodeError
-from kazoo.recipe.election import Election
-from kazoo.recipe.watchers import DataWatch
+import configparser
 import json
-import timeit
-import time
 
 class PublisherMW(PinguMW):
   def handle_exception(func):
@@ -28,37 +26,50 @@ class PublisherMW(PinguMW):
     self.zk = None 
     self.disc = None 
     self.name = None 
+    self.ring = None # ShmRingWriter we also write every message to, with shm in Transports
+    self.multicast = None # sends to the group of each topic instead of PUB, with Strategy=Multicast
+    self.outbox = None # what a send does when the queue of a subscriber is full (see Outbox)
+    self.feedback = None # numbers our messages and hears from our subscribers, with [Feedback] (see Feedback)
 
   @handle_exception
   def configure(self, args):
     self.logger.info("PublisherMW::configure")
     self.port = args.port
     self.addr = args.addr
-    context = zmq.Context()  # returns a singleton object
-    self.poller = zmq.Poller()
-    self.zk = KazooClient(hosts=args.zookeeper)
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    self.lookup = config["Discovery"]["Strategy"]
+    self.setIdlePolicy(config, "Publisher")
+    self.transport.configure(config)
+    if config["Dissemination"]["Strategy"] == "Multicast":
+      self.multicast = Multicast(self.logger)
+      self.multicast.configure(config)
+      self.multicast.require()
+    self.startup_timeout = config.getfloat("Discovery", "StartupTimeoutS", fallback=0) or None
+    self.lease_ms = config.getint("Discovery", "LeaseMs", fallback=0)
+    self.outbox = Outbox(self.logger, "PublisherMW")
+    self.outbox.configure(config, "Publisher")
+    self.dht_json = args.dht_json
+    context = self.context
+    self.zk = self.session(args.zookeeper)
     self.req = context.socket(zmq.REQ)
     self.pub = context.socket(zmq.PUB)
-    self.poller.register(self.req, zmq.POLLIN)
+    self.outbox.attach(self.pub, self.schedule, self.cancel)
+    self.reactor.register(self.req, self.handle_reply, "PublisherMW.req")
     self.setRequest()
-    connect_str = "tcp://" + args.discovery
-    self.req.connect(connect_str)
-    bind_string = "tcp://*:" + str(self.port)
-    self.pub.bind (bind_string)
-    
-    @self.zk.DataWatch("/leader")
-    def watchLeader(data, stat):
-      meta = json.loads(self.zk.get("/leader")[0].decode('utf-8'))
-      self.logger.info("PublisherMW::watch_leader: disconnecting req and redirecting to new leader")
-      if self.disc != None:
-        self.req.disconnect(self.disc)
-      self.req.connect(meta["repAddress"])
-      self.disc = meta["repAddress"]
-      self.logger.info("Successfully connected to the new leader")  
+    self.locality = self.transport.bind(self.pub, args.name, self.addr, self.port)
+    group = getattr(args, "group", None) # -g of PublisherAppln; other callers may leave it out
+    if group:
+      self.locality["group"] = group # the workers of a group register one by one, under their own names
+    self.ring = self.transport.ring
+    if FeedbackServer.isEnabled(config) and self.multicast is None and self.feedback_capable:
+      self.feedback = FeedbackServer(self.logger, args.name)
+      self.feedback.configure(config)
+      self.feedback.attach(self, self.locality["endpoints"])
     self.logger.info("PublisherMW::configure completed")
 
   def event_loop(self, timeout=None):
-   super().event_loop("PublisherMW", self.req, timeout)
+   super().event_loop("PublisherMW", timeout)
             
   @handle_exception
   def handle_reply(self):
@@ -67,9 +78,17 @@ class PublisherMW(PinguMW):
     discovery_response = discovery_pb2.DiscoveryResp()
     discovery_response.ParseFromString(bytesRcvd)
     if discovery_response.msg_type == discovery_pb2.TYPE_REGISTER:
+      if self.registerAgain("PublisherMW", [discovery_response.register_resp]):
+        return None
+      self.keepAlive([discovery_response.register_resp])
       timeout = self.upcall_obj.register_response(discovery_response.register_resp)
     elif discovery_response.msg_type == discovery_pb2.TYPE_ISREADY:
       timeout = self.upcall_obj.isready_response(discovery_response.isready_resp)
+    elif discovery_response.msg_type == discovery_pb2.TYPE_REGISTER_BATCH:
+      if self.registerAgain("PublisherMW", discovery_response.register_batch_resp.results):
+        return None
+      self.keepAlive(discovery_response.register_batch_resp.results)
+      timeout = self.upcall_obj.register_batch_response(discovery_response.register_batch_resp)
     else:
       raise ValueError("Unrecognized response message")
     return timeout
@@ -77,12 +96,25 @@ class PublisherMW(PinguMW):
 
   def is_ready(self):
     super().is_ready("PublisherMW")
+
+  def register_batch(self, registrants):
+    super().register_batch("PublisherMW", registrants)
     
   @handle_exception
   def disseminate (self, id, topic, data, current_time):
     send_str = topic + ":" + id + ":" + data + ":" + current_time
+    if self.feedback is not None:
+      send_str = self.feedback.stamp(topic, id, send_str) # numbered, and kept if topic is reliable
     self.logger.info("PublisherMW::disseminate - {}".format (send_str))
-    self.pub.send(bytes(send_str, "utf-8"))
+    buf = bytes(send_str, "utf-8")
+    if self.multicast is not None:
+      self.multicast.send(topic, buf) # one send for all the subscribers of the topic
+    elif self.outbox is not None:
+      self.outbox.send(topic, buf) # full queues are dealt with per OverflowPolicy
+    else:
+      self.pub.send(buf)
+    if self.ring is not None:
+      self.ring.write(buf) # for the subscribers on our host that read it (see ShmRing)
             
   # here we save a pointer (handle) to the application object
   def set_upcall_handle(self, upcall_obj):
@@ -90,6 +122,26 @@ class PublisherMW(PinguMW):
         
   def disable_event_loop(self):
     super().disable_event_loop()
+
+  # with OverflowPolicy=Block: a send is waiting for room, so hold back; with Credits in
+  # [Feedback]: our slowest subscriber has no credit left
+  def congested(self):
+    return (self.outbox is not None and self.outbox.congested()) or (self.feedback is not None and self.feedback.congested())
+
+  # once we are done disseminating: close our RADIO sockets and remove our shm ring, if any,
+  # and report what our outbox dropped and how far behind our subscribers were
+  def close(self):
+    if self.feedback is not None:
+      self.feedback.close()
+      self.feedback = None
+    if self.outbox is not None:
+      self.outbox.close()
+      self.outbox = None
+    if self.multicast is not None:
+      self.multicast.close()
+    if self.ring is not None:
+      self.ring.close()
+      self.ring = None
     
   # New code for PA3
   """
@@ -97,34 +149,48 @@ class PublisherMW(PinguMW):
   /publisher/{name} path in Zookeeper, where name is the name of the publisher. 
   The method takes two arguments: name and topiclist. 
   The name is the name of the publisher, and topiclist is the list of topics the publisher
-  is interested in. The register() method creates a dictionary with two keys: id and topiclist, 
+  is interested in. The register() method creates a dictionary with keys id, topiclist and strength, 
   where id is a dictionary with id, addr and port keys. The id key contains the name of the 
   publisher, addr contains the IP address, and port contains the port number of the publisher. 
   The topiclist key contains the list of topics the publisher is interested in. 
+  The strength key holds our ownership strength, either one number for all our topics or a
+  number per topic; with Ownership=Exclusive only the strongest live publisher of a topic is
+  delivered (see Ownership).
+  The id also carries our locality (see Transport): every endpoint we are bound to, tcp, ipc
+  and inproc, and where we run, so that readers on our host or in our process can pick ipc or
+  inproc; the same goes to the discovery service in our RegistrantInfo.
   The dictionary is then converted to a JSON string and stored as the value of the ephemeral node. 
+  The same value is stored under /topics/{topic}/pub/{name} for each of our topics, in the same
+  transaction (see PinguMW.announce), so that subscribers can watch just the topics they want.
   Finally, the method logs a message indicating that the register message has been sent.
 
-  The setRequest() method connects the publisher to the leader broker. It first starts the 
-  Zookeeper client and waits until a leader is elected. Once a leader is elected, the method 
-  gets the metadata of the leader from the /leader node in Zookeeper and connects to the 
-  leader's repAddress using a ZeroMQ socket. Finally, the method logs a message indicating that 
-  the publisher is successfully connected to the leader.
+  After creating the znode the registration is also sent to the discovery service, which is what
+  gets us the register_response the application's state machine is waiting for.
+
+  The setRequest() method connects the publisher to the discovery service. It first starts the 
+  Zookeeper client and waits until a leader is elected. Once a leader is elected, the REQ socket
+  is connected to every discovery replica under /discovery (see PinguMW.watchDiscovery); the
+  replicas forward our registration to the leader. With Strategy=DHT we instead enter the Chord
+  ring through a random node from dht.json.
   """
   @handle_exception
-  def register(self, name, topiclist):
+  def register(self, name, topiclist, strength=0):
     self.logger.info("PublisherMW::register - register publisher to ZK")
     data = {}
-    data["id"] = {"id": name, "addr": self.addr, "port": self.port} 
+    data["id"] = dict({"id": name, "addr": self.addr, "port": self.port}, **self.locality)
     data["topiclist"] = topiclist
+    data["strength"] = strength
     data_json = json.dumps(data)
-    self.zk.create("/publisher/" + self.name, value=data_json.encode("utf-8"), ephemeral=True, makepath=True)
-    self.logger.info ("PublisherMW::register - sent register message and now now wait for reply")
+    self.name = name
+    self.announce("PublisherMW", self.name, data_json.encode("utf-8"), topiclist, "pub", "/publisher")
+    super().register("PublisherMW", name, topiclist)
   
   @handle_exception
   def setRequest(self):
     self.zk.start()
-    while self.zk.exists("/leader") == None:
-      time.sleep(1)
-    metadata = json.loads(self.zk.get("/leader")[0].decode('utf-8'))
-    self.req.connect(metadata["repAddress"])
-    self.logger.debug("Successfully connected to the leader")
\ No newline at end of file
+    if self.lookup == "DHT":
+      self.connectDHT("PublisherMW", self.dht_json)
+      return
+    self.waitForZnode("PublisherMW", "/leader", self.startup_timeout)
+    self.watchDiscovery("PublisherMW")
+    self.logger.debug("Successfully connected to the discovery replicas")
\ No newline at end of file
@@ -0,0 +1,219 @@
+"""
+Shared memory ring buffer for same host dissemination: the shm transport (see Transport).
+
+A publisher with shm in its Transports also writes every message it disseminates into a ring in
+a multiprocessing.shared_memory segment, and subscribers on its host read the ring instead of a
+socket: no copy through the kernel and no system call per message. There is one producer (the
+publisher) and any number of readers, each reading every message at its own pace, as with
+PUB/SUB. The segment holds:
+
+    header   geometry, the head (sequence of the last message written), the wake endpoint and,
+             per reader slot, the pid of the reader and its parked word
+    slots    slots x slot_bytes, a slot being [seq u64][length u32][pad u32][payload]
+
+Message n (counting from 1) goes to slot n % slots. The producer clears the seq of the slot,
+writes the payload and the length, then the seq and last the head. A reader copies the payload
+out between two reads of the seq and keeps the copy only if both are n: a seqlock per slot, so
+the data path takes no lock and the sequences are all that is shared. A reader lapped by the
+producer (more than slots messages behind) loses the oldest messages the way a SUB socket over
+its high water mark does; it counts them and skips ahead.
+
+A reader that runs out of messages parks: it writes a fresh number into its parked word and
+looks at the head once more before its event loop sleeps on a SUB socket connected to the wake
+endpoint of the ring (an ipc PUB socket of the producer). After a write the producer sends one
+wake for every parking it has not answered yet, so a reader that keeps up costs it a comparison
+of the parked words and nothing more. Readers that spin (IdlePolicy=Spin or BusyPoll) see new
+messages before any wake arrives. Stores are seen in program order on x86; SubscriberMW still
+rechecks its rings on a timer in case a parking and a write ever cross unseen.
+
+Reader slots are claimed under flock on the segment, the only lock there is; the slot of a
+reader whose pid is gone is taken over.
+"""
+
+import fcntl
+import os
+import struct
+import time
+import zmq
+from multiprocessing import resource_tracker, shared_memory
+
+class ShmRing():
+    MAGIC = b"CSR1"
+    READERS = 32 # reader slots of a ring
+    GEOMETRY = struct.Struct("<4sII") # magic, slots, slot_bytes
+    U32 = struct.Struct("<I")
+    U64 = struct.Struct("<Q")
+    PARKED_WORDS = struct.Struct("<{}Q".format(READERS))
+    SLOT_HEADER = 16 # seq u64, length u32, pad u32
+    # offsets in the header; the head has a cache line of its own
+    HEAD = 64
+    WAKE = 128
+    PIDS = 256
+    PARKED = 384
+    PARKED_END = PARKED + PARKED_WORDS.size
+    HEADER = 1024
+
+    def __init__(self, name, shm):
+        self.name = name
+        self.shm = shm
+        self.buf = shm.buf
+        magic, self.slots, self.slot_bytes = self.GEOMETRY.unpack_from(self.buf, 0)
+        if magic != self.MAGIC:
+            raise ValueError("{} is not a ring".format(name))
+        self.mask = self.slots - 1
+        self.capacity = self.slot_bytes - self.SLOT_HEADER # largest message
+
+    def head(self):
+        return self.U64.unpack_from(self.buf, self.HEAD)[0]
+
+    def wakeEndpoint(self):
+        return bytes(self.buf[self.WAKE:self.PIDS]).rstrip(b"\0").decode("utf-8")
+
+class ShmRingWriter(ShmRing):
+    written = set() # names of the rings of this process
+
+    def __init__(self, context, name, wake_endpoint, slots=65536, slot_bytes=256):
+        slots = 1 << max(0, slots - 1).bit_length() # a power of two, for the mask
+        size = self.HEADER + slots * slot_bytes
+        try:
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError: # left behind by a publisher of ours that crashed
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+        shm.buf[self.HEADER:] = bytes(size - self.HEADER) # fault the pages in now rather than on the first lap
+        encoded = wake_endpoint.encode("utf-8")
+        if len(encoded) >= self.PIDS - self.WAKE:
+            raise ValueError("wake endpoint too long: {}".format(wake_endpoint))
+        shm.buf[self.WAKE:self.WAKE + len(encoded)] = encoded
+        self.GEOMETRY.pack_into(shm.buf, 0, self.MAGIC, slots, slot_bytes)
+        super().__init__(name, shm)
+        self.written.add(name)
+        self.seq = 0 # last message written
+        self.wake = context.socket(zmq.PUB)
+        self.wake.bind(wake_endpoint)
+        self.parked = bytes(self.PARKED_WORDS.size) # the parked words as of our last look
+        self.woken = [0] * self.READERS # parking of every reader we last sent a wake for
+        self.wakes = 0
+
+    def write(self, data):
+        length = len(data)
+        if length > self.capacity:
+            raise ValueError("a message of {} bytes does not fit the slots of ring {} ({} bytes at most)".format(length, self.name, self.capacity))
+        seq = self.seq + 1
+        offset = self.HEADER + (seq & self.mask) * self.slot_bytes
+        buf = self.buf
+        pack_u64 = self.U64.pack_into
+        pack_u64(buf, offset, 0)
+        start = offset + self.SLOT_HEADER
+        buf[start:start + length] = data
+        self.U32.pack_into(buf, offset + 8, length)
+        pack_u64(buf, offset, seq)
+        pack_u64(buf, self.HEAD, seq)
+        self.seq = seq
+        if bytes(buf[self.PARKED:self.PARKED_END]) != self.parked:
+            self.wakeParked()
+
+    # one wake on the PUB socket reaches every reader; send it if any of them parked anew
+    def wakeParked(self):
+        self.parked = bytes(self.buf[self.PARKED:self.PARKED_END])
+        wake = False
+        for reader, parking in enumerate(self.PARKED_WORDS.unpack(self.parked)):
+            if parking and parking != self.woken[reader]:
+                self.woken[reader] = parking
+                wake = True
+        if wake:
+            self.wake.send(b"", zmq.NOBLOCK)
+            self.wakes += 1
+
+    def close(self):
+        self.wake.close(linger=100) # a last wake; readers also recheck on a timer
+        self.buf = None
+        self.shm.close()
+        self.shm.unlink()
+        self.written.discard(self.name)
+
+class ShmRingReader(ShmRing):
+    def __init__(self, name):
+        try:
+            shm = shared_memory.SharedMemory(name, track=False)
+        except TypeError: # before python 3.13: our exit must not unlink the producer's segment
+            shm = shared_memory.SharedMemory(name)
+            if name not in ShmRingWriter.written: # unless it is ours, and the tracker has it once
+                resource_tracker.unregister(shm._name, "shared_memory")
+        super().__init__(name, shm)
+        self.reader = self.claim()
+        self.parked_at = self.PARKED + 8 * self.reader
+        self.cursor = self.head() # like a SUB socket that just connected, we get what comes next
+        self.known = self.cursor # the head as of our last look
+        self.parkings = time.monotonic_ns() # parked words never repeat those of an earlier reader of our slot
+        self.parked = False
+        self.lost = 0 # messages the producer overwrote before we read them
+
+    @staticmethod
+    def alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def claim(self):
+        fcntl.flock(self.shm._fd, fcntl.LOCK_EX)
+        try:
+            for reader in range(self.READERS):
+                pid = self.U32.unpack_from(self.buf, self.PIDS + 4 * reader)[0]
+                if pid == 0 or not self.alive(pid):
+                    self.U64.pack_into(self.buf, self.PARKED + 8 * reader, 0)
+                    self.U32.pack_into(self.buf, self.PIDS + 4 * reader, os.getpid())
+                    return reader
+            raise ValueError("all {} reader slots of ring {} are taken".format(self.READERS, self.name))
+        finally:
+            fcntl.flock(self.shm._fd, fcntl.LOCK_UN)
+
+    # the next message, None if we have read everything written so far
+    def read(self):
+        buf = self.buf
+        while True:
+            seq = self.cursor + 1
+            if seq > self.known:
+                self.known = self.head()
+                if seq > self.known:
+                    return None
+            if self.parked:
+                self.U64.pack_into(buf, self.parked_at, 0)
+                self.parked = False
+            if self.known - self.cursor <= self.slots:
+                offset = self.HEADER + (seq & self.mask) * self.slot_bytes
+                if self.U64.unpack_from(buf, offset)[0] == seq:
+                    length = self.U32.unpack_from(buf, offset + 8)[0]
+                    start = offset + self.SLOT_HEADER
+                    data = bytes(buf[start:start + length])
+                    if self.U64.unpack_from(buf, offset)[0] == seq:
+                        self.cursor = seq
+                        return data
+                self.known = self.head() # overwritten while we were at it
+            # lapped: skip to half a ring behind the producer
+            skip_to = max(self.cursor, self.known - self.slots // 2)
+            self.lost += skip_to - self.cursor
+            self.cursor = skip_to
+
+    def pending(self):
+        return self.cursor < self.known or self.head() > self.cursor
+
+    # tell the producer we are about to sleep; True if a message came in meanwhile
+    def park(self):
+        if not self.parked:
+            self.parkings += 1
+            self.U64.pack_into(self.buf, self.parked_at, self.parkings)
+            self.parked = True
+        return self.pending()
+
+    def close(self):
+        self.U64.pack_into(self.buf, self.parked_at, 0)
+        self.U32.pack_into(self.buf, self.PIDS + 4 * self.reader, 0)
+        self.buf = None
+        self.shm.close()
@@ -3,17 +3,24 @@ from CS6381_MW import discovery_pb2
 from CS6381_MW import topic_pb2
 from CS6381_MW.Common import PinguMW
 from functools import wraps
-from kazoo.client import KazooClient
-from kazoo.exceptions import NodeExistsError, NoNodeError
-from kazoo.recipe.election import Election
-from kazoo.recipe.watchers import DataWatch
-import time
+import configparser
 import json
 import timeit 
-import signal 
+import collections
 import csv 
+from CS6381_MW.ZkCache import ZkCache
+from CS6381_MW.Ownership import Ownership
+from CS6381_MW.Transport import Transport
+from CS6381_MW.ShmRing import ShmRingReader
+from CS6381_MW.Multicast import Multicast
+from CS6381_MW.Outbox import Outbox
+from CS6381_MW.Feedback import FeedbackClient
 
 class SubscriberMW(PinguMW):
+  reads_rings = True # we read the shm rings of the publishers on our host (see ShmRing)
+  RING_RECHECK_MS = 100 # look at our rings this often even without a wake
+  CONFLATE_BATCH = 1024 # most messages read at once to conflate them
+
   def handle_exception(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
@@ -30,27 +37,68 @@ class SubscriberMW(PinguMW):
     self.zk = None # for zookeeper client
     self.disc= None
     self.lookupMethod = None
+    self.dissemination = None # Direct or Broker, from config.ini
+    self.topiclist = None # the topics we registered for
+    self.membership = None # Coalescer of the publisher events, for its counters
+    self.connected = set() # publisher (or broker) endpoints our SUB socket is connected to
+    self.endpoint_refs = {} # endpoint -> number of watched znodes pointing at it
+    self.subscribed = set() # topics set on our SUB socket
+    self.ownership = None # who owns each of our topics, with Ownership=Exclusive
+    self.rings = {} # shm endpoint -> ShmRingReader, for the publishers we read over shm
+    self.ring_list = [] # the same readers, in the order we take turns over
+    self.next_ring = 0
+    self.wake = None # SUB socket for the wakes of our rings, made with the first one
+    self.prefixes = () # our subscribed topics, to filter what we read from rings
+    self.multicast = None # with Strategy=Multicast, the groups we joined and what we lost
+    self.dish = None # DISH socket joined to the groups of our topics, with Strategy=Multicast
+    self.conflate = frozenset() # topics of which we deliver the newest waiting message only
+    self.conflated = 0 # messages of those we skipped for a newer one
+    self.conflate_topics = frozenset() # the ConflateTopics of config.ini, to go back to
+    self.feedback = None # acks what we delivered to our senders, with [Feedback] (see Feedback)
+    self.degraded = set() # endpoints of the senders that told us to degrade (conflate everything)
+    self.benched = set() # endpoints of the senders that told us to disconnect, until we rejoin
 
   @handle_exception
   def configure(self, args):
     self.logger.info("SubscriberMW::configure")
     self.port = args.port
     self.addr = args.addr
-    context = zmq.Context()  # returns a singleton object
-    self.poller = zmq.Poller()
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    self.lookup = config["Discovery"]["Strategy"]
+    self.setIdlePolicy(config, "Subscriber")
+    self.transport.configure(config, shm=self.reads_rings)
+    self.dissemination = config["Dissemination"]["Strategy"]
+    self.startup_timeout = config.getfloat("Discovery", "StartupTimeoutS", fallback=0) or None
+    self.membership_window = config.getint("Discovery", "MembershipWindowMs", fallback=100)
+    self.lease_ms = config.getint("Discovery", "LeaseMs", fallback=0)
+    if self.lookup != "DHT" and self.dissemination == "Direct" and config.get("Dissemination", "Ownership", fallback="Shared") == "Exclusive":
+      self.ownership = Ownership(self.logger, self.transport) # the watch on our topic groups picks the owners
+    self.dht_json = args.dht_json
+    context = self.context
     self.req = context.socket(zmq.REQ)
     self.sub = context.socket(zmq.SUB)
-    self.poller.register(self.req, zmq.POLLIN)
-    self.poller.register(self.sub, zmq.POLLIN)
-    connect_str = "tcp://" + args.discovery
-    self.req.connect(connect_str)
-    self.zk = KazooClient(hosts=args.zookeeper)
+    Outbox.setHwm(self.sub, rcv=Outbox.hwms(config, "Subscriber")[1])
+    self.conflate = self.conflate_topics = Outbox.conflatedTopics(config, "Subscriber")
+    if FeedbackClient.isEnabled(config) and self.feedback_capable and self.dissemination != "Multicast":
+      self.feedback = FeedbackClient(self.logger, args.name)
+      self.feedback.configure(config)
+      self.feedback.start(self)
+    self.reactor.register(self.req, self.handle_reply, "SubscriberMW.req")
+    self.reactor.register(self.sub, self.handle_data, "SubscriberMW.sub")
+    if self.dissemination == "Multicast":
+      self.multicast = Multicast(self.logger)
+      self.multicast.configure(config)
+      self.multicast.require()
+      self.dish = context.socket(zmq.DISH)
+      self.reactor.register(self.dish, self.handle_group, "SubscriberMW.dish")
+    self.zk = self.session(args.zookeeper)
     self.zk.start()
     self.setRequest()
     self.logger.info("SubscriberMW::configure completed")
 
   def event_loop(self, timeout=None):
-    super().event_loop("SubscriberMW", self.req, timeout)
+    super().event_loop("SubscriberMW", timeout)
 
   @handle_exception
   def handle_reply(self):
@@ -59,47 +107,165 @@ class SubscriberMW(PinguMW):
     discovery_response = discovery_pb2.DiscoveryResp()
     discovery_response.ParseFromString(bytesRcvd)
     if discovery_response.msg_type == discovery_pb2.TYPE_REGISTER:
+      if self.registerAgain("SubscriberMW", [discovery_response.register_resp]):
+        return None
+      self.keepAlive([discovery_response.register_resp])
       timeout = self.upcall_obj.register_response(discovery_response.register_resp)
     elif discovery_response.msg_type == discovery_pb2.TYPE_ISREADY:
       timeout = self.upcall_obj.isready_response(discovery_response.isready_resp)
+    elif discovery_response.msg_type == discovery_pb2.TYPE_REGISTER_BATCH:
+      if self.registerAgain("SubscriberMW", discovery_response.register_batch_resp.results):
+        return None
+      self.keepAlive(discovery_response.register_batch_resp.results)
+      timeout = self.upcall_obj.register_batch_response(discovery_response.register_batch_resp)
+    elif discovery_response.msg_type == discovery_pb2.TYPE_LOOKUP_BATCH:
+      for lookup_response in discovery_response.lookup_batch_resp.results:
+        self.joinGroups(lookup_response.groups)
+      timeout = self.upcall_obj.lookup_batch_response(discovery_response.lookup_batch_resp)
     elif discovery_response.msg_type == discovery_pb2.TYPE_LOOKUP_PUB_BY_TOPIC:
+      self.joinGroups(discovery_response.lookup_resp.groups)
       timeout = self.upcall_obj.receiveSubscribedPublishersResponse(discovery_response.lookup_resp)
     else: 
       raise ValueError ("Unrecognized response message")
     return timeout
             
   def register (self, name, topiclist):
+    self.topiclist = topiclist
+    data = {"id": {"id": name, "addr": self.addr, "port": self.port}, "topiclist": topiclist}
+    self.announce("SubscriberMW", name, json.dumps(data).encode("utf-8"), topiclist, "sub")
     super().register("SubscriberMW", name, topiclist)
 
   def is_ready(self):
     super().is_ready("SubscriberMW")
 
+  def register_batch(self, registrants):
+    super().register_batch("SubscriberMW", registrants)
+
+  def lookup_batch(self, topiclists):
+    super().lookup_batch("SubscriberMW", topiclists)
+
   @handle_exception
   def receiveSubscribedPublishers(self, topiclist):
     self.logger.info("SubscriberMW::receiveSubscribedPublishers - start")
+    self.req.send(self.lookupReq(topiclist)) 
+    self.logger.info("SubscriberMW::receiveSubscribedPublishers - end")
+
+  def lookupReq(self, topiclist):
     lookup_request = discovery_pb2.LookupPubByTopicReq()
     lookup_request.topiclist[:] = topiclist
     discovery_request = discovery_pb2.DiscoveryReq()
     discovery_request.msg_type = discovery_pb2.TYPE_LOOKUP_PUB_BY_TOPIC
     discovery_request.lookup_req.CopyFrom(lookup_request)
-    buf2send = discovery_request.SerializeToString()
-    self.req.send(buf2send) 
-    self.logger.info("SubscriberMW::receiveSubscribedPublishers - end")
+    return discovery_request.SerializeToString()
   
   @handle_exception
   def makeSubscription(self, pub, topiclist):
     self.logger.info("SubscriberMW::makeSubscription - start")
-    self.connect2pubs(pub.addr, pub.port)
+    if self.ownership is None: # otherwise we only connect to the owners, see setWatch
+      self.connect(self.transport.choose(Transport.endpointOf(pub)))
+    self.subscribeTopics(topiclist)
+
+  def subscribeTopics(self, topiclist):
     for topic in topiclist:
-      self.sub.setsockopt_string(zmq.SUBSCRIBE, topic)
-      self.logger.info("SubscriberMW::makeSubscription - topic: {}".format(topic))
+      if topic not in self.subscribed:
+        self.sub.setsockopt_string(zmq.SUBSCRIBE, topic)
+        self.subscribed.add(topic)
+        self.prefixes = tuple(self.subscribed)
+        self.logger.info("SubscriberMW::subscribeTopics - topic: {}".format(topic))
     
+  # one message from our SUB socket, or None if its publisher does not own its topic (it
+  # also owns another of our topics, but not this one). Its sender learns that we got it either
+  # way, or it would take us for a laggard (see Feedback)
   @handle_exception
   def receive(self):
-    self.logger.info("SubscriberMW:: receive messages")
     msg = self.sub.recv_string()
+    if self.feedback is not None:
+      msg = self.feedback.seen(msg)
+    if self.ownership is not None and not self.ownership.accepts(*msg.split(":")[:2]):
+      return None
     self.logger.info("SubscriberMW:: received message = {}".format (msg))
     return msg 
+
+  # the reactor calls us for every message on the SUB socket; we hand it to the application
+  @handle_exception
+  def handle_data(self):
+    if self.conflate:
+      return self.deliverConflated(self.receive, lambda: self.sub.getsockopt(zmq.EVENTS) & zmq.POLLIN)
+    msg = self.receive()
+    if msg is None:
+      return None
+    return self.upcall_obj.data_received(msg)
+
+  # with ConflateTopics: read what waits (up to CONFLATE_BATCH) and deliver it in order, except
+  # that of a conflated topic only the newest message is delivered, in the place of its oldest.
+  # A slow application then catches up on a backlog in one message per such topic.
+  def deliverConflated(self, receive, more):
+    waiting = collections.OrderedDict() # topic, or arrival number for other topics -> message
+    for count in range(self.CONFLATE_BATCH):
+      msg = receive()
+      if msg is not None:
+        topic = msg.split(":", 1)[0]
+        key = topic if topic in self.conflate else count
+        if key in waiting:
+          self.conflated += 1
+        waiting[key] = msg
+      if not more():
+        break
+    timeouts = [timeout for timeout in (self.upcall_obj.data_received(msg) for msg in waiting.values()) if timeout is not None]
+    return min(timeouts) if timeouts else None
+
+  # the next message for one of our topics from our rings, taking turns over them; None once
+  # they are all read, and then we park them and drain the wakes that woke us
+  def receiveRing(self):
+    count = len(self.ring_list)
+    for turn in range(count):
+      index = (self.next_ring + turn) % count
+      ring = self.ring_list[index]
+      data = ring.read()
+      while data is not None:
+        msg = data.decode("utf-8")
+        if msg.startswith(self.prefixes):
+          if self.feedback is not None:
+            msg = self.feedback.seen(msg)
+          if self.ownership is None or self.ownership.accepts(*msg.split(":")[:2]):
+            self.next_ring = (index + 1) % count
+            return msg
+        data = ring.read()
+    while self.wake.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+      self.wake.recv()
+    for ring in self.ring_list:
+      ring.park()
+    return None
+
+  # the reactor calls us while our rings have messages, the same way as for the SUB socket
+  @handle_exception
+  def handle_ring(self):
+    if self.conflate:
+      return self.deliverConflated(self.receiveRing, self.ringsPending)
+    msg = self.receiveRing()
+    if msg is None:
+      return None
+    self.logger.info("SubscriberMW:: received message over shm = {}".format(msg))
+    return self.upcall_obj.data_received(msg)
+
+  # with Strategy=Multicast the discovery service answers our lookups with the groups of our
+  # topics rather than with publishers; we join them (see Multicast)
+  def joinGroups(self, groups):
+    for group in groups:
+      self.multicast.join(self.dish, group.topic, group.endpoint)
+
+  # the reactor calls us for every message on the DISH socket
+  @handle_exception
+  def handle_group(self):
+    msg = self.multicast.check(self.dish.recv(copy=False).bytes)
+    self.logger.info("SubscriberMW:: received message over multicast = {}".format(msg))
+    return self.upcall_obj.data_received(msg)
+
+  def ringsPending(self):
+    for ring in self.ring_list:
+      if ring.pending():
+        return True
+    return False
             
   # here we save a pointer (handle) to the application object
   def set_upcall_handle(self, upcall_obj):
@@ -110,31 +276,130 @@ class SubscriberMW(PinguMW):
   
   @handle_exception
   def connect2pubs(self, IP, port):
-    connect_str = "tcp://" + IP + ":" + str(port)
-    self.logger.info("SubscriberMW:: connect2pubs method. connect_str = {}".format(connect_str))
-    self.sub.connect(connect_str)
+    self.connect("tcp://" + IP + ":" + str(port))
+
+  # connect_str is the endpoint Transport.choose picked: tcp, or ipc/inproc/shm when co-located
+  @handle_exception
+  def connect(self, connect_str):
+    if connect_str in self.connected:
+      return # found both by the lookup and by the watch
+    self.logger.info("SubscriberMW:: connect method. connect_str = {}".format(connect_str))
+    if connect_str.startswith("shm://"):
+      self.attachRing(connect_str)
+    else:
+      self.sub.connect(connect_str)
+    self.connected.add(connect_str)
+    if self.feedback is not None:
+      self.feedback.attach(connect_str)
+
+  def disconnect(self, connect_str):
+    self.benched.discard(connect_str) # gone for good, or benched again by isolate
+    if connect_str not in self.connected:
+      return
+    self.logger.info("SubscriberMW:: disconnect method. connect_str = {}".format(connect_str))
+    if connect_str.startswith("shm://"):
+      self.detachRing(connect_str)
+    else:
+      self.sub.disconnect(connect_str)
+    self.connected.discard(connect_str)
+    if self.feedback is not None:
+      self.feedback.detach(connect_str)
+    if connect_str in self.degraded:
+      self.isolate(connect_str, "RESTORE")
+
+  # a sender found us to be a chronic laggard (see Feedback). DEGRADE: conflate all of our
+  # topics until every sender that told us so RESTOREs us. DISCONNECT: leave the sender for
+  # rejoin_ms, unless it goes away meanwhile
+  def isolate(self, connect_str, command, body=None):
+    if command == "DEGRADE":
+      self.degraded.add(connect_str)
+    elif command == "RESTORE":
+      self.degraded.discard(connect_str)
+    elif command == "DISCONNECT":
+      self.disconnect(connect_str)
+      self.benched.add(connect_str)
+      self.schedule(body["rejoin_ms"], lambda: self.rejoin(connect_str), "SubscriberMW.rejoin")
+    self.conflate = frozenset(self.subscribed) if self.degraded else self.conflate_topics
+    return None
+
+  # messages of reliable topics we missed, retransmitted over the side channel (see Feedback)
+  def recover(self, msgs):
+    timeouts = []
+    for msg in msgs:
+      self.logger.info("SubscriberMW:: recovered message = {}".format(msg))
+      timeouts.append(self.upcall_obj.data_received(msg))
+    timeouts = [timeout for timeout in timeouts if timeout is not None]
+    return min(timeouts) if timeouts else None
+
+  def rejoin(self, connect_str):
+    if connect_str in self.benched:
+      self.benched.discard(connect_str)
+      self.logger.warning("SubscriberMW::rejoin - connecting to {} again".format(connect_str))
+      self.connect(connect_str)
+    return None
+
+  # read the ring of a publisher on our host instead of connecting our SUB socket to it. The
+  # wakes of all our rings come in on one SUB socket, which is what the reactor blocks on
+  def attachRing(self, connect_str):
+    ring = ShmRingReader(connect_str[len("shm://"):])
+    if self.wake is None:
+      self.wake = self.context.socket(zmq.SUB)
+      self.wake.setsockopt(zmq.SUBSCRIBE, b"")
+      self.reactor.register(self.wake, self.handle_ring, "SubscriberMW.rings", pending=self.ringsPending)
+      self.schedule(self.RING_RECHECK_MS, lambda: None, "SubscriberMW.ringRecheck", self.RING_RECHECK_MS)
+    self.wake.connect(ring.wakeEndpoint())
+    ring.park()
+    self.rings[connect_str] = ring
+    self.ring_list = list(self.rings.values())
+
+  # closing the ring unmaps it, so this must not run while receiveRing reads it: like
+  # everything that connects or disconnects, it runs on the loop, the watches that make us leave
+  # a publisher included (see PinguMW.onLoop)
+  def detachRing(self, connect_str):
+    ring = self.rings.pop(connect_str)
+    self.ring_list = list(self.rings.values())
+    self.next_ring = 0
+    self.wake.disconnect(ring.wakeEndpoint())
+    if ring.lost:
+      self.logger.warning("SubscriberMW::detachRing - {} messages of {} were overwritten before we read them".format(ring.lost, connect_str))
+    ring.close()
   
   # New code for PA3  
   """
-  The setRequest method sets up the connection between the subscriber and the leader. 
-  It waits for the leader node to be available and retrieves its metadata, then connects to 
-  the leader's REP socket. If the subscriber is already connected to a different leader, it 
-  disconnects from the previous leader and reconnects to the new one.
+  The setRequest method sets up the connection between the subscriber and the discovery service. 
+  It waits for the leader node to be available, then connects the REQ socket to every discovery
+  replica (see PinguMW.watchDiscovery) so that our lookups are spread over the replicas. Replicas
+  coming and going, including a change of leader, are handled by the watch on /discovery. With
+  Strategy=DHT we instead enter the Chord ring through a random node from dht.json.
+
+  The setWatch method listens to the broker and publisher nodes through the shared ZkCache, which
+  hands us one added/updated/removed event per znode instead of the whole list on every change.
 
-  The setWatch method sets up watches for changes in the leader, broker, and publisher nodes in 
-  ZooKeeper. It uses the DataWatch decorator provided by the Kazoo library to register a function 
-  as a watch for a given ZooKeeper node. If the node changes, the watch function is called.
+  With Strategy=Broker dissemination, watchBroker follows the /broker node: we connect to the new
+  broker and disconnect from the one that went away.
 
-  The watchLeader function is a watch for the /leader node. When this node changes, it calls the 
-  setRequest method to reconnect to the new leader.
+  With Direct dissemination, watchPublishers does the same for the publishers of our topics. We
+  only watch /topics/{topic}/pub for each of our topics, never the whole /publisher group, so what
+  we watch and read grows with our interest and not with the number of publishers. Publisher
+  events are coalesced over MembershipWindowMs, so a publisher that comes and goes within the
+  window never costs us a connect. The SUB socket is subscribed to our topics right away, since
+  publishers found by the watch may precede the answer to our lookup.
 
-  The watchBroker function is a watch for the /broker node. When this node changes, it retrieves 
-  the metadata for the new broker and writes it to a CSV file if the subscriber is using the 
-  "Broker" lookup method.
+  With Ownership=Exclusive the same events go to an Ownership object instead, which picks the
+  strongest live publisher of each topic, and we stay connected to those owners only (see
+  followOwners). receive() drops messages from a publisher that does not own their topic. When an
+  owner dies its znodes go away and we switch to the next strongest; Ownership times each
+  switchover.
 
-  The watchPublishers function is a watch for the /publisher node. When this node changes, it 
-  retrieves the metadata for all publishers and passes it to the setPublisherInfo method of the 
-  upcall object if the subscriber is using the "Direct" lookup method.
+  When a publisher on our host also writes to a shm ring (Transports=...,shm) we read the ring
+  instead of connecting our SUB socket (see ShmRing): connect/disconnect attach and detach it,
+  and the reactor calls handle_ring while any ring has messages, filtering them by our topics
+  the way the SUB socket would. We only block on the SUB socket that carries the wakes of all
+  our rings. Rings are attached and detached on the loop only, between two reads of handle_ring.
+
+  With Strategy=Multicast dissemination we connect to no publisher and watch none: the discovery
+  service answers our lookup with the multicast group of each of our topics, which our DISH
+  socket joins (see Multicast), and handle_group hands what it receives to the application.
 
   The writeToCSV method writes the metadata for a list of publishers to a CSV file. It first opens 
   the file for writing, then iterates over the list of publishers, connects to each publisher's 
@@ -143,42 +408,66 @@ class SubscriberMW(PinguMW):
   """
   @handle_exception
   def setRequest(self):
-    while self.zk.exists("/leader") == None:
-      time.sleep(2)
-      metadata = json.loads(self.zk.get("/leader")[0].decode('utf-8'))
-      if self.disc != None:
-        self.logger.info("SubscriberMW::setRequest:: disconnecting from {}".format(self.disc))
-        self.req.disconnect(self.disc)
-        self.req.connect(metadata["repAddress"])
-        self.disc = metadata["repAddress"]
-        self.logger.info("SubscriberMW::setRequest:: - successfully connected to the leader")
+    if self.lookup == "DHT":
+      self.connectDHT("SubscriberMW", self.dht_json)
+      return
+    self.waitForZnode("SubscriberMW", "/leader", self.startup_timeout)
+    self.watchDiscovery("SubscriberMW")
+    self.logger.info("SubscriberMW::setRequest:: - successfully connected to the discovery replicas")
   
   @handle_exception
-  def setWatch(self):
-    @self.zk.DataWatch("/leader")
-    def watchLeader():
-      self.logger.info("SubscriberMW::watchLeader:: Leader node has changed")
-      self.setRequest()
-      return
-          
-    @self.zk.DataWatch("/broker")
-    def watchBroker(data):
-      self.logger.info("SubscriberMW::watchBroker:: Broker node has changed")
-      if self.lookup_method == "Broker" and data is not None:
-        metadata = json.loads(self.zk.get("/broker")[0].decode('utf-8'))
-        self.writeToCSV([metadata])
-
-    @self.zk.crenWatch("/publisher")
-    def watchPublishers(children):
-      self.logger.info("SubscriberMW::watchPublishers:: Publishers have changed, re-subscribing")
-      if self.lookup_method == "Direct":
-        pubs = []
-        for c in children:
-          path = "/publisher/" + c
-          data, _ = self.zk.get(path)
-          pubs.append(json.loads(data.decode("utf-8")))
-          self.logger.info("DiscoveryMW::watchPublishers:: {}".format(pubs))
-          self.upcall_obj.setPublisherInfo(pubs)
+  def setWatch(self, topiclist):
+    cache = ZkCache.forClient(self.zk, self.logger)
+    self.topiclist = topiclist
+    self.subscribeTopics(topiclist)
+
+    def watchBroker(event):
+      self.logger.info("SubscriberMW::watchBroker:: {}".format(event))
+      if self.dissemination == "Broker":
+        self.follow(event)
+
+    def watchPublishers(events):
+      self.logger.info("SubscriberMW::watchPublishers:: {} publishers changed".format(len(events)))
+      if self.ownership is not None:
+        self.ownership.apply(events)
+        self.followOwners()
+        return
+      for event in events:
+        self.follow(event)
+
+    cache.listen("/broker", self.onLoop(watchBroker))
+    if self.dissemination == "Direct":
+      groups = [ZkCache.topicGroup(topic) for topic in topiclist]
+      self.membership = cache.listenCoalesced(groups, self.onLoop(watchPublishers), self.membership_window)
+
+  # connect to / disconnect from the endpoint of a znode as it comes and goes. A publisher of
+  # several of our topics shows up once per topic, so endpoints are reference counted.
+  def follow(self, event):
+    for info, connect in [(event.old, False), (event.data, True)]:
+      if info is None:
+        continue
+      endpoint = info["id"] if isinstance(info.get("id"), dict) else info # publisher znodes nest their endpoint under "id"
+      connect_str = self.transport.choose(endpoint)
+      refs = self.endpoint_refs.get(connect_str, 0) + (1 if connect else -1)
+      if refs > 0:
+        self.endpoint_refs[connect_str] = refs
+      else:
+        self.endpoint_refs.pop(connect_str, None)
+      if connect and refs == 1:
+        self.connect(connect_str)
+      elif not connect and refs <= 0:
+        self.disconnect(connect_str)
+
+  # connect to the publishers that own at least one of our topics, and only to those
+  def followOwners(self):
+    wanted = self.ownership.wanted()
+    for connect_str in [c for c in self.connected if c not in wanted]:
+      self.logger.info("SubscriberMW::followOwners - disconnecting from {}".format(connect_str))
+      self.disconnect(connect_str)
+    for connect_str in wanted:
+      if connect_str not in self.connected:
+        self.logger.info("SubscriberMW::followOwners - connecting to {}".format(connect_str))
+        self.connect(connect_str)
 
   @handle_exception
   def writeToCSV(self, publist):
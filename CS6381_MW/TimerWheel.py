@@ -0,0 +1,182 @@
+"""
+TimerWheel is a hashed timing wheel used to expire keys (e.g. registration leases) without
+scanning all of them.
+
+Time is cut into ticks of tick_ms and the wheel has a fixed number of slots; a key with a given
+deadline lives in the slot of the tick it expires in, modulo the number of slots. schedule(),
+reschedule (calling schedule() again for the same key) and cancel() are O(1): they only move the
+key between two slot sets. advance(now) visits only the slots of the ticks that went by since the
+last call and returns the keys whose deadline has passed. Keys whose deadline is more than one
+turn of the wheel away simply stay in their slot until the wheel comes around to them again.
+"""
+
+import math
+
+class TimerWheel():
+    def __init__(self, tick_ms=100, slots=512, now_ms=0):
+        self.tick_ms = tick_ms # resolution of the wheel
+        self.slots = [set() for _ in range(slots)]
+        self.deadlines = {} # key -> deadline in msec
+        self.where = {} # key -> index of the slot holding it
+        self.current = int(now_ms // tick_ms) # tick of the last advance()
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def slotOf(self, deadline_ms):
+        # a deadline in the past goes into the slot we will visit next
+        return max(int(deadline_ms // self.tick_ms), self.current) % len(self.slots)
+
+    def schedule(self, key, deadline_ms):
+        if key in self.where:
+            self.slots[self.where[key]].discard(key)
+        self.deadlines[key] = deadline_ms
+        self.where[key] = self.slotOf(deadline_ms)
+        self.slots[self.where[key]].add(key)
+
+    def cancel(self, key):
+        if key in self.where:
+            self.slots[self.where.pop(key)].discard(key)
+            del self.deadlines[key]
+
+    def advance(self, now_ms):
+        expired = []
+        target = int(now_ms // self.tick_ms)
+        # the current tick is visited again since keys due later in it may still be there;
+        # after a full turn every slot has been visited once, no need to go round again
+        first = max(self.current, target - len(self.slots) + 1)
+        for tick in range(first, target + 1):
+            slot = self.slots[tick % len(self.slots)]
+            for key in [key for key in slot if self.deadlines[key] <= now_ms]:
+                slot.discard(key)
+                del self.deadlines[key]
+                del self.where[key]
+                expired.append(key)
+        self.current = max(self.current, target)
+        return expired
+
+    # msec until the next tick, for use as a poll timeout
+    def nextTimeout(self, now_ms):
+        if not self.deadlines:
+            return None
+        return max(int((self.current + 1) * self.tick_ms - now_ms), 0)
+
+
+"""
+HierarchicalTimerWheel keeps timers with a fine resolution over a long range, for the Reactor.
+
+Level 0 has one slot per tick for the next len(slots) ticks; every level above has slots as
+wide as a whole turn of the level below it. A timer goes into the lowest level whose range
+covers its deadline, so schedule() and cancel() are O(1) whatever the number of timers. When
+level 0 completes a turn, the next slot of level 1 is cascaded: its timers are put back at the
+level (now lower) that covers them, and so on upwards. Deadlines beyond the top level wait in it
+and are placed again every time their slot is cascaded.
+
+advance(now) returns the timers that are due, never early. It steps tick by tick only while
+level 0 holds timers; otherwise it jumps straight to the next cascade that matters, so an idle
+wheel costs nothing however long we slept. nextTimeout(now) is the msec until the earliest
+deadline in level 0 or until the next cascade of a higher level, whichever comes first, which
+makes it a poll timeout that never oversleeps a timer.
+"""
+class HierarchicalTimerWheel():
+    def __init__(self, tick_ms=1, slots=64, levels=4, now_ms=0):
+        self.tick_ms = tick_ms
+        self.size = slots
+        self.wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.counts = [0] * levels # timers per level
+        self.deadlines = {} # key -> deadline in msec
+        self.where = {} # key -> (level, slot)
+        self.current = int(now_ms // tick_ms) # last tick processed
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def tickOf(self, deadline_ms):
+        return -int(-deadline_ms // self.tick_ms) # rounded up, so timers never fire early
+
+    def place(self, key):
+        tick = max(self.tickOf(self.deadlines[key]), self.current + 1)
+        delta = tick - self.current
+        level = 0
+        while level < len(self.wheels) - 1 and delta >= self.size ** (level + 1):
+            level += 1
+        slot = (tick // self.size ** level) % self.size
+        self.wheels[level][slot].add(key)
+        self.counts[level] += 1
+        self.where[key] = (level, slot)
+
+    def remove(self, key):
+        level, slot = self.where.pop(key)
+        self.wheels[level][slot].discard(key)
+        self.counts[level] -= 1
+
+    def schedule(self, key, deadline_ms):
+        if key in self.where:
+            self.remove(key)
+        self.deadlines[key] = deadline_ms
+        self.place(key)
+
+    def cancel(self, key):
+        if key in self.where:
+            self.remove(key)
+            del self.deadlines[key]
+
+    def cascade(self, level):
+        slot = (self.current // self.size ** level) % self.size
+        keys, self.wheels[level][slot] = self.wheels[level][slot], set()
+        self.counts[level] -= len(keys)
+        for key in keys:
+            del self.where[key]
+            self.place(key)
+
+    def advance(self, now_ms):
+        expired = []
+        target = int(now_ms // self.tick_ms)
+        while self.current < target:
+            lowest = next((level for level, count in enumerate(self.counts) if count), None)
+            if lowest is None:
+                self.current = target
+                break
+            if lowest > 0:
+                # nothing can fire before the next cascade of that level
+                span = self.size ** lowest
+                boundary = (self.current // span + 1) * span
+                if boundary > target:
+                    self.current = target
+                    break
+                self.current = boundary - 1
+            self.current += 1
+            for level in range(len(self.wheels) - 1, 0, -1):
+                if self.current % self.size ** level == 0:
+                    self.cascade(level)
+            slot = self.wheels[0][self.current % self.size]
+            for key in [key for key in slot if self.deadlines[key] <= now_ms]:
+                self.remove(key)
+                del self.deadlines[key]
+                expired.append(key)
+        return expired
+
+    def nextTimeout(self, now_ms):
+        if not self.deadlines:
+            return None
+        ticks = []
+        if self.counts[0]:
+            ticks.append(next(tick for tick in range(self.current + 1, self.current + self.size + 1)
+                              if self.wheels[0][tick % self.size]))
+        # a timer in a higher level may be due right after its cascade, which can come before
+        # the next occupied tick of level 0
+        upper = next((level for level, count in enumerate(self.counts) if count and level), None)
+        if upper is not None:
+            span = self.size ** upper
+            ticks.append((self.current // span + 1) * span)
+        return self.until(min(ticks), now_ms)
+
+    # msec until the given tick starts, rounded up: waking up before it would find nothing due
+    def until(self, tick, now_ms):
+        return max(math.ceil(tick * self.tick_ms - now_ms), 0)
@@ -0,0 +1,157 @@
+"""
+Transport picks how we reach a publisher: tcp, ipc, inproc or shm.
+
+Publishers bind their PUB socket once per transport listed in Transports ([Dissemination] in
+config.ini) and advertise all of those endpoints with their registration, along with where they
+run: the host key and their pid. Subscribers and the broker then connect over the nearest
+transport they both have:
+
+    inproc   same process; no copy through the kernel at all (ZMQ needs the same context, which
+             every middleware object takes from zmq.Context.instance())
+    shm      same host, when both sides list it: the publisher also writes every message into a
+             shared memory ring that the subscribers on its host read (see ShmRing); only
+             SubscriberMW reads rings, so the broker and the asyncio subscriber never pick it
+    ipc      same host; a Unix domain socket under IpcDir, no TCP/IP stack
+    tcp      anywhere else, or when the publisher advertised nothing else (a publisher with
+             Transports=tcp, or one registered by hand like the benchmarks do)
+
+"Same host" means sharing a kernel and a filesystem, which is what an ipc path needs: the host
+key is the hostname and the kernel boot id. Mininet hosts are network namespaces of one kernel,
+so co-located entities of a Mininet experiment talk over ipc too.
+
+The locality of a registrant is a dict with endpoints (list of connect strings), host and pid,
+and group for the workers of a publisher group (PublisherGroupAppln.py); it travels in the
+ZooKeeper znodes (merged into the "id" of the publisher) and in RegistrantInfo.
+
+With [Feedback] enabled every data endpoint has a feedback endpoint next to it (feedbackOf), so
+that whoever reaches a sender over one transport reaches its side channel over the same one,
+without advertising anything more (see Feedback).
+"""
+
+import os
+import socket
+from CS6381_MW.ShmRing import ShmRingWriter
+
+class Transport():
+    KINDS = ("inproc", "shm", "ipc", "tcp") # nearest first
+    DEFAULT = ("inproc", "ipc", "tcp") # shm is opt-in
+    _host = None
+
+    def __init__(self, logger, kinds=DEFAULT, ipc_dir="/tmp"):
+        self.logger = logger
+        self.kinds = tuple(kinds) # what we bind and what we may connect over
+        self.ipc_dir = ipc_dir
+        self.shm_slots = 65536 # geometry of the ring we write with shm
+        self.shm_slot_bytes = 256
+        self.ring = None # our ShmRingWriter once bound with shm
+
+    # shm=False for readers that only read sockets: they keep to the other transports
+    def configure(self, config, shm=True):
+        kinds = config.get("Dissemination", "Transports", fallback=",".join(self.DEFAULT))
+        self.kinds = tuple(kind.strip() for kind in kinds.split(",") if kind.strip())
+        unknown = [kind for kind in self.kinds if kind not in self.KINDS]
+        if unknown or "tcp" not in self.kinds:
+            raise ValueError("Transports must include tcp and only list {}: {}".format(", ".join(self.KINDS), kinds))
+        if not shm:
+            self.kinds = tuple(kind for kind in self.kinds if kind != "shm")
+        self.ipc_dir = config.get("Dissemination", "IpcDir", fallback=self.ipc_dir)
+        self.shm_slots = config.getint("Dissemination", "ShmSlots", fallback=self.shm_slots)
+        self.shm_slot_bytes = config.getint("Dissemination", "ShmSlotBytes", fallback=self.shm_slot_bytes)
+
+    @classmethod
+    def hostKey(cls):
+        if cls._host is None:
+            try:
+                with open("/proc/sys/kernel/random/boot_id") as f:
+                    boot_id = f.read().strip()
+            except OSError:
+                boot_id = ""
+            cls._host = socket.gethostname() + "/" + boot_id
+        return cls._host
+
+    # bind sock on every transport we use and return the locality to advertise
+    def bind(self, sock, name, addr, port):
+        endpoints = []
+        for kind in self.kinds:
+            if kind == "tcp":
+                sock.bind("tcp://*:" + str(port))
+                endpoints.append("tcp://" + addr + ":" + str(port))
+            elif kind == "shm":
+                ring = "cs6381-{}-{}".format(name, port)
+                wake = "ipc://" + os.path.join(self.ipc_dir, ring + "-wake.ipc")
+                self.ring = ShmRingWriter(sock.context, ring, wake, self.shm_slots, self.shm_slot_bytes)
+                endpoints.append("shm://" + ring)
+            elif kind == "ipc":
+                endpoint = "ipc://" + os.path.join(self.ipc_dir, "cs6381-{}-{}.ipc".format(name, port))
+                sock.bind(endpoint)
+                endpoints.append(endpoint)
+            else:
+                endpoint = "inproc://cs6381-{}-{}".format(name, port)
+                sock.bind(endpoint)
+                endpoints.append(endpoint)
+        self.logger.info("Transport::bind - {}".format(endpoints))
+        return {"endpoints": endpoints, "host": self.hostKey(), "pid": os.getpid()}
+
+    # the connect string to use for an endpoint dict (addr and port, and the locality if any)
+    def choose(self, endpoint):
+        advertised = endpoint.get("endpoints") or []
+        near = []
+        if endpoint.get("host") == self.hostKey():
+            near += ["shm", "ipc"]
+            if endpoint.get("pid") == os.getpid():
+                near.insert(0, "inproc")
+        for kind in near:
+            if kind in self.kinds:
+                for connect_str in advertised:
+                    if connect_str.startswith(kind + "://"):
+                        return connect_str
+        return "tcp://" + endpoint["addr"] + ":" + str(endpoint["port"])
+
+    # the feedback endpoint next to a data endpoint: tcp at port + port_offset, ipc and inproc
+    # under a name of their own, and the ipc path of the ring for shm (a ROUTER cannot be shm)
+    def feedbackOf(self, connect_str, port_offset):
+        kind, rest = connect_str.split("://", 1)
+        if kind == "tcp":
+            addr, port = rest.rsplit(":", 1)
+            return "tcp://" + addr + ":" + str(int(port) + port_offset)
+        if kind == "shm":
+            return "ipc://" + os.path.join(self.ipc_dir, rest + "-feedback.ipc")
+        if kind == "ipc" and rest.endswith(".ipc"):
+            return "ipc://" + rest[:-len(".ipc")] + "-feedback.ipc"
+        return connect_str + "-feedback"
+
+    # bind sock at the feedback endpoint of each of our data endpoints; tcp on all interfaces,
+    # like the data socket
+    def bindFeedback(self, sock, endpoints, port_offset):
+        bound = []
+        for connect_str in endpoints:
+            endpoint = self.feedbackOf(connect_str, port_offset)
+            if endpoint.startswith("tcp://"):
+                endpoint = "tcp://*:" + endpoint.rsplit(":", 1)[1]
+            sock.bind(endpoint)
+            bound.append(endpoint)
+        self.logger.info("Transport::bindFeedback - {}".format(bound))
+        return bound
+
+    # locality <-> RegistrantInfo
+    @staticmethod
+    def toInfo(reg_info, locality):
+        if locality:
+            reg_info.endpoints[:] = locality["endpoints"]
+            reg_info.host = locality["host"]
+            reg_info.pid = locality["pid"]
+            reg_info.group = locality.get("group", "")
+
+    @staticmethod
+    def localityOf(reg_info):
+        if not reg_info.endpoints:
+            return {}
+        locality = {"endpoints": list(reg_info.endpoints), "host": reg_info.host, "pid": reg_info.pid}
+        if reg_info.group:
+            locality["group"] = reg_info.group
+        return locality
+
+    # the endpoint dict of a RegistrantInfo, for choose()
+    @staticmethod
+    def endpointOf(reg_info):
+        return dict({"addr": reg_info.addr, "port": reg_info.port}, **Transport.localityOf(reg_info))
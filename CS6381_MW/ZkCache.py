@@ -0,0 +1,241 @@
+"""
+ZkCache keeps a local copy of the parts of the ZooKeeper tree the middleware cares about and
+tells listeners what changed.
+
+Groups (/publisher, /discovery, /topics/{topic}/pub, ...) are watched with one ChildrenWatch
+each, from the moment somebody first listens to them, and every child gets its own DataWatch
+when it first shows up. A client that listens to only a few topic groups therefore never
+watches or reads the publishers of the other topics. A membership change therefore costs one read for the child
+that joined instead of re-reading all N children, and a child that leaves costs nothing. Single
+nodes (/leader, /broker) are watched with a DataWatch. Reads are served from the local copy.
+
+Listeners get a ZkEvent for every change: ADDED when a node appears, UPDATED when its data
+changes and REMOVED when it goes away (old holds the data it had). Data is decoded from JSON,
+which is what all our znodes hold. Listeners run on the kazoo event thread, like any watch, and
+are called with the current content of the subtree (as ADDED events) when they subscribe.
+
+Listeners that would rather see a storm of changes (hundreds of publishers starting at once)
+as one diff subscribe with listenCoalesced: their events are held for a short window, folded per
+znode into the net change (a node that came and went again is dropped altogether) and delivered
+as one list. The Coalescer counts how many events it suppressed this way.
+
+There is one cache per ZooKeeper client (see forClient), so all the middleware objects sharing a
+client share the cache as well.
+"""
+
+import json
+import threading
+from enum import Enum
+
+class ZkEventType(Enum):
+    ADDED = 0
+    UPDATED = 1
+    REMOVED = 2
+
+class ZkEvent():
+    def __init__(self, kind, path, data, old=None):
+        self.kind = kind # ZkEventType
+        self.path = path # full path of the znode
+        self.name = path.rsplit("/", 1)[-1] # last component of the path
+        self.data = data # decoded data, None once removed
+        self.old = old # decoded data before an update or removal
+
+    def __repr__(self):
+        return "ZkEvent({}, {})".format(self.kind.name, self.path)
+
+class ZkCache():
+    NODES = ("/leader", "/broker") # watched as single znodes; any other path is a group
+
+    _caches = {} # id of the zk client -> its cache
+    _guard = threading.Lock()
+
+    @classmethod
+    def forClient(cls, zk, logger):
+        with cls._guard:
+            cache = cls._caches.get(id(zk))
+            if cache is None:
+                cache = cls(zk, logger)
+                cls._caches[id(zk)] = cache
+                cache.start()
+            return cache
+
+    def __init__(self, zk, logger, nodes=NODES):
+        self.zk = zk
+        self.logger = logger
+        self.groups = set() # groups we have a ChildrenWatch on
+        self.nodes = nodes
+        self.lock = threading.RLock() # protects tree and listeners
+        self.tree = {} # path -> decoded data of every node we know about
+        self.listeners = [] # (path, callback) pairs
+        self.watched = set() # paths that have a DataWatch on them
+
+    def start(self):
+        for node in self.nodes:
+            self.watchNode(node)
+
+    @staticmethod
+    def topicGroup(topic, side="pub"):
+        return "/topics/" + topic + "/" + side
+
+    def watchGroup(self, group):
+        with self.lock:
+            if group in self.groups:
+                return
+            self.groups.add(group)
+        self.zk.ensure_path(group)
+
+        @self.zk.ChildrenWatch(group)
+        def watchChildren(children):
+            for child in children:
+                self.watchNode(group + "/" + child)
+            # removals are reported by the DataWatch of each child
+
+    def watchNode(self, path):
+        with self.lock:
+            if path in self.watched:
+                return
+            self.watched.add(path)
+        single = path in self.nodes
+
+        @self.zk.DataWatch(path)
+        def watchData(data, stat):
+            if stat is None:
+                self.apply(path, None, False)
+                if single:
+                    return True # /leader and /broker come and go; keep watching
+                with self.lock:
+                    self.watched.discard(path)
+                return False # the child is gone; a new one gets a new watch
+            self.apply(path, self.decode(data), True)
+
+    def decode(self, data):
+        if not data:
+            return None
+        try:
+            return json.loads(data.decode("utf-8"))
+        except ValueError:
+            return data
+
+    def apply(self, path, data, exists):
+        with self.lock:
+            known = path in self.tree
+            old = self.tree.get(path)
+            if exists:
+                self.tree[path] = data
+                if not known:
+                    event = ZkEvent(ZkEventType.ADDED, path, data)
+                elif old != data:
+                    event = ZkEvent(ZkEventType.UPDATED, path, data, old)
+                else:
+                    return
+            elif known:
+                del self.tree[path]
+                event = ZkEvent(ZkEventType.REMOVED, path, None, old)
+            else:
+                return
+            listeners = [callback for prefix, callback in self.listeners if self.under(path, prefix)]
+        self.logger.debug("ZkCache::apply - {}".format(event))
+        for callback in listeners:
+            callback(event)
+
+    def under(self, path, prefix):
+        return path == prefix or path.startswith(prefix + "/")
+
+    # Subscribe to the changes under prefix. The current content is replayed as ADDED events.
+    def listen(self, prefix, callback):
+        if prefix not in self.nodes:
+            self.watchGroup(prefix)
+        with self.lock:
+            self.listeners.append((prefix, callback))
+            current = [(path, data) for path, data in self.tree.items() if self.under(path, prefix)]
+        for path, data in current:
+            callback(ZkEvent(ZkEventType.ADDED, path, data))
+
+    # Like listen, but callback gets lists of net changes at most once every window_ms.
+    # prefixes may also be a list, e.g. the topic groups of a subscriber, sharing one window.
+    def listenCoalesced(self, prefixes, callback, window_ms):
+        coalescer = Coalescer(callback, window_ms, self.logger)
+        for prefix in ([prefixes] if isinstance(prefixes, str) else prefixes):
+            self.listen(prefix, coalescer)
+        return coalescer
+
+    def unlisten(self, callback):
+        with self.lock:
+            self.listeners = [(prefix, cb) for prefix, cb in self.listeners if cb != callback]
+
+    # Local reads
+    def get(self, path):
+        with self.lock:
+            return self.tree.get(path)
+
+    def exists(self, path):
+        with self.lock:
+            return path in self.tree
+
+    def children(self, group):
+        with self.lock:
+            return dict((path.rsplit("/", 1)[-1], data) for path, data in self.tree.items()
+                        if path.startswith(group + "/") and "/" not in path[len(group) + 1:])
+
+class Coalescer():
+    def __init__(self, callback, window_ms, logger):
+        self.callback = callback # called with a list of ZkEvents
+        self.window = window_ms / 1000.0
+        self.logger = logger
+        self.lock = threading.Lock() # protects pending, timer and the counters
+        self.deliver = threading.Lock() # one batch is delivered at a time, in order
+        self.pending = {} # path -> net change in the current window
+        self.timer = None
+        self.received = 0 # events we got from the cache
+        self.delivered = 0 # net changes handed to the callback
+        self.batches = 0
+
+    def __call__(self, event):
+        with self.lock:
+            self.received += 1
+            merged = self.merge(self.pending.get(event.path), event)
+            if merged is None:
+                self.pending.pop(event.path, None)
+            else:
+                self.pending[event.path] = merged
+            if self.window > 0:
+                if self.timer is None:
+                    self.timer = threading.Timer(self.window, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+                return
+        self.flush() # no window, deliver right away
+
+    # fold a new event into the net change we already have for that znode
+    def merge(self, prev, event):
+        if prev is None:
+            return event
+        existed = prev.kind != ZkEventType.ADDED # before the window started
+        exists = event.kind != ZkEventType.REMOVED
+        if not existed and not exists:
+            return None
+        if not existed:
+            return ZkEvent(ZkEventType.ADDED, event.path, event.data)
+        if not exists:
+            return ZkEvent(ZkEventType.REMOVED, event.path, None, prev.old)
+        if prev.old == event.data:
+            return None # back to where it was
+        return ZkEvent(ZkEventType.UPDATED, event.path, event.data, prev.old)
+
+    def flush(self):
+        with self.deliver:
+            with self.lock:
+                events = list(self.pending.values())
+                self.pending = {}
+                self.timer = None
+                self.batches += 1
+                self.delivered += len(events)
+                received, suppressed = self.received, self.received - self.delivered
+            if events:
+                self.logger.info("ZkCache::Coalescer - applying {} changes ({} events so far, {} suppressed)".format(len(events), received, suppressed))
+                self.callback(events)
+
+    def stats(self):
+        with self.lock:
+            return {"received": self.received, "delivered": self.delivered,
+                    "suppressed": self.received - self.delivered - len(self.pending), "batches": self.batches}
@@ -3,9 +3,13 @@ import configparser # for configuration parsing
 import logging # for logging. Use it in place of print statements.
 from topic_selector import TopicSelector
 from CS6381_MW.DiscoveryMW import DiscoveryMW
+from CS6381_MW.AsyncMW import AsyncDiscoveryMW
+from CS6381_MW.TimerWheel import TimerWheel
+from CS6381_MW.Transport import Transport
 from CS6381_MW import discovery_pb2
 from CS6381_MW import topic_pb2
 from enum import Enum  # for an enumeration we are using to describe what state we are in
+import time # for pacing the replica sync
 from functools import wraps # for a decorator we are using to handle exceptions
 
 class DiscoveryAppln():
@@ -38,14 +42,24 @@ class DiscoveryAppln():
         self.no_pubs = 0 # Initialise to 0
         self.no_subs = 0 # Initialise to 0
         self.no_broker = 0 # Initialise to 0
-        self.pub_list = [] # Initialise to empty list
-        self.sub_list = [] # Initialise to empty list
-        self.broker_list = [] # Initalise to empty list
+        self.broker_index = {} # broker name -> its entry; there is at most one
         self.lookup = None # one of the diff ways we do lookup
         self.dissemination = None # direct or via broker
         self.is_ready = False
         self.topics2pubs = {}
         self.pubs2ip = {}
+        self.version = 0 # bumped on every change to the registration state
+        self.dirty = False # whether replicas have not seen the latest version yet
+        self.sync_interval = 500 # in msec; how often the leader re-publishes its state
+        self.last_backup = 0 # monotonic time of the last state sent to the replicas
+        self.pub_index = {} # publisher name -> its entry, in the order they registered
+        self.sub_index = {} # subscriber name -> its entry, in the order they registered
+        self.topic_index = {} # topic -> publisher name -> entry, of the publishers of that topic
+        self.lease_ms = 10000 # in msec; longest lease we grant, 0 disables leases
+        self.leases = {} # registrant name -> lease granted to it (replicated)
+        self.wheel = None # deadlines of the leases; only armed on the leader
+        self.timers = [] # lease and sync timers of the event loop, while we lead
+        self.asyncio = False # run on the asyncio middleware (AsyncMW) instead of the Reactor
     
     @handle_exception
     def configure(self, args):
@@ -62,7 +76,10 @@ class DiscoveryAppln():
         config.read(args.config)
         self.lookup = config["Discovery"]["Strategy"]
         self.dissemination = config["Dissemination"]["Strategy"]
-        self.mw_obj = DiscoveryMW(self.logger)
+        self.sync_interval = config.getint("Discovery", "SyncIntervalMs", fallback=500)
+        self.lease_ms = config.getint("Discovery", "LeaseMs", fallback=10000)
+        self.asyncio = args.asyncio
+        self.mw_obj = AsyncDiscoveryMW(self.logger) if self.asyncio else DiscoveryMW(self.logger)
         self.mw_obj.configure(args) # pass remainder of the args to the m/w object
         self.logger.info("DiscoveryAppln::configure - configuration complete")
 
@@ -71,52 +88,167 @@ class DiscoveryAppln():
         self.logger.info("DiscoveryAppln::driver")
         self.dump()
         self.logger.info("DiscoveryAppln::driver - upcall handle")
-        self.mw_obj.setWatch()
         self.mw_obj.set_upcall_handle(self)
+        if self.lookup != "DHT":
+            self.mw_obj.setWatch()
         self.state = self.State.ISREADY
-        self.mw_obj.event_loop(timeout=0)  # start the event loop
+        if self.asyncio:
+            self.mw_obj.drive(self.mw_obj.run()) # our upcalls stay as they are, run from its tasks
+        else:
+            self.mw_obj.event_loop(timeout=0)  # start the event loop
         self.logger.info("DiscoveryAppln::driver completed")
 
     @handle_exception    
     def register_request(self, reg_request):
         self.logger.info("DiscoveryAppln::register_request")
-        status = False # success = True, failure = False
-        reason = ""
+        status, reason = self.applyRegistration(reg_request)
+        self.updateReadiness()
+        lease_ms = 0
+        if status:
+            lease_ms = self.grantLease(reg_request)
+            self.version += 1
+            self.dirty = True
+        self.mw_obj.handle_register(status, reason, lease_ms=lease_ms)
+        self.syncReplicas()
+        return 0
+
+    @handle_exception
+    def register_batch_request(self, batch_req):
+        self.logger.info("DiscoveryAppln::register_batch_request - {} registrations".format(len(batch_req.registrations)))
+        results = [self.applyRegistration(reg_request) for reg_request in batch_req.registrations]
+        self.updateReadiness()
+        leases = [self.grantLease(reg_request) if status else 0
+                  for reg_request, (status, _) in zip(batch_req.registrations, results)]
+        if any(status for status, _ in results):
+            # the whole batch is one state change, replicated once
+            self.version += 1
+            self.dirty = True
+        self.mw_obj.send_register_batch(results, leases=leases)
+        self.syncReplicas()
+        return 0
+
+    @handle_exception
+    def applyRegistration(self, reg_request):
+        info = reg_request.info
         if reg_request.role == discovery_pb2.ROLE_PUBLISHER:
-            self.logger.info("DiscoveryAppln::register_request - ROLE_PUBLISHER")
-            if len(self.pub_list) != 0:
-                for pub in self.pub_list:
-                    if pub[0] == reg_request.info.id:
-                        reason = "The publisher name is not unique."
-            if reason == "":
-                self.pub_list.append([reg_request.info.id, reg_request.info.addr, reg_request.info.port, reg_request.topiclist])
-                status = True
-                reason = "The publisher name is unique."
+            self.logger.debug("DiscoveryAppln::applyRegistration - ROLE_PUBLISHER")
+            if info.id in self.pub_index:
+                return False, "The publisher name is not unique."
+            pub = [info.id, info.addr, info.port, list(reg_request.topiclist), Transport.localityOf(info)]
+            self.indexPublisher(pub)
+            return True, "The publisher name is unique."
         elif reg_request.role == discovery_pb2.ROLE_SUBSCRIBER:
-            self.logger.info("DiscoveryAppln::register_request - ROLE_SUBSCRIBER")
-            if len(self.sub_list) != 0:
-                for sub in self.sub_list:
-                    if sub[0] == reg_request.info.id:
-                        reason = "The subscriber name is not unique."
-            if reason == "":
-                self.sub_list.append([reg_request.info.id, reg_request.info.addr, reg_request.info.port, reg_request.topiclist])
-                status = True
-                reason = "The subscriber name is unique."
+            self.logger.debug("DiscoveryAppln::applyRegistration - ROLE_SUBSCRIBER")
+            if info.id in self.sub_index:
+                return False, "The subscriber name is not unique."
+            sub = [info.id, info.addr, info.port, list(reg_request.topiclist)]
+            self.sub_index[info.id] = sub
+            return True, "The subscriber name is unique."
         elif reg_request.role == discovery_pb2.ROLE_BOTH:
-            self.logger.info("DiscoveryAppln::register_request - ROLE_BOTH")
-            if len(self.broker_list) != 0:
-                reason = "There should be only one broker."
-            if reason == "":
-                self.broker_list.append([reg_request.info.id, reg_request.info.addr, reg_request.info.port, reg_request.topiclist])
-                status = True
-                reason = "The broker name is unique and there is only one broker."
-        else:
-            raise Exception("Role unknown: Should be either publisher, subscriber, or broker.")
-        if len(self.pub_list) >= self.no_pubs and len(self.sub_list) >= self.no_subs:
+            self.logger.debug("DiscoveryAppln::applyRegistration - ROLE_BOTH")
+            if self.broker_index:
+                return False, "There should be only one broker."
+            self.broker_index[info.id] = [info.id, info.addr, info.port, list(reg_request.topiclist)]
+            return True, "The broker name is unique and there is only one broker."
+        return False, "Role unknown: Should be either publisher, subscriber, or broker."
+
+    def updateReadiness(self):
+        if len(self.pub_index) >= self.no_pubs and len(self.sub_index) >= self.no_subs:
             self.is_ready = True
-        self.mw_obj.handle_register(status, reason)
+
+    # pub_index, sub_index and broker_index hold the registrants by name, and topic_index maps
+    # a topic to its publishers by name, so that registrations, lookups (single or batched) and
+    # evictions never have to scan a list. The replicas get them as lists (see backup).
+    def indexPublisher(self, pub):
+        self.pub_index[pub[0]] = pub
+        for topic in pub[3]:
+            self.topic_index.setdefault(topic, {})[pub[0]] = pub
+
+    def rebuildIndexes(self, pub_list, sub_list, broker_list):
+        self.pub_index = {}
+        self.topic_index = {}
+        for pub in pub_list:
+            self.indexPublisher(pub)
+        self.sub_index = dict((sub[0], sub) for sub in sub_list)
+        self.broker_index = dict((broker[0], broker) for broker in broker_list)
+
+    # Leases
+    """
+    Registrations that ask for a lease (RegisterReq.lease_ms) are granted at most LeaseMs and
+    must be renewed by heartbeats before it runs out; registrations without one never expire.
+    The lease lengths are part of the replicated state but only the leader keeps their
+    deadlines, in a TimerWheel, so expiring them costs nothing per registration. A replica that
+    takes over arms the wheel with a full lease for everybody on its first invoke_operation, along
+    with two timers of the event loop: one advancing the wheel every tick, one re-publishing our
+    state every SyncIntervalMs. A leader that became a replica again cancels them in setState.
+    """
+    def now(self):
+        return time.monotonic() * 1000
+
+    def grantLease(self, reg_request):
+        if not reg_request.lease_ms or not self.lease_ms:
+            return 0
+        lease_ms = min(reg_request.lease_ms, self.lease_ms)
+        self.leases[reg_request.info.id] = lease_ms
+        if self.wheel is not None:
+            self.wheel.schedule(reg_request.info.id, self.now() + lease_ms)
+        return lease_ms
+
+    def armLeases(self):
+        self.wheel = TimerWheel(tick_ms=100, now_ms=self.now())
+        for name, lease_ms in self.leases.items():
+            self.wheel.schedule(name, self.now() + lease_ms)
+        self.disarm()
+        self.timers = [self.mw_obj.schedule(self.wheel.tick_ms, self.expireLeases, "DiscoveryAppln.leases", self.wheel.tick_ms),
+                       self.mw_obj.schedule(self.sync_interval, self.resync, "DiscoveryAppln.sync", self.sync_interval)]
+
+    def disarm(self):
+        for timer in self.timers:
+            self.mw_obj.cancel(timer)
+        self.timers = []
+
+    @handle_exception
+    def heartbeat_request(self, hb_req):
+        self.logger.debug("DiscoveryAppln::heartbeat_request - {} ids".format(len(hb_req.ids)))
+        if self.wheel is None:
+            self.armLeases()
+        unknown = []
+        renewed = []
+        for name in hb_req.ids:
+            if name in self.leases:
+                self.wheel.schedule(name, self.now() + self.leases[name])
+                renewed.append(self.leases[name])
+            else:
+                unknown.append(name)
+        self.mw_obj.send_heartbeat(unknown, min(renewed, default=0)) # the lease granted, not the most we grant
         return 0
 
+    # timer: evict the registrations whose lease ran out and tell the replicas right away
+    @handle_exception
+    def expireLeases(self):
+        if self.wheel is None:
+            return None
+        expired = self.wheel.advance(self.now())
+        for name in expired:
+            self.logger.info("DiscoveryAppln::expireLeases - lease of {} expired".format(name))
+            self.evict(name)
+        if expired:
+            self.version += 1
+            self.dirty = True
+            self.syncReplicas()
+        return None
+
+    def evict(self, name):
+        self.leases.pop(name, None)
+        pub = self.pub_index.pop(name, None)
+        if pub is not None:
+            for topic in pub[3]:
+                del self.topic_index[topic][name]
+                if not self.topic_index[topic]:
+                    del self.topic_index[topic]
+        self.sub_index.pop(name, None)
+        self.broker_index.pop(name, None)
+
     @handle_exception
     def isready_request(self):
         self.logger.info("DiscoveryAppln:: isready_request")
@@ -126,35 +258,56 @@ class DiscoveryAppln():
     @handle_exception
     def handle_topic_request(self, topic_req):
         self.logger.info("DiscoveryAppln::handle_topic_request - start")
-        pubTopicList = []
-        for pub in self.pub_list:
-            if any(topic in pub[3] for topic in topic_req.topiclist):
-                self.logger.info("DiscoveryAppln::handle_topic_request - add pub")
-                pubTopicList.append([pub[0], pub[1], pub[2]])     
-        self.mw_obj.send_pubinfo_for_topic(pubTopicList)
+        pubTopicList = self.pubsForTopics(topic_req.topiclist)
+        self.mw_obj.send_pubinfo_for_topic(pubTopicList, self.version, topiclist=topic_req.topiclist)
+        return 0
+
+    @handle_exception
+    def lookup_batch_request(self, batch_req):
+        self.logger.info("DiscoveryAppln::lookup_batch_request - {} lookups".format(len(batch_req.lookups)))
+        results = [self.pubsForTopics(lookup.topiclist) for lookup in batch_req.lookups]
+        self.mw_obj.send_lookup_batch(results, self.version, [lookup.topiclist for lookup in batch_req.lookups])
         return 0
 
+    @handle_exception
+    def pubsForTopics(self, topiclist):
+        pubTopicList = []
+        seen = set()
+        for topic in topiclist:
+            for pub in self.topic_index.get(topic, {}).values():
+                if pub[0] not in seen:
+                    seen.add(pub[0])
+                    pubTopicList.append(self.pubInfo(pub))
+        return pubTopicList
+
     @handle_exception    
     def handle_all_publist(self):
         self.logger.info ("DiscoveryAppln:: handle_all_publist")
         pubWithoutTopicList = []
-        if len(self.pub_list) != 0:
-            for pub in self.pub_list:
-                pubWithoutTopicList.append([pub[0], pub[1], pub[2]])
+        if len(self.pub_index) != 0:
+            for pub in self.pub_index.values():
+                pubWithoutTopicList.append(self.pubInfo(pub))
         else:
             pubWithoutTopicList = []
-        self.mw_obj.send_all_pub_list(pubWithoutTopicList)
+        self.mw_obj.send_all_pub_list(pubWithoutTopicList, self.version)
         return 0
     
     # New code for PA3
     """
     invoke_operation(): I think I need for this assignment to check the current state of the 
-    application and decides whether to execute a requested operation or not. 
+    application and decides whether to execute a requested operation or not. On a leader that
+    just took over it arms the leases and the timers that expire them and keep the replicas in
+    sync.
     
-    backup(): This method is responsible for sending the state of the application to a replica. 
+    backup(): This method is responsible for sending the state of the application to the replicas. 
     It calls the sendStateReplica() method of a DiscoveryMW object (which is an instance variable 
-    of the DiscoveryAppln class) and passes the current state information (topics2pubs, pubs2ip, 
-    no_pubs, and no_subs) to it.
+    of the DiscoveryAppln class) and passes the registration state (publishers, subscribers,
+    brokers, readiness, the granted leases and the state version) to it.
+
+    syncReplicas(): Called by the leader after handling requests. It sends a backup right away
+    when the state changed. resync(), the leader's sync timer, sends one every SyncIntervalMs
+    even when nothing changed, which is what bounds the staleness of lookups answered by the
+    replicas.
 
     setBrokerInfo(self, broker): This method is called by the DiscoveryMW object when it receives 
     information about a new broker. It sets the broker instance variable of the DiscoveryAppln 
@@ -164,15 +317,16 @@ class DiscoveryAppln():
     receives information about publishers. It updates the pubs2ip and topics2pubs instance 
     variables of the DiscoveryAppln object based on the given information.
 
-    setState(self, topics2pubs, pubs2ip, no_pubs, no_subs): This method is called by the 
-    DiscoveryMW object when it receives state information from a leader or a replica. It 
-    updates the topics2pubs, pubs2ip, no_pubs, and no_subs instance variables of the 
-    DiscoveryAppln object based on the given information.
+    setState(self, state): This method is called by the DiscoveryMW object on a replica when it 
+    receives the state published by the leader. It replaces our registration state with it and
+    rebuilds the lookup indexes.
     """
     @handle_exception
     def invoke_operation(self):
         self.logger.info("DiscoveryAppln::invoke_operation - start")
         if self.state == self.State.WAIT or self.state == self.State.ISREADY:
+            if self.mw_obj.is_leader and self.wheel is None:
+                self.armLeases()
             return None
         else:
             raise ValueError("undefined")
@@ -180,7 +334,27 @@ class DiscoveryAppln():
     @handle_exception
     def backup(self):
         self.logger.info("DiscoveryAppln::backup - start")
-        self.mw_obj.sendStateReplica(self.topics2pubs, self.pubs2ip, self.no_pubs, self.no_subs, self.state)
+        state = {"version": self.version, "pub_list": list(self.pub_index.values()), "sub_list": list(self.sub_index.values()),
+                 "broker_list": list(self.broker_index.values()), "no_pubs": self.no_pubs, "no_subs": self.no_subs,
+                 "is_ready": self.is_ready, "leases": self.leases}
+        self.mw_obj.sendStateReplica(state)
+        self.last_backup = time.monotonic()
+        self.dirty = False
+
+    @handle_exception
+    def syncReplicas(self):
+        if not self.mw_obj.is_leader:
+            return None
+        elapsed = (time.monotonic() - self.last_backup) * 1000
+        if self.dirty or elapsed >= self.sync_interval:
+            self.backup()
+        return None
+
+    @handle_exception
+    def resync(self):
+        if self.mw_obj.is_leader:
+            self.backup()
+        return None
 
     @handle_exception
     def setBrokerInfo(self, broker):   
@@ -203,18 +377,82 @@ class DiscoveryAppln():
         self.logger.info("DiscoveryAppln::setPublisherInfo - updated topics: {}".format(self.topics2pubs))
             
     @handle_exception
-    def setState(self, topics2pubs, pubs2ip, no_pubs, no_subs):
-        self.topics2pubs = topics2pubs
-        self.pubs2ip = pubs2ip
-        self.no_pubs = no_pubs
-        self.no_subs = no_subs
+    def setState(self, state):
+        self.logger.info("DiscoveryAppln::setState - version {}".format(state["version"]))
+        self.version = state["version"]
+        self.no_pubs = state["no_pubs"]
+        self.no_subs = state["no_subs"]
+        self.is_ready = state["is_ready"]
+        self.leases = state.get("leases", {})
+        self.wheel = None # re-armed if we ever take over as the leader
+        self.disarm()
+        self.rebuildIndexes(state["pub_list"], state["sub_list"], state["broker_list"])
     
+    # DHT lookups (Strategy=DHT)
+    """
+    In DHT mode the DiscoveryMW routes each request around the Chord ring and calls these on the
+    nodes that own the keys. Each node only keeps the records whose keys it owns: publishers
+    under every topic they publish, subscribers and brokers under their id. Unlike the
+    centralized upcalls these return their result to the middleware, which carries it along
+    the route and replies once the last key has been resolved.
+
+    dht_register(self, reg_request, key): Stores the registrant under the given key and returns
+    (status, reason).
+
+    dht_lookup(self, topic): Returns the publishers of a topic we own.
+
+    dht_all_pubs(self): Returns all the publishers stored on this node.
+    """
+    @handle_exception
+    def dht_register(self, reg_request, key):
+        self.logger.info("DiscoveryAppln::dht_register - {} under {}".format(reg_request.info.id, key))
+        info = reg_request.info
+        if reg_request.role == discovery_pb2.ROLE_PUBLISHER:
+            pub = self.pub_index.get(info.id)
+            if pub is not None:
+                if pub[1] != info.addr or pub[2] != info.port:
+                    return False, "The publisher name is not unique."
+                if key not in pub[3]:
+                    pub[3].append(key)
+                    self.topic_index.setdefault(key, {})[pub[0]] = pub
+                return True, ""
+            pub = [info.id, info.addr, info.port, [key], Transport.localityOf(info)]
+            self.indexPublisher(pub)
+        elif reg_request.role == discovery_pb2.ROLE_SUBSCRIBER:
+            if info.id in self.sub_index:
+                return False, "The subscriber name is not unique."
+            sub = [info.id, info.addr, info.port, list(reg_request.topiclist)]
+            self.sub_index[info.id] = sub
+        elif reg_request.role == discovery_pb2.ROLE_BOTH:
+            if self.broker_index:
+                return False, "There should be only one broker."
+            self.broker_index[info.id] = [info.id, info.addr, info.port, list(reg_request.topiclist)]
+        else:
+            raise Exception("Role unknown: Should be either publisher, subscriber, or broker.")
+        self.version += 1
+        return True, ""
+
+    @handle_exception
+    def dht_lookup(self, topic):
+        return self.pubsForTopics([topic])
+
+    @handle_exception
+    def dht_all_pubs(self):
+        return [self.pubInfo(pub) for pub in self.pub_index.values()]
+
+    # what lookups return of a publisher entry: name, addr, port and its locality (Transport)
+    @staticmethod
+    def pubInfo(pub):
+        return [pub[0], pub[1], pub[2], pub[4] if len(pub) > 4 else {}]
+
     @handle_exception
     def dump(self):
         self.logger.info ("**********************************")
         self.logger.info ("DiscoveryAppln::dump")
         self.logger.info ("     Lookup: {}".format (self.lookup))
         self.logger.info ("     Dissemination: {}".format (self.dissemination))
+        if self.lookup == "DHT":
+            self.mw_obj.dumpFingerTable()
         self.logger.info ("**********************************")
  
 def parseCmdLineArgs ():
@@ -237,6 +475,7 @@ def parseCmdLineArgs ():
     # New code for PA3
     parser.add_argument("-q", "--quorum", type=int, default=3, help="Number of discovery nodes in the quorum, default=3")
     parser.add_argument ("-z", "--zookeeper", default="localhost:2181", help="IPv4 address for the zookeeper service, default = localhost:2181")
+    parser.add_argument ("-A", "--asyncio", action="store_true", help="Run on the asyncio middleware instead of the Reactor event loop")
     return parser.parse_args()
     
 def main():
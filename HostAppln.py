@@ -0,0 +1,121 @@
+# Purpose:
+#
+# Runs many publishers and subscribers in one process (see CS6381_MW/Host.py), for experiments
+# larger than one interpreter per entity allows. Each one is a PublisherAppln or SubscriberAppln
+# configured and driven exactly as its own process would be, with its own name, port and
+# registration; they share the process wide ZMQ context, one event loop and one ZooKeeper
+# session. Publishers are {name}pub1..{name}pubN on ports -p, -p+1, ..., subscribers
+# {name}sub1..{name}subM on the ports after those, all with the same -T/-f/-i/-c as their own
+# command lines would take.
+#
+# Publishers are done after -i iterations, subscribers never are: the host runs until every
+# entity is done, for -t seconds, or until SIGTERM, and then writes out what the subscribers
+# have not written to sample.csv yet. With Transports listing inproc, subscribers reach the
+# publishers of this host without leaving the process. HostIdlePolicy in [EventLoop] is the
+# idle policy of the shared loop.
+
+import sys    # for syspath and system exception
+import argparse # for argument parsing
+import configparser # for configuration parsing
+import logging # for logging. Use it in place of print statements.
+import signal
+from types import SimpleNamespace
+from CS6381_MW.Host import Host
+from PublisherAppln import PublisherAppln
+from SubscriberAppln import SubscriberAppln
+
+class HostAppln():
+  def __init__(self, logger):
+    self.host = None # the Host all our entities run in
+    self.publishers = [] # PublisherAppln objects
+    self.subscribers = [] # SubscriberAppln objects
+    self.duration = None # in sec; None is until every entity is done
+    self.logger = logger
+
+  def configure(self, args):
+    self.logger.info("HostAppln::configure")
+    self.duration = args.duration
+    self.host = Host(self.logger)
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    self.host.setIdlePolicy(config)
+    self.host.activate()
+    for i in range(args.num_pubs):
+      pub_args = SimpleNamespace(name=args.name + "pub" + str(i + 1), addr=args.addr, port=args.port + i,
+                                 discovery=args.discovery, num_topics=args.num_topics, config=args.config,
+                                 frequency=args.frequency, iters=args.iters, loglevel=args.loglevel,
+                                 dht_json=args.dht_json, asyncio=False, strength=args.strength,
+                                 group="", topiclist="", zookeeper=args.zookeeper)
+      pub_app = PublisherAppln(self.entityLogger(pub_args))
+      pub_app.configure(pub_args)
+      self.publishers.append(pub_app)
+    for i in range(args.num_subs):
+      sub_args = SimpleNamespace(name=args.name + "sub" + str(i + 1), addr=args.addr, port=args.port + args.num_pubs + i,
+                                 discovery=args.discovery, num_topics=args.num_topics, config=args.config,
+                                 frequency=args.frequency, iters=args.iters, loglevel=args.loglevel,
+                                 dht_json=args.dht_json, asyncio=False, zookeeper=args.zookeeper)
+      sub_app = SubscriberAppln(self.entityLogger(sub_args))
+      sub_app.configure(sub_args)
+      self.subscribers.append(sub_app)
+    self.logger.info("HostAppln::configure - {} publishers and {} subscribers".format(len(self.publishers), len(self.subscribers)))
+
+  # a child of our logger per entity, so that the log tells them apart
+  def entityLogger(self, args):
+    logger = self.logger.getChild(args.name)
+    logger.setLevel(args.loglevel)
+    return logger
+
+  def driver(self):
+    self.logger.info("HostAppln::driver")
+    try:
+      # the drivers return at once in a host: they only start the state machines
+      for app in self.subscribers + self.publishers:
+        app.driver()
+      if self.duration is not None:
+        self.host.reactor.schedule(self.duration * 1000, self.host.stop, "HostAppln.duration")
+      self.host.run()
+    finally:
+      for sub_app in self.subscribers:
+        sub_app.flushCSV()
+      for pub_app in self.publishers:
+        pub_app.mw_obj.close()
+      self.host.deactivate()
+    self.logger.info("HostAppln::driver completed")
+
+def parseCmdLineArgs():
+  parser = argparse.ArgumentParser(description="Host many publishers and subscribers in one process")
+  parser.add_argument("-P", "--num_pubs", type=int, default=10, help="Number of publishers to host, default 10")
+  parser.add_argument("-S", "--num_subs", type=int, default=10, help="Number of subscribers to host, default 10")
+  parser.add_argument("-n", "--name", default="", help="Prefix of the names of the entities, e.g. the host's name; keep the names unique across hosts")
+  parser.add_argument("-a", "--addr", default="localhost", help="IP addr of this host to advertise (default: localhost)")
+  parser.add_argument("-p", "--port", type=int, default=6000, help="Port of the first publisher; the other publishers and then the subscribers count up from it, default 6000")
+  parser.add_argument("-d", "--discovery", default="localhost:5555", help="IP Addr:Port combo for the discovery service, default localhost:5555")
+  parser.add_argument("-T", "--num_topics", type=int, choices=range(1,10), default=7, help="Number of topics each entity publishes or subscribes to, currently restricted to max of 9")
+  parser.add_argument("-c", "--config", default="config.ini", help="configuration file (default: config.ini)")
+  parser.add_argument("-f", "--frequency", type=int, default=1, help="Rate at which the publishers disseminate: default once a second - use integers")
+  parser.add_argument("-i", "--iters", type=int, default=1000, help="number of publication iterations (default: 1000)")
+  parser.add_argument("-t", "--duration", type=float, default=None, help="Stop after this many seconds; default when every entity is done")
+  parser.add_argument("-s", "--strength", default="0", help="Ownership strength of the publishers with Ownership=Exclusive, default 0")
+  parser.add_argument("-j", "--dht_json", default="dht.json", help="JSON file with all DHT nodes, default dht.json")
+  parser.add_argument("-z", "--zookeeper", default="localhost:2181", help="IPv4 address for the zookeeper service, default = localhost:2181")
+  parser.add_argument("-l", "--loglevel", type=int, default=logging.WARNING, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 30=logging.WARNING, as every entity logs every message otherwise")
+  return parser.parse_args()
+
+def main():
+  # exit through the driver's cleanup on SIGTERM too, so the last rows reach sample.csv
+  signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+  try:
+    logging.info("Main - acquire a child logger and then log messages in the child")
+    logger = logging.getLogger("HostAppln")
+    args = parseCmdLineArgs()
+    logger.setLevel(args.loglevel)
+    host_app = HostAppln(logger)
+    host_app.configure(args)
+    host_app.driver()
+  except Exception as e:
+    logger.error("Exception caught in main - {}".format(e))
+    return
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+  main()
@@ -1,11 +1,13 @@
 import os     # for OS functions
 import sys    # for syspath and system exception
 import time   # for sleep
+import asyncio # for the -A/--asyncio variant
 import argparse # for argument parsing
 import configparser # for configuration parsing
 import logging # for logging. Use it in place of print statements.
 from topic_selector import TopicSelector
 from CS6381_MW.PublisherMW import PublisherMW
+from CS6381_MW.AsyncMW import AsyncPublisherMW
 from CS6381_MW import discovery_pb2
 from CS6381_MW import topic_pb2
 from enum import Enum  
@@ -28,7 +30,7 @@ class PublisherAppln():
         return func(*args, **kwargs)
       except Exception as e:
         raise e
-      return wrapper
+    return wrapper
 
   def __init__ (self, logger):
     self.name = None # our name (some unique name)
@@ -41,6 +43,14 @@ class PublisherAppln():
     self.state = self.State.INITIALIZE # state that are we in
     self.lookup = None # one of the diff ways we do lookup
     self.dissemination = None # direct or via broker
+    self.strength = 0 # ownership strength, for all our topics or per topic
+    self.iteration = 0 # dissemination rounds done so far
+    self.pacer = None # timer that disseminates one round every 1/frequency sec
+    self.retry_ms = 10000 # how long to wait before asking again if the system is ready
+    self.asyncio = False # run on the asyncio middleware (AsyncMW) instead of the Reactor
+    self.sent = 0 # messages disseminated so far
+    self.started_at = None # monotonic time of the first round, and of the end of the last one
+    self.completed_at = None
 
   @handle_exception
   def configure (self, args):
@@ -50,14 +60,16 @@ class PublisherAppln():
     self.iters = args.iters  # num of iterations
     self.frequency = args.frequency # frequency with which topics are disseminated
     self.num_topics = args.num_topics  # total num of topics we publish
+    self.strength = self.parseStrength(args.strength)
     config = configparser.ConfigParser()
     config.read(args.config)
     self.lookup = config["Discovery"]["Strategy"]
     self.dissemination = config["Dissemination"]["Strategy"]
     self.logger.info("PublisherAppln::configure - selecting our topic list")
-    self.selectTopics()
+    self.selectTopics(args.topiclist)
     self.logger.info("PublisherAppln::configure - initialize the middleware object")
-    self.mw_obj = PublisherMW(self.logger)
+    self.asyncio = args.asyncio
+    self.mw_obj = AsyncPublisherMW(self.logger) if self.asyncio else PublisherMW(self.logger)
     self.mw_obj.configure(args) # pass remainder of the args to the m/w object
     self.logger.info("PublisherAppln::configure - configuration complete")
 
@@ -69,35 +81,55 @@ class PublisherAppln():
     self.logger.info("PublisherAppln::driver - upcall handle")
     self.mw_obj.set_upcall_handle(self)
     self.state = self.State.REGISTER
-    self.mw_obj.event_loop(timeout=0)  # start the event loop
+    if self.asyncio:
+      self.mw_obj.drive(self.asyncDriver())
+      self.mw_obj.close()
+    else:
+      self.mw_obj.event_loop(timeout=0)  # start the event loop
     self.logger.info("PublisherAppln::driver completed")
+
+  # the same steps as the state machine, as one coroutine on the asyncio middleware
+  async def asyncDriver(self):
+    self.register_response(await self.mw_obj.register(self.name, self.topiclist, self.strength))
+    await self.mw_obj.waitReady(self.retry_ms)
+    self.state = self.State.DISSEMINATE
+    self.logger.info("PublisherAppln::asyncDriver - start Disseminating")
+    self.ts = TopicSelector()
+    start = asyncio.get_running_loop().time()
+    self.started_at = time.monotonic()
+    for self.iteration in range(self.iters):
+      for topic in self.topiclist:
+        dissemination_data = self.ts.gen_publication(topic)
+        current_time = datetime.now().strftime('%H-%M-%S-%f')[:-3]
+        await self.mw_obj.disseminate(self.name, topic, dissemination_data, current_time)
+        self.sent += 1
+      # pace against the start so that the rounds do not drift
+      await asyncio.sleep(max(0, start + (self.iteration + 1) / self.frequency - asyncio.get_running_loop().time()))
+    self.logger.info("PublisherAppln::asyncDriver - Dissemination completed")
+    self.completed_at = time.monotonic()
+    self.state = self.State.COMPLETED
   
   @handle_exception
   def invoke_operation (self):
     self.logger.info("PublisherAppln::invoke_operation")
     if self.state == self.State.REGISTER:
       self.logger.info("PublisherAppln::invoke_operation - register with the discovery service")
-      self.mw_obj.register(self.name, self.topiclist)
+      self.mw_obj.register(self.name, self.topiclist, self.strength)
       return None
     elif self.state == self.State.ISREADY:
       self.logger.info ("PublisherAppln::invoke_operation - check if are ready to go")
       self.mw_obj.is_ready()  # send the is_ready? request
       return None
     elif self.state == self.State.DISSEMINATE:
-      self.logger.info("PublisherAppln::invoke_operation - start Disseminating")
-      # Now disseminate topics at the rate at which we have configured ourselves.
-      ts = TopicSelector()
-      for i in range(self.iters):
-        for topic in self.topiclist:
-          dissemination_data = ts.gen_publication(topic)
-          current_time = datetime.now().strftime('%H-%M-%S-%f')[:-3]
-          current_time = str(current_time)
-          self.mw_obj.disseminate(self.name, topic, dissemination_data, current_time) # Current time is sent as well
-        time.sleep(1/float (self.frequency))  # ensure we get a floating point num
-      self.logger.info("PublisherAppln::invoke_operation - Dissemination completed")
-      self.state = self.State.COMPLETED
-      return 0
+      if self.pacer is None:
+        self.logger.info("PublisherAppln::invoke_operation - start Disseminating")
+        # Now disseminate topics at the rate at which we have configured ourselves, from a
+        # timer of the event loop instead of sleeping in it.
+        self.ts = TopicSelector()
+        self.pacer = self.mw_obj.schedule(0, self.disseminate, "PublisherAppln.disseminate", 1000.0 / self.frequency)
+      return None
     elif self.state == self.State.COMPLETED:
+      self.mw_obj.close()
       self.mw_obj.disable_event_loop()
       return None
     else:
@@ -120,9 +152,33 @@ class PublisherAppln():
     self.logger.info ("PublisherAppln::isready_response")
     if not isready_resp.status: # discovery service is not ready yet
       self.logger.debug ("PublisherAppln::driver - Not ready yet; check again")
-      time.sleep (10)  # sleep between calls so that we don't make excessive calls
-    else:
-      self.state = self.State.DISSEMINATE
+      # ask again later so that we don't make excessive calls; the timer brings us back to invoke_operation
+      self.mw_obj.schedule(self.retry_ms, lambda: 0, "PublisherAppln.isready_retry")
+      return None
+    self.state = self.State.DISSEMINATE
+    return 0
+
+  # timer: one round of publications, one per topic
+  @handle_exception
+  def disseminate(self):
+    if self.started_at is None:
+      self.started_at = time.monotonic()
+    if self.mw_obj.congested():
+      return None # our subscribers' queues are full (OverflowPolicy=Block); this round waits
+    if self.iteration < self.iters:
+      for topic in self.topiclist:
+        dissemination_data = self.ts.gen_publication(topic)
+        current_time = datetime.now().strftime('%H-%M-%S-%f')[:-3]
+        current_time = str(current_time)
+        self.mw_obj.disseminate(self.name, topic, dissemination_data, current_time) # Current time is sent as well
+        self.sent += 1
+      self.iteration += 1
+      if self.iteration < self.iters or self.mw_obj.congested():
+        return None
+    self.logger.info("PublisherAppln::disseminate - Dissemination completed")
+    self.completed_at = time.monotonic()
+    self.mw_obj.cancel(self.pacer)
+    self.state = self.State.COMPLETED
     return 0
 
   @handle_exception
@@ -138,8 +194,19 @@ class PublisherAppln():
     self.logger.info("     Frequency: {}".format (self.frequency))
     self.logger.info("**********************************")
   
+  # "10" gives all our topics the same strength, "weather:10,humidity:5" one per topic
+  def parseStrength(self, strength):
+    if ":" not in strength:
+      return int(strength)
+    return dict((topic, int(value)) for topic, value in (pair.split(":") for pair in strength.split(",")))
+
+  # the topics given with -L, if any, or num_topics random ones
   @handle_exception
-  def selectTopics(self):
+  def selectTopics(self, topiclist=""):
+    if topiclist:
+      self.topiclist = topiclist.split(",")
+      self.num_topics = len(self.topiclist)
+      return
     topicSelector = TopicSelector()
     self.topiclist = topicSelector.interest(self.num_topics)  # let topic selector give us the desired num of topics
 
@@ -154,6 +221,11 @@ def parseCmdLineArgs():
   parser.add_argument("-f", "--frequency", type=int,default=1, help="Rate at which topics disseminated: default once a second - use integers")
   parser.add_argument("-i", "--iters", type=int, default=1000, help="number of publication iterations (default: 1000)")
   parser.add_argument("-l", "--loglevel", type=int, default=logging.INFO, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 20=logging.INFO")
+  parser.add_argument ("-j", "--dht_json", default="dht.json", help="JSON file with all DHT nodes, default dht.json")
+  parser.add_argument ("-A", "--asyncio", action="store_true", help="Run on the asyncio middleware instead of the Reactor event loop")
+  parser.add_argument ("-g", "--group", default="", help="Publisher group we are a worker of (see PublisherGroupAppln.py), advertised with our registration; default none")
+  parser.add_argument ("-L", "--topiclist", default="", help="Comma separated topics to publish instead of -T random ones")
+  parser.add_argument ("-s", "--strength", default="0", help="Ownership strength with Ownership=Exclusive, one number or topic:number pairs separated by commas, default 0")
   # New code for PA3
   parser.add_argument ("-z", "--zookeeper", default="localhost:2181", help="IPv4 address for the zookeeper service, default = localhost:2181")
   return parser.parse_args()
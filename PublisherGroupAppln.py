@@ -0,0 +1,149 @@
+# Purpose:
+#
+# One logical publisher for capacity testing, spread over worker processes: a single
+# PublisherAppln runs out of its Python core long before the network does. We fork -N workers,
+# each pinned to a core of its own and running a real PublisherAppln with its own PUB socket
+# (port -p + i) and its share of the group's -T topics, dealt out round robin; with more workers
+# than topics, workers share topics. Every worker registers as the publisher {name}-w{i} and
+# advertises the group it belongs to (-g of PublisherAppln, the "group" of its locality), so
+# subscribers find and connect to all endpoints of the group through the usual lookups and
+# watches, without knowing about groups.
+#
+# Each worker disseminates -i rounds at -f rounds per second (a high -f, e.g. 100000, is as fast
+# as the worker can go) and reports back how many messages it sent and over what time. We print
+# the per worker stats and the aggregate rate of the group, from the first message of any worker
+# to the last one of all (CLOCK_MONOTONIC is shared by the processes of a host); -o writes them
+# to a CSV file as well. With Ownership=Exclusive keep -N at most -T, or only the strongest
+# worker of a shared topic gets through.
+
+import os
+import time
+import queue
+import argparse # for argument parsing
+import logging # for logging. Use it in place of print statements.
+import multiprocessing
+from types import SimpleNamespace
+from topic_selector import TopicSelector
+from PublisherAppln import PublisherAppln
+
+# Worker process: one PublisherAppln on its core, publishing its topics until done
+def groupWorker(index, core, topics, args, report):
+  logger = logging.getLogger("PublisherGroupAppln.w" + str(index))
+  logger.setLevel(args.loglevel)
+  if core is not None:
+    os.sched_setaffinity(0, [core])
+  pub_args = SimpleNamespace(name=args.name + "-w" + str(index), addr=args.addr, port=args.port + index,
+                             discovery=args.discovery, num_topics=len(topics), config=args.config,
+                             frequency=args.frequency, iters=args.iters, loglevel=args.loglevel,
+                             dht_json=args.dht_json, asyncio=False, strength=args.strength,
+                             group=args.name, topiclist=",".join(topics), zookeeper=args.zookeeper)
+  pub_app = PublisherAppln(logger)
+  cpu = time.process_time()
+  try:
+    pub_app.configure(pub_args)
+    pub_app.driver()
+  finally:
+    report.put({"worker": pub_args.name, "core": core, "topics": "/".join(topics), "sent": pub_app.sent,
+                "started_at": pub_app.started_at, "completed_at": pub_app.completed_at,
+                "cpu_s": round(time.process_time() - cpu, 2)})
+
+class PublisherGroupAppln():
+  def __init__(self, logger):
+    self.args = None
+    self.topiclist = None # the topics of the group, dealt out to the workers
+    self.results = [] # one dict per worker
+    self.logger = logger
+
+  def configure(self, args):
+    self.logger.info("PublisherGroupAppln::configure")
+    self.args = args
+    self.topiclist = args.topiclist.split(",") if args.topiclist else TopicSelector().interest(args.num_topics)
+
+  # the topics of worker i of n
+  def topicsOf(self, i, n):
+    if n <= len(self.topiclist):
+      return self.topiclist[i::n]
+    return [self.topiclist[i % len(self.topiclist)]]
+
+  def driver(self):
+    self.logger.info("PublisherGroupAppln::driver - {} workers publishing {}".format(self.args.workers, self.topiclist))
+    cores = sorted(os.sched_getaffinity(0))
+    report = multiprocessing.Queue()
+    workers = []
+    for i in range(self.args.workers):
+      core = cores[i % len(cores)] if self.args.pin else None
+      worker = multiprocessing.Process(target=groupWorker, args=(i, core, self.topicsOf(i, self.args.workers), self.args, report))
+      worker.start()
+      workers.append(worker)
+    try:
+      while len(self.results) < len(workers):
+        try:
+          self.results.append(report.get(timeout=1))
+        except queue.Empty:
+          if not any(worker.is_alive() for worker in workers):
+            self.logger.warning("PublisherGroupAppln::driver - {} workers never reported".format(len(workers) - len(self.results)))
+            break
+    finally:
+      for worker in workers:
+        worker.terminate()
+        worker.join()
+    self.summarize()
+
+  def summarize(self):
+    for result in self.results:
+      secs = result["completed_at"] - result["started_at"] if result["completed_at"] and result["started_at"] else 0
+      result["secs"] = round(secs, 3)
+      result["msgs_per_s"] = round(result["sent"] / secs) if secs else 0
+    self.results.sort(key=lambda result: result["worker"])
+    header = ["worker", "core", "topics", "sent", "secs", "msgs_per_s", "cpu_s"]
+    done = [result for result in self.results if result["completed_at"] and result["started_at"]]
+    sent = sum(result["sent"] for result in self.results)
+    secs = max(result["completed_at"] for result in done) - min(result["started_at"] for result in done) if done else 0
+    total = {"worker": self.args.name, "core": "all", "topics": "/".join(self.topiclist), "sent": sent, "secs": round(secs, 3),
+             "msgs_per_s": round(sent / secs) if secs else 0, "cpu_s": round(sum(result["cpu_s"] for result in self.results), 2)}
+    rows = self.results + [total]
+    self.logger.warning(" ".join("{:>12}".format(h) for h in header))
+    for row in rows:
+      self.logger.warning(" ".join("{:>12}".format(str(row[h])) for h in header))
+    if self.args.output:
+      with open(self.args.output, "w") as f:
+        f.write(",".join(header) + "\n")
+        for row in rows:
+          f.write(",".join(str(row[h]) for h in header) + "\n")
+
+def parseCmdLineArgs():
+  parser = argparse.ArgumentParser(description="Publisher group: one logical publisher over many worker processes")
+  parser.add_argument("-n", "--name", default="pubgroup", help="Name of the group; worker i registers as {name}-w{i}")
+  parser.add_argument("-N", "--workers", type=int, default=os.cpu_count(), help="Number of worker processes, default one per core")
+  parser.add_argument("--no_pin", dest="pin", action="store_false", help="Do not pin every worker to a core of its own")
+  parser.add_argument("-a", "--addr", default="localhost", help="IP addr of this host to advertise (default: localhost)")
+  parser.add_argument("-p", "--port", type=int, default=5700, help="Port of worker 0; the others count up from it, default 5700")
+  parser.add_argument("-d", "--discovery", default="localhost:5555", help="IP Addr:Port combo for the discovery service, default localhost:5555")
+  parser.add_argument("-T", "--num_topics", type=int, choices=range(1,10), default=7, help="Number of topics of the group, currently restricted to max of 9")
+  parser.add_argument("-L", "--topiclist", default="", help="Comma separated topics of the group instead of -T random ones")
+  parser.add_argument("-c", "--config", default="config.ini", help="configuration file (default: config.ini)")
+  parser.add_argument("-f", "--frequency", type=int, default=1000, help="Rounds per second of every worker, one message per topic of the worker each: default 1000")
+  parser.add_argument("-i", "--iters", type=int, default=10000, help="number of rounds of every worker (default: 10000)")
+  parser.add_argument("-s", "--strength", default="0", help="Ownership strength of the workers with Ownership=Exclusive, default 0")
+  parser.add_argument("-o", "--output", default=None, help="CSV file to write the per worker and aggregate stats to")
+  parser.add_argument("-j", "--dht_json", default="dht.json", help="JSON file with all DHT nodes, default dht.json")
+  parser.add_argument("-z", "--zookeeper", default="localhost:2181", help="IPv4 address for the zookeeper service, default = localhost:2181")
+  parser.add_argument("-l", "--loglevel", type=int, default=logging.WARNING, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 30=logging.WARNING, as the workers log every message otherwise")
+  return parser.parse_args()
+
+def main():
+  try:
+    logging.info("Main - acquire a child logger and then log messages in the child")
+    logger = logging.getLogger("PublisherGroupAppln")
+    args = parseCmdLineArgs()
+    logger.setLevel(args.loglevel)
+    group_app = PublisherGroupAppln(logger)
+    group_app.configure(args)
+    group_app.driver()
+  except Exception as e:
+    logger.error("Exception caught in main - {}".format(e))
+    return
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+  main()
@@ -6,6 +6,7 @@ import configparser # for configuration parsing
 import logging # for logging. Use it in place of print statements.
 from topic_selector import TopicSelector
 from CS6381_MW.SubscriberMW import SubscriberMW
+from CS6381_MW.AsyncMW import AsyncSubscriberMW
 from CS6381_MW import discovery_pb2
 from CS6381_MW import topic_pb2
 from functools import wraps
@@ -13,6 +14,7 @@ from functools import wraps
 # import any other packages you need.
 from enum import Enum  # for an enumeration we are using to describe what state we are in
 import csv
+import signal
 from datetime import datetime
 
 class SubscriberAppln():
@@ -45,7 +47,10 @@ class SubscriberAppln():
     self.state = self.State.INITIALIZE # state that are we in
     self.lookup = None # one of the diff ways we do lookup
     self.dissemination = None # direct or via broker
-    self.msg_list = []
+    self.msg_list = [] # CSV rows not written to sample.csv yet
+    self.flush_ms = 1000 # how often msg_list is written out
+    self.retry_ms = 10000 # how long to wait before asking again if the system is ready
+    self.asyncio = False # run on the asyncio middleware (AsyncMW) instead of the Reactor
 
   @handle_exception
   def configure (self, args):
@@ -62,7 +67,8 @@ class SubscriberAppln():
     self.logger.info("SubscriberAppln::configure - selecting our topic list")
     self.subscribeTopics()
     self.logger.info("SubscriberAppln::configure - initialize the middleware object")
-    self.mw_obj = SubscriberMW(self.logger)
+    self.asyncio = args.asyncio
+    self.mw_obj = AsyncSubscriberMW(self.logger) if self.asyncio else SubscriberMW(self.logger)
     self.mw_obj.configure(args) # pass remainder of the args to the m/w object
     self.logger.info("SubscriberAppln::configure - configuration complete")
 
@@ -72,10 +78,27 @@ class SubscriberAppln():
     self.dump()
     self.logger.info("SubscriberAppln::driver - upcall handle")
     self.mw_obj.set_upcall_handle(self)
+    if self.lookup != "DHT":
+      self.mw_obj.setWatch(self.topiclist) # follow the publishers of our topics as they come and go
     self.state = self.State.REGISTER
-    self.mw_obj.event_loop(timeout=0)  # start the event loop
+    self.mw_obj.schedule(self.flush_ms, self.flushCSV, "SubscriberAppln.flush", self.flush_ms)
+    try:
+      if self.asyncio:
+        self.mw_obj.drive(self.asyncDriver())
+      else:
+        self.mw_obj.event_loop(timeout=0)  # start the event loop
+    finally:
+      self.flushCSV()
     self.logger.info("SubscriberAppln::driver completed")
 
+  # the same steps as the state machine, as one coroutine on the asyncio middleware
+  async def asyncDriver(self):
+    self.register_response(await self.mw_obj.register(self.name, self.topiclist))
+    await self.mw_obj.waitReady(self.retry_ms)
+    self.state = self.State.CHECKMSG
+    self.receiveSubscribedPublishersResponse(await self.mw_obj.lookupTopics(self.topiclist))
+    await self.mw_obj.run() # messages come in through data_received
+
   @handle_exception
   def invoke_operation (self):
     self.logger.info ("SubscriberAppln::invoke_operation")
@@ -92,14 +115,7 @@ class SubscriberAppln():
       self.mw_obj.receiveSubscribedPublishers(self.topiclist)
       return None
     elif self.state == self.State.RECEIVE:
-      while True:
-        msg = self.mw_obj.receive()
-        self.logger.info(msg)
-        current_time = datetime.now().strftime('%H-%M-%S-%f')[:-3]
-        self.saveCSV(msg, current_time)
-        self.logger.info("SubscriberAppln::invoke_operation - RECEIVING Messages as shown below: {}".format (msg))
-        self.logger.info("SubscriberAppln::invoke_operation - Current time: {}".format (current_time))
-      return None
+      return None # messages come in through data_received
     elif self.state == self.State.COMPLETED:
       self.mw_obj.disable_event_loop()
       return None
@@ -123,11 +139,21 @@ class SubscriberAppln():
     self.logger.info("SubscriberAppln::isready_response")
     if not isready_resp.status:
       self.logger.info("SubscriberAppln::driver - Not ready yet; check again")
-      time.sleep (10)  # sleep between calls so that we don't make excessive calls
-    else:
-      self.state = self.State.CHECKMSG
+      # ask again later so that we don't make excessive calls; the timer brings us back to invoke_operation
+      self.mw_obj.schedule(self.retry_ms, lambda: 0, "SubscriberAppln.isready_retry")
+      return None
+    self.state = self.State.CHECKMSG
     return 0
 
+  # upcall made by the middleware for every message delivered to us
+  @handle_exception
+  def data_received(self, msg):
+    current_time = datetime.now().strftime('%H-%M-%S-%f')[:-3]
+    self.saveCSV(msg, current_time)
+    self.logger.info("SubscriberAppln::data_received - RECEIVING Messages as shown below: {}".format (msg))
+    self.logger.info("SubscriberAppln::data_received - Current time: {}".format (current_time))
+    return None
+
   @handle_exception
   def dump(self):
     self.logger.info("**********************************")
@@ -167,6 +193,13 @@ class SubscriberAppln():
       "latency" : latency, # in milliseconds
       "receivedFromBroker" : receivedFromBroker
     }
+    self.msg_list.append(msgDict) # written out by flushCSV
+
+  # timer: append the rows collected since the last flush to sample.csv in one go
+  @handle_exception
+  def flushCSV(self):
+    if not self.msg_list:
+      return None
     with open("sample.csv", "a+") as outfile:
       writer = csv.DictWriter(outfile, fieldnames = ["pub_id", "topic", "disseminationdata", 
                                                        "sent_time", "sub_id", "received_time", 
@@ -174,7 +207,9 @@ class SubscriberAppln():
                                                        "receivedFromBroker"])
       if outfile.tell() == 0: # if file is empty, write the header
         writer.writeheader()
-      writer.writerow(msgDict)
+      writer.writerows(self.msg_list)
+    self.msg_list = []
+    return None
 
   @handle_exception    
   def receiveSubscribedPublishersResponse(self, lookup_resp):
@@ -224,11 +259,15 @@ def parseCmdLineArgs():
   parser.add_argument("-f", "--frequency", type=int,default=1, help="Rate at which topics disseminated: default once a second - use integers")
   parser.add_argument("-i", "--iters", type=int, default=1000, help="number of publication iterations (default: 1000)")
   parser.add_argument("-l", "--loglevel", type=int, default=logging.INFO, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 20=logging.INFO")
-   # New code for PA3
+  parser.add_argument ("-j", "--dht_json", default="dht.json", help="JSON file with all DHT nodes, default dht.json")
+  # New code for PA3
   parser.add_argument ("-z", "--zookeeper", default="localhost:2181", help="IPv4 address for the zookeeper service, default = localhost:2181")
+  parser.add_argument ("-A", "--asyncio", action="store_true", help="Run on the asyncio middleware instead of the Reactor event loop")
   return parser.parse_args()
 
 def main ():
+  # exit through the driver's cleanup on SIGTERM too, so the last rows reach sample.csv
+  signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
   try:
     logging.info("Main - acquire a child logger and then log messages in the child")
     logger = logging.getLogger("SubscriberAppln")
@@ -0,0 +1,179 @@
+# Purpose:
+#
+# Compares the asyncio middleware (CS6381_MW/AsyncMW.py) with the Reactor event loop on the data
+# plane. For every loop a publisher and a subscriber process are wired to each other directly
+# (no discovery, no ZooKeeper), the publisher sending with PublisherMW.disseminate or
+# AsyncPublisherMW.disseminate and the subscriber receiving through SubscriberMW's reactor
+# handler or AsyncSubscriberMW.run, which hands every message to the data_received upcall (a
+# coroutine on the asyncio side). Every message carries the time it was sent (CLOCK_MONOTONIC is
+# shared by the processes of a host). Two phases are run per loop:
+#
+#   flood   -n messages as fast as the publisher can send them; msgs_per_s is what the
+#           subscriber received per second, between the first and the last message
+#   paced   -m messages at -r per second; lat_p50_us / lat_p99_us is the one-way latency from
+#           disseminate to the upcall, mostly what the loops cost per message when not saturated
+#
+# cpu_pct is the CPU the subscriber used relative to the wall clock time of the phase. High water
+# marks are lifted so that the flood is not measured by what PUB drops.
+
+import time
+import asyncio
+import argparse # argument parsing
+import logging # for logging. Use it in place of print statements.
+import multiprocessing
+import zmq
+from CS6381_MW.PublisherMW import PublisherMW
+from CS6381_MW.SubscriberMW import SubscriberMW
+from CS6381_MW.AsyncMW import AsyncPublisherMW, AsyncSubscriberMW
+
+TOPIC = "weather"
+
+class Collector():
+    def __init__(self, mw_obj):
+        self.mw_obj = mw_obj
+        self.latencies = []
+        self.first = None
+        self.last = None
+
+    def invoke_operation(self):
+        return None
+
+    def data_received(self, msg):
+        sent = int(msg.split(":")[2])
+        if sent < 0:
+            self.mw_obj.disable_event_loop() # the publisher is done
+            return None
+        self.last = time.monotonic_ns()
+        if self.first is None:
+            self.first = self.last
+        self.latencies.append((self.last - sent) / 1000.0)
+        return None
+
+class AsyncCollector(Collector):
+    async def data_received(self, msg):
+        return super().data_received(msg)
+
+# Subscriber: bind a SUB socket and deliver to the collector until the publisher is done
+def subscriberWorker(loop, args, ready, report):
+    logger = logging.getLogger("AsyncBenchmark.sub")
+    logger.setLevel(logging.WARNING) # one line per message otherwise
+    mw_obj = AsyncSubscriberMW(logger) if loop == "asyncio" else SubscriberMW(logger)
+    mw_obj.sub = mw_obj.context.socket(zmq.SUB)
+    mw_obj.sub.setsockopt(zmq.RCVHWM, 0)
+    mw_obj.sub.bind("tcp://*:" + str(args.port))
+    mw_obj.subscribeTopics([TOPIC])
+    collector = AsyncCollector(mw_obj) if loop == "asyncio" else Collector(mw_obj)
+    mw_obj.set_upcall_handle(collector)
+    ready.set()
+    wall, cpu = time.monotonic(), time.process_time()
+    if loop == "asyncio":
+        mw_obj.drive(mw_obj.run())
+    else:
+        mw_obj.reactor.register(mw_obj.sub, mw_obj.handle_data, "SubscriberMW.sub")
+        mw_obj.event_loop()
+    wall, cpu = time.monotonic() - wall, time.process_time() - cpu
+    latencies = sorted(collector.latencies)
+    elapsed = (collector.last - collector.first) / 1e9 if len(latencies) > 1 else 0
+    report.put({"received": len(latencies),
+                "msgs_per_s": round((len(latencies) - 1) / elapsed) if elapsed else 0,
+                "lat_p50_us": round(latencies[len(latencies) // 2], 1),
+                "lat_p99_us": round(latencies[int(len(latencies) * 0.99)], 1),
+                "cpu_pct": round(100 * cpu / wall, 1)})
+
+# the send times of a phase, in monotonic ns; None for as fast as we can
+def schedule(args, phase):
+    if phase == "flood":
+        return [None] * args.messages
+    start = time.monotonic_ns() + 1000000
+    return [start + int(i * 1e9 / args.rate) for i in range(args.paced)]
+
+def syncPublisher(mw_obj, args, phase):
+    for due in schedule(args, phase):
+        if due is not None and due > time.monotonic_ns():
+            time.sleep((due - time.monotonic_ns()) / 1e9)
+        mw_obj.disseminate("pub", TOPIC, str(time.monotonic_ns()), "-")
+    mw_obj.disseminate("pub", TOPIC, "-1", "-")
+
+async def asyncPublisher(mw_obj, args, phase):
+    for due in schedule(args, phase):
+        if due is not None and due > time.monotonic_ns():
+            await asyncio.sleep((due - time.monotonic_ns()) / 1e9)
+        await mw_obj.disseminate("pub", TOPIC, str(time.monotonic_ns()), "-")
+    await mw_obj.disseminate("pub", TOPIC, "-1", "-")
+
+class AsyncBenchmark():
+    def __init__(self, logger):
+        self.args = None
+        self.results = []
+        self.logger = logger
+
+    def configure(self, args):
+        self.logger.debug("AsyncBenchmark::configure")
+        self.args = args
+
+    def runPhase(self, loop, phase):
+        args = self.args
+        ready = multiprocessing.Event()
+        report = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=subscriberWorker, args=(loop, args, ready, report))
+        proc.start()
+        ready.wait()
+        logger = logging.getLogger("AsyncBenchmark.pub")
+        logger.setLevel(logging.WARNING)
+        mw_obj = AsyncPublisherMW(logger) if loop == "asyncio" else PublisherMW(logger)
+        mw_obj.pub = mw_obj.context.socket(zmq.PUB)
+        mw_obj.pub.setsockopt(zmq.SNDHWM, 0)
+        mw_obj.pub.connect("tcp://localhost:" + str(args.port))
+        time.sleep(0.5) # let the subscription reach us
+        if loop == "asyncio":
+            mw_obj.drive(asyncPublisher(mw_obj, args, phase))
+        else:
+            syncPublisher(mw_obj, args, phase)
+        result = dict({"loop": loop, "phase": phase}, **report.get())
+        proc.join()
+        mw_obj.pub.close()
+        self.logger.info("AsyncBenchmark::runPhase - {}".format(result))
+        return result
+
+    def driver(self):
+        self.logger.debug("AsyncBenchmark::driver")
+        for loop in self.args.loops.split(","):
+            for phase in ["flood", "paced"]:
+                self.results.append(self.runPhase(loop, phase))
+        header = list(self.results[0].keys())
+        self.logger.info(" ".join("{:>12}".format(h) for h in header))
+        for result in self.results:
+            self.logger.info(" ".join("{:>12}".format(result[h]) for h in header))
+        if self.args.output:
+            with open(self.args.output, "w") as f:
+                f.write(",".join(header) + "\n")
+                for result in self.results:
+                    f.write(",".join(str(result[h]) for h in header) + "\n")
+
+def parseCmdLineArgs ():
+    parser = argparse.ArgumentParser(description="Asyncio middleware vs Reactor benchmark")
+    parser.add_argument("-L", "--loops", default="reactor,asyncio", help="Comma separated event loops to compare, default reactor,asyncio")
+    parser.add_argument("-n", "--messages", type=int, default=100000, help="Messages of the flood phase, default 100000")
+    parser.add_argument("-m", "--paced", type=int, default=5000, help="Messages of the paced phase, default 5000")
+    parser.add_argument("-r", "--rate", type=int, default=1000, help="Messages per second of the paced phase, default 1000")
+    parser.add_argument("-p", "--port", type=int, default=5591, help="Port of the subscriber, default 5591")
+    parser.add_argument("-o", "--output", default=None, help="CSV file to write the results to")
+    parser.add_argument("-l", "--loglevel", type=int, default=logging.INFO, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 20=logging.INFO")
+    return parser.parse_args()
+
+def main():
+    try:
+        logging.info("Main - acquire a child logger and then log messages in the child")
+        logger = logging.getLogger("AsyncBenchmark")
+        args = parseCmdLineArgs()
+        logger.setLevel(args.loglevel)
+        benchmark = AsyncBenchmark(logger)
+        benchmark.configure(args)
+        benchmark.driver()
+    except Exception as e:
+        logger.error("Exception caught in main - {}".format(e))
+        return
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    main()
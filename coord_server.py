@@ -0,0 +1,40 @@
+# Purpose:
+#
+# Runs the in-process coordination backend (CS6381_MW/Coordination.py) as a standalone server, a
+# stand-in for ZooKeeper when none is available. Start it once and point every component at it
+# with -z local://<addr>:<port>, e.g.
+#
+#   python3 coord_server.py -p 2182 &
+#   python3 DiscoveryAppln.py -n disc1 -p 5555 -z local://127.0.0.1:2182 ...
+#
+# It keeps the znode tree in memory only, so restarting it starts from an empty tree.
+
+import argparse # argument parsing
+import logging # for logging. Use it in place of print statements.
+from CS6381_MW.Coordination import LocalCoordServer
+
+def parseCmdLineArgs ():
+    parser = argparse.ArgumentParser(description="Local coordination server")
+    parser.add_argument("-a", "--addr", default="127.0.0.1", help="IP address to listen on, default 127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=2182, help="Port to listen on, default 2182")
+    parser.add_argument("-s", "--session_timeout", type=int, default=4000, help="Session timeout in msec for clients that do not propose one, default 4000")
+    parser.add_argument("-l", "--loglevel", type=int, default=logging.INFO, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 20=logging.INFO")
+    return parser.parse_args()
+
+def main():
+    try:
+        logging.info("Main - acquire a child logger and then log messages in the child")
+        logger = logging.getLogger("CoordServer")
+        args = parseCmdLineArgs()
+        logger.setLevel(args.loglevel)
+        server = LocalCoordServer("tcp://{}:{}".format(args.addr, args.port), logger, args.session_timeout)
+        server.serve()
+    except KeyboardInterrupt:
+        return
+    except Exception as e:
+        logger.error("Exception caught in main - {}".format(e))
+        return
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    main()
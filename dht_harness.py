@@ -0,0 +1,199 @@
+# Purpose:
+#
+# Local multi-process harness for the Chord based discovery service (Strategy=DHT).
+#
+# For each requested ring size we generate a dht.json with that many discovery nodes on
+# localhost, and spread the nodes over a few worker processes. Each worker hosts its share of
+# the ring as real DiscoveryAppln/DiscoveryMW objects and services all of their sockets from a
+# single Reactor, so a 1000 node ring does not need 1000 interpreters.
+#
+# The harness process then plays the clients: it registers a number of publishers, each with a
+# few topics, through random entry nodes and afterwards issues single topic lookups, again
+# through random entry nodes. The number of hops each request took around the ring is
+# reported back in the replies; we record it together with the round trip latency and print
+# the mean and tail of both per ring size. Chord should need about 0.5 * log2(N) + 1 hops on average.
+
+import os
+import math
+import time
+import json
+import random
+import tempfile
+import argparse # argument parsing
+import logging # for logging. Use it in place of print statements.
+import multiprocessing
+import zmq
+from types import SimpleNamespace
+from topic_selector import TopicSelector
+from CS6381_MW import discovery_pb2
+from CS6381_MW.ChordDHT import ChordRing
+from CS6381_MW.Common import Reactor
+from DiscoveryAppln import DiscoveryAppln
+
+# Worker process: host a subset of the ring nodes and service them until told to stop
+def dhtWorker(nodes, dht_json, config_file, ready, stop):
+    logger = logging.getLogger("DHTWorker")
+    logger.setLevel(logging.WARNING)
+    # all the nodes share the process wide context; lift its default cap of 1023 sockets
+    zmq.Context.instance().set(zmq.MAX_SOCKETS, 64 * len(nodes) + 1024)
+    reactor = Reactor(logger) # one loop servicing the sockets of all our nodes
+    for node in nodes:
+        args = SimpleNamespace(name=node["id"], addr=node["IP"], port=node["port"], config=config_file,
+                               dht_json=dht_json, iters=0, frequency=1, num_topics=1, no_pubs=0,
+                               no_subs=0, no_broker=0, quorum=1, zookeeper=None, asyncio=False)
+        disc_app = DiscoveryAppln(logger)
+        disc_app.configure(args)
+        disc_app.mw_obj.set_upcall_handle(disc_app)
+        for sock, handler in disc_app.mw_obj.reactor.handlers.items():
+            reactor.register(sock, handler.callback, node["id"] + "." + handler.name, handler.budget)
+    ready.put(len(nodes))
+    reactor.schedule(100, lambda: stop.is_set() and reactor.stop(), "stop", interval_ms=100)
+    reactor.run(lambda: None)
+
+class DHTHarness():
+    def __init__(self, logger):
+        self.sizes = None # ring sizes to test
+        self.workers = None # number of worker processes hosting the ring
+        self.base_port = None # first port used by the discovery nodes
+        self.num_pubs = None # publishers registered before the lookups
+        self.num_topics = None # size of the topic space the publishers draw from
+        self.lookups = None # number of lookups per ring size
+        self.output = None # optional CSV file for the results
+        self.results = []
+        self.logger = logger
+
+    def configure(self, args):
+        self.logger.debug("DHTHarness::configure")
+        self.sizes = [int(n) for n in args.sizes.split(",")]
+        self.workers = args.workers
+        self.base_port = args.base_port
+        self.num_pubs = args.num_pubs
+        self.num_topics = args.num_topics
+        self.lookups = args.lookups
+        self.output = args.output
+        self.tmpdir = tempfile.mkdtemp(prefix="dht_harness_")
+        self.config_file = os.path.join(self.tmpdir, "config.ini")
+        with open(self.config_file, "w") as f:
+            f.write("[Discovery]\nStrategy=DHT\n\n[Dissemination]\nStrategy=Direct\n")
+        # the real topics plus synthetic ones so that the keys land all over the ring
+        self.topics = TopicSelector.topiclist + ["topic" + str(i) for i in range(max(self.num_topics - len(TopicSelector.topiclist), 0))]
+
+    def genRing(self, size, base_port):
+        nodes = []
+        for i in range(size):
+            node = {"id": "disc" + str(i + 1), "IP": "127.0.0.1", "port": base_port + i, "host": "localhost"}
+            node["hash"] = ChordRing.hashOf(node["id"] + ":" + node["IP"] + ":" + str(node["port"]))
+            nodes.append(node)
+        dht_json = os.path.join(self.tmpdir, "dht_{}.json".format(size))
+        with open(dht_json, "w") as f:
+            json.dump({"dht": nodes}, f)
+        return nodes, dht_json
+
+    def request(self, entries, disc_req):
+        req = random.choice(entries)
+        start = time.perf_counter()
+        req.send(disc_req.SerializeToString())
+        disc_resp = discovery_pb2.DiscoveryResp()
+        disc_resp.ParseFromString(req.recv())
+        return disc_resp, (time.perf_counter() - start) * 1000
+
+    def runSize(self, size, base_port):
+        self.logger.info("DHTHarness::runSize - {} nodes over {} workers".format(size, self.workers))
+        nodes, dht_json = self.genRing(size, base_port)
+        ready = multiprocessing.Queue()
+        stop = multiprocessing.Event()
+        procs = []
+        for w in range(self.workers):
+            proc = multiprocessing.Process(target=dhtWorker, args=(nodes[w::self.workers], dht_json, self.config_file, ready, stop))
+            proc.start()
+            procs.append(proc)
+        for _ in procs:
+            ready.get(timeout=300) # raises if a worker died while building its share of the ring
+        context = zmq.Context.instance()
+        entries = []
+        for node in random.sample(nodes, min(size, 32)):
+            req = context.socket(zmq.REQ)
+            req.connect(ChordRing.endpoint(node))
+            entries.append(req)
+        try:
+            reg_hops = []
+            for i in range(self.num_pubs):
+                disc_req = discovery_pb2.DiscoveryReq()
+                disc_req.msg_type = discovery_pb2.TYPE_REGISTER
+                disc_req.register_req.role = discovery_pb2.ROLE_PUBLISHER
+                disc_req.register_req.info.id = "pub" + str(i + 1)
+                disc_req.register_req.info.addr = "127.0.0.1"
+                disc_req.register_req.info.port = 7000 + i
+                disc_req.register_req.topiclist[:] = random.sample(self.topics, 3)
+                disc_resp, _ = self.request(entries, disc_req)
+                reg_hops.append(disc_resp.register_resp.hops)
+            hops = []
+            latency = []
+            for _ in range(self.lookups):
+                disc_req = discovery_pb2.DiscoveryReq()
+                disc_req.msg_type = discovery_pb2.TYPE_LOOKUP_PUB_BY_TOPIC
+                disc_req.lookup_req.topiclist[:] = [random.choice(self.topics)]
+                disc_resp, elapsed = self.request(entries, disc_req)
+                hops.append(disc_resp.lookup_resp.hops)
+                latency.append(elapsed)
+        finally:
+            for req in entries:
+                req.close(linger=0)
+            stop.set()
+            for proc in procs:
+                proc.join()
+        hops.sort()
+        latency.sort()
+        result = {"nodes": size, "log2N": round(math.log2(size), 2),
+                  "reg_hops_mean": round(sum(reg_hops) / len(reg_hops), 2) if reg_hops else 0,
+                  "hops_mean": round(sum(hops) / len(hops), 2), "hops_p99": hops[int(0.99 * (len(hops) - 1))],
+                  "hops_max": hops[-1], "latency_mean_ms": round(sum(latency) / len(latency), 3),
+                  "latency_p50_ms": round(latency[len(latency) // 2], 3),
+                  "latency_p99_ms": round(latency[int(0.99 * (len(latency) - 1))], 3)}
+        self.logger.info("DHTHarness::runSize - {}".format(result))
+        return result
+
+    def driver(self):
+        self.logger.debug("DHTHarness::driver")
+        base_port = self.base_port
+        for size in self.sizes:
+            self.results.append(self.runSize(size, base_port))
+            base_port += size # fresh ports for every ring so we never race the previous one
+        header = list(self.results[0].keys())
+        self.logger.info(" ".join("{:>15}".format(h) for h in header))
+        for result in self.results:
+            self.logger.info(" ".join("{:>15}".format(result[h]) for h in header))
+        if self.output:
+            with open(self.output, "w") as f:
+                f.write(",".join(header) + "\n")
+                for result in self.results:
+                    f.write(",".join(str(result[h]) for h in header) + "\n")
+
+def parseCmdLineArgs ():
+    parser = argparse.ArgumentParser(description="DHT discovery harness")
+    parser.add_argument("-N", "--sizes", default="20,50,100,200,500,1000", help="Comma separated ring sizes to test, default 20,50,100,200,500,1000")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="Number of worker processes hosting the ring, default 4")
+    parser.add_argument("-p", "--base_port", type=int, default=6000, help="First port used by the discovery nodes, default 6000")
+    parser.add_argument("-P", "--num_pubs", type=int, default=50, help="Number of publishers registered before the lookups, default 50")
+    parser.add_argument("-T", "--num_topics", type=int, default=100, help="Number of distinct topics the publishers draw from, default 100")
+    parser.add_argument("-L", "--lookups", type=int, default=500, help="Number of lookups per ring size, default 500")
+    parser.add_argument("-o", "--output", default=None, help="CSV file to write the results to")
+    parser.add_argument("-l", "--loglevel", type=int, default=logging.INFO, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 20=logging.INFO")
+    return parser.parse_args()
+
+def main():
+    try:
+        logging.info("Main - acquire a child logger and then log messages in the child")
+        logger = logging.getLogger("DHTHarness")
+        args = parseCmdLineArgs()
+        logger.setLevel(args.loglevel)
+        harness = DHTHarness(logger)
+        harness.configure(args)
+        harness.driver()
+    except Exception as e:
+        logger.error("Exception caught in main - {}".format(e))
+        return
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    main()
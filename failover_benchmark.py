@@ -0,0 +1,246 @@
+# Purpose:
+#
+# Failover benchmark for the ZooKeeper based discovery service (Strategy=Centralized).
+#
+# Every round starts a discovery quorum and N clients. Each client is connected to all the
+# replicas (PinguMW.watchDiscovery) and issues lookups (which any replica may answer) and
+# registrations (which only the leader can apply) every few msec, resending a request that got
+# no answer within the retry interval. Once both kinds are being served, we kill the leader with
+# SIGKILL, so it cannot close its ZooKeeper session, and record:
+#
+#   takeover_ms   until /leader names the standby that took over
+#   lookup_ms     until each client completed its next lookup issued after the kill
+#   register_ms   until each client completed its next successful registration issued after the kill
+#
+# The takeover is bounded below by SessionTimeoutMs in the config, which is how long ZooKeeper
+# takes to notice that the leader died; the rest is the election and the clients catching up.
+#
+# Needs a running ZooKeeper (-z), or a local coordination server with -z local://127.0.0.1:2182;
+# -S starts one in this process.
+
+import time
+import json
+import argparse # argument parsing
+import configparser
+import logging # for logging. Use it in place of print statements.
+import multiprocessing
+import threading
+import zmq
+from CS6381_MW import discovery_pb2
+from CS6381_MW.Common import PinguMW
+from CS6381_MW.Coordination import LOCAL_SCHEME, LocalCoordServer, coordinationClient
+from startup_benchmark import discoveryWorker
+
+# One request, resent every retry_ms until some replica answers it. We do not run an event
+# loop, so while waiting we run the watch callbacks the Reactor queued for us (replicas joining
+# or leaving, see PinguMW.onLoop) as soon as they are posted
+def request(mw_obj, buf, retry_ms):
+    poller = zmq.Poller()
+    poller.register(mw_obj.req, zmq.POLLIN)
+    poller.register(mw_obj.reactor.wake_in, zmq.POLLIN)
+    while True:
+        mw_obj.reactor.runCalls()
+        try:
+            mw_obj.req.send(buf, zmq.NOBLOCK)
+        except zmq.Again:
+            pass # not connected to any replica yet; the watch may still be on its way
+        deadline = time.time() + retry_ms / 1000.0
+        while time.time() < deadline:
+            events = dict(poller.poll(timeout=max(0, int((deadline - time.time()) * 1000))))
+            mw_obj.reactor.runCalls()
+            if mw_obj.req in events:
+                disc_resp = discovery_pb2.DiscoveryResp()
+                disc_resp.ParseFromString(mw_obj.req.recv())
+                return disc_resp
+
+# Probe: issue one kind of request every few msec until one issued after the kill is served
+def probe(kind, name, zk, args, killed_at, ready, served):
+    logger = logging.getLogger(name)
+    mw_obj = PinguMW(logger)
+    mw_obj.req = zmq.Context.instance().socket(zmq.REQ)
+    mw_obj.zk = zk
+    mw_obj.watchDiscovery("FailoverBenchmark")
+    seq = 0
+    while True:
+        seq += 1
+        disc_req = discovery_pb2.DiscoveryReq()
+        if kind == "lookup":
+            disc_req.msg_type = discovery_pb2.TYPE_LOOKUP_PUB_BY_TOPIC
+            disc_req.lookup_req.topiclist[:] = ["weather"]
+        else:
+            disc_req.msg_type = discovery_pb2.TYPE_REGISTER
+            disc_req.register_req.role = discovery_pb2.ROLE_PUBLISHER
+            disc_req.register_req.info.id = "{}-{}".format(name, seq)
+            disc_req.register_req.info.addr = "localhost"
+            disc_req.register_req.info.port = 9000
+            disc_req.register_req.topiclist[:] = ["weather"]
+            disc_req.register_req.lease_ms = 2000 # never renewed, so the leader forgets it soon
+        after_kill = killed_at.value and time.time() >= killed_at.value
+        disc_resp = request(mw_obj, disc_req.SerializeToString(), args.retry)
+        if kind == "lookup" or disc_resp.register_resp.status == discovery_pb2.STATUS_SUCCESS:
+            if after_kill:
+                served[kind] = (time.time() - killed_at.value) * 1000
+                return
+            ready.set()
+        time.sleep(args.interval / 1000.0)
+
+# Client: one lookup probe and one registration probe, each on its own REQ socket so that a
+# registration waiting for the new leader does not hold up the lookups
+def clientWorker(name, args, killed_at, readies, report):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.WARNING)
+    zk = coordinationClient(args.zookeeper, logger)
+    zk.start()
+    waiter = PinguMW(logger)
+    waiter.zk = zk
+    waiter.waitForZnode("FailoverBenchmark", "/leader", args.timeout)
+    served = {}
+    probes = [threading.Thread(target=probe, args=(kind, name, zk, args, killed_at, ready, served))
+              for kind, ready in zip(["lookup", "register"], readies)]
+    for thread in probes:
+        thread.start()
+    for thread in probes:
+        thread.join()
+    report.put((name, served["lookup"], served["register"]))
+    zk.stop()
+
+class FailoverBenchmark():
+    def __init__(self, logger):
+        self.args = None
+        self.results = []
+        self.server = None # local coordination server, with -S
+        self.session_timeout = None # SessionTimeoutMs of the discovery nodes
+        self.logger = logger
+
+    def configure(self, args):
+        self.logger.debug("FailoverBenchmark::configure")
+        self.args = args
+        config = configparser.ConfigParser()
+        config.read(args.config)
+        self.session_timeout = config.getint("Discovery", "SessionTimeoutMs", fallback=10000)
+        if args.serve:
+            if not args.zookeeper.startswith(LOCAL_SCHEME):
+                raise ValueError("-S needs a {}host:port address in -z".format(LOCAL_SCHEME))
+            endpoint = "tcp://" + args.zookeeper[len(LOCAL_SCHEME):]
+            self.server = LocalCoordServer(endpoint, self.logger).startInThread()
+        self.zk = coordinationClient(args.zookeeper, self.logger)
+        self.zk.start()
+
+    def cleanZK(self):
+        for path in ["/leader", "/election", "/discovery", "/publisher", "/subscriber", "/broker", "/topics"]:
+            if self.zk.exists(path):
+                self.zk.delete(path, recursive=True)
+
+    def leaderName(self):
+        try:
+            data, _ = self.zk.get("/leader")
+        except Exception:
+            return None
+        return json.loads(data.decode("utf-8"))["name"]
+
+    def runRound(self, rnd):
+        self.cleanZK()
+        args = self.args
+        report = multiprocessing.Queue()
+        killed_at = multiprocessing.Value("d", 0.0)
+        discs = {}
+        clients = []
+        base_port = args.base_port + rnd * 100 # fresh ports for every round
+        try:
+            for i in range(args.quorum):
+                name = "disc" + str(i + 1)
+                discs[name] = multiprocessing.Process(target=discoveryWorker, args=(name, base_port + 10 * i, args, report))
+                discs[name].start()
+            for _ in range(args.quorum):
+                report.get(timeout=args.timeout)
+            readies = []
+            for i in range(args.clients):
+                ready = [multiprocessing.Event(), multiprocessing.Event()] # lookup and registration served
+                proc = multiprocessing.Process(target=clientWorker, args=("cli" + str(i + 1), args, killed_at, ready, report))
+                proc.start()
+                clients.append(proc)
+                readies.extend(ready)
+            for ready in readies:
+                if not ready.wait(timeout=args.timeout):
+                    raise TimeoutError("a client did not get served before the kill")
+            old_leader = self.leaderName()
+            took_over = threading.Event()
+
+            @self.zk.DataWatch("/leader")
+            def watchLeader(data, stat):
+                if data and json.loads(data.decode("utf-8"))["name"] != old_leader:
+                    took_over.set()
+                    return False
+
+            killed_at.value = time.time()
+            discs[old_leader].kill()
+            if not took_over.wait(timeout=args.timeout):
+                raise TimeoutError("no standby took over from {}".format(old_leader))
+            takeover_ms = (time.time() - killed_at.value) * 1000
+            lookups, registers = [], []
+            for _ in range(args.clients):
+                name, lookup_ms, register_ms = report.get(timeout=args.timeout)
+                lookups.append(lookup_ms)
+                registers.append(register_ms)
+        finally:
+            for proc in clients + list(discs.values()):
+                proc.terminate()
+                proc.join()
+        result = {"round": rnd + 1, "session_timeout_ms": self.session_timeout, "killed": old_leader,
+                  "new_leader": self.leaderName(), "takeover_ms": round(takeover_ms, 1),
+                  "lookup_mean_ms": round(sum(lookups) / len(lookups), 1), "lookup_max_ms": round(max(lookups), 1),
+                  "register_mean_ms": round(sum(registers) / len(registers), 1), "register_max_ms": round(max(registers), 1)}
+        self.logger.info("FailoverBenchmark::runRound - {}".format(result))
+        return result
+
+    def driver(self):
+        self.logger.debug("FailoverBenchmark::driver")
+        try:
+            for rnd in range(self.args.rounds):
+                self.results.append(self.runRound(rnd))
+        finally:
+            self.zk.stop()
+            if self.server is not None:
+                self.server.stop()
+        header = list(self.results[0].keys())
+        self.logger.info(" ".join("{:>15}".format(h) for h in header))
+        for result in self.results:
+            self.logger.info(" ".join("{:>15}".format(result.get(h, "")) for h in header))
+        if self.args.output:
+            with open(self.args.output, "w") as f:
+                f.write(",".join(header) + "\n")
+                for result in self.results:
+                    f.write(",".join(str(result.get(h, "")) for h in header) + "\n")
+
+def parseCmdLineArgs ():
+    parser = argparse.ArgumentParser(description="Discovery leader failover benchmark")
+    parser.add_argument("-N", "--clients", type=int, default=4, help="Number of clients issuing requests, default 4")
+    parser.add_argument("-q", "--quorum", type=int, default=3, help="Number of discovery nodes in the quorum, default 3")
+    parser.add_argument("-r", "--rounds", type=int, default=5, help="Number of rounds, default 5")
+    parser.add_argument("-R", "--retry", type=int, default=100, help="Msec a client waits for a reply before resending, default 100")
+    parser.add_argument("-i", "--interval", type=int, default=10, help="Msec a client waits between requests, default 10")
+    parser.add_argument("-p", "--base_port", type=int, default=8000, help="First port used by the discovery nodes, default 8000")
+    parser.add_argument("-t", "--timeout", type=float, default=60, help="Seconds to wait for each step of a round, default 60")
+    parser.add_argument("-c", "--config", default="config.ini", help="configuration file (default: config.ini)")
+    parser.add_argument("-z", "--zookeeper", default="localhost:2181", help="IPv4 address for the zookeeper service, default = localhost:2181")
+    parser.add_argument("-S", "--serve", action="store_true", help="Start a local coordination server at the -z local:// address")
+    parser.add_argument("-o", "--output", default=None, help="CSV file to write the results to")
+    parser.add_argument("-l", "--loglevel", type=int, default=logging.INFO, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 20=logging.INFO")
+    return parser.parse_args()
+
+def main():
+    try:
+        logging.info("Main - acquire a child logger and then log messages in the child")
+        logger = logging.getLogger("FailoverBenchmark")
+        args = parseCmdLineArgs()
+        logger.setLevel(args.loglevel)
+        benchmark = FailoverBenchmark(logger)
+        benchmark.configure(args)
+        benchmark.driver()
+    except Exception as e:
+        logger.error("Exception caught in main - {}".format(e))
+        return
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,241 @@
+# Purpose:
+#
+# Shows what credit based flow control (Credits in [Feedback] of config.ini, see
+# CS6381_MW/Feedback.py) does under overload. A publisher offers -r messages per second for -t
+# seconds to -N subscribers, each in a process of its own; the first one is slow, spending -w
+# usec of work on every message, so that it cannot take what is offered. Two modes are run:
+#
+#   plain    PUB as it always was: the publisher keeps its rate, the queues of the slow
+#            subscriber fill up (-q is SndHwm and RcvHwm) and ZMQ drops what does not fit
+#   credits  every subscriber grants -C credits over the feedback side channel and the
+#            publisher skips its slots while the slowest one has none left (see
+#            PublisherMW.congested), as PublisherAppln skips its rounds
+#
+# The publisher sends through PublisherMW.disseminate and the subscribers receive through
+# SubscriberMW's reactor handler, as the applications would. For the publisher we report the
+# slots offered and the messages sent; for every subscriber what it received, lost (sent minus
+# received), its rate between its first and last message, how steady that rate was (cv, the
+# coefficient of variation of its per second counts) and its p99 latency from disseminate to
+# the upcall. A subscriber is done once nothing came for a second. Needs no ZooKeeper.
+#
+# The defaults offer 20000 msgs/s to a slow subscriber that takes about 4000 (250 usec each),
+# with queues of 200 messages, so that the backlog cannot hide in them. Plain mode should then
+# lose most of what the slow subscriber was sent (about two thirds) and deliver the rest
+# seconds late (lat_p99_ms in the thousands), while credits mode sends only what the slow
+# subscriber can take and loses nothing, with a p99 latency of tens of msec; the fast
+# subscriber is held to the same pace. Keep -C at most -q: a window larger than the queues can
+# overflow them when it is granted at once. With queues of thousands of messages, or a rate only
+# a little above what the slow subscriber takes, the kernel's socket buffers absorb the backlog
+# and plain mode hardly loses anything.
+
+import time
+import argparse # argument parsing
+import configparser
+import logging # for logging. Use it in place of print statements.
+import multiprocessing
+import statistics
+import zmq
+from CS6381_MW.PublisherMW import PublisherMW
+from CS6381_MW.SubscriberMW import SubscriberMW
+from CS6381_MW.Transport import Transport
+from CS6381_MW.Outbox import Outbox
+from CS6381_MW.Feedback import FeedbackServer, FeedbackClient
+
+TOPIC = "weather"
+IDLE_S = 1.0 # a subscriber is done after this long without a message
+
+def feedbackConfig(args):
+    config = configparser.ConfigParser()
+    config.read_dict({"Feedback": {"Enabled": "True", "Credits": str(args.credits), "AckMs": "50",
+                                   "LagThreshold": str(10 * args.credits), "ForgetMs": "5000"}})
+    return config
+
+class Collector():
+    def __init__(self, mw_obj, work_us):
+        self.mw_obj = mw_obj
+        self.work_ns = work_us * 1000
+        self.latencies = []
+        self.seconds = {} # whole seconds since the first message -> messages received in it
+        self.first = None
+        self.last = None
+
+    def invoke_operation(self):
+        return None
+
+    def data_received(self, msg):
+        now = time.monotonic_ns()
+        if self.work_ns:
+            while time.monotonic_ns() - now < self.work_ns:
+                pass # the slow subscriber's work on the message
+        self.last = time.monotonic_ns()
+        if self.first is None:
+            self.first = self.last
+        second = (self.last - self.first) // 1000000000
+        self.seconds[second] = self.seconds.get(second, 0) + 1
+        self.latencies.append((self.last - int(msg.split(":")[3])) / 1e6)
+        return None
+
+    # timer: done once nothing came for IDLE_S
+    def idle(self):
+        if self.last is not None and time.monotonic_ns() - self.last > IDLE_S * 1e9:
+            self.mw_obj.disable_event_loop()
+        return None
+
+# Subscriber: connect to the publisher, with the side channel in credits mode, and deliver to
+# the collector until the publisher has been quiet for a while
+def subscriberWorker(index, mode, port, args, ready, report):
+    logger = logging.getLogger("FlowBenchmark.sub" + str(index))
+    logger.setLevel(logging.WARNING) # one line per message otherwise
+    mw_obj = SubscriberMW(logger)
+    mw_obj.transport = Transport(logger, ["tcp"])
+    mw_obj.sub = mw_obj.context.socket(zmq.SUB)
+    Outbox.setHwm(mw_obj.sub, rcv=args.hwm)
+    mw_obj.subscribeTopics([TOPIC])
+    if mode == "credits":
+        mw_obj.feedback = FeedbackClient(logger, "sub" + str(index))
+        mw_obj.feedback.configure(feedbackConfig(args))
+        mw_obj.feedback.start(mw_obj)
+    collector = Collector(mw_obj, args.work if index == 0 else 0)
+    mw_obj.set_upcall_handle(collector)
+    mw_obj.reactor.register(mw_obj.sub, mw_obj.handle_data, "SubscriberMW.sub")
+    mw_obj.schedule(100, collector.idle, "FlowBenchmark.idle", 100)
+    mw_obj.connect("tcp://localhost:" + str(port))
+    ready.set()
+    mw_obj.event_loop()
+    if mw_obj.feedback is not None:
+        mw_obj.feedback.close()
+    mw_obj.sub.close(linger=0)
+    latencies = sorted(collector.latencies)
+    elapsed = (collector.last - collector.first) / 1e9 if len(latencies) > 1 else 0
+    full = [collector.seconds[s] for s in sorted(collector.seconds)][:-1] # the last second is partial
+    report.put({"subscriber": "slow" if index == 0 else "sub" + str(index), "received": len(latencies),
+                "msgs_per_s": round((len(latencies) - 1) / elapsed) if elapsed else 0,
+                "cv": round(statistics.pstdev(full) / statistics.mean(full), 3) if len(full) > 1 else 0,
+                "lat_p99_ms": round(latencies[int(len(latencies) * 0.99)], 1) if latencies else 0})
+
+class Source():
+    """The publisher's application: -r slots per second for -t seconds, each one a message
+    unless the middleware is congested"""
+
+    def __init__(self, mw_obj, args):
+        self.mw_obj = mw_obj
+        self.args = args
+        self.payload = "x" * args.size
+        self.start = None
+        self.offered = 0
+        self.sent = 0
+
+    def invoke_operation(self):
+        return None
+
+    # timer: the slots due since the last tick
+    def tick(self):
+        now = time.monotonic()
+        if self.start is None:
+            self.start = now
+        due = min(int((now - self.start) * self.args.rate), int(self.args.time * self.args.rate)) - self.offered
+        for _ in range(due):
+            self.offered += 1
+            if not self.mw_obj.congested():
+                self.mw_obj.disseminate("pub", TOPIC, self.payload, str(time.monotonic_ns()))
+                self.sent += 1
+        if now - self.start >= self.args.time:
+            self.mw_obj.disable_event_loop()
+        return None
+
+class FlowBenchmark():
+    def __init__(self, logger):
+        self.args = None
+        self.results = []
+        self.logger = logger
+
+    def configure(self, args):
+        self.logger.debug("FlowBenchmark::configure")
+        self.args = args
+
+    def runMode(self, mode):
+        args = self.args
+        logger = logging.getLogger("FlowBenchmark.pub")
+        logger.setLevel(logging.WARNING)
+        mw_obj = PublisherMW(logger)
+        mw_obj.transport = Transport(logger, ["tcp"])
+        mw_obj.pub = mw_obj.context.socket(zmq.PUB)
+        Outbox.setHwm(mw_obj.pub, snd=args.hwm)
+        port = args.port + len(self.results) # a fresh endpoint per mode; closed ones linger
+        locality = mw_obj.transport.bind(mw_obj.pub, "flow", "localhost", port)
+        if mode == "credits":
+            mw_obj.feedback = FeedbackServer(logger, "pub")
+            mw_obj.feedback.configure(feedbackConfig(args))
+            mw_obj.feedback.attach(mw_obj, locality["endpoints"])
+        report = multiprocessing.Queue()
+        workers = []
+        for i in range(args.subscribers):
+            ready = multiprocessing.Event()
+            worker = multiprocessing.Process(target=subscriberWorker, args=(i, mode, port, args, ready, report))
+            worker.start()
+            ready.wait()
+            workers.append(worker)
+        source = Source(mw_obj, args)
+        mw_obj.set_upcall_handle(source)
+        def start():
+            mw_obj.schedule(0, source.tick, "FlowBenchmark.tick", 1)
+            return None
+        mw_obj.schedule(500, start, "FlowBenchmark.start") # once the subscriptions, and the HELLOs, reached us
+        mw_obj.event_loop()
+        subs = sorted((report.get() for _ in workers), key=lambda result: result["subscriber"])
+        for worker in workers:
+            worker.join()
+        mw_obj.close()
+        mw_obj.pub.close(linger=0)
+        results = []
+        for sub in subs:
+            results.append(dict({"mode": mode, "offered": source.offered, "sent": source.sent}, **sub,
+                                lost=source.sent - sub["received"]))
+            self.logger.info("FlowBenchmark::runMode - {}".format(results[-1]))
+        return results
+
+    def driver(self):
+        self.logger.debug("FlowBenchmark::driver")
+        for mode in self.args.modes.split(","):
+            self.results += self.runMode(mode)
+        header = ["mode", "offered", "sent", "subscriber", "received", "lost", "msgs_per_s", "cv", "lat_p99_ms"]
+        self.logger.info(" ".join("{:>12}".format(h) for h in header))
+        for result in self.results:
+            self.logger.info(" ".join("{:>12}".format(result[h]) for h in header))
+        if self.args.output:
+            with open(self.args.output, "w") as f:
+                f.write(",".join(header) + "\n")
+                for result in self.results:
+                    f.write(",".join(str(result[h]) for h in header) + "\n")
+
+def parseCmdLineArgs ():
+    parser = argparse.ArgumentParser(description="Credit based flow control under overload")
+    parser.add_argument("-m", "--modes", default="plain,credits", help="Comma separated modes to run, plain and/or credits, default both")
+    parser.add_argument("-N", "--subscribers", type=int, default=2, help="Number of subscribers, the first of them slow, default 2")
+    parser.add_argument("-r", "--rate", type=int, default=20000, help="Messages per second the publisher offers, default 20000")
+    parser.add_argument("-t", "--time", type=float, default=5.0, help="Seconds the publisher offers them for, default 5")
+    parser.add_argument("-w", "--work", type=int, default=250, help="usec of work of the slow subscriber per message, default 250")
+    parser.add_argument("-C", "--credits", type=int, default=200, help="Credits of every subscriber in credits mode, at most -q, default 200")
+    parser.add_argument("-q", "--hwm", type=int, default=200, help="SndHwm of the publisher and RcvHwm of the subscribers, default 200")
+    parser.add_argument("-s", "--size", type=int, default=100, help="Payload size in bytes, default 100")
+    parser.add_argument("-p", "--port", type=int, default=5620, help="tcp port of the publisher's first mode, the next one counts up from it, default 5620")
+    parser.add_argument("-o", "--output", default=None, help="CSV file to write the results to")
+    parser.add_argument("-l", "--loglevel", type=int, default=logging.INFO, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 20=logging.INFO")
+    return parser.parse_args()
+
+def main():
+    try:
+        logging.info("Main - acquire a child logger and then log messages in the child")
+        logger = logging.getLogger("FlowBenchmark")
+        args = parseCmdLineArgs()
+        logger.setLevel(args.loglevel)
+        benchmark = FlowBenchmark(logger)
+        benchmark.configure(args)
+        benchmark.driver()
+    except Exception as e:
+        logger.error("Exception caught in main - {}".format(e))
+        return
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    main()
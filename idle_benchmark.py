@@ -0,0 +1,132 @@
+# Purpose:
+#
+# Idle policy benchmark for the Reactor (IdlePolicy in the [EventLoop] section of config.ini).
+#
+# For every policy a receiver process runs a Reactor with that policy and a PULL socket, the way
+# a subscriber or discovery node waits for its next message. A sender pushes messages in bursts
+# of -b, one every -g usec within a burst and -i msec apart between bursts, so that the receiver
+# goes idle between bursts. Every message carries the time it was sent (CLOCK_MONOTONIC is
+# shared by the processes of a host) and the receiver records:
+#
+#   wake_p50_us / wake_p99_us   one-way latency from send to the handler, which is mostly the
+#                               cost of waking the receiver up
+#   cpu_pct                     CPU the receiver used, relative to the wall clock time
+#   cpu_us_per_msg              the same per message received
+#
+# Block costs nothing while idle but pays the wake-up on every burst; BusyPoll is the other end.
+# Spin sits in between, depending on SpinPolls (-s) and on how far apart the messages are.
+# Needs no ZooKeeper.
+
+import time
+import argparse # argument parsing
+import logging # for logging. Use it in place of print statements.
+import multiprocessing
+import zmq
+from CS6381_MW.Common import Reactor
+
+# Receiver: service the PULL socket with the given policy until the sender is done
+def receiverWorker(policy, args, ready, report):
+    logger = logging.getLogger("IdleBenchmark." + policy)
+    logger.setLevel(logging.WARNING)
+    sock = zmq.Context.instance().socket(zmq.PULL)
+    sock.bind("tcp://*:" + str(args.port))
+    reactor = Reactor(logger)
+    reactor.setIdlePolicy(policy, args.spin_polls)
+    latencies = []
+
+    def handleMessage():
+        sent = int(sock.recv())
+        if sent < 0:
+            reactor.stop() # the sender is done
+        else:
+            latencies.append((time.monotonic_ns() - sent) / 1000.0)
+        return None
+
+    reactor.register(sock, handleMessage, "pull")
+    ready.set()
+    reactor.run(lambda: None)
+    latencies.sort()
+    loop = reactor.stats()["loop"]
+    report.put({"policy": policy, "messages": len(latencies),
+                "wake_p50_us": round(latencies[len(latencies) // 2], 1),
+                "wake_p99_us": round(latencies[int(len(latencies) * 0.99)], 1),
+                "cpu_pct": loop["cpu_pct"], "cpu_us_per_msg": loop["cpu_us_per_msg"],
+                "polls": loop["polls"], "empty_polls": loop["empty_polls"]})
+
+class IdleBenchmark():
+    def __init__(self, logger):
+        self.args = None
+        self.results = []
+        self.logger = logger
+
+    def configure(self, args):
+        self.logger.debug("IdleBenchmark::configure")
+        self.args = args
+
+    def runPolicy(self, policy):
+        args = self.args
+        ready = multiprocessing.Event()
+        report = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=receiverWorker, args=(policy, args, ready, report))
+        proc.start()
+        ready.wait()
+        sock = zmq.Context.instance().socket(zmq.PUSH)
+        sock.connect("tcp://localhost:" + str(args.port))
+        time.sleep(0.5) # let the connection settle
+        for _ in range(args.bursts):
+            for _ in range(args.burst):
+                sock.send(str(time.monotonic_ns()).encode("utf-8"))
+                pause = time.perf_counter() + args.gap / 1e6
+                while time.perf_counter() < pause:
+                    pass # sleeping is far coarser than the gaps we want
+            time.sleep(args.interval / 1000.0)
+        sock.send(b"-1")
+        result = report.get()
+        proc.join()
+        sock.close()
+        self.logger.info("IdleBenchmark::runPolicy - {}".format(result))
+        return result
+
+    def driver(self):
+        self.logger.debug("IdleBenchmark::driver")
+        for policy in self.args.policies.split(","):
+            self.results.append(self.runPolicy(policy))
+        header = list(self.results[0].keys())
+        self.logger.info(" ".join("{:>15}".format(h) for h in header))
+        for result in self.results:
+            self.logger.info(" ".join("{:>15}".format(result[h]) for h in header))
+        if self.args.output:
+            with open(self.args.output, "w") as f:
+                f.write(",".join(header) + "\n")
+                for result in self.results:
+                    f.write(",".join(str(result[h]) for h in header) + "\n")
+
+def parseCmdLineArgs ():
+    parser = argparse.ArgumentParser(description="Event loop idle policy benchmark")
+    parser.add_argument("-P", "--policies", default="Block,Spin,BusyPoll", help="Comma separated idle policies to compare, default Block,Spin,BusyPoll")
+    parser.add_argument("-s", "--spin_polls", type=int, default=1000, help="SpinPolls for the Spin policy, default 1000")
+    parser.add_argument("-n", "--bursts", type=int, default=200, help="Number of bursts, default 200")
+    parser.add_argument("-b", "--burst", type=int, default=10, help="Messages per burst, default 10")
+    parser.add_argument("-g", "--gap", type=int, default=50, help="Usec between the messages of a burst, default 50")
+    parser.add_argument("-i", "--interval", type=int, default=10, help="Msec between bursts, default 10")
+    parser.add_argument("-p", "--port", type=int, default=5590, help="Port of the receiver, default 5590")
+    parser.add_argument("-o", "--output", default=None, help="CSV file to write the results to")
+    parser.add_argument("-l", "--loglevel", type=int, default=logging.INFO, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 20=logging.INFO")
+    return parser.parse_args()
+
+def main():
+    try:
+        logging.info("Main - acquire a child logger and then log messages in the child")
+        logger = logging.getLogger("IdleBenchmark")
+        args = parseCmdLineArgs()
+        logger.setLevel(args.loglevel)
+        benchmark = IdleBenchmark(logger)
+        benchmark.configure(args)
+        benchmark.driver()
+    except Exception as e:
+        logger.error("Exception caught in main - {}".format(e))
+        return
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    main()
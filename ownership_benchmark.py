@@ -0,0 +1,175 @@
+# Purpose:
+#
+# Switchover benchmark for exclusive topic ownership (Ownership=Exclusive in config.ini).
+#
+# P publishers of the same topic announce themselves with strengths P, P-1, ..., 1 and publish
+# every few msec. A subscriber, driven by the real SubscriberMW watch and receive code, delivers
+# only the stream of the strongest live publisher. Every round kills the current owner, either
+# with SIGKILL (-k crash; ZooKeeper notices once its session expires) or by closing its session
+# (-k stop; its znodes go away at once), and reports the switchover the subscriber measured
+# (see CS6381_MW/Ownership.py):
+#
+#   gap_ms         between the last message of the old owner and the first of the new one
+#   detect_ms      of that, until the subscriber learnt that the owner was gone
+#   switchover_ms  of that, until the new owner's first message was delivered
+#
+# It also counts the messages the subscriber dropped since their publisher did not own the topic;
+# as it only connects to the owner there should be hardly any.
+#
+# Needs a running ZooKeeper (-z), or a local coordination server with -z local://127.0.0.1:2182;
+# -S starts one in this process.
+
+import os
+import json
+import time
+import signal
+import argparse # argument parsing
+import logging # for logging. Use it in place of print statements.
+import multiprocessing
+import zmq
+from datetime import datetime
+from CS6381_MW.Coordination import LOCAL_SCHEME, LocalCoordServer, coordinationClient
+from CS6381_MW.Ownership import Ownership
+from CS6381_MW.PublisherMW import PublisherMW
+from CS6381_MW.SubscriberMW import SubscriberMW
+
+TOPIC = "weather"
+
+# Publisher: announce ourselves with our strength and publish until killed or stopped
+def publisherWorker(name, port, strength, args):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.WARNING)
+    mw_obj = PublisherMW(logger)
+    mw_obj.addr = "localhost"
+    mw_obj.port = port
+    mw_obj.zk = coordinationClient(args.zookeeper, logger, args.session_timeout / 1000.0)
+    mw_obj.zk.start()
+    mw_obj.pub = zmq.Context.instance().socket(zmq.PUB)
+    mw_obj.pub.bind("tcp://*:" + str(port))
+    signal.signal(signal.SIGTERM, lambda *_: (mw_obj.zk.stop(), os._exit(0))) # a clean stop
+    data = {"id": {"id": name, "addr": mw_obj.addr, "port": port}, "topiclist": [TOPIC], "strength": strength}
+    mw_obj.announce("PublisherMW", name, json.dumps(data).encode("utf-8"), [TOPIC], "pub", "/publisher")
+    while True:
+        mw_obj.disseminate(name, TOPIC, "data", datetime.now().strftime('%H-%M-%S-%f')[:-3])
+        time.sleep(args.interval / 1000.0)
+
+class OwnershipBenchmark():
+    def __init__(self, logger):
+        self.args = None
+        self.server = None # local coordination server, with -S
+        self.logger = logger
+
+    def configure(self, args):
+        self.logger.debug("OwnershipBenchmark::configure")
+        self.args = args
+        if args.serve:
+            if not args.zookeeper.startswith(LOCAL_SCHEME):
+                raise ValueError("-S needs a {}host:port address in -z".format(LOCAL_SCHEME))
+            self.server = LocalCoordServer("tcp://" + args.zookeeper[len(LOCAL_SCHEME):], self.logger).startInThread()
+        self.zk = coordinationClient(args.zookeeper, self.logger)
+        self.zk.start()
+        for path in ["/publisher", "/topics"]:
+            if self.zk.exists(path):
+                self.zk.delete(path, recursive=True)
+
+    def subscriber(self):
+        logger = logging.getLogger("OwnershipBenchmark.sub")
+        logger.setLevel(logging.WARNING) # one line per message otherwise
+        mw_obj = SubscriberMW(logger)
+        mw_obj.zk = self.zk
+        mw_obj.dissemination = "Direct"
+        mw_obj.membership_window = 0
+        mw_obj.ownership = Ownership(logger)
+        mw_obj.sub = zmq.Context.instance().socket(zmq.SUB)
+        mw_obj.setWatch([TOPIC])
+        return mw_obj
+
+    def driver(self):
+        self.logger.debug("OwnershipBenchmark::driver")
+        args = self.args
+        pubs = {}
+        for i in range(args.publishers):
+            name = "pub" + str(i + 1)
+            pubs[name] = multiprocessing.Process(target=publisherWorker, args=(name, args.base_port + i, args.publishers - i, args))
+            pubs[name].start()
+        mw_obj = self.subscriber()
+        # we do not run the event loop, so the watch callbacks the Reactor queued for us
+        # (see PinguMW.onLoop) are run here as soon as they are posted
+        poller = zmq.Poller()
+        poller.register(mw_obj.sub, zmq.POLLIN)
+        poller.register(mw_obj.reactor.wake_in, zmq.POLLIN)
+        def step():
+            events = dict(poller.poll(timeout=100))
+            mw_obj.reactor.runCalls()
+            return mw_obj.sub in events and mw_obj.receive() is not None
+        received = 0
+        try:
+            for rnd in range(min(args.rounds, args.publishers - 1)):
+                owner = "pub" + str(rnd + 1) # the strongest one still alive
+                deadline = time.time() + args.timeout
+                while mw_obj.ownership.owners.get(TOPIC) != owner or received < args.warmup * (rnd + 1):
+                    if time.time() > deadline:
+                        raise TimeoutError("never heard from {}".format(owner))
+                    if step():
+                        received += 1
+                self.logger.info("OwnershipBenchmark::driver - round {}: {} owns {}, killing it".format(rnd + 1, owner, TOPIC))
+                if args.kill == "crash":
+                    pubs[owner].kill()
+                else:
+                    pubs[owner].terminate()
+                done = len(mw_obj.ownership.switchovers) + 1
+                while len(mw_obj.ownership.switchovers) < done:
+                    if time.time() > deadline + args.timeout:
+                        raise TimeoutError("no switchover away from {}".format(owner))
+                    if step():
+                        received += 1
+        finally:
+            for proc in pubs.values():
+                proc.kill()
+                proc.join()
+            self.zk.stop()
+            if self.server is not None:
+                self.server.stop()
+        header = ["topic", "from", "to", "gap_ms", "detect_ms", "switchover_ms"]
+        self.logger.info(" ".join("{:>15}".format(h) for h in header))
+        for switchover in mw_obj.ownership.switchovers:
+            self.logger.info(" ".join("{:>15}".format(switchover[h]) for h in header))
+        self.logger.info("OwnershipBenchmark::driver - {} messages delivered, {} dropped since their publisher did not own the topic".format(received, mw_obj.ownership.rejected))
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(",".join(header) + "\n")
+                for switchover in mw_obj.ownership.switchovers:
+                    f.write(",".join(str(switchover[h]) for h in header) + "\n")
+
+def parseCmdLineArgs ():
+    parser = argparse.ArgumentParser(description="Exclusive ownership switchover benchmark")
+    parser.add_argument("-P", "--publishers", type=int, default=4, help="Number of publishers of the topic, default 4")
+    parser.add_argument("-r", "--rounds", type=int, default=3, help="Number of owners to kill, at most P-1, default 3")
+    parser.add_argument("-k", "--kill", choices=["crash", "stop"], default="crash", help="SIGKILL the owner (crash) or close its session (stop), default crash")
+    parser.add_argument("-i", "--interval", type=int, default=5, help="Msec between two messages of a publisher, default 5")
+    parser.add_argument("-w", "--warmup", type=int, default=50, help="Messages to receive from each owner before killing it, default 50")
+    parser.add_argument("-T", "--session_timeout", type=int, default=4000, help="Session timeout of the publishers in msec, default 4000")
+    parser.add_argument("-p", "--base_port", type=int, default=9100, help="First port used by the publishers, default 9100")
+    parser.add_argument("-t", "--timeout", type=float, default=30, help="Seconds to wait for each step, default 30")
+    parser.add_argument("-z", "--zookeeper", default="localhost:2181", help="IPv4 address for the zookeeper service, default = localhost:2181")
+    parser.add_argument("-S", "--serve", action="store_true", help="Start a local coordination server at the -z local:// address")
+    parser.add_argument("-o", "--output", default=None, help="CSV file to write the switchovers to")
+    parser.add_argument("-l", "--loglevel", type=int, default=logging.INFO, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 20=logging.INFO")
+    return parser.parse_args()
+
+def main():
+    try:
+        logging.info("Main - acquire a child logger and then log messages in the child")
+        logger = logging.getLogger("OwnershipBenchmark")
+        args = parseCmdLineArgs()
+        logger.setLevel(args.loglevel)
+        benchmark = OwnershipBenchmark(logger)
+        benchmark.configure(args)
+        benchmark.driver()
+    except Exception as e:
+        logger.error("Exception caught in main - {}".format(e))
+        return
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    main()
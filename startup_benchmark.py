@@ -0,0 +1,155 @@
+# Purpose:
+#
+# Startup-time benchmark for the ZooKeeper based discovery service (Strategy=Centralized).
+#
+# Every round starts N clients (half publishers, half subscribers) first, and then the discovery
+# quorum one node at a time, stagger seconds apart. Every component runs in its own process and
+# reports when it is up: a discovery node once the quorum has formed and the leader is known,
+# a client once the discovery service has answered its registration. Since the quorum cannot
+# form before the last discovery node starts, we report the startup time of every component
+# relative to that instant. With watch-driven waits this is the cost of the ZooKeeper round trips
+# and our own registration, instead of being rounded up to the next tick of a sleep loop.
+#
+# Needs a running ZooKeeper (-z), or a local coordination server (coord_server.py) with
+# -z local://127.0.0.1:2182.
+
+import time
+import argparse # argument parsing
+import logging # for logging. Use it in place of print statements.
+import multiprocessing
+from types import SimpleNamespace
+from CS6381_MW import discovery_pb2
+from CS6381_MW.Coordination import coordinationClient
+from CS6381_MW.PublisherMW import PublisherMW
+from CS6381_MW.SubscriberMW import SubscriberMW
+from DiscoveryAppln import DiscoveryAppln
+
+# Discovery node: report once the quorum and leader are settled, then serve until terminated
+def discoveryWorker(name, port, args, report):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.WARNING)
+    disc_args = SimpleNamespace(name=name, addr="localhost", port=port, config=args.config,
+                                dht_json="dht.json", iters=0, frequency=1, num_topics=1,
+                                no_pubs=0, no_subs=0, no_broker=0, quorum=args.quorum, zookeeper=args.zookeeper,
+                                asyncio=False)
+    disc_app = DiscoveryAppln(logger)
+    disc_app.configure(disc_args)
+    report.put(("discovery", name, time.time()))
+    disc_app.driver()
+
+# Client: report once our registration has been answered
+def clientWorker(role, name, port, args, report):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.WARNING)
+    client_args = SimpleNamespace(name=name, addr="localhost", port=port, config=args.config,
+                                  dht_json="dht.json", zookeeper=args.zookeeper)
+    mw_obj = PublisherMW(logger) if role == "publisher" else SubscriberMW(logger)
+    mw_obj.configure(client_args)
+    # we run no event loop, so connect to the replicas watchDiscovery found ourselves (see PinguMW.onLoop)
+    mw_obj.reactor.runCalls()
+    mw_obj.register(name, ["weather"])
+    disc_resp = discovery_pb2.DiscoveryResp()
+    disc_resp.ParseFromString(mw_obj.req.recv())
+    if disc_resp.register_resp.status != discovery_pb2.STATUS_SUCCESS:
+        logger.error("{} failed to register: {}".format(name, disc_resp.register_resp.reason))
+    report.put((role, name, time.time()))
+
+class StartupBenchmark():
+    def __init__(self, logger):
+        self.args = None
+        self.results = []
+        self.logger = logger
+
+    def configure(self, args):
+        self.logger.debug("StartupBenchmark::configure")
+        self.args = args
+
+    def cleanZK(self):
+        # leftovers from a previous round would satisfy our waits before anybody started
+        zk = coordinationClient(self.args.zookeeper, self.logger)
+        zk.start()
+        for path in ["/leader", "/discovery", "/publisher", "/subscriber", "/broker", "/topics"]:
+            if zk.exists(path):
+                zk.delete(path, recursive=True)
+        zk.stop()
+
+    def runRound(self, rnd):
+        self.cleanZK()
+        args = self.args
+        report = multiprocessing.Queue()
+        procs = []
+        base_port = args.base_port + rnd * 1000 # fresh ports for every round
+        for i in range(args.clients):
+            role = "publisher" if i % 2 == 0 else "subscriber"
+            proc = multiprocessing.Process(target=clientWorker, args=(role, role[:3] + str(i + 1), base_port + 100 + i, args, report))
+            proc.start()
+            procs.append(proc)
+        for i in range(args.quorum):
+            if i:
+                time.sleep(args.stagger)
+            quorum_at = time.time() # the quorum can form once the last discovery node is started
+            proc = multiprocessing.Process(target=discoveryWorker, args=("disc" + str(i + 1), base_port + 10 * i, args, report))
+            proc.start()
+            procs.append(proc)
+        try:
+            startup = {"discovery": [], "publisher": [], "subscriber": []}
+            for _ in range(args.quorum + args.clients):
+                role, name, ready_at = report.get(timeout=args.timeout)
+                startup[role].append((ready_at - quorum_at) * 1000)
+        finally:
+            for proc in procs:
+                proc.terminate()
+                proc.join()
+        result = {"round": rnd + 1, "clients": args.clients}
+        for role, times in startup.items():
+            if times:
+                result[role + "_mean_ms"] = round(sum(times) / len(times), 1)
+                result[role + "_max_ms"] = round(max(times), 1)
+        result["all_up_ms"] = round(max(max(times) for times in startup.values() if times), 1)
+        self.logger.info("StartupBenchmark::runRound - {}".format(result))
+        return result
+
+    def driver(self):
+        self.logger.debug("StartupBenchmark::driver")
+        for rnd in range(self.args.rounds):
+            self.results.append(self.runRound(rnd))
+        header = list(self.results[0].keys())
+        self.logger.info(" ".join("{:>15}".format(h) for h in header))
+        for result in self.results:
+            self.logger.info(" ".join("{:>15}".format(result.get(h, "")) for h in header))
+        if self.args.output:
+            with open(self.args.output, "w") as f:
+                f.write(",".join(header) + "\n")
+                for result in self.results:
+                    f.write(",".join(str(result.get(h, "")) for h in header) + "\n")
+
+def parseCmdLineArgs ():
+    parser = argparse.ArgumentParser(description="Discovery startup-time benchmark")
+    parser.add_argument("-N", "--clients", type=int, default=10, help="Number of clients, half publishers and half subscribers, default 10")
+    parser.add_argument("-q", "--quorum", type=int, default=3, help="Number of discovery nodes in the quorum, default 3")
+    parser.add_argument("-s", "--stagger", type=float, default=0.5, help="Seconds between the starts of the discovery nodes, default 0.5")
+    parser.add_argument("-r", "--rounds", type=int, default=5, help="Number of rounds, default 5")
+    parser.add_argument("-p", "--base_port", type=int, default=7000, help="First port used by the components, default 7000")
+    parser.add_argument("-t", "--timeout", type=float, default=60, help="Seconds to wait for each component to come up, default 60")
+    parser.add_argument("-c", "--config", default="config.ini", help="configuration file (default: config.ini)")
+    parser.add_argument("-z", "--zookeeper", default="localhost:2181", help="IPv4 address for the zookeeper service, default = localhost:2181")
+    parser.add_argument("-o", "--output", default=None, help="CSV file to write the results to")
+    parser.add_argument("-l", "--loglevel", type=int, default=logging.INFO, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 20=logging.INFO")
+    return parser.parse_args()
+
+def main():
+    try:
+        logging.info("Main - acquire a child logger and then log messages in the child")
+        logger = logging.getLogger("StartupBenchmark")
+        args = parseCmdLineArgs()
+        logger.setLevel(args.loglevel)
+        benchmark = StartupBenchmark(logger)
+        benchmark.configure(args)
+        benchmark.driver()
+    except Exception as e:
+        logger.error("Exception caught in main - {}".format(e))
+        return
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,255 @@
+import json
+import logging
+import configparser
+from CS6381_MW.Feedback import Feedback, FeedbackServer, FeedbackClient, Peer
+
+class Router():
+    """Stands in for the ROUTER of a FeedbackServer: keeps what was sent, hands out what the
+    test queued as received"""
+
+    def __init__(self):
+        self.sent = []
+        self.inbox = []
+
+    def send_multipart(self, frames, flags=0):
+        self.sent.append((frames[0], frames[1], Feedback.decode(frames[2])))
+
+    def recv_multipart(self):
+        return self.inbox.pop(0)
+
+def receive(feedback, identity, kind, body=None):
+    feedback.router.inbox.append([identity] + Feedback.encode(kind, body))
+    feedback.handle()
+
+def configured(feedback, **options):
+    config = configparser.ConfigParser()
+    config.read_dict({"Feedback": dict({"Enabled": "True"}, **options)})
+    feedback.configure(config)
+    return feedback
+
+def server(**options):
+    feedback = configured(FeedbackServer(logging.getLogger("test"), "pub1"), **options)
+    feedback.router = Router()
+    return feedback
+
+def hello(feedback, identity, topics):
+    peer = feedback.peers[identity] = Peer(identity, feedback.now())
+    feedback.greet(peer, topics)
+    return peer
+
+def test_stamp_numbers_each_stream():
+    feedback = server()
+    assert feedback.stamp("weather", "pub1", "weather:pub1:data:t") == "weather:pub1:data:t:1"
+    assert feedback.stamp("weather", "pub1", "weather:pub1:data:t") == "weather:pub1:data:t:2"
+    assert feedback.stamp("news", "pub1", "news:pub1:data:t") == "news:pub1:data:t:1"
+    assert feedback.sent == {"weather:pub1": 2, "news:pub1": 1}
+
+def test_lag_counts_from_hello():
+    feedback = server()
+    for _ in range(5):
+        feedback.stamp("weather", "pub1", "m")
+    peer = hello(feedback, b"sub1", ["weather"])
+    assert feedback.lagOf(peer) == 0 # what was sent before its HELLO is not owed
+    for _ in range(3):
+        feedback.stamp("weather", "pub1", "m")
+    assert feedback.lagOf(peer) == 3
+
+def test_lag_of_a_stream_started_after_hello():
+    feedback = server()
+    peer = hello(feedback, b"sub1", ["weather"])
+    feedback.stamp("weather", "pub1", "m")
+    feedback.stamp("news", "pub1", "m") # not one of its topics
+    assert feedback.lagOf(peer) == 1
+
+def test_hello_is_welcomed():
+    feedback = server()
+    feedback.stamp("weather", "pub1", "m")
+    receive(feedback, b"sub1", b"HELLO", {"topics": ["weather"]})
+    assert feedback.peers[b"sub1"].topics == ("weather",)
+    assert feedback.peers[b"sub1"].acked == {"weather:pub1": 1}
+    assert feedback.router.sent == [(b"sub1", b"WELCOME", {"name": "pub1", "relay": False})]
+
+def test_acks_take_the_highest_seq():
+    feedback = server()
+    receive(feedback, b"sub1", b"HELLO", {"topics": ["weather"]})
+    for _ in range(10):
+        feedback.stamp("weather", "pub1", "m")
+    receive(feedback, b"sub1", b"ACK", {"weather:pub1": 7})
+    receive(feedback, b"sub1", b"ACK", {"weather:pub1": 4}) # acks may cross on the way
+    assert feedback.lagOf(feedback.peers[b"sub1"]) == 3
+
+def test_forwarded_seq_of_a_relay():
+    feedback = server()
+    peer = hello(feedback, b"sub1", ["weather"])
+    feedback.forwarded("weather:pub7:data:t:41")
+    feedback.forwarded("weather:pub7:data:t:45")
+    assert feedback.sent["weather:pub7"] == 45
+    assert feedback.lagOf(peer) == 5 # from 41 on
+
+def test_chronic_laggard_is_degraded_and_restored():
+    feedback = server(LagThreshold="10", LagStrikes="2", SlowPolicy="Degrade")
+    peer = hello(feedback, b"sub1", ["weather"])
+    for _ in range(20):
+        feedback.stamp("weather", "pub1", "m")
+    feedback.check()
+    assert not peer.isolated
+    feedback.check()
+    assert peer.isolated and feedback.degrades == 1
+    assert feedback.router.sent[-1][:2] == (b"sub1", b"DEGRADE")
+    peer.acked["weather:pub1"] = 18
+    feedback.check()
+    assert not peer.isolated
+    assert feedback.router.sent[-1][:2] == (b"sub1", b"RESTORE")
+
+def test_chronic_laggard_is_disconnected():
+    feedback = server(LagThreshold="10", LagStrikes="1", SlowPolicy="Disconnect", RejoinMs="500")
+    hello(feedback, b"sub1", ["weather"])
+    for _ in range(20):
+        feedback.stamp("weather", "pub1", "m")
+    feedback.check()
+    assert b"sub1" not in feedback.peers and feedback.disconnects == 1
+    assert feedback.router.sent[-1] == (b"sub1", b"DISCONNECT", {"rejoin_ms": 500})
+
+def test_silent_subscriber_is_forgotten():
+    feedback = server(ForgetMs="1000")
+    peer = hello(feedback, b"sub1", ["weather"])
+    peer.heard -= 2000
+    feedback.check()
+    assert feedback.peers == {}
+
+def test_client_strips_the_seq_and_acks_the_highest():
+    client = configured(FeedbackClient(logging.getLogger("test"), "sub1"))
+    assert client.seen("weather:pub1:data:t:3") == "weather:pub1:data:t"
+    assert client.seen("weather:pub1:data:t:2") == "weather:pub1:data:t"
+    assert client.seen("weather:pub1:data:t") == "weather:pub1:data:t" # not numbered
+    assert client.delivered == {"weather:pub1": 3}
+    assert client.unacked == {"weather:pub1"}
+    client.ack()
+    assert client.unacked == set() and client.unacked_count == 0
+
+def test_idle_client_keeps_itself_known():
+    client = configured(FeedbackClient(logging.getLogger("test"), "sub1"), ForgetMs="1000")
+    acks = []
+    client.send = lambda sender, kind, body=None: acks.append((sender, kind, body))
+    client.senders = {"tcp://pub1:5577": "pub1"}
+    client.ack()
+    assert acks == []
+    client.told -= 600
+    client.ack()
+    assert acks == [("pub1", b"ACK", {})]
+
+def test_encode_and_decode():
+    kind, body = Feedback.encode(b"ACK", {"weather:pub1": 3})
+    assert kind == b"ACK" and json.loads(body) == {"weather:pub1": 3}
+    assert Feedback.decode(Feedback.encode(b"HELLO")[1]) is None
+
+def test_credit_is_that_of_the_slowest_subscriber():
+    feedback = server(Credits="10")
+    assert feedback.credit() is None # nobody to hold us back
+    fast = hello(feedback, b"fast", ["weather"])
+    hello(feedback, b"slow", ["weather"])
+    for _ in range(6):
+        feedback.stamp("weather", "pub1", "m")
+    fast.acked["weather:pub1"] = 6
+    assert feedback.credit() == 4
+    for _ in range(4):
+        feedback.stamp("weather", "pub1", "m")
+    assert feedback.congested() and feedback.stalls == 1
+    receive(feedback, b"slow", b"ACK", {"weather:pub1": 10})
+    assert feedback.credit() == 10 - 4 # now the fast one lags most
+    assert not feedback.congested()
+
+def test_no_flow_control_without_credits():
+    feedback = server()
+    hello(feedback, b"sub1", ["weather"])
+    for _ in range(100000):
+        feedback.stamp("weather", "pub1", "m")
+    assert feedback.credit() is None and not feedback.congested()
+
+def test_hello_seeds_a_subscriber_that_has_not_acked_yet():
+    feedback = server(Credits="10")
+    hello(feedback, b"sub1", ["weather"])
+    for _ in range(10):
+        feedback.stamp("weather", "pub1", "m")
+    assert feedback.congested() # a joiner is not overrun before its first ack
+    hello(feedback, b"idle", ["news"]) # owes us nothing
+    assert feedback.credit() == 0
+
+def test_client_grants_credit_after_a_quarter_of_it():
+    client = configured(FeedbackClient(logging.getLogger("test"), "sub1"), Credits="8")
+    acks = []
+    client.tell = lambda kind, values: acks.append((kind, dict(values)))
+    client.seen("weather:pub1:data:t:1")
+    assert acks == []
+    client.seen("weather:pub1:data:t:2")
+    assert acks == [(b"ACK", {"weather:pub1": 2})]
+    assert client.unacked_count == 0
+
+def reliableClient(**options):
+    client = configured(FeedbackClient(logging.getLogger("test"), "sub1"), ReliableTopics="weather", **options)
+    client.nacks = []
+    client.tell = lambda kind, values: client.nacks.append((kind, dict(values)))
+    return client
+
+def test_history_is_bounded_per_stream():
+    feedback = server(ReliableTopics="weather", HistorySize="3")
+    for _ in range(5):
+        feedback.stamp("weather", "pub1", "m")
+        feedback.stamp("news", "pub1", "m") # best effort: not kept
+    assert list(feedback.history) == ["weather:pub1"]
+    assert list(feedback.history["weather:pub1"]) == [3, 4, 5]
+
+def test_retransmit_in_batches():
+    feedback = server(ReliableTopics="weather", HistorySize="10", NackBatch="2")
+    for _ in range(12):
+        feedback.stamp("weather", "pub1", "weather:pub1:data:t")
+    receive(feedback, b"sub1", b"NACK", {"weather:pub1": [[1, 3], [10, 11]]})
+    batches = [body for identity, kind, body in feedback.router.sent if kind == b"RETX"]
+    assert batches == [["weather:pub1:data:t:3", "weather:pub1:data:t:10"], ["weather:pub1:data:t:11"]]
+    assert (feedback.nacks, feedback.retransmitted, feedback.unavailable) == (1, 3, 2)
+
+def test_gap_of_a_reliable_topic_is_nacked():
+    client = reliableClient()
+    client.seen("weather:pub1:data:t:5") # where we joined, not a gap
+    client.seen("news:pub1:data:t:5")
+    assert client.nacks == []
+    client.seen("weather:pub1:data:t:9")
+    client.seen("news:pub1:data:t:9") # best effort: no NACK
+    assert client.nacks == [(b"NACK", {"weather:pub1": [[6, 8]]})]
+    assert client.gaps == 3 and sorted(client.missing["weather:pub1"]) == [6, 7, 8]
+
+def test_gap_beyond_the_history_is_lost():
+    client = reliableClient(HistorySize="4")
+    client.seen("weather:pub1:data:t:1")
+    client.seen("weather:pub1:data:t:12")
+    assert client.gaps == 10 and client.lost == 6
+    assert client.nacks == [(b"NACK", {"weather:pub1": [[8, 11]]})]
+
+def test_retransmitted_are_delivered_once():
+    client = reliableClient()
+    client.seen("weather:pub1:data:t:1")
+    client.seen("weather:pub1:data:t:4")
+    found = client.retransmitted(["weather:pub1:data:t:2", "weather:pub1:data:t:2", "weather:pub1:data:t:3"])
+    assert found == ["weather:pub1:data:t", "weather:pub1:data:t"]
+    assert client.recovered == 2 and client.missing == {}
+
+def test_renack_until_retries_run_out():
+    client = reliableClient(AckMs="100", NackRetries="2")
+    client.seen("weather:pub1:data:t:1")
+    client.seen("weather:pub1:data:t:5")
+    client.retransmitted(["weather:pub1:data:t:3"])
+    for waiting in client.missing.values():
+        for entry in waiting.values():
+            entry[1] -= 100
+    client.renack()
+    assert client.nacks[-1] == (b"NACK", {"weather:pub1": [[2, 2], [4, 4]]})
+    for waiting in client.missing.values():
+        for entry in waiting.values():
+            entry[1] -= 100
+    client.renack()
+    assert client.lost == 2 and client.missing == {}
+    assert len(client.nacks) == 2
+
+def test_spans():
+    assert FeedbackClient.spans([7, 1, 2, 3, 5, 6]) == [[1, 3], [5, 7]]
+    assert FeedbackClient.spans([]) == []
@@ -0,0 +1,61 @@
+import logging
+import configparser
+import ipaddress
+from CS6381_MW.Multicast import Multicast
+
+def multicast(sequence=True):
+    mc = Multicast(logging.getLogger("test"))
+    mc.sequence = sequence
+    return mc
+
+def message(topic, publisher, seq):
+    return "{}:{}:data:12-00-00-000:{}".format(topic, publisher, seq).encode("utf-8")
+
+def test_check_strips_the_sequence_number():
+    mc = multicast()
+    assert mc.check(message("weather", "pub1", 1)) == "weather:pub1:data:12-00-00-000"
+    assert mc.check(message("weather", "pub1", 2)) == "weather:pub1:data:12-00-00-000"
+    assert (mc.lost, mc.late) == (0, 0)
+
+def test_check_counts_a_gap_as_lost():
+    mc = multicast()
+    mc.check(message("weather", "pub1", 1))
+    mc.check(message("weather", "pub1", 5))
+    assert (mc.lost, mc.late) == (3, 0)
+    mc.check(message("weather", "pub1", 6))
+    assert mc.lost == 3
+
+def test_check_counts_going_backwards_as_late():
+    mc = multicast()
+    mc.check(message("weather", "pub1", 1))
+    mc.check(message("weather", "pub1", 3))
+    assert mc.check(message("weather", "pub1", 2)) == "weather:pub1:data:12-00-00-000"
+    mc.check(message("weather", "pub1", 3)) # a duplicate
+    assert (mc.lost, mc.late) == (1, 2)
+    # the late ones do not move what we expect next
+    mc.check(message("weather", "pub1", 4))
+    assert (mc.lost, mc.late) == (1, 2)
+
+def test_check_numbers_per_publisher_and_topic():
+    mc = multicast()
+    mc.check(message("weather", "pub1", 7)) # the first one we hear of sets the start
+    mc.check(message("weather", "pub2", 1))
+    mc.check(message("news", "pub1", 1))
+    mc.check(message("weather", "pub1", 8))
+    mc.check(message("news", "pub1", 2))
+    assert (mc.lost, mc.late) == (0, 0)
+
+def test_check_without_sequence_numbers():
+    mc = multicast(sequence=False)
+    assert mc.check(b"weather:pub1:data:12-00-00-000") == "weather:pub1:data:12-00-00-000"
+
+def test_group_of_a_topic():
+    mc = multicast()
+    config = configparser.ConfigParser()
+    config.read_dict({"Dissemination": {"MulticastBase": "239.1.0.0", "MulticastPort": "6000", "MulticastInterface": "eth0"}})
+    mc.configure(config)
+    group = mc.groupOf("weather")
+    assert group == mc.groupOf("weather")
+    assert group.startswith("udp://eth0;239.1.") and group.endswith(":6000")
+    addr = ipaddress.IPv4Address(group[len("udp://eth0;"):].rsplit(":", 1)[0])
+    assert int(addr) - int(ipaddress.IPv4Address("239.1.0.0")) < 0x10000
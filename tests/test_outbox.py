@@ -0,0 +1,118 @@
+import logging
+import configparser
+import pytest
+import zmq
+from CS6381_MW.Outbox import Outbox
+
+class Sock():
+    """Stands in for a PUB socket whose queues hold room messages"""
+
+    def __init__(self, room):
+        self.room = room
+        self.sent = []
+        self.options = {}
+
+    def setsockopt(self, option, value):
+        self.options[option] = value
+
+    def send(self, buf, flags=0):
+        if len(self.sent) >= self.room:
+            raise zmq.Again()
+        self.sent.append(buf)
+
+class Timers():
+    def __init__(self):
+        self.timers = {}
+        self.seq = 0
+
+    def schedule(self, delay_ms, callback, name=None, interval_ms=None):
+        self.seq += 1
+        self.timers[self.seq] = callback
+        return self.seq
+
+    def cancel(self, handle):
+        self.timers.pop(handle, None)
+
+def outbox(room, drained=None, **queues):
+    config = configparser.ConfigParser()
+    config.read_dict({"Queues": queues})
+    box = Outbox(logging.getLogger("test"))
+    box.configure(config, "Publisher")
+    sock, timers = Sock(room), Timers()
+    box.attach(sock, timers.schedule, timers.cancel, drained)
+    return box, sock, timers
+
+def test_role_settings_override_the_common_ones():
+    config = configparser.ConfigParser()
+    config.read_dict({"Queues": {"SndHwm": "100", "RcvHwm": "200", "BrokerSndHwm": "50", "SubscriberConflateTopics": "temperature, pressure"}})
+    assert Outbox.hwms(config, "Publisher") == (100, 200)
+    assert Outbox.hwms(config, "Broker") == (50, 200)
+    assert Outbox.conflatedTopics(config, "Subscriber") == {"temperature", "pressure"}
+    assert Outbox.conflatedTopics(config, "Publisher") == frozenset()
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        outbox(1, OverflowPolicy="Spill")
+
+def test_plain_sockets_are_left_alone():
+    box, sock, timers = outbox(1)
+    assert zmq.XPUB_NODROP not in sock.options
+    assert box.send("weather", b"1")
+    assert not box.send("weather", b"2")
+    assert box.stats()["sent"] == 1 and box.stats()["dropped"] == 1
+    assert timers.timers == {}
+
+def test_drop_counts_what_does_not_fit():
+    box, sock, timers = outbox(2, OverflowPolicy="Drop", SndHwm="10")
+    assert sock.options == {zmq.SNDHWM: 10, zmq.XPUB_NODROP: 1}
+    for i in range(5):
+        box.send("weather", bytes([i]))
+    assert (box.sent, box.dropped, len(box.backlog)) == (2, 3, 0)
+    assert not box.congested()
+
+def test_block_keeps_the_order_and_loses_nothing():
+    drained = []
+    box, sock, timers = outbox(1, lambda: drained.append(True), OverflowPolicy="Block")
+    for i in range(4):
+        box.send("weather", bytes([i]))
+    assert sock.sent == [b"\x00"] and len(box.backlog) == 3
+    assert box.congested() and len(timers.timers) == 1
+    retry = next(iter(timers.timers.values()))
+    retry() # still full
+    assert box.retries == 1 and box.congested()
+    sock.room = 3
+    retry()
+    assert sock.sent == [b"\x00", b"\x01", b"\x02"] and box.congested()
+    sock.room = 10
+    box.send("weather", b"\x04") # behind what waits, even though there is room now
+    retry()
+    assert sock.sent == [b"\x00", b"\x01", b"\x02", b"\x03", b"\x04"]
+    assert not box.congested() and timers.timers == {} and drained == [True]
+    assert (box.dropped, box.max_backlog) == (0, 3)
+
+def test_conflate_keeps_the_newest_per_topic():
+    box, sock, timers = outbox(0, OverflowPolicy="Conflate")
+    for topic, buf in [("weather", b"w1"), ("news", b"n1"), ("weather", b"w2"), ("weather", b"w3")]:
+        box.send(topic, buf)
+    assert box.conflated == 2 and not box.congested()
+    sock.room = 10
+    next(iter(timers.timers.values()))()
+    assert sock.sent == [b"w3", b"n1"]
+
+def test_conflated_topics_without_a_policy():
+    box, sock, timers = outbox(0, ConflateTopics="temperature")
+    assert sock.options[zmq.XPUB_NODROP] == 1
+    for topic, buf in [("temperature", b"t1"), ("news", b"n1"), ("temperature", b"t2")]:
+        box.send(topic, buf)
+    assert (box.dropped, box.conflated, len(box.backlog)) == (1, 1, 1)
+    sock.room = 10
+    next(iter(timers.timers.values()))()
+    assert sock.sent == [b"t2"]
+
+def test_close_counts_the_backlog_as_dropped():
+    box, sock, timers = outbox(0, OverflowPolicy="Block", ReportMs="1000")
+    assert len(timers.timers) == 1 # the report
+    box.send("weather", b"1")
+    box.send("weather", b"2")
+    box.close()
+    assert box.dropped == 2 and box.backlog == {} and timers.timers == {}
@@ -0,0 +1,153 @@
+import logging
+import itertools
+import threading
+import pytest
+import zmq
+from CS6381_MW.Common import Reactor
+
+endpoints = itertools.count()
+
+@pytest.fixture
+def pairs():
+    """Connected inproc PAIRs: pairs() gives (ours, theirs), closed after the test"""
+    made = []
+
+    def pair():
+        context = zmq.Context.instance()
+        address = "inproc://test-reactor-{}".format(next(endpoints))
+        ours = context.socket(zmq.PAIR)
+        ours.bind(address)
+        theirs = context.socket(zmq.PAIR)
+        theirs.connect(address)
+        made.extend([ours, theirs])
+        return ours, theirs
+    yield pair
+    for sock in made:
+        sock.close(linger=0)
+
+def reactor():
+    return Reactor(logging.getLogger("test"))
+
+def reader(sock, got, name, timeout=None):
+    def handle():
+        got.append((name, sock.recv()))
+        return timeout
+    return handle
+
+def test_budget_bounds_a_wakeup(pairs):
+    loop = reactor()
+    ours, theirs = pairs()
+    got = []
+    loop.register(ours, reader(ours, got, "data"), "data", budget=4)
+    for i in range(10):
+        theirs.send(bytes([i]))
+    loop.running = True
+    assert ours.poll(1000)
+    loop.dispatch(loop.poll(1000))
+    assert len(got) == 4
+    loop.dispatch(loop.poll(1000))
+    loop.dispatch(loop.poll(1000))
+    assert [msg for _, msg in got] == [bytes([i]) for i in range(10)]
+    counters = loop.stats()["data"]
+    assert (counters["calls"], counters["messages"], counters["exhausted"]) == (3, 10, 2)
+
+def test_every_ready_socket_is_serviced(pairs):
+    loop = reactor()
+    (data, data_peer), (req, req_peer) = pairs(), pairs()
+    got = []
+    loop.register(data, reader(data, got, "data", 50), "data", budget=2)
+    loop.register(req, reader(req, got, "req", 20), "req")
+    for i in range(5):
+        data_peer.send(b"d")
+    req_peer.send(b"r")
+    assert data.poll(1000) and req.poll(1000)
+    loop.running = True
+    assert loop.dispatch(loop.poll(1000)) == 20 # the shortest timeout asked for
+    assert sorted(got) == [("data", b"d"), ("data", b"d"), ("req", b"r")]
+
+def test_timers_run_in_order_and_can_be_cancelled():
+    loop = reactor()
+    ran = []
+    loop.schedule(30, lambda: ran.append("later"))
+    loop.schedule(10, lambda: ran.append("sooner"))
+    handle = loop.schedule(20, lambda: ran.append("cancelled"))
+    loop.cancel(handle)
+    periodic = loop.schedule(5, lambda: ran.append("tick"), "tick", 5)
+    loop.schedule(50, loop.stop)
+    loop.run(lambda: None)
+    assert [name for name in ran if name != "tick"] == ["sooner", "later"]
+    assert ran.count("tick") >= 5
+    assert periodic in loop.timers # still scheduled
+    assert loop.stats()["tick"]["calls"] == ran.count("tick")
+
+def test_idle_operation_runs_when_nothing_happens():
+    loop = reactor()
+    idle = []
+    def invoke_operation():
+        idle.append(loop.now())
+        if len(idle) == 3:
+            loop.stop()
+        return 10
+    start = loop.now()
+    loop.run(invoke_operation, 0)
+    assert len(idle) == 3
+    assert idle[2] - start >= 20
+
+def test_unknown_idle_policy():
+    with pytest.raises(ValueError):
+        reactor().setIdlePolicy("Sleep")
+
+def test_threadsafe_runs_calls_on_the_loop():
+    loop = reactor()
+    ran = []
+    def record(value):
+        ran.append((value, threading.get_ident()))
+        if len(ran) == 100:
+            loop.stop()
+    post = loop.threadsafe(record)
+    posters = [threading.Thread(target=lambda start=start: [post(start + i) for i in range(25)]) for start in range(0, 100, 25)]
+    for thread in posters:
+        thread.start()
+    loop.schedule(5000, loop.stop) # in case a wakeup is lost
+    loop.run(lambda: None)
+    for thread in posters:
+        thread.join()
+    assert sorted(value for value, _ in ran) == list(range(100))
+    assert set(ident for _, ident in ran) == {threading.get_ident()}
+    assert loop.stats()["Reactor.calls"]["calls"] == 100
+
+def test_one_wakeup_per_batch():
+    loop = reactor()
+    post = loop.threadsafe(lambda: None)
+    for _ in range(10):
+        post()
+    assert loop.wake_in.poll(1000)
+    loop.wake_in.recv()
+    assert not loop.wake_in.poll(50)
+    assert loop.runCalls() is None and loop.calls == []
+
+def test_posted_calls_keep_the_idle_deadline():
+    loop = reactor()
+    idle = []
+    post = loop.threadsafe(lambda: None) # returns None, like a watch callback
+    ticker = loop.schedule(1, post, "post", 1) # a call queued on every loop turn
+    def invoke_operation():
+        idle.append(True)
+        loop.stop()
+        return None
+    loop.schedule(5000, loop.stop)
+    loop.run(invoke_operation, 30)
+    loop.cancel(ticker)
+    assert idle == [True]
+
+def test_posted_call_timeout_runs_the_idle_operation():
+    loop = reactor()
+    idle = []
+    def invoke_operation():
+        idle.append(True)
+        loop.stop()
+        return None
+    loop.threadsafe(lambda: 0)()
+    loop.schedule(5000, loop.stop)
+    loop.run(invoke_operation)
+    assert idle == [True]
@@ -0,0 +1,74 @@
+from CS6381_MW.TimerWheel import TimerWheel, HierarchicalTimerWheel
+
+# drive the wheel the way the Reactor does: sleep nextTimeout(), then advance()
+def runUntilEmpty(wheel, now_ms=0):
+    fired = {}
+    while len(wheel):
+        now_ms += wheel.nextTimeout(now_ms)
+        for key in wheel.advance(now_ms):
+            fired[key] = now_ms
+    return fired
+
+def test_hashed_wheel_expires_only_due_keys():
+    wheel = TimerWheel(tick_ms=100, slots=8)
+    wheel.schedule("a", 250)
+    wheel.schedule("b", 2000) # more than one turn away
+    assert wheel.advance(200) == []
+    assert wheel.advance(300) == ["a"]
+    assert wheel.advance(1300) == []
+    assert wheel.advance(2000) == ["b"]
+    assert len(wheel) == 0
+
+def test_hashed_wheel_reschedule_and_cancel():
+    wheel = TimerWheel(tick_ms=100, slots=8)
+    wheel.schedule("a", 250)
+    wheel.schedule("a", 650)
+    wheel.schedule("b", 250)
+    wheel.cancel("b")
+    assert wheel.advance(300) == []
+    assert wheel.advance(700) == ["a"]
+    assert wheel.nextTimeout(700) is None
+
+def test_never_early():
+    wheel = HierarchicalTimerWheel(tick_ms=1, slots=8, levels=3)
+    for deadline in (1, 7, 8, 9, 63, 64, 65, 100, 511, 700):
+        wheel.schedule(deadline, deadline)
+    fired = runUntilEmpty(wheel)
+    assert all(fired[deadline] >= deadline for deadline in fired)
+    assert sorted(fired) == [1, 7, 8, 9, 63, 64, 65, 100, 511, 700]
+
+def test_next_timeout_in_level_zero():
+    wheel = HierarchicalTimerWheel(tick_ms=1, slots=64)
+    wheel.schedule("a", 10)
+    assert wheel.nextTimeout(0) == 10
+    assert wheel.nextTimeout(4) == 6
+    assert wheel.nextTimeout(12) == 0
+
+def test_next_timeout_waits_for_cascade():
+    wheel = HierarchicalTimerWheel(tick_ms=1, slots=64)
+    wheel.schedule("a", 100)
+    # only level 1 is occupied: wake up at its next cascade, not at the deadline
+    assert wheel.nextTimeout(0) == 64
+    assert wheel.advance(64) == []
+    assert wheel.nextTimeout(64) == 36
+    assert wheel.advance(100) == ["a"]
+
+def test_next_timeout_mixing_levels_does_not_skip_cascade():
+    wheel = HierarchicalTimerWheel(tick_ms=1, slots=64)
+    wheel.schedule("far", 100) # level 1, cascaded at tick 64
+    wheel.advance(50)
+    wheel.schedule("near", 110) # level 0, next occupied tick 110
+    # the cascade at 64 brings "far" into level 0 before "near" is due
+    assert wheel.nextTimeout(50) == 14
+    fired = runUntilEmpty(wheel, 50)
+    assert fired == {"far": 100, "near": 110}
+
+def test_cancel_keeps_counts():
+    wheel = HierarchicalTimerWheel(tick_ms=1, slots=8, levels=3)
+    wheel.schedule("a", 5)
+    wheel.schedule("b", 50)
+    wheel.schedule("b", 500)
+    wheel.cancel("a")
+    wheel.cancel("missing")
+    assert sum(wheel.counts) == len(wheel) == 1
+    assert runUntilEmpty(wheel) == {"b": 500}
@@ -0,0 +1,84 @@
+import logging
+import threading
+from CS6381_MW.ZkCache import ZkCache, ZkEvent, ZkEventType, Coalescer
+
+ADDED, UPDATED, REMOVED = ZkEventType.ADDED, ZkEventType.UPDATED, ZkEventType.REMOVED
+
+def held(window_ms=60000):
+    """A coalescer whose window we close ourselves with flush()"""
+    batches = []
+    coalescer = Coalescer(batches.append, window_ms, logging.getLogger("test"))
+    return coalescer, batches
+
+def close(coalescer):
+    if coalescer.timer is not None:
+        coalescer.timer.cancel()
+    coalescer.flush()
+
+def net(batch):
+    return sorted((event.kind, event.path, event.data, event.old) for event in batch)
+
+def test_no_window_delivers_every_event():
+    coalescer, batches = held(0)
+    coalescer(ZkEvent(ADDED, "/publisher/pub1", {"port": 1}))
+    coalescer(ZkEvent(REMOVED, "/publisher/pub1", None, {"port": 1}))
+    assert [net(batch) for batch in batches] == [[(ADDED, "/publisher/pub1", {"port": 1}, None)],
+                                                 [(REMOVED, "/publisher/pub1", None, {"port": 1})]]
+
+def test_came_and_went_is_dropped():
+    coalescer, batches = held()
+    coalescer(ZkEvent(ADDED, "/publisher/pub1", {"port": 1}))
+    coalescer(ZkEvent(UPDATED, "/publisher/pub1", {"port": 2}, {"port": 1}))
+    coalescer(ZkEvent(REMOVED, "/publisher/pub1", None, {"port": 2}))
+    coalescer(ZkEvent(ADDED, "/publisher/pub2", {"port": 3}))
+    close(coalescer)
+    assert [net(batch) for batch in batches] == [[(ADDED, "/publisher/pub2", {"port": 3}, None)]]
+    assert coalescer.stats() == {"received": 4, "delivered": 1, "suppressed": 3, "batches": 1}
+
+def test_net_change_of_a_known_node():
+    coalescer, batches = held()
+    coalescer(ZkEvent(UPDATED, "/publisher/pub1", {"port": 2}, {"port": 1}))
+    coalescer(ZkEvent(UPDATED, "/publisher/pub1", {"port": 3}, {"port": 2}))
+    coalescer(ZkEvent(REMOVED, "/publisher/pub2", None, {"port": 5}))
+    coalescer(ZkEvent(ADDED, "/publisher/pub2", {"port": 6}))
+    coalescer(ZkEvent(UPDATED, "/publisher/pub3", {"port": 8}, {"port": 7}))
+    coalescer(ZkEvent(UPDATED, "/publisher/pub3", {"port": 7}, {"port": 8})) # back to where it was
+    close(coalescer)
+    assert net(batches[0]) == [(UPDATED, "/publisher/pub1", {"port": 3}, {"port": 1}),
+                               (UPDATED, "/publisher/pub2", {"port": 6}, {"port": 5})]
+
+def test_removed_keeps_the_data_from_before_the_window():
+    coalescer, batches = held()
+    coalescer(ZkEvent(UPDATED, "/publisher/pub1", {"port": 2}, {"port": 1}))
+    coalescer(ZkEvent(REMOVED, "/publisher/pub1", None, {"port": 2}))
+    close(coalescer)
+    assert net(batches[0]) == [(REMOVED, "/publisher/pub1", None, {"port": 1})]
+
+def test_window_flushes_on_its_own():
+    done = threading.Event()
+    batches = []
+    coalescer = Coalescer(lambda events: (batches.append(events), done.set()), 20, logging.getLogger("test"))
+    for i in range(10):
+        coalescer(ZkEvent(ADDED, "/publisher/pub" + str(i), {"port": i}))
+    assert done.wait(5)
+    assert len(batches) == 1 and len(batches[0]) == 10
+    assert coalescer.timer is None
+
+def test_cache_replays_and_reports_changes():
+    cache = ZkCache(None, logging.getLogger("test"), nodes=("/leader",))
+    cache.apply("/leader", {"name": "disc1"}, True)
+    events = []
+    cache.listen("/leader", events.append)
+    cache.apply("/leader", {"name": "disc1"}, True) # no change
+    cache.apply("/leader", {"name": "disc2"}, True)
+    cache.apply("/leader", None, False)
+    cache.apply("/leader", None, False) # already gone
+    assert [(event.kind, event.data, event.old) for event in events] == [
+        (ADDED, {"name": "disc1"}, None), (UPDATED, {"name": "disc2"}, {"name": "disc1"}), (REMOVED, None, {"name": "disc2"})]
+    assert cache.get("/leader") is None
+
+def test_cache_decodes_json():
+    cache = ZkCache(None, logging.getLogger("test"))
+    assert cache.decode(b'{"port": 1}') == {"port": 1}
+    assert cache.decode(b"") is None
+    assert cache.decode(b"not json") == b"not json"
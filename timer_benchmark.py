@@ -0,0 +1,113 @@
+# Purpose:
+#
+# Timer benchmark for the Reactor (CS6381_MW/Common.py) and its HierarchicalTimerWheel.
+#
+# One Reactor hosts N periodic timers, as a process hosting many entities with their own
+# schedules would: each fires every P msec with P drawn at random between the -m and -M bounds,
+# and a fraction of them is cancelled and scheduled again every round, as leases renewed by
+# heartbeats are. We run for D seconds and report:
+#
+#   schedule_us / cancel_us   mean cost of one schedule() and one cancel()
+#   late_p50_ms / late_p99_ms how long after its deadline a timer ran
+#   fired                     number of timer runs
+#   cpu_pct                   CPU used by the process, relative to the wall clock time
+#
+# With the poll timeout taken from the earliest deadline the process sleeps between timers, so
+# cpu_pct should stay far below 100 even with thousands of timers. Needs no ZooKeeper.
+
+import time
+import random
+import argparse # argument parsing
+import logging # for logging. Use it in place of print statements.
+from CS6381_MW.Common import Reactor
+
+class TimerBenchmark():
+    def __init__(self, logger):
+        self.args = None
+        self.logger = logger
+        self.reactor = None
+        self.deadlines = {} # timer id -> (handle, next deadline in msec, period in msec)
+        self.lateness = []
+        self.schedule_ns = 0
+        self.schedules = 0
+        self.cancel_ns = 0
+        self.cancels = 0
+
+    def configure(self, args):
+        self.logger.debug("TimerBenchmark::configure")
+        self.args = args
+        self.reactor = Reactor(self.logger)
+
+    def arm(self, timer, delay_ms, period_ms):
+        start = time.perf_counter_ns()
+        handle = self.reactor.schedule(delay_ms, lambda: self.fired(timer), "timer", period_ms)
+        self.schedule_ns += time.perf_counter_ns() - start
+        self.schedules += 1
+        self.deadlines[timer] = (handle, Reactor.now() + delay_ms, period_ms)
+
+    def fired(self, timer):
+        handle, deadline, period_ms = self.deadlines[timer]
+        self.lateness.append(Reactor.now() - deadline)
+        self.deadlines[timer] = (handle, deadline + period_ms, period_ms)
+
+    # move a share of the timers, as heartbeats move the leases they renew
+    def churn(self):
+        for timer in random.sample(list(self.deadlines), int(len(self.deadlines) * self.args.churn)):
+            handle, _, period_ms = self.deadlines[timer]
+            start = time.perf_counter_ns()
+            self.reactor.cancel(handle)
+            self.cancel_ns += time.perf_counter_ns() - start
+            self.cancels += 1
+            self.arm(timer, period_ms, period_ms)
+
+    def driver(self):
+        self.logger.debug("TimerBenchmark::driver")
+        args = self.args
+        for timer in range(args.timers):
+            period_ms = random.uniform(args.min_period, args.max_period)
+            self.arm(timer, random.uniform(0, period_ms), period_ms)
+        self.reactor.schedule(args.max_period, self.churn, "churn", args.max_period)
+        self.reactor.schedule(args.duration * 1000, self.reactor.stop, "stop")
+        wall, cpu = time.monotonic(), time.process_time()
+        self.reactor.run(lambda: None)
+        wall, cpu = time.monotonic() - wall, time.process_time() - cpu
+        self.lateness.sort()
+        result = {"timers": args.timers, "fired": len(self.lateness),
+                  "schedule_us": round(self.schedule_ns / 1e3 / self.schedules, 2),
+                  "cancel_us": round(self.cancel_ns / 1e3 / max(self.cancels, 1), 2),
+                  "late_p50_ms": round(self.lateness[len(self.lateness) // 2], 2),
+                  "late_p99_ms": round(self.lateness[int(len(self.lateness) * 0.99)], 2),
+                  "cpu_pct": round(100 * cpu / wall, 1)}
+        self.logger.info("TimerBenchmark::driver - {}".format(result))
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(",".join(result.keys()) + "\n")
+                f.write(",".join(str(value) for value in result.values()) + "\n")
+
+def parseCmdLineArgs ():
+    parser = argparse.ArgumentParser(description="Reactor timer benchmark")
+    parser.add_argument("-N", "--timers", type=int, default=5000, help="Number of periodic timers, default 5000")
+    parser.add_argument("-m", "--min_period", type=float, default=100, help="Shortest period in msec, default 100")
+    parser.add_argument("-M", "--max_period", type=float, default=10000, help="Longest period in msec, default 10000")
+    parser.add_argument("-C", "--churn", type=float, default=0.1, help="Share of the timers cancelled and scheduled again every longest period, default 0.1")
+    parser.add_argument("-d", "--duration", type=float, default=20, help="Seconds to run, default 20")
+    parser.add_argument("-o", "--output", default=None, help="CSV file to write the results to")
+    parser.add_argument("-l", "--loglevel", type=int, default=logging.INFO, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 20=logging.INFO")
+    return parser.parse_args()
+
+def main():
+    try:
+        logging.info("Main - acquire a child logger and then log messages in the child")
+        logger = logging.getLogger("TimerBenchmark")
+        args = parseCmdLineArgs()
+        logger.setLevel(args.loglevel)
+        benchmark = TimerBenchmark(logger)
+        benchmark.configure(args)
+        benchmark.driver()
+    except Exception as e:
+        logger.error("Exception caught in main - {}".format(e))
+        return
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    main()
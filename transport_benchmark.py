@@ -0,0 +1,186 @@
+# Purpose:
+#
+# Compares the transports a subscriber can reach a publisher over (CS6381_MW/Transport.py):
+# tcp, ipc, inproc and shm (CS6381_MW/ShmRing.py). For every transport a publisher binds its
+# PUB socket the way PublisherMW does (Transport.bind) and a subscriber connects to the endpoint
+# Transport.choose picks for it and receives through SubscriberMW's reactor handler. tcp, ipc and
+# shm run the subscriber in its own process on this host, as co-located entities of an
+# experiment would; inproc only works within a process, so there the subscriber runs in a thread
+# of the publisher's process. Every message carries the time it was sent (CLOCK_MONOTONIC is
+# shared by the processes of a host). Two phases are run per transport:
+#
+#   flood   -n messages as fast as the publisher can send them; msgs_per_s is what the
+#           subscriber received per second, between the first and the last message
+#   paced   -m messages at -r per second; lat_p50_us / lat_p99_us is the one-way latency from
+#           disseminate to the data_received upcall
+#
+# -s sets the payload size in bytes. High water marks are lifted so that the flood is not
+# measured by what PUB drops; a shm ring holds -S messages, and lost counts what the publisher
+# overwrote before the subscriber read it. -P is the idle policy of the subscriber: with shm,
+# Spin or BusyPoll see a message without waiting for its wake. Needs no ZooKeeper.
+
+import time
+import argparse # argument parsing
+import logging # for logging. Use it in place of print statements.
+import multiprocessing
+import threading
+import zmq
+from CS6381_MW.PublisherMW import PublisherMW
+from CS6381_MW.SubscriberMW import SubscriberMW
+from CS6381_MW.Transport import Transport
+
+TOPIC = "weather"
+
+class Collector():
+    def __init__(self, mw_obj):
+        self.mw_obj = mw_obj
+        self.latencies = []
+        self.first = None
+        self.last = None
+
+    def invoke_operation(self):
+        return None
+
+    def data_received(self, msg):
+        sent = int(msg.split(":")[3])
+        if sent < 0:
+            self.mw_obj.disable_event_loop() # the publisher is done
+            return None
+        self.last = time.monotonic_ns()
+        if self.first is None:
+            self.first = self.last
+        self.latencies.append((self.last - sent) / 1000.0)
+        return None
+
+# Subscriber: connect to the publisher over the transport it picks and deliver to the collector
+# until the publisher is done
+def subscriberWorker(kind, locality, port, args, ready, report):
+    logger = logging.getLogger("TransportBenchmark.sub")
+    logger.setLevel(logging.WARNING) # one line per message otherwise
+    mw_obj = SubscriberMW(logger)
+    mw_obj.reactor.setIdlePolicy(args.policy, args.spin_polls)
+    mw_obj.transport = Transport(logger, [k for k in Transport.KINDS if k in (kind, "tcp")])
+    mw_obj.sub = mw_obj.context.socket(zmq.SUB)
+    mw_obj.sub.setsockopt(zmq.RCVHWM, 0)
+    mw_obj.subscribeTopics([TOPIC])
+    connect_str = mw_obj.transport.choose(dict({"addr": "localhost", "port": port}, **locality))
+    if not connect_str.startswith(kind + "://"):
+        raise ValueError("picked {} for {}".format(connect_str, kind))
+    mw_obj.connect(connect_str)
+    collector = Collector(mw_obj)
+    mw_obj.set_upcall_handle(collector)
+    mw_obj.reactor.register(mw_obj.sub, mw_obj.handle_data, "SubscriberMW.sub")
+    ready.set()
+    wall, cpu = time.monotonic(), time.process_time()
+    mw_obj.event_loop()
+    wall, cpu = time.monotonic() - wall, time.process_time() - cpu
+    latencies = sorted(collector.latencies)
+    elapsed = (collector.last - collector.first) / 1e9 if len(latencies) > 1 else 0
+    lost = sum(ring.lost for ring in mw_obj.ring_list)
+    mw_obj.disconnect(connect_str)
+    mw_obj.sub.close()
+    report.put({"received": len(latencies), "lost": lost,
+                "msgs_per_s": round((len(latencies) - 1) / elapsed) if elapsed else 0,
+                "lat_p50_us": round(latencies[len(latencies) // 2], 1),
+                "lat_p99_us": round(latencies[int(len(latencies) * 0.99)], 1)})
+
+class TransportBenchmark():
+    def __init__(self, logger):
+        self.args = None
+        self.results = []
+        self.logger = logger
+
+    def configure(self, args):
+        self.logger.debug("TransportBenchmark::configure")
+        self.args = args
+
+    def publish(self, mw_obj, phase):
+        args = self.args
+        payload = "x" * args.size
+        if phase == "flood":
+            for _ in range(args.messages):
+                mw_obj.disseminate("pub", TOPIC, payload, str(time.monotonic_ns()))
+        else:
+            start = time.monotonic_ns() + 1000000
+            for i in range(args.paced):
+                due = start + int(i * 1e9 / args.rate)
+                if due > time.monotonic_ns():
+                    time.sleep((due - time.monotonic_ns()) / 1e9)
+                mw_obj.disseminate("pub", TOPIC, payload, str(time.monotonic_ns()))
+        mw_obj.disseminate("pub", TOPIC, payload, "-1")
+
+    def runPhase(self, kind, phase):
+        args = self.args
+        logger = logging.getLogger("TransportBenchmark.pub")
+        logger.setLevel(logging.WARNING)
+        mw_obj = PublisherMW(logger)
+        mw_obj.transport = Transport(logger, [k for k in Transport.KINDS if k in (kind, "tcp")])
+        mw_obj.transport.shm_slots = args.slots
+        mw_obj.pub = mw_obj.context.socket(zmq.PUB)
+        mw_obj.pub.setsockopt(zmq.SNDHWM, 0)
+        port = args.port + len(self.results) # a fresh endpoint per phase; closed ones linger
+        locality = mw_obj.transport.bind(mw_obj.pub, "bench", "localhost", port)
+        mw_obj.ring = mw_obj.transport.ring
+        ready = multiprocessing.Event()
+        report = multiprocessing.Queue()
+        if kind == "inproc":
+            worker = threading.Thread(target=subscriberWorker, args=(kind, locality, port, args, ready, report))
+        else:
+            worker = multiprocessing.Process(target=subscriberWorker, args=(kind, locality, port, args, ready, report))
+        worker.start()
+        ready.wait()
+        time.sleep(0.5) # let the subscription reach us
+        self.publish(mw_obj, phase)
+        result = dict({"transport": kind, "phase": phase}, **report.get())
+        worker.join()
+        mw_obj.close()
+        mw_obj.pub.close(linger=0)
+        self.logger.info("TransportBenchmark::runPhase - {}".format(result))
+        return result
+
+    def driver(self):
+        self.logger.debug("TransportBenchmark::driver")
+        for kind in self.args.transports.split(","):
+            for phase in ["flood", "paced"]:
+                self.results.append(self.runPhase(kind, phase))
+        header = list(self.results[0].keys())
+        self.logger.info(" ".join("{:>12}".format(h) for h in header))
+        for result in self.results:
+            self.logger.info(" ".join("{:>12}".format(result[h]) for h in header))
+        if self.args.output:
+            with open(self.args.output, "w") as f:
+                f.write(",".join(header) + "\n")
+                for result in self.results:
+                    f.write(",".join(str(result[h]) for h in header) + "\n")
+
+def parseCmdLineArgs ():
+    parser = argparse.ArgumentParser(description="tcp/ipc/inproc transport benchmark")
+    parser.add_argument("-t", "--transports", default="tcp,ipc,inproc,shm", help="Comma separated transports to compare, default tcp,ipc,inproc,shm")
+    parser.add_argument("-n", "--messages", type=int, default=100000, help="Messages of the flood phase, default 100000")
+    parser.add_argument("-m", "--paced", type=int, default=5000, help="Messages of the paced phase, default 5000")
+    parser.add_argument("-r", "--rate", type=int, default=1000, help="Messages per second of the paced phase, default 1000")
+    parser.add_argument("-s", "--size", type=int, default=100, help="Payload size in bytes, default 100")
+    parser.add_argument("-S", "--slots", type=int, default=65536, help="Slots of the shm ring, default 65536")
+    parser.add_argument("-P", "--policy", default="Block", help="Idle policy of the subscriber (Block, Spin, BusyPoll), default Block")
+    parser.add_argument("--spin_polls", type=int, default=1000, help="SpinPolls for the Spin policy, default 1000")
+    parser.add_argument("-p", "--port", type=int, default=5592, help="tcp port of the publisher's first phase, the next phases count up from it, default 5592")
+    parser.add_argument("-o", "--output", default=None, help="CSV file to write the results to")
+    parser.add_argument("-l", "--loglevel", type=int, default=logging.INFO, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 20=logging.INFO")
+    return parser.parse_args()
+
+def main():
+    try:
+        logging.info("Main - acquire a child logger and then log messages in the child")
+        logger = logging.getLogger("TransportBenchmark")
+        args = parseCmdLineArgs()
+        logger.setLevel(args.loglevel)
+        benchmark = TransportBenchmark(logger)
+        benchmark.configure(args)
+        benchmark.driver()
+    except Exception as e:
+        logger.error("Exception caught in main - {}".format(e))
+        return
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    main()